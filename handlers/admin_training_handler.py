@@ -1,12 +1,26 @@
+import asyncio
 import logging
 from datetime import datetime
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import ContextTypes
-from services.training_data_service import get_training_service
-from services.model_training_service import get_model_training_service
+
+from toolbot.utils.tracing import bind_context
 
 logger = logging.getLogger(__name__)
 
+
+def get_training_service():
+    """Сервис обучающих данных (импорт с torch откладывается до первой команды)"""
+    from services.training_data_service import get_training_service as _get_training_service
+    return _get_training_service()
+
+
+def get_model_training_service():
+    """Сервис дообучения модели (импорт с torch откладывается до первой команды)"""
+    from services.model_training_service import get_model_training_service as _get_model_training_service
+    return _get_model_training_service()
+
+
 # ID администраторов (можно вынести в config)
 ADMIN_USER_IDS = [2093834331]  # ID администратора из логов
 
@@ -14,14 +28,11 @@ def is_admin(user_id: int) -> bool:
     """Проверка прав администратора"""
     # Пытаемся использовать проверку из основной системы бота
     try:
-        from toolbot.utils.access import is_allowed_user
-        from toolbot.config import load_config
-        
-        config = load_config()
-        if config:
-            admin_ids = config.get('admin_users', []) or config.get('admin_ids', []) or config.get('admins', [])
-            if user_id in admin_ids:
-                return True
+        from toolbot.config import is_admin as config_is_admin
+        
+        # Проверка по закэшированному снимку конфигурации, без расшифровки файла
+        if config_is_admin(user_id):
+            return True
     except Exception as e:
         logger.warning(f"Не удалось проверить права через основную систему: {e}")
     
@@ -121,7 +132,7 @@ async def admin_start_training_command(update: Update, context: ContextTypes.DEF
             f"🚀 **Готов к запуску дообучения!**\n\n"
             f"📊 Рекомендации:\n{reasons_text}\n\n"
             f"⚠️ Процесс может занять несколько минут.\n"
-            f"🔄 Бот будет недоступен во время обучения.\n\n"
+            f"🔄 Поиск продолжит работать на текущей модели, новая включится после проверки.\n\n"
             f"Подтвердить запуск?",
             parse_mode='Markdown',
             reply_markup=reply_markup
@@ -370,15 +381,33 @@ async def handle_admin_callback(update: Update, context: ContextTypes.DEFAULT_TY
         logger.error(f"Ошибка в admin callback: {e}")
         await query.edit_message_text("❌ Произошла ошибка при обработке команды")
 
+def _run_in_background(context, name: str, coroutine_function, *args):
+    """
+    Запуск долгой операции админки фоновой задачей приложения.
+    Обработчик сразу возвращается, и бот продолжает отвечать остальным пользователям.
+    """
+    return context.application.create_task(coroutine_function(*args), name=name)
+
+async def _run_blocking(func, *args):
+    """Блокирующий вызов сервиса в пуле потоков с сохранением трассы"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, bind_context(func, *args))
+
 async def confirm_training_start(query, context):
     """Подтверждение и запуск дообучения"""
-    await query.edit_message_text("🚀 Запуск дообучения...\n\n⏳ Пожалуйста, подождите...")
-    
+    await query.edit_message_text(
+        "🚀 Запуск дообучения...\n\n"
+        "⏳ Поиск работает на текущей модели, новая включится после проверки."
+    )
+    _run_in_background(context, "admin:fine_tune", _fine_tune_in_background, query)
+
+async def _fine_tune_in_background(query):
+    """Дообучение, построение индекса и переключение модели вне обработчика"""
     try:
         training_service = get_model_training_service()
         
         # Подготавливаем данные
-        train_data, val_data = training_service.prepare_training_data(min_examples=10)
+        train_data, val_data = await _run_blocking(training_service.prepare_training_data, 10)
         
         if not train_data:
             await query.edit_message_text(
@@ -388,9 +417,14 @@ async def confirm_training_start(query, context):
             return
         
         # Запускаем дообучение
-        result = training_service.fine_tune_model(train_data, val_data)
+        result = await _run_blocking(training_service.fine_tune_model, train_data, val_data)
         
         if result.get('success'):
+            swap = result.get('swap') or {}
+            if swap.get('success'):
+                swap_text = "🎯 Поиск переключен на новую модель без остановки бота!"
+            else:
+                swap_text = f"⚠️ Поиск остался на прежней модели: {swap.get('error', 'проверка не пройдена')}"
             success_text = f"""
 ✅ **Дообучение завершено успешно!**
 
@@ -400,7 +434,7 @@ async def confirm_training_start(query, context):
 📈 Точность до: {result.get('accuracy_before', 'Н/Д'):.3f}
 📈 Точность после: {result.get('accuracy_after', 'Н/Д'):.3f}
 
-🎯 Модель обновлена и готова к использованию!
+{swap_text}
 """
             await query.edit_message_text(success_text, parse_mode='Markdown')
         else:
@@ -508,7 +542,8 @@ async def start_training_process(query, context):
 
 ⚠️ **Внимание:**
 • Процесс займет 5-15 минут
-• Бот будет недоступен во время обучения
+• Поиск продолжит работать на текущей модели
+• Новая модель включится только после проверки
 • Рекомендуется делать резервную копию
 
 🚀 Начать дообучение?
@@ -780,11 +815,17 @@ async def restore_backup_menu(query, context):
 
 async def restore_specific_backup(query, context, backup_id: str):
     """Восстановление конкретной резервной копии"""
-    await query.edit_message_text(f"🔄 Восстановление из резервной копии...\n\n⏳ ID: {backup_id}")
-    
+    await query.edit_message_text(
+        f"🔄 Восстановление из резервной копии...\n\n⏳ ID: {backup_id}\n"
+        f"Поиск работает на текущей модели до проверки копии."
+    )
+    _run_in_background(context, f"admin:restore:{backup_id}", _restore_in_background, query, backup_id)
+
+async def _restore_in_background(query, backup_id: str):
+    """Восстановление и переключение модели вне обработчика"""
     try:
         model_service = get_model_training_service()
-        result = model_service.restore_model_from_backup(backup_id)
+        result = await _run_blocking(model_service.restore_model_from_backup, backup_id)
         
         if result.get('success'):
             success_text = f"""✅ Модель успешно восстановлена!
@@ -793,7 +834,7 @@ async def restore_specific_backup(query, context, backup_id: str):
 📅 Время восстановления: {result.get('restored_at', '')[:19]}
 💾 Создана резервная копия текущей модели
 
-Модель готова к использованию."""
+Поиск переключен на восстановленную модель без остановки бота."""
             
             keyboard = [
                 [InlineKeyboardButton("📋 Список копий", callback_data="admin_list_backups")],
@@ -1,14 +1,24 @@
 import os
+import time
+import asyncio
 import logging
 import hashlib
+import threading
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup
-from telegram.ext import ContextTypes
+from telegram.ext import ContextTypes, MessageHandler, filters
+
+from toolbot.utils.latency_sketch import timed_stage, stage_timer, STAGE_DOWNLOAD, STAGE_TELEGRAM_SEND
+from toolbot.utils.tracing import start_span, current_span, bind_context
 
 logger = logging.getLogger(__name__)
 
 # Ленивая инициализация сервиса поиска (инициализируется только при первом использовании)
 _unified_db_service = None
 _department_search_service = None
+_department_search_lock = threading.Lock()
+
+# Фоновый прогрев модели поиска, запускаемый при старте бота
+_search_warm_up_task = None
 
 def get_unified_db_service():
     """Получение экземпляра сервиса с ленивой инициализацией"""
@@ -28,15 +38,49 @@ def get_department_search_service():
     """Получение экземпляра сервиса поиска по отделам"""
     global _department_search_service
     if _department_search_service is None:
+        # Сервис может создаваться одновременно из потока прогрева и обработчика
+        with _department_search_lock:
+            if _department_search_service is None:
+                try:
+                    logger.info("Ленивая инициализация DepartmentSearchService...")
+                    from services.department_search_service import DepartmentSearchService
+                    _department_search_service = DepartmentSearchService()
+                    logger.info("✓ DepartmentSearchService успешно инициализирован")
+                except Exception as e:
+                    logger.error(f"Ошибка при инициализации DepartmentSearchService: {e}")
+                    raise
+    return _department_search_service
+
+def start_search_warm_up(application):
+    """
+    Запускает фоновый прогрев поиска: импорт torch, загрузку CLIP и чтение
+    индекса товаров в пуле потоков, не задерживая начало опроса Telegram.
+    Пока прогрев не завершен, /readyz отвечает 503.
+    """
+    global _search_warm_up_task
+    
+    async def warm_up():
+        loop = asyncio.get_running_loop()
+        start = time.perf_counter()
         try:
-            logger.info("Ленивая инициализация DepartmentSearchService...")
-            from services.department_search_service import DepartmentSearchService
-            _department_search_service = DepartmentSearchService()
-            logger.info("✓ DepartmentSearchService успешно инициализирован")
+            timings = await loop.run_in_executor(None, lambda: get_department_search_service().warm_up())
+            logger.info(
+                f"🔥 Поиск прогрет за {time.perf_counter() - start:.1f}с на {timings['device']}: "
+                f"модель {timings['model_load']:.1f}с, первый проход {timings['first_inference']:.2f}с, "
+                f"индекс {timings['index_rows']} векторов за {timings['index_read']:.2f}с"
+            )
         except Exception as e:
-            logger.error(f"Ошибка при инициализации DepartmentSearchService: {e}")
-            raise
-    return _department_search_service
+            logger.error(f"❌ Ошибка прогрева поиска, модель загрузится при первом запросе: {e}")
+    
+    _search_warm_up_task = application.create_task(warm_up())
+    return _search_warm_up_task
+
+async def wait_for_search_warm_up():
+    """Ожидание незавершенного прогрева без блокировки цикла событий"""
+    task = _search_warm_up_task
+    if task is not None and not task.done():
+        logger.info("⏳ Запрос поиска ждет завершения прогрева модели")
+        await asyncio.shield(task)
 
 def get_stats_service():
     """Получение экземпляра сервиса статистики"""
@@ -201,14 +245,15 @@ async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         
         photo = update.message.photo[-1]  # Берем фото наибольшего размера
-        file = await context.bot.get_file(photo.file_id)
         
         # Создаем директорию для временных файлов
         os.makedirs('temp', exist_ok=True)
         
         # Скачиваем фото
         photo_path = f'temp/{photo.file_id}.jpg'
-        await file.download_to_drive(photo_path)
+        with stage_timer(STAGE_DOWNLOAD):
+            file = await context.bot.get_file(photo.file_id)
+            await file.download_to_drive(photo_path)
         
         # Сохраняем путь к фото для дальнейшего использования
         short_id = get_short_id(photo.file_id)
@@ -249,6 +294,17 @@ async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
         logger.error(f"Ошибка при обработке фото: {e}")
         await update.message.reply_text("❌ Произошла ошибка при обработке изображения.")
 
+def create_photo_handler():
+    """
+    Обработчик фото для регистрации в приложении.
+
+    Приложение обрабатывает обновления по одному, поэтому обработчик не блокирует
+    очередь (block=False): фото разных пользователей ищутся одновременно, а их
+    число и очередь ожидания ограничивает контроллер допуска в perform_department_search.
+    """
+    return MessageHandler(filters.PHOTO, handle_photo, block=False)
+
+@timed_stage(STAGE_TELEGRAM_SEND)
 async def send_search_results(update: Update, context: ContextTypes.DEFAULT_TYPE, products, short_id):
     """Отправка результатов поиска с улучшенной информацией"""
     try:
@@ -373,6 +429,9 @@ async def perform_department_search(update: Update, context: ContextTypes.DEFAUL
         # Логируем начало поиска
         logger.info(f"🔍 Начинаем поиск по отделу: '{department}'")
         
+        # Запрос, пришедший во время прогрева, дожидается его, а не грузит модель заново в цикле событий
+        await wait_for_search_warm_up()
+        
         # Получаем сервис поиска по отделам
         dept_search_service = get_department_search_service()
         
@@ -380,12 +439,61 @@ async def perform_department_search(update: Update, context: ContextTypes.DEFAUL
         search_department = None if department == "ВСЕ" else department
         logger.info(f"🎯 Отдел для API поиска: {search_department}")
         
-        # Выполняем поиск
-        similar_products = dept_search_service.search_with_multiple_thresholds_by_department(
-            photo_path, 
-            department=search_department, 
-            top_k=5
-        )
+        # Почти одинаковые фото (пересъемка того же товара) берем из кэша без запуска CLIP
+        from services.search_result_cache import get_result_cache, perceptual_hash
+        result_cache = get_result_cache()
+        index_version = dept_search_service.get_index_version()
+        image_hash = perceptual_hash(photo_path)
+        similar_products = result_cache.get(image_hash, search_department, 5, index_version)
+        
+        span = current_span()
+        if span is not None:
+            span.set_attribute('search.department', department)
+            span.set_attribute('search.cache_hit', similar_products is not None)
+        
+        if similar_products is None:
+            from services.admission_control import get_admission_controller, QueueFullError
+            from handlers.admin_training_handler import is_admin
+            
+            status_message = processing_msg or (update.callback_query.message if update.callback_query else None)
+            
+            async def notify_position(position):
+                if status_message:
+                    await status_message.edit_text(
+                        f"⏳ Сейчас много запросов на поиск, вы в очереди: {position}\n"
+                        "Поиск начнется автоматически."
+                    )
+            
+            try:
+                async with get_admission_controller().admit(is_admin(update.effective_user.id), notify_position) as ticket:
+                    # Выполняем поиск вне цикла событий, чтобы бот отвечал остальным пользователям;
+                    # bind_context переносит трассу запроса в поток пула
+                    loop = asyncio.get_running_loop()
+                    with start_span("department_search", degraded=ticket.degraded,
+                                    queue_wait_ms=round(ticket.queue_wait * 1000, 1)):
+                        similar_products = await loop.run_in_executor(
+                            None,
+                            bind_context(
+                                dept_search_service.search_with_multiple_thresholds_by_department,
+                                photo_path,
+                                department=search_department,
+                                top_k=5,
+                                degraded=ticket.degraded
+                            )
+                        )
+            except QueueFullError:
+                if os.path.exists(photo_path):
+                    os.remove(photo_path)
+                overload_text = "🚦 Сейчас слишком много запросов на поиск по фото. Пожалуйста, попробуйте через минуту."
+                if status_message:
+                    await status_message.edit_text(overload_text)
+                else:
+                    await update.effective_message.reply_text(overload_text)
+                return
+            
+            # Результаты облегченного режима не кэшируем
+            if not ticket.degraded:
+                result_cache.put(image_hash, search_department, 5, index_version, similar_products)
         
         # Логируем сессию поиска
         stats_service = get_stats_service()
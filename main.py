@@ -10,14 +10,13 @@ from handlers.photo_handler import (
     handle_correct_feedback, handle_incorrect_feedback, 
     handle_new_item_request, handle_specify_correct_item,
     handle_text_message, photo_search_handler, department_selection_handler,
-    back_to_departments_handler
+    back_to_departments_handler, create_photo_handler
 )
 from handlers.admin_training_handler import (
     admin_training_stats_command, admin_start_training_command,
     admin_view_examples_command, admin_manage_new_products_command,
     admin_model_backups_command, handle_admin_callback
 )
-from services.unified_database_search import UnifiedDatabaseService
 
 # Настройка логирования
 logging.basicConfig(
@@ -94,7 +93,7 @@ async def admin_help_command(update: Update, context):
 
 ⚠️ Важно:
 • Дообучение может занимать несколько минут
-• Бот будет недоступен во время обучения
+• Поиск работает на текущей модели, новая включается после проверки
 • Сохраняйте резервные копии моделей"""
     
     await update.message.reply_text(admin_help_text)
@@ -172,6 +171,13 @@ def main():
             print("Запустите create_unified_database.py для создания БД")
             return
         
+        # Полнотекстовый индекс товаров создается до начала опроса, а не в первом текстовом поиске
+        try:
+            from services.db_migrations import apply_products_fts_migrations
+            apply_products_fts_migrations('data/unified_products.db')
+        except Exception as e:
+            logger.warning(f"⚠️ Не удалось применить миграции полнотекстового индекса товаров: {e}")
+        
         # Создаем приложение
         application = Application.builder().token(BOT_TOKEN).build()
         
@@ -188,8 +194,8 @@ def main():
         application.add_handler(CommandHandler("admin_new_products", admin_manage_new_products_command))
         application.add_handler(CommandHandler("admin_model_backups", admin_model_backups_command))
         
-        # Обработчик фотографий
-        application.add_handler(MessageHandler(filters.PHOTO, handle_photo))
+        # Обработчик фотографий: не блокирует очередь обновлений, одновременные поиски ограничивает контроллер допуска
+        application.add_handler(create_photo_handler())
         
         # ИСПРАВЛЕНИЕ: Добавляем обработчики для выбора отделов
         # Обработчик кнопки "📸 Поиск по фото"
@@ -242,9 +248,6 @@ def main():
                 elif query.data.startswith("specify_correct_"):
                     logger.info("➡️ Направляем в handle_specify_correct_item")
                     await handle_specify_correct_item(update, context)
-                elif query.data.startswith("search_dept_"):
-                    logger.info("➡️ Направляем в handle_department_selection (поиск по отделу)")
-                    await handle_department_selection(update, context)
                 elif query.data.startswith("admin_") or query.data.startswith("fill_product_data_") or query.data.startswith("reject_product_"):
                     logger.info("➡️ Направляем в handle_admin_callback")
                     await handle_admin_callback(update, context)
@@ -253,10 +256,14 @@ def main():
                     await handle_department_selection(update, context)
             return callback_router
         
+        # Выбор отдела запускает поиск, поэтому эти кнопки не блокируют очередь обновлений;
+        # остальные кнопки (админские, обратная связь) меняют user_data и обрабатываются по порядку
+        application.add_handler(CallbackQueryHandler(handle_department_selection, pattern=r"^search_dept_", block=False))
         application.add_handler(CallbackQueryHandler(create_callback_handler()))
         
         # Проверяем подключение к unified database service
         try:
+            from services.unified_database_search import UnifiedDatabaseService
             unified_service = UnifiedDatabaseService()
             stats = unified_service.get_database_stats()
             print(f"✅ Подключение к единой БД успешно!")
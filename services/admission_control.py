@@ -0,0 +1,225 @@
+"""
+Глобальный контроль допуска для тяжелых поисков по фото
+
+Ограничитель частоты работает по пользователям, поэтому одновременные фото от
+разных пользователей запускают CLIP все сразу. Контроллер пропускает к поиску
+не больше max_concurrent запросов, остальные ждут в ограниченной очереди
+(администраторы - вперед). Ожидающим сообщается их позиция в очереди.
+
+Если ожидание в очереди превысило SLO или по длине очереди видно, что оно его
+превысит, запрос выполняется в облегченном режиме (degraded) - без улучшения
+изображения и повторных проходов модели. Так задержка остается ограниченной
+при всплесках нагрузки.
+
+Контроллер рассчитан на один цикл событий asyncio и не использует блокировок.
+"""
+import time
+import heapq
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# Приоритеты (меньше - раньше)
+PRIORITY_ADMIN = 0
+PRIORITY_USER = 1
+
+# Обработчик изменения позиции в очереди: (позиция, начиная с 1) -> корутина
+PositionCallback = Callable[[int], Awaitable[Any]]
+
+
+class QueueFullError(Exception):
+    """Очередь поиска заполнена, запрос отклонен"""
+
+
+class Ticket:
+    """Допуск к поиску"""
+
+    __slots__ = ("priority", "seq", "enqueued_at", "admitted_at", "future", "on_position", "position", "degraded")
+
+    def __init__(self, priority: int, seq: int, on_position: Optional[PositionCallback]):
+        self.priority = priority
+        self.seq = seq
+        self.enqueued_at = time.monotonic()
+        self.admitted_at: Optional[float] = None
+        self.future: Optional[asyncio.Future] = None
+        self.on_position = on_position
+        self.position = 0
+        self.degraded = False
+
+    def __lt__(self, other: "Ticket") -> bool:
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+    @property
+    def queue_wait(self) -> float:
+        """Время ожидания в очереди (секунды)"""
+        end = self.admitted_at if self.admitted_at is not None else time.monotonic()
+        return end - self.enqueued_at
+
+
+class AdmissionController:
+    """
+    Ограничение числа одновременных поисков с приоритетной очередью
+
+    Использование:
+        async with controller.admit(is_admin=False, on_position=notify) as ticket:
+            results = await run_search(degraded=ticket.degraded)
+    """
+
+    def __init__(self, max_concurrent: int = 2, max_queue: int = 30, slo: float = 10.0):
+        """
+        Args:
+            max_concurrent: Максимальное количество одновременных поисков
+            max_queue: Максимальная длина очереди ожидания
+            slo: Целевое время ожидания в очереди (секунды), сверх него - облегченный режим
+        """
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.slo = slo
+
+        self._active = 0
+        self._waiting: List[Ticket] = []
+        self._seq = 0
+
+        # Сглаженное время выполнения поиска (секунды)
+        self._service_time: Optional[float] = None
+
+        self.admitted = 0
+        self.rejected = 0
+        self.degraded = 0
+        self.max_queue_seen = 0
+
+    @property
+    def queue_length(self) -> int:
+        return len(self._waiting)
+
+    def estimated_wait(self, position: int) -> float:
+        """Оценка времени ожидания для позиции в очереди (секунды)"""
+        if self._service_time is None:
+            return 0.0
+        return position * self._service_time / self.max_concurrent
+
+    @asynccontextmanager
+    async def admit(self, is_admin: bool = False, on_position: Optional[PositionCallback] = None):
+        """
+        Ожидание допуска к поиску
+
+        Raises:
+            QueueFullError: если очередь заполнена
+        """
+        ticket = await self._acquire(PRIORITY_ADMIN if is_admin else PRIORITY_USER, on_position)
+        try:
+            yield ticket
+        finally:
+            self._release(ticket)
+
+    async def _acquire(self, priority: int, on_position: Optional[PositionCallback]) -> Ticket:
+        self._seq += 1
+        ticket = Ticket(priority, self._seq, on_position)
+
+        if self._active < self.max_concurrent and not self._waiting:
+            self._start(ticket)
+            return ticket
+
+        # Администраторы проходят в очередь даже при переполнении
+        if len(self._waiting) >= self.max_queue and priority != PRIORITY_ADMIN:
+            self.rejected += 1
+            logger.warning(f"⚠️ Очередь поиска заполнена ({len(self._waiting)}), запрос отклонен")
+            raise QueueFullError(f"Очередь поиска заполнена: {len(self._waiting)}")
+
+        ticket.future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiting, ticket)
+        self.max_queue_seen = max(self.max_queue_seen, len(self._waiting))
+        self._notify_positions()
+
+        try:
+            await ticket.future
+        except asyncio.CancelledError:
+            if ticket.admitted_at is not None:
+                # Допуск уже выдан - освобождаем место для следующего
+                self._release(ticket)
+            else:
+                self._waiting.remove(ticket)
+                heapq.heapify(self._waiting)
+                self._notify_positions()
+            raise
+        return ticket
+
+    def _start(self, ticket: Ticket) -> None:
+        """Выдача допуска"""
+        self._active += 1
+        self.admitted += 1
+        ticket.admitted_at = time.monotonic()
+
+        # Облегченный режим: SLO уже нарушен или будет нарушен для тех, кто в очереди
+        if ticket.queue_wait > self.slo or self.estimated_wait(len(self._waiting)) > self.slo:
+            ticket.degraded = True
+            self.degraded += 1
+            logger.info(f"🪶 Поиск в облегченном режиме: ожидание {ticket.queue_wait:.1f}с, "
+                        f"в очереди {len(self._waiting)}")
+
+    def _release(self, ticket: Ticket) -> None:
+        """Освобождение места и допуск следующего из очереди"""
+        self._active -= 1
+
+        elapsed = time.monotonic() - ticket.admitted_at
+        if self._service_time is None:
+            self._service_time = elapsed
+        else:
+            self._service_time = 0.8 * self._service_time + 0.2 * elapsed
+
+        started = False
+        while self._waiting and self._active < self.max_concurrent:
+            waiter = heapq.heappop(self._waiting)
+            if waiter.future.done():
+                continue
+            self._start(waiter)
+            waiter.future.set_result(None)
+            started = True
+
+        if started:
+            self._notify_positions()
+
+    def _notify_positions(self) -> None:
+        """Сообщает ожидающим об изменении их позиции в очереди"""
+        for position, waiter in enumerate(sorted(self._waiting), start=1):
+            if waiter.position == position:
+                continue
+            waiter.position = position
+            if waiter.on_position is not None:
+                asyncio.ensure_future(self._call_position(waiter.on_position, position))
+
+    @staticmethod
+    async def _call_position(callback: PositionCallback, position: int) -> None:
+        try:
+            await callback(position)
+        except Exception as e:
+            logger.warning(f"⚠️ Не удалось сообщить позицию в очереди: {e}")
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Статистика контроллера"""
+        return {
+            'active': self._active,
+            'queued': len(self._waiting),
+            'max_concurrent': self.max_concurrent,
+            'max_queue': self.max_queue,
+            'admitted': self.admitted,
+            'rejected': self.rejected,
+            'degraded': self.degraded,
+            'max_queue_seen': self.max_queue_seen,
+            'avg_service_time': self._service_time,
+            'slo': self.slo,
+        }
+
+
+# Глобальный экземпляр контроллера
+_admission_controller = None
+
+def get_admission_controller():
+    """Получение экземпляра контроллера допуска к поиску"""
+    global _admission_controller
+    if _admission_controller is None:
+        _admission_controller = AdmissionController()
+    return _admission_controller
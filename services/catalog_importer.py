@@ -0,0 +1,524 @@
+"""
+Массовая загрузка каталога товаров в unified_products.db
+
+Импорт выполняется офлайн, отдельно от бота:
+- строки читаются из CSV/XLSX потоково (формат txt_export/unified_products.csv);
+- картинки скачиваются пулом HTTP-соединений с ограничением числа одновременных запросов;
+- векторы CLIP считаются пачками, а не по одному изображению;
+- записи вставляются большими транзакциями, вторичные индексы и
+  полнотекстовый индекс перестраиваются один раз после загрузки;
+- товары, у которых уже есть вектор, пропускаются, поэтому прерванный импорт
+  можно просто запустить повторно.
+
+Тот же конвейер без записи в базу (embed_products) строит индекс товаров
+для новой версии модели поиска (services/search_model_registry.py).
+
+Запуск:
+    python -m services.catalog_importer data/txt_export/unified_products.csv
+"""
+import os
+import sys
+import csv
+import time
+import asyncio
+import logging
+import argparse
+import sqlite3
+from io import BytesIO
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from services.db_migrations import apply_migrations, fts5_available, PRODUCTS_FTS_MIGRATIONS
+
+logger = logging.getLogger(__name__)
+
+PRODUCTS_DB = 'data/unified_products.db'
+
+# Колонки таблицы products и допустимые названия колонок во входном файле
+CATALOG_COLUMNS: Dict[str, Tuple[str, ...]] = {
+    'item_id': ('item_id', 'артикул', 'article', 'id'),
+    'url': ('url', 'ссылка', 'link'),
+    'picture': ('picture', 'картинка', 'image', 'image_url'),
+    'department': ('department', 'отдел'),
+    'product_name': ('product_name', 'название', 'name', 'title'),
+}
+
+PRODUCTS_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS products (
+        item_id TEXT PRIMARY KEY,
+        url TEXT,
+        picture TEXT,
+        vector BLOB,
+        department TEXT,
+        product_name TEXT
+    )
+"""
+
+# Триггеры полнотекстового индекса снимаются на время загрузки
+PRODUCTS_FTS_TRIGGERS = ('products_fts_bi', 'products_fts_ai', 'products_fts_ad', 'products_fts_au')
+
+
+@dataclass
+class ImportStats:
+    """Итоги импорта"""
+    total_rows: int = 0
+    skipped_existing: int = 0
+    skipped_invalid: int = 0
+    download_failed: int = 0
+    imported: int = 0
+    started_at: float = field(default_factory=time.time)
+    # Артикулы товаров, картинку которых не удалось скачать или прочитать
+    failed_items: List[str] = field(default_factory=list)
+
+    def summary(self) -> str:
+        elapsed = time.time() - self.started_at
+        rate = self.imported / elapsed if elapsed > 0 else 0.0
+        return (
+            f"строк: {self.total_rows}, загружено: {self.imported}, "
+            f"уже в базе: {self.skipped_existing}, без артикула/картинки: {self.skipped_invalid}, "
+            f"ошибок загрузки: {self.download_failed}, время: {elapsed:.1f} с ({rate:.1f} тов/с)"
+        )
+
+
+def _resolve_columns(header: List[str]) -> Dict[str, int]:
+    """Сопоставляет колонки входного файла с колонками таблицы products"""
+    normalized = [str(name or '').strip().lower() for name in header]
+    mapping = {}
+    for column, aliases in CATALOG_COLUMNS.items():
+        for alias in aliases:
+            if alias in normalized:
+                mapping[column] = normalized.index(alias)
+                break
+
+    if 'item_id' not in mapping or 'picture' not in mapping:
+        raise ValueError(f"Во входном файле нет колонок item_id/picture: {header}")
+    return mapping
+
+
+def _iter_raw_rows(path: str) -> Iterator[List[Any]]:
+    """Потоковое чтение строк CSV или XLSX (первая строка - заголовок)"""
+    extension = os.path.splitext(path)[1].lower()
+
+    if extension in ('.xlsx', '.xlsm'):
+        # openpyxl в режиме read_only не загружает лист в память целиком
+        from openpyxl import load_workbook
+        workbook = load_workbook(path, read_only=True, data_only=True)
+        try:
+            for row in workbook.active.iter_rows(values_only=True):
+                yield list(row)
+        finally:
+            workbook.close()
+        return
+
+    with open(path, newline='', encoding='utf-8-sig') as f:
+        sample = f.read(4096)
+        f.seek(0)
+        try:
+            dialect = csv.Sniffer().sniff(sample, delimiters=',;\t')
+        except csv.Error:
+            dialect = csv.excel
+        for row in csv.reader(f, dialect):
+            yield row
+
+
+def iter_catalog_rows(path: str) -> Iterator[Dict[str, str]]:
+    """
+    Потоково читает каталог товаров
+
+    Args:
+        path: Путь к CSV или XLSX файлу
+
+    Yields:
+        Словари с ключами колонок таблицы products (кроме vector)
+    """
+    rows = _iter_raw_rows(path)
+    header = next(rows, None)
+    if header is None:
+        return
+
+    mapping = _resolve_columns(header)
+    for row in rows:
+        product = {}
+        for column, index in mapping.items():
+            value = row[index] if index < len(row) else None
+            product[column] = str(value).strip() if value is not None else ''
+        yield product
+
+
+class CatalogImporter:
+    """Офлайн-загрузчик каталога в unified_products.db"""
+
+    def __init__(self, db_path: str = PRODUCTS_DB, concurrency: int = 16, batch_size: int = 64,
+                 commit_every: int = 2000, timeout: float = 20.0, retries: int = 2,
+                 force: bool = False, search_service=None, version=None):
+        """
+        Args:
+            db_path: Путь к базе товаров
+            concurrency: Максимум одновременных HTTP-запросов
+            batch_size: Размер пачки изображений для CLIP
+            commit_every: Число товаров в одной транзакции
+            timeout: Таймаут загрузки одной картинки, секунд
+            retries: Число повторных попыток загрузки
+            force: Пересчитать векторы и для товаров, которые уже есть в базе
+            search_service: Готовый DepartmentSearchService (по умолчанию создается свой)
+            version: Версия модели поиска для векторов (по умолчанию активная версия сервиса)
+        """
+        self.db_path = db_path
+        self.concurrency = concurrency
+        self.batch_size = batch_size
+        self.commit_every = commit_every
+        self.timeout = timeout
+        self.retries = retries
+        self.force = force
+        self.version = version
+        self.stats = ImportStats()
+        self._search_service = search_service
+        self._conn: Optional[sqlite3.Connection] = None
+        self._columns: List[str] = []
+        self._dropped_indexes: List[str] = []
+        self._fts_deferred = False
+        self._pending_in_transaction = 0
+
+    # ---------- База данных ----------
+
+    def _open_database(self) -> None:
+        """Открывает базу и настраивает ее на массовую запись"""
+        os.makedirs(os.path.dirname(self.db_path) or '.', exist_ok=True)
+        conn = sqlite3.connect(self.db_path, isolation_level=None)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute('PRAGMA cache_size=-65536')
+        conn.execute('PRAGMA temp_store=MEMORY')
+        conn.execute(PRODUCTS_SCHEMA)
+        self._columns = [row[1] for row in conn.execute('PRAGMA table_info(products)')]
+        self._conn = conn
+
+    def _load_existing_ids(self) -> set:
+        """Артикулы, для которых вектор уже посчитан"""
+        if self.force:
+            return set()
+        return {row[0] for row in self._conn.execute(
+            'SELECT item_id FROM products WHERE vector IS NOT NULL'
+        )}
+
+    def _defer_indexes(self) -> None:
+        """Снимает вторичные индексы и триггеры полнотекстового индекса на время загрузки"""
+        conn = self._conn
+        # Уникальные индексы нужны для INSERT OR REPLACE, их не трогаем
+        for name, sql in conn.execute(
+            "SELECT name, sql FROM sqlite_master WHERE type = 'index' AND tbl_name = 'products' "
+            "AND sql IS NOT NULL AND sql NOT LIKE 'CREATE UNIQUE%'"
+        ).fetchall():
+            conn.execute(f'DROP INDEX IF EXISTS "{name}"')
+            self._dropped_indexes.append(sql)
+
+        has_fts = conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE name = 'products_fts'"
+        ).fetchone() is not None
+        if has_fts:
+            for trigger in PRODUCTS_FTS_TRIGGERS:
+                conn.execute(f'DROP TRIGGER IF EXISTS {trigger}')
+            self._fts_deferred = True
+
+        if self._dropped_indexes or self._fts_deferred:
+            logger.info(f"⏸️ Индексы отложены до конца загрузки: {len(self._dropped_indexes)} вторичных"
+                        f"{', полнотекстовый' if self._fts_deferred else ''}")
+
+    def _rebuild_indexes(self) -> None:
+        """Восстанавливает индексы, снятые перед загрузкой"""
+        conn = self._conn
+        for sql in self._dropped_indexes:
+            conn.execute(sql)
+        self._dropped_indexes = []
+
+        if fts5_available(conn):
+            if self._fts_deferred:
+                # Повторное применение миграций создает триггеры и заново заполняет индекс
+                conn.executemany("DELETE FROM schema_migrations WHERE name = ?",
+                                 [(name,) for name, _ in PRODUCTS_FTS_MIGRATIONS])
+                self._fts_deferred = False
+            # Новая база получает полнотекстовый индекс здесь, а не в первом текстовом поиске бота
+            apply_migrations(conn, PRODUCTS_FTS_MIGRATIONS)
+
+        conn.execute('PRAGMA optimize')
+        logger.info("✅ Индексы товаров перестроены")
+
+    def _write_batch(self, products: List[Dict[str, str]], vectors) -> None:
+        """Записывает пачку товаров, транзакция фиксируется каждые commit_every строк"""
+        columns = [column for column in CATALOG_COLUMNS if column in self._columns] + ['vector']
+        placeholders = ', '.join('?' for _ in columns)
+        rows = [
+            tuple(product.get(column) or None for column in columns[:-1]) + (vector.tobytes(),)
+            for product, vector in zip(products, vectors)
+        ]
+
+        if self._pending_in_transaction == 0:
+            self._conn.execute('BEGIN')
+        self._conn.executemany(
+            f"INSERT OR REPLACE INTO products ({', '.join(columns)}) VALUES ({placeholders})",
+            rows,
+        )
+        self._pending_in_transaction += len(rows)
+        self.stats.imported += len(rows)
+
+        if self._pending_in_transaction >= self.commit_every:
+            self._commit()
+
+    def _commit(self) -> None:
+        """Фиксирует открытую транзакцию - точка восстановления импорта"""
+        if self._pending_in_transaction:
+            self._conn.execute('COMMIT')
+            self._pending_in_transaction = 0
+            logger.info(f"💾 Сохранено: {self.stats.summary()}")
+
+    # ---------- Изображения и векторы ----------
+
+    def _get_search_service(self):
+        """Модель берется из сервиса поиска, чтобы векторы совпадали с поисковыми"""
+        if self._search_service is None:
+            from services.department_search_service import DepartmentSearchService
+            self._search_service = DepartmentSearchService(self.db_path)
+        if self.version is None:
+            self._search_service._ensure_model_loaded()
+        return self._search_service
+
+    def _prepare_image(self, data: bytes):
+        """Декодирование и предобработка картинки (выполняется в пуле потоков)"""
+        from PIL import Image
+        service = self._get_search_service()
+        preprocess = self.version.preprocess if self.version is not None else service.preprocess
+        image = Image.open(BytesIO(data))
+        return preprocess(service.enhance_image(image))
+
+    def _embed_batch(self, tensors: List[Any]):
+        """Нормализованные векторы CLIP для пачки изображений"""
+        import torch
+        import numpy as np
+        service = self._get_search_service()
+        model = self.version.model if self.version is not None else service.model
+        with torch.no_grad():
+            batch = torch.stack(tensors).to(service.device)
+            features = model.encode_image(batch)
+            features = features / features.norm(dim=-1, keepdim=True)
+        return features.cpu().numpy().astype(np.float32)
+
+    async def _fetch(self, session, source: str) -> Optional[bytes]:
+        """Скачивает картинку с повторами; локальные пути читаются с диска"""
+        if not source.startswith(('http://', 'https://')):
+            if not os.path.exists(source):
+                return None
+            with open(source, 'rb') as f:
+                return f.read()
+
+        for attempt in range(self.retries + 1):
+            try:
+                async with session.get(source) as response:
+                    if response.status == 200:
+                        return await response.read()
+                    if response.status < 500 and response.status != 429:
+                        return None
+            except Exception as e:
+                logger.debug(f"Ошибка загрузки {source}: {e}")
+            await asyncio.sleep(0.5 * (2 ** attempt))
+        return None
+
+    async def _download_worker(self, session, product: Dict[str, str], queue: asyncio.Queue,
+                               semaphore: asyncio.Semaphore) -> None:
+        """
+        Скачивает и подготавливает одну картинку, результат кладет в очередь
+
+        Семафор освобождается только после того, как тензор принят очередью:
+        если векторизация отстает, новые загрузки ждут, а не копят тензоры в памяти.
+        """
+        try:
+            try:
+                data = await self._fetch(session, product['picture'])
+                tensor = None
+                if data:
+                    loop = asyncio.get_running_loop()
+                    tensor = await loop.run_in_executor(None, self._prepare_image, data)
+            except Exception as e:
+                logger.warning(f"⚠️ Не удалось подготовить картинку товара {product['item_id']}: {e}")
+                tensor = None
+
+            if tensor is None:
+                self.stats.download_failed += 1
+                self.stats.failed_items.append(product['item_id'])
+                return
+            await queue.put((product, tensor))
+        finally:
+            semaphore.release()
+
+    async def _produce(self, products: Iterable[Dict[str, str]], queue: asyncio.Queue,
+                       existing: set) -> None:
+        """Перебирает товары и запускает загрузку картинок не больше concurrency за раз"""
+        import aiohttp
+
+        semaphore = asyncio.Semaphore(self.concurrency)
+        tasks = set()
+        timeout = aiohttp.ClientTimeout(total=self.timeout)
+        connector = aiohttp.TCPConnector(limit=self.concurrency)
+        seen = set()
+
+        try:
+            async with aiohttp.ClientSession(timeout=timeout, connector=connector) as session:
+                for product in products:
+                    self.stats.total_rows += 1
+                    item_id = product.get('item_id')
+                    if not item_id or not product.get('picture'):
+                        self.stats.skipped_invalid += 1
+                        continue
+                    if item_id in existing or item_id in seen:
+                        self.stats.skipped_existing += 1
+                        continue
+                    seen.add(item_id)
+
+                    # Семафор ограничивает и число запросов, и число задач с тензорами в памяти:
+                    # слот освобождается, когда результат принят очередью
+                    await semaphore.acquire()
+                    task = asyncio.create_task(self._download_worker(session, product, queue, semaphore))
+                    tasks.add(task)
+                    task.add_done_callback(tasks.discard)
+
+                if tasks:
+                    await asyncio.gather(*tasks)
+        finally:
+            await queue.put(None)
+
+    async def _consume(self, queue: asyncio.Queue, on_batch: Callable[[List[Dict[str, str]], Any], None]) -> None:
+        """Собирает пачки изображений, считает векторы и передает их on_batch"""
+        loop = asyncio.get_running_loop()
+        products: List[Dict[str, str]] = []
+        tensors: List[Any] = []
+
+        async def flush():
+            vectors = await loop.run_in_executor(None, self._embed_batch, tensors)
+            on_batch(products, vectors)
+            products.clear()
+            tensors.clear()
+
+        while True:
+            item = await queue.get()
+            if item is None:
+                break
+            product, tensor = item
+            products.append(product)
+            tensors.append(tensor)
+            if len(tensors) >= self.batch_size:
+                await flush()
+
+        if tensors:
+            await flush()
+
+    async def _pipeline(self, products: Iterable[Dict[str, str]],
+                        on_batch: Callable[[List[Dict[str, str]], Any], None], existing: set) -> None:
+        """Загрузка картинок, векторизация пачками и передача пачек on_batch"""
+        queue: asyncio.Queue = asyncio.Queue(maxsize=self.batch_size * 4)
+        producer = asyncio.create_task(self._produce(products, queue, existing))
+        await self._consume(queue, on_batch)
+        await producer
+
+    async def embed_products(self, products: Iterable[Dict[str, str]],
+                             on_batch: Callable[[List[Dict[str, str]], Any], None]) -> ImportStats:
+        """
+        Векторы товаров без записи в базу
+
+        Args:
+            products: Словари с ключами item_id и picture (остальные ключи передаются как есть)
+            on_batch: Вызывается для каждой пачки: (товары, нормализованные векторы)
+
+        Returns:
+            Итоги: загружено, ошибок загрузки и т.д.
+        """
+        def deliver(batch_products, vectors):
+            self.stats.imported += len(batch_products)
+            on_batch(batch_products, vectors)
+
+        self.stats = ImportStats()
+        await asyncio.get_running_loop().run_in_executor(None, self._get_search_service)
+        await self._pipeline(products, deliver, set())
+        return self.stats
+
+    async def run(self, source_path: str) -> ImportStats:
+        """
+        Импорт каталога
+
+        Args:
+            source_path: Путь к CSV или XLSX файлу
+
+        Returns:
+            Итоги импорта
+        """
+        self.stats = ImportStats()
+        try:
+            self._open_database()
+            # Модель загружаем заранее, чтобы не держать открытыми HTTP-соединения во время загрузки
+            await asyncio.get_running_loop().run_in_executor(None, self._get_search_service)
+            self._defer_indexes()
+
+            await self._pipeline(iter_catalog_rows(source_path), self._write_batch, self._load_existing_ids())
+            self._commit()
+        except BaseException:
+            # Уже зафиксированные пачки сохраняются, повторный запуск продолжит с них
+            if self._pending_in_transaction:
+                self._conn.execute('ROLLBACK')
+                self.stats.imported -= self._pending_in_transaction
+                self._pending_in_transaction = 0
+            raise
+        finally:
+            # База могла не открыться - тогда восстанавливать нечего
+            if self._conn is not None:
+                self._rebuild_indexes()
+                self._conn.close()
+                self._conn = None
+
+        logger.info(f"✅ Импорт завершен: {self.stats.summary()}")
+        return self.stats
+
+
+def parse_args():
+    """Парсинг аргументов командной строки"""
+    parser = argparse.ArgumentParser(description='Массовая загрузка каталога в unified_products.db')
+    parser.add_argument('source', type=str, help='CSV или XLSX файл в формате txt_export/unified_products.csv')
+    parser.add_argument('--db', type=str, default=PRODUCTS_DB, help='Путь к базе товаров')
+    parser.add_argument('--concurrency', type=int, default=16, help='Одновременных загрузок картинок')
+    parser.add_argument('--batch-size', type=int, default=64, help='Размер пачки для CLIP')
+    parser.add_argument('--commit-every', type=int, default=2000, help='Товаров в одной транзакции')
+    parser.add_argument('--timeout', type=float, default=20.0, help='Таймаут загрузки картинки, секунд')
+    parser.add_argument('--force', action='store_true', help='Пересчитать векторы для уже загруженных товаров')
+    return parser.parse_args()
+
+
+def main():
+    """Основная функция"""
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    )
+    args = parse_args()
+
+    if not os.path.exists(args.source):
+        logger.error(f"❌ Файл каталога не найден: {args.source}")
+        return 1
+
+    importer = CatalogImporter(
+        db_path=args.db,
+        concurrency=args.concurrency,
+        batch_size=args.batch_size,
+        commit_every=args.commit_every,
+        timeout=args.timeout,
+        force=args.force,
+    )
+    try:
+        asyncio.run(importer.run(args.source))
+    except KeyboardInterrupt:
+        logger.warning(f"⏹️ Импорт прерван, сохранено: {importer.stats.summary()}")
+        return 130
+    except Exception as e:
+        logger.error(f"❌ Ошибка импорта каталога: {e}")
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
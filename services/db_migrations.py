@@ -0,0 +1,336 @@
+"""
+Миграции схемы SQLite баз бота и аудит планов выполнения запросов
+"""
+import re
+import sqlite3
+import logging
+from typing import Dict, List, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Миграция: (уникальное имя, список SQL выражений)
+Migration = Tuple[str, List[str]]
+
+# Миграции search_stats.db (таблицы SearchStatisticsService)
+SEARCH_STATS_MIGRATIONS: List[Migration] = [
+    ('0001_search_stats_indexes', [
+        'CREATE INDEX IF NOT EXISTS idx_failed_searches_timestamp ON failed_searches(timestamp)',
+        'CREATE INDEX IF NOT EXISTS idx_failed_searches_user ON failed_searches(user_id, username)',
+        'CREATE INDEX IF NOT EXISTS idx_search_sessions_timestamp ON search_sessions(timestamp)',
+        'CREATE INDEX IF NOT EXISTS idx_search_sessions_user ON search_sessions(user_id, timestamp)',
+        # Покрывающий индекс для COUNT/AVG по успешным поискам
+        'CREATE INDEX IF NOT EXISTS idx_search_sessions_success ON search_sessions(was_successful, best_similarity)',
+    ]),
+]
+
+# Миграции search_stats.db (таблицы TrainingDataService)
+TRAINING_DATA_MIGRATIONS: List[Migration] = [
+    ('0001_training_indexes', [
+        'CREATE INDEX IF NOT EXISTS idx_training_examples_created ON training_examples(created_at)',
+        'CREATE INDEX IF NOT EXISTS idx_training_examples_used ON training_examples(is_used_for_training, created_at)',
+        'CREATE INDEX IF NOT EXISTS idx_training_examples_type ON training_examples(feedback_type, created_at)',
+        'CREATE INDEX IF NOT EXISTS idx_training_examples_user ON training_examples(user_id)',
+        'CREATE INDEX IF NOT EXISTS idx_annotations_approved ON new_product_annotations(admin_approved, created_at)',
+        'CREATE INDEX IF NOT EXISTS idx_annotations_user ON new_product_annotations(user_id)',
+        'CREATE INDEX IF NOT EXISTS idx_training_history_active ON model_training_history(is_active, training_date)',
+    ]),
+]
+
+# Миграции feedback.db
+FEEDBACK_MIGRATIONS: List[Migration] = [
+    ('0001_feedback_indexes', [
+        'CREATE INDEX IF NOT EXISTS idx_error_reports_timestamp ON error_reports(timestamp)',
+        'CREATE INDEX IF NOT EXISTS idx_error_reports_status ON error_reports(status, timestamp)',
+        'CREATE INDEX IF NOT EXISTS idx_error_reports_user ON error_reports(user_id)',
+        'CREATE INDEX IF NOT EXISTS idx_suggestions_timestamp ON improvement_suggestions(timestamp)',
+        'CREATE INDEX IF NOT EXISTS idx_suggestions_status ON improvement_suggestions(status, timestamp)',
+        'CREATE INDEX IF NOT EXISTS idx_suggestions_user ON improvement_suggestions(user_id)',
+    ]),
+]
+
+# Токенизатор FTS5 для русского текста: unicode61 разбивает по границам слов
+# Unicode и приводит кириллицу к нижнему регистру, префиксные индексы
+# ускоряют поиск по началу слова ("молот*")
+FTS_OPTIONS = "tokenize='unicode61 remove_diacritics 2', prefix='2 3 4'"
+
+
+def fold_yo_sql(expr: str) -> str:
+    """
+    SQL выражение, заменяющее ё на е
+
+    unicode61 не считает ё диакритикой, поэтому "ерш" не находит "ёршик".
+    Текст попадает в индекс уже с е, а build_fts_query делает ту же замену в запросе.
+    """
+    return f"replace(replace({expr}, 'ё', 'е'), 'Ё', 'Е')"
+
+# Полнотекстовый индекс text_messages.db
+TEXT_MESSAGES_FTS_MIGRATIONS: List[Migration] = [
+    ('0001_text_messages_fts', [
+        f"""CREATE VIRTUAL TABLE IF NOT EXISTS text_messages_fts USING fts5(
+            message_text, content='text_messages', content_rowid='id', {FTS_OPTIONS})""",
+        """CREATE TRIGGER IF NOT EXISTS text_messages_fts_ai AFTER INSERT ON text_messages BEGIN
+            INSERT INTO text_messages_fts(rowid, message_text) VALUES (new.id, new.message_text);
+        END""",
+        """CREATE TRIGGER IF NOT EXISTS text_messages_fts_ad AFTER DELETE ON text_messages BEGIN
+            INSERT INTO text_messages_fts(text_messages_fts, rowid, message_text)
+            VALUES ('delete', old.id, old.message_text);
+        END""",
+        """CREATE TRIGGER IF NOT EXISTS text_messages_fts_au AFTER UPDATE OF message_text ON text_messages BEGIN
+            INSERT INTO text_messages_fts(text_messages_fts, rowid, message_text)
+            VALUES ('delete', old.id, old.message_text);
+            INSERT INTO text_messages_fts(rowid, message_text) VALUES (new.id, new.message_text);
+        END""",
+        "INSERT INTO text_messages_fts(text_messages_fts) VALUES ('rebuild')",
+    ]),
+    ('0002_text_messages_fts_fold_yo', [
+        'DROP TRIGGER IF EXISTS text_messages_fts_ai',
+        'DROP TRIGGER IF EXISTS text_messages_fts_ad',
+        'DROP TRIGGER IF EXISTS text_messages_fts_au',
+        f"""CREATE TRIGGER text_messages_fts_ai AFTER INSERT ON text_messages BEGIN
+            INSERT INTO text_messages_fts(rowid, message_text) VALUES (new.id, {fold_yo_sql('new.message_text')});
+        END""",
+        f"""CREATE TRIGGER text_messages_fts_ad AFTER DELETE ON text_messages BEGIN
+            INSERT INTO text_messages_fts(text_messages_fts, rowid, message_text)
+            VALUES ('delete', old.id, {fold_yo_sql('old.message_text')});
+        END""",
+        f"""CREATE TRIGGER text_messages_fts_au AFTER UPDATE OF message_text ON text_messages BEGIN
+            INSERT INTO text_messages_fts(text_messages_fts, rowid, message_text)
+            VALUES ('delete', old.id, {fold_yo_sql('old.message_text')});
+            INSERT INTO text_messages_fts(rowid, message_text) VALUES (new.id, {fold_yo_sql('new.message_text')});
+        END""",
+        # 'rebuild' читает исходный текст без замены, поэтому индекс заполняется явно
+        "INSERT INTO text_messages_fts(text_messages_fts) VALUES ('delete-all')",
+        f"""INSERT INTO text_messages_fts(rowid, message_text)
+            SELECT id, {fold_yo_sql('message_text')} FROM text_messages""",
+    ]),
+]
+
+
+def _feedback_fts_statements(table: str) -> List[str]:
+    """SQL для полнотекстового индекса таблицы обратной связи (message, username)"""
+    fts = f'{table}_fts'
+    return [
+        f"""CREATE VIRTUAL TABLE IF NOT EXISTS {fts} USING fts5(
+            message, username, content='{table}', content_rowid='id', {FTS_OPTIONS})""",
+        f"""CREATE TRIGGER IF NOT EXISTS {fts}_ai AFTER INSERT ON {table} BEGIN
+            INSERT INTO {fts}(rowid, message, username) VALUES (new.id, new.message, new.username);
+        END""",
+        f"""CREATE TRIGGER IF NOT EXISTS {fts}_ad AFTER DELETE ON {table} BEGIN
+            INSERT INTO {fts}({fts}, rowid, message, username)
+            VALUES ('delete', old.id, old.message, old.username);
+        END""",
+        f"""CREATE TRIGGER IF NOT EXISTS {fts}_au AFTER UPDATE OF message, username ON {table} BEGIN
+            INSERT INTO {fts}({fts}, rowid, message, username)
+            VALUES ('delete', old.id, old.message, old.username);
+            INSERT INTO {fts}(rowid, message, username) VALUES (new.id, new.message, new.username);
+        END""",
+        f"INSERT INTO {fts}({fts}) VALUES ('rebuild')",
+    ]
+
+
+def _feedback_fts_fold_yo_statements(table: str) -> List[str]:
+    """Пересоздание триггеров и индекса таблицы обратной связи с заменой ё на е"""
+    fts = f'{table}_fts'
+    message, username = fold_yo_sql('new.message'), fold_yo_sql('new.username')
+    old_message, old_username = fold_yo_sql('old.message'), fold_yo_sql('old.username')
+    return [
+        f'DROP TRIGGER IF EXISTS {fts}_ai',
+        f'DROP TRIGGER IF EXISTS {fts}_ad',
+        f'DROP TRIGGER IF EXISTS {fts}_au',
+        f"""CREATE TRIGGER {fts}_ai AFTER INSERT ON {table} BEGIN
+            INSERT INTO {fts}(rowid, message, username) VALUES (new.id, {message}, {username});
+        END""",
+        f"""CREATE TRIGGER {fts}_ad AFTER DELETE ON {table} BEGIN
+            INSERT INTO {fts}({fts}, rowid, message, username)
+            VALUES ('delete', old.id, {old_message}, {old_username});
+        END""",
+        f"""CREATE TRIGGER {fts}_au AFTER UPDATE OF message, username ON {table} BEGIN
+            INSERT INTO {fts}({fts}, rowid, message, username)
+            VALUES ('delete', old.id, {old_message}, {old_username});
+            INSERT INTO {fts}(rowid, message, username) VALUES (new.id, {message}, {username});
+        END""",
+        f"INSERT INTO {fts}({fts}) VALUES ('delete-all')",
+        f"""INSERT INTO {fts}(rowid, message, username)
+            SELECT id, {fold_yo_sql('message')}, {fold_yo_sql('username')} FROM {table}""",
+    ]
+
+
+# Полнотекстовые индексы feedback.db
+FEEDBACK_FTS_MIGRATIONS: List[Migration] = [
+    ('0002_error_reports_fts', _feedback_fts_statements('error_reports')),
+    ('0003_improvement_suggestions_fts', _feedback_fts_statements('improvement_suggestions')),
+    ('0004_error_reports_fts_fold_yo', _feedback_fts_fold_yo_statements('error_reports')),
+    ('0005_improvement_suggestions_fts_fold_yo', _feedback_fts_fold_yo_statements('improvement_suggestions')),
+]
+
+# Полнотекстовый индекс названий и ссылок товаров unified_products.db.
+# Таблица хранит собственную копию текста (не external content): каталог
+# пополняется через INSERT OR REPLACE, при котором триггеры удаления не
+# срабатывают, поэтому старая запись снимается отдельным BEFORE INSERT триггером.
+PRODUCTS_FTS_MIGRATIONS: List[Migration] = [
+    ('0001_products_fts', [
+        f"CREATE VIRTUAL TABLE IF NOT EXISTS products_fts USING fts5(product_name, url, {FTS_OPTIONS})",
+        """CREATE TRIGGER IF NOT EXISTS products_fts_bi BEFORE INSERT ON products BEGIN
+            DELETE FROM products_fts WHERE rowid IN (SELECT rowid FROM products WHERE item_id = new.item_id);
+        END""",
+        """CREATE TRIGGER IF NOT EXISTS products_fts_ai AFTER INSERT ON products BEGIN
+            INSERT INTO products_fts(rowid, product_name, url) VALUES (new.rowid, new.product_name, new.url);
+        END""",
+        """CREATE TRIGGER IF NOT EXISTS products_fts_ad AFTER DELETE ON products BEGIN
+            DELETE FROM products_fts WHERE rowid = old.rowid;
+        END""",
+        """CREATE TRIGGER IF NOT EXISTS products_fts_au AFTER UPDATE OF product_name, url ON products BEGIN
+            DELETE FROM products_fts WHERE rowid = old.rowid;
+            INSERT INTO products_fts(rowid, product_name, url) VALUES (new.rowid, new.product_name, new.url);
+        END""",
+        "DELETE FROM products_fts",
+        "INSERT INTO products_fts(rowid, product_name, url) SELECT rowid, product_name, url FROM products",
+    ]),
+    ('0002_products_fts_fold_yo', [
+        'DROP TRIGGER IF EXISTS products_fts_ai',
+        'DROP TRIGGER IF EXISTS products_fts_au',
+        f"""CREATE TRIGGER products_fts_ai AFTER INSERT ON products BEGIN
+            INSERT INTO products_fts(rowid, product_name, url)
+            VALUES (new.rowid, {fold_yo_sql('new.product_name')}, {fold_yo_sql('new.url')});
+        END""",
+        f"""CREATE TRIGGER products_fts_au AFTER UPDATE OF product_name, url ON products BEGIN
+            DELETE FROM products_fts WHERE rowid = old.rowid;
+            INSERT INTO products_fts(rowid, product_name, url)
+            VALUES (new.rowid, {fold_yo_sql('new.product_name')}, {fold_yo_sql('new.url')});
+        END""",
+        "DELETE FROM products_fts",
+        f"""INSERT INTO products_fts(rowid, product_name, url)
+            SELECT rowid, {fold_yo_sql('product_name')}, {fold_yo_sql('url')} FROM products""",
+    ]),
+]
+
+
+def fts5_available(conn: sqlite3.Connection) -> bool:
+    """Проверяет, собран ли SQLite с поддержкой FTS5"""
+    try:
+        conn.execute('CREATE VIRTUAL TABLE IF NOT EXISTS temp._fts5_probe USING fts5(x)')
+        conn.execute('DROP TABLE IF EXISTS temp._fts5_probe')
+        return True
+    except sqlite3.OperationalError:
+        return False
+
+
+def apply_products_fts_migrations(db_path: str) -> bool:
+    """
+    Создает полнотекстовый индекс товаров в unified_products.db
+
+    Вызывается при запуске бота и после импорта каталога: заполнение индекса
+    держит блокировку записи, поэтому в пути запроса оно не выполняется.
+
+    Returns:
+        True, если индекс доступен
+    """
+    conn = sqlite3.connect(db_path)
+    try:
+        if not fts5_available(conn):
+            logger.warning("⚠️ SQLite собран без FTS5, текстовый поиск товаров работает через LIKE")
+            return False
+        apply_migrations(conn, PRODUCTS_FTS_MIGRATIONS)
+        return True
+    finally:
+        conn.close()
+
+
+def products_fts_ready(conn: sqlite3.Connection) -> bool:
+    """Проверяет, применены ли все миграции полнотекстового индекса товаров (без записи в базу)"""
+    try:
+        row = conn.execute('SELECT 1 FROM schema_migrations WHERE name = ?',
+                           (PRODUCTS_FTS_MIGRATIONS[-1][0],)).fetchone()
+    except sqlite3.OperationalError:
+        return False
+    return row is not None
+
+
+def build_fts_query(text: str) -> str:
+    """
+    Преобразует пользовательский запрос в выражение FTS5 MATCH
+
+    Каждое слово экранируется и ищется по префиксу, слова объединяются по И:
+    "молоток зубр" -> '"молоток"* "зубр"*'. Буква ё заменяется на е, как при индексации.
+    Совпадения внутри слова не ищутся: "ток" не находит "молоток".
+
+    Returns:
+        Выражение MATCH или пустая строка, если в запросе нет слов
+    """
+    tokens = re.findall(r'\w+', text.lower().replace('ё', 'е'))
+    return ' '.join(f'"{token}"*' for token in tokens)
+
+
+def apply_migrations(conn: sqlite3.Connection, migrations: List[Migration]) -> int:
+    """
+    Применяет еще не выполненные миграции к открытому соединению
+
+    Применённые миграции записываются в таблицу schema_migrations,
+    поэтому повторный вызов ничего не делает.
+
+    Args:
+        conn: Соединение с базой данных
+        migrations: Список миграций в порядке применения
+
+    Returns:
+        Количество примененных миграций
+    """
+    cursor = conn.cursor()
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            name TEXT PRIMARY KEY,
+            applied_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    cursor.execute('SELECT name FROM schema_migrations')
+    applied = {row[0] for row in cursor.fetchall()}
+
+    applied_count = 0
+    for name, statements in migrations:
+        if name in applied:
+            continue
+        try:
+            for statement in statements:
+                cursor.execute(statement)
+            cursor.execute('INSERT INTO schema_migrations (name) VALUES (?)', (name,))
+            conn.commit()
+            applied_count += 1
+            logger.info(f"✅ Применена миграция {name}")
+        except Exception as e:
+            conn.rollback()
+            logger.error(f"❌ Ошибка при применении миграции {name}: {e}")
+            raise
+
+    if applied_count:
+        # Обновляем статистику планировщика после создания индексов
+        cursor.execute('PRAGMA optimize')
+
+    return applied_count
+
+
+def explain_query_plan(conn: sqlite3.Connection, query: str, params: tuple = ()) -> List[str]:
+    """Возвращает строки EXPLAIN QUERY PLAN для запроса"""
+    cursor = conn.execute(f'EXPLAIN QUERY PLAN {query}', params)
+    return [row[-1] for row in cursor.fetchall()]
+
+
+def find_full_scans(conn: sqlite3.Connection, queries: List[Tuple[str, tuple]]) -> List[Dict]:
+    """
+    Ищет запросы, план которых содержит полное сканирование таблицы
+
+    Сканирование по покрывающему индексу (SCAN ... USING COVERING INDEX)
+    допускается: так выполняются COUNT(*) и группировки без фильтра.
+
+    Args:
+        conn: Соединение с базой данных, к которой применены миграции
+        queries: Список пар (SQL, параметры)
+
+    Returns:
+        Список словарей {'query', 'plan'} для проблемных запросов
+    """
+    offenders = []
+    for query, params in queries:
+        plan = explain_query_plan(conn, query, params)
+        if any(step.startswith('SCAN') and 'INDEX' not in step for step in plan):
+            offenders.append({'query': ' '.join(query.split()), 'plan': plan})
+    return offenders
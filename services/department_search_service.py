@@ -1,28 +1,142 @@
+import os
+import time
 import sqlite3
+import threading
+from contextlib import contextmanager
 import numpy as np
 import torch
 from PIL import Image, ImageEnhance, ImageOps
 import requests
 from io import BytesIO
 
+from services.search_model_registry import load_active_version
+from services.db_migrations import build_fts_query, products_fts_ready
+from toolbot.utils.latency_sketch import (stage_timer, STAGE_DOWNLOAD, STAGE_DECODE, STAGE_PREPROCESS,
+                                          STAGE_EMBED, STAGE_INDEX_SEARCH, STAGE_DB_FETCH)
+
+# Модель CLIP, которой посчитаны векторы товаров
+CLIP_MODEL_NAME = "ViT-B/32"
+
 class DepartmentSearchService:
     def __init__(self, db_path='data/unified_products.db'):
         self.db_path = db_path
+        self.model_name = CLIP_MODEL_NAME
         self.device = "cuda" if torch.cuda.is_available() else "cpu"
-        # Ленивая инициализация - модель загружается только при первом использовании
-        self.model = None
-        self.preprocess = None
+        # Активная версия модели (SearchModelVersion); ленивая инициализация -
+        # модель загружается только при первом использовании
+        self._active = None
+        self._model_lock = threading.Lock()
+        # Готовность к запросам без задержки: модель загружена и прогрета
+        self.ready = False
         # Порог схожести для фильтрации результатов
         self.similarity_threshold = 0.2
+        # Полнотекстовый индекс товаров создается при запуске бота и импортом каталога
+        self.fts_enabled = False
+        
+    @property
+    def active_version(self):
+        return self._active
+    
+    @property
+    def model(self):
+        return self._active.model if self._active is not None else None
+    
+    @property
+    def preprocess(self):
+        return self._active.preprocess if self._active is not None else None
         
     def _ensure_model_loaded(self):
-        """Ленивая инициализация CLIP модели"""
-        if self.model is None:
+        """Ленивая инициализация CLIP модели (активной версии)"""
+        if self._active is None:
+            # Прогрев и первый запрос могут прийти одновременно - модель грузится один раз
+            with self._model_lock:
+                if self._active is None:
+                    try:
+                        self._active = load_active_version(CLIP_MODEL_NAME, self.device)
+                    except Exception as e:
+                        raise Exception(f"Ошибка при загрузке CLIP модели: {e}")
+    
+    @contextmanager
+    def acquire(self):
+        """
+        Версия модели на время одного поиска.
+        Замена версии во время поиска его не затрагивает: он завершается на взятой версии.
+        """
+        self._ensure_model_loaded()
+        with self._active.lease() as version:
+            yield version
+    
+    def swap(self, version):
+        """
+        Атомарная замена активной версии (модель и индекс товаров вместе)
+        
+        Returns:
+            Предыдущая версия
+        """
+        with self._model_lock:
+            previous, self._active = self._active, version
+        self.ready = True
+        return previous
+    
+    def warm_up(self):
+        """
+        Прогрев перед первым запросом: загрузка CLIP, пробный проход модели
+        и чтение векторов товаров, чтобы они оказались в кэше страниц ОС.
+        
+        Returns:
+            Словарь с устройством, длительностями этапов (сек) и числом векторов
+        """
+        timings = {'device': self.device}
+        
+        start = time.perf_counter()
+        self._ensure_model_loaded()
+        timings['model_load'] = time.perf_counter() - start
+        
+        start = time.perf_counter()
+        with torch.no_grad():
+            image_input = self.preprocess(Image.new("RGB", (224, 224))).unsqueeze(0).to(self.device)
+            self.model.encode_image(image_input)
+        timings['first_inference'] = time.perf_counter() - start
+        
+        start = time.perf_counter()
+        conn = sqlite3.connect(self.db_path)
+        try:
+            self._text_index_available(conn)
+            rows = 0
+            for _ in conn.execute("SELECT vector FROM products WHERE vector IS NOT NULL"):
+                rows += 1
+        finally:
+            conn.close()
+        timings['index_read'] = time.perf_counter() - start
+        timings['index_rows'] = rows
+        
+        self.ready = True
+        return timings
+        
+    def _text_index_available(self, conn):
+        """
+        Готов ли полнотекстовый индекс по названию и ссылке товара
+
+        Индекс создает apply_products_fts_migrations; здесь он только проверяется,
+        пока не появится (без него поиск идет через LIKE).
+        """
+        if not self.fts_enabled:
+            self.fts_enabled = products_fts_ready(conn)
+        return self.fts_enabled
+        
+    def get_index_version(self):
+        """
+        Версия поискового индекса: модель, ее версия и состояние файлов базы товаров.
+        Меняется при любом изменении каталога (в том числе через WAL) и при замене модели.
+        """
+        parts = [CLIP_MODEL_NAME, self._active.version if self._active is not None else "-"]
+        for path in (self.db_path, self.db_path + '-wal'):
             try:
-                import clip
-                self.model, self.preprocess = clip.load("ViT-B/32", device=self.device)
-            except Exception as e:
-                raise Exception(f"Ошибка при загрузке CLIP модели: {e}")
+                stat = os.stat(path)
+                parts.append(f"{stat.st_mtime_ns}:{stat.st_size}")
+            except OSError:
+                parts.append("-")
+        return "|".join(parts)
         
     def enhance_image(self, image):
         """Улучшение качества изображения перед обработкой"""
@@ -47,41 +161,61 @@ class DepartmentSearchService:
             print(f"Ошибка при улучшении изображения: {e}")
             return image
         
-    def get_image_features(self, image_path_or_url):
-        """Извлечение признаков из изображения с улучшенной обработкой"""
+    def get_image_features(self, image_path_or_url, degraded=False, version=None):
+        """
+        Извлечение признаков из изображения с улучшенной обработкой
+        
+        degraded=True - облегченный режим под нагрузкой: без улучшения изображения
+        и с одним проходом модели вместо трех
+        version - версия модели (по умолчанию активная)
+        """
         try:
-            # Ленивая инициализация модели
-            self._ensure_model_loaded()
+            if version is None:
+                # Ленивая инициализация модели
+                self._ensure_model_loaded()
+                version = self._active
             
             if image_path_or_url.startswith(('http://', 'https://')):
                 # URL изображения
-                response = requests.get(image_path_or_url, timeout=15)
+                with stage_timer(STAGE_DOWNLOAD):
+                    response = requests.get(image_path_or_url, timeout=15)
                 if response.status_code != 200:
                     return None
-                image = Image.open(BytesIO(response.content))
+                image_source = BytesIO(response.content)
             else:
                 # Локальный файл
-                image = Image.open(image_path_or_url)
+                image_source = image_path_or_url
             
-            # Улучшаем изображение
-            image = self.enhance_image(image)
+            with stage_timer(STAGE_DECODE):
+                image = Image.open(image_source)
+                image.load()
             
-            # Обрабатываем CLIP дважды для стабильности
-            image_input = self.preprocess(image).unsqueeze(0).to(self.device)
+            with stage_timer(STAGE_PREPROCESS):
+                # Улучшаем изображение
+                if not degraded:
+                    image = self.enhance_image(image)
+                
+                # Обрабатываем CLIP дважды для стабильности
+                image_input = version.preprocess(image).unsqueeze(0).to(self.device)
             
             features_list = []
             # Делаем несколько проходов для стабильности
-            for _ in range(3):
-                with torch.no_grad():
-                    features = self.model.encode_image(image_input)
-                    # Нормализуем вектор для корректного косинусного сходства
-                    features = features / features.norm(dim=-1, keepdim=True)
-                    features_list.append(features.cpu().numpy().flatten())
+            with stage_timer(STAGE_EMBED):
+                for _ in range(1 if degraded else 3):
+                    with torch.no_grad():
+                        features = version.model.encode_image(image_input)
+                        # Нормализуем вектор для корректного косинусного сходства
+                        features = features / features.norm(dim=-1, keepdim=True)
+                        features_list.append(features.cpu().numpy().flatten())
             
             # Берем средний вектор для большей стабильности
             avg_features = np.mean(features_list, axis=0)
             # Повторно нормализуем
             avg_features = avg_features / np.linalg.norm(avg_features)
+            
+            # Если прогрев не удался, модель загрузил этот запрос
+            if version is self._active:
+                self.ready = True
                 
             return avg_features
             
@@ -109,74 +243,131 @@ class DepartmentSearchService:
         conn.close()
         return departments
     
-    def search_by_department_and_image(self, image_path_or_url, department=None, top_k=5, min_similarity=None):
+    def search_by_department_and_image(self, image_path_or_url, department=None, top_k=5, min_similarity=None,
+                                       query_vector=None, degraded=False, version=None):
         """Поиск похожих товаров по изображению с фильтрацией по отделу"""
-        query_vector = self.get_image_features(image_path_or_url)
+        if version is None:
+            with self.acquire() as active:
+                return self.search_by_department_and_image(image_path_or_url, department, top_k, min_similarity,
+                                                           query_vector, degraded, version=active)
+        
+        if query_vector is None:
+            query_vector = self.get_image_features(image_path_or_url, degraded=degraded, version=version)
         if query_vector is None:
             return []
         
+        if version.index is not None:
+            return self._search_in_index(version.index, query_vector, department, top_k, min_similarity)
+        
         conn = sqlite3.connect(self.db_path)
         cursor = conn.cursor()
         
-        # Формируем SQL запрос с учетом фильтра по отделу
-        if department and department.upper() != 'ВСЕ':
-            cursor.execute("""
-                SELECT item_id, url, picture, vector, department, product_name 
-                FROM products 
-                WHERE department = ? AND vector IS NOT NULL
-                ORDER BY item_id
-            """, (department.upper(),))
-        else:
-            cursor.execute("""
-                SELECT item_id, url, picture, vector, department, product_name 
-                FROM products 
-                WHERE vector IS NOT NULL
-                ORDER BY item_id
-            """)
-        
-        rows = cursor.fetchall()
-        
-        similarities = []
-        
-        # Понижаем минимальный порог схожести для лучшего поиска
-        threshold = min_similarity if min_similarity is not None else 0.1
+        with stage_timer(STAGE_DB_FETCH):
+            # Формируем SQL запрос с учетом фильтра по отделу
+            if department and department.upper() != 'ВСЕ':
+                cursor.execute("""
+                    SELECT item_id, url, picture, vector, department, product_name 
+                    FROM products 
+                    WHERE department = ? AND vector IS NOT NULL
+                    ORDER BY item_id
+                """, (department.upper(),))
+            else:
+                cursor.execute("""
+                    SELECT item_id, url, picture, vector, department, product_name 
+                    FROM products 
+                    WHERE vector IS NOT NULL
+                    ORDER BY item_id
+                """)
+            
+            rows = cursor.fetchall()
         
-        for row in rows:
-            item_id, url, picture, vector_blob, dept, product_name = row
+        with stage_timer(STAGE_INDEX_SEARCH):
+            similarities = []
             
-            # Восстанавливаем вектор из БД
-            db_vector = np.frombuffer(vector_blob, dtype=np.float32)
+            # Понижаем минимальный порог схожести для лучшего поиска
+            threshold = min_similarity if min_similarity is not None else 0.1
             
-            # Вычисляем косинусное сходство
-            similarity = self.cosine_similarity(query_vector, db_vector)
+            for row in rows:
+                item_id, url, picture, vector_blob, dept, product_name = row
             
-            # Фильтруем по порогу схожести
-            if similarity >= threshold:
-                similarities.append({
-                    'item_id': item_id,
-                    'url': url,
-                    'picture': picture,
-                    'department': dept,
-                    'product_name': product_name,
-                    'similarity': float(similarity)
-                })
-        
-        # Сортируем по убыванию схожести
-        similarities.sort(key=lambda x: (-x['similarity'], x['item_id']))
+                # Восстанавливаем вектор из БД
+                db_vector = np.frombuffer(vector_blob, dtype=np.float32)
+            
+                # Вычисляем косинусное сходство
+                similarity = self.cosine_similarity(query_vector, db_vector)
+            
+                # Фильтруем по порогу схожести
+                if similarity >= threshold:
+                    similarities.append({
+                        'item_id': item_id,
+                        'url': url,
+                        'picture': picture,
+                        'department': dept,
+                        'product_name': product_name,
+                        'similarity': float(similarity)
+                    })
+            
+            # Сортируем по убыванию схожести
+            similarities.sort(key=lambda x: (-x['similarity'], x['item_id']))
         
         conn.close()
         return similarities[:top_k]
     
-    def search_with_multiple_thresholds_by_department(self, image_path_or_url, department=None, top_k=5):
+    def _search_in_index(self, index, query_vector, department, top_k, min_similarity):
+        """Поиск по векторам версии в памяти (дообученная модель) с данными товаров из БД"""
+        with stage_timer(STAGE_INDEX_SEARCH):
+            by_department = department if department and department.upper() != 'ВСЕ' else None
+            threshold = min_similarity if min_similarity is not None else 0.1
+            ranked = index.search(query_vector, by_department, top_k, threshold)
+        if not ranked:
+            return []
+        
+        with stage_timer(STAGE_DB_FETCH):
+            conn = sqlite3.connect(self.db_path)
+            try:
+                placeholders = ",".join("?" * len(ranked))
+                rows = conn.execute(f"""
+                    SELECT item_id, url, picture, department, product_name
+                    FROM products
+                    WHERE item_id IN ({placeholders})
+                """, [item_id for item_id, _ in ranked]).fetchall()
+            finally:
+                conn.close()
+        
+        products = {row[0]: row for row in rows}
+        return [{
+            'item_id': item_id,
+            'url': products[item_id][1],
+            'picture': products[item_id][2],
+            'department': products[item_id][3],
+            'product_name': products[item_id][4],
+            'similarity': similarity
+        } for item_id, similarity in ranked if item_id in products]
+    
+    def search_with_multiple_thresholds_by_department(self, image_path_or_url, department=None, top_k=5, degraded=False,
+                                                      version=None):
         """Поиск с несколькими порогами для лучшего качества результатов с фильтром по отделу"""
+        if version is None:
+            # Все пороги одного запроса проходят на одной версии модели
+            with self.acquire() as active:
+                return self.search_with_multiple_thresholds_by_department(image_path_or_url, department, top_k,
+                                                                          degraded, version=active)
+        
         thresholds = [0.5, 0.4, 0.3, 0.25, 0.2, 0.15, 0.1]
         
+        # Вектор запроса считаем один раз для всех порогов
+        query_vector = self.get_image_features(image_path_or_url, degraded=degraded, version=version)
+        if query_vector is None:
+            return []
+        
         for threshold in thresholds:
             results = self.search_by_department_and_image(
                 image_path_or_url, 
                 department=department, 
                 top_k=top_k*2, 
-                min_similarity=threshold
+                min_similarity=threshold,
+                query_vector=query_vector,
+                version=version
             )
             if len(results) >= top_k:
                 # Дополнительная фильтрация: убираем результаты с очень низкой схожестью
@@ -190,7 +381,9 @@ class DepartmentSearchService:
             image_path_or_url, 
             department=department, 
             top_k=top_k, 
-            min_similarity=0.05
+            min_similarity=0.05,
+            query_vector=query_vector,
+            version=version
         )
     
     def get_department_stats(self):
@@ -218,9 +411,23 @@ class DepartmentSearchService:
         conn = sqlite3.connect(self.db_path)
         cursor = conn.cursor()
         
-        search_pattern = f"%{search_text.lower()}%"
+        match_query = build_fts_query(search_text) if self._text_index_available(conn) else ''
+        by_department = department and department.upper() != 'ВСЕ'
         
-        if department and department.upper() != 'ВСЕ':
+        if match_query:
+            # Индексный поиск с ранжированием bm25
+            department_filter = "AND p.department = ?" if by_department else ""
+            params = [match_query] + ([department.upper()] if by_department else []) + [top_k]
+            cursor.execute(f"""
+                SELECT p.item_id, p.url, p.picture, p.department, p.product_name
+                FROM products_fts
+                JOIN products p ON p.rowid = products_fts.rowid
+                WHERE products_fts MATCH ? {department_filter}
+                ORDER BY products_fts.rank, p.item_id
+                LIMIT ?
+            """, params)
+        elif by_department:
+            search_pattern = f"%{search_text.lower()}%"
             cursor.execute("""
                 SELECT item_id, url, picture, department, product_name
                 FROM products 
@@ -229,6 +436,7 @@ class DepartmentSearchService:
                 LIMIT ?
             """, (department.upper(), search_pattern, search_pattern, top_k))
         else:
+            search_pattern = f"%{search_text.lower()}%"
             cursor.execute("""
                 SELECT item_id, url, picture, department, product_name
                 FROM products 
@@ -7,6 +7,9 @@ import os
 from datetime import datetime
 from typing import List, Dict, Optional
 
+from services.db_migrations import (apply_migrations, fts5_available, build_fts_query,
+                                    FEEDBACK_MIGRATIONS, FEEDBACK_FTS_MIGRATIONS)
+
 logger = logging.getLogger(__name__)
 
 class FeedbackDatabaseService:
@@ -14,6 +17,8 @@ class FeedbackDatabaseService:
     
     def __init__(self, db_path='data/feedback.db'):
         self.db_path = db_path
+        # Полнотекстовый индекс используется, если SQLite собран с FTS5
+        self.fts_enabled = False
         self.ensure_database_exists()
     
     def ensure_database_exists(self):
@@ -75,6 +80,15 @@ class FeedbackDatabaseService:
             ''')
             
             conn.commit()
+            
+            # Индексы для выборок по статусу и дате
+            apply_migrations(conn, FEEDBACK_MIGRATIONS)
+            
+            # Полнотекстовые индексы для поиска по сообщениям
+            if fts5_available(conn):
+                apply_migrations(conn, FEEDBACK_FTS_MIGRATIONS)
+                self.fts_enabled = True
+            
             logger.info("✅ База данных обратной связи готова к работе")
     
     def add_error_report(self, user_id: int, username: str, message: str) -> int:
@@ -261,32 +275,37 @@ class FeedbackDatabaseService:
     def search_feedback(self, query: str, feedback_type: str = None) -> List[Dict]:
         """Поиск в сообщениях обратной связи"""
         results = []
+        tables = []
+        
+        if not feedback_type or feedback_type == 'errors':
+            tables.append(('error', 'error_reports'))
+        if not feedback_type or feedback_type == 'suggestions':
+            tables.append(('suggestion', 'improvement_suggestions'))
+        
+        match_query = build_fts_query(query) if self.fts_enabled else ''
+        columns = ['type', 'id', 'user_id', 'username', 'message', 'timestamp', 'status']
         
         with sqlite3.connect(self.db_path) as conn:
             cursor = conn.cursor()
             
-            # Поиск в ошибках
-            if not feedback_type or feedback_type == 'errors':
-                cursor.execute('''
-                    SELECT 'error' as type, id, user_id, username, message, timestamp, status
-                    FROM error_reports 
-                    WHERE message LIKE ? OR username LIKE ?
-                    ORDER BY timestamp DESC
-                ''', (f'%{query}%', f'%{query}%'))
-                
-                columns = ['type', 'id', 'user_id', 'username', 'message', 'timestamp', 'status']
-                results.extend([dict(zip(columns, row)) for row in cursor.fetchall()])
-            
-            # Поиск в предложениях
-            if not feedback_type or feedback_type == 'suggestions':
-                cursor.execute('''
-                    SELECT 'suggestion' as type, id, user_id, username, message, timestamp, status
-                    FROM improvement_suggestions 
-                    WHERE message LIKE ? OR username LIKE ?
-                    ORDER BY timestamp DESC
-                ''', (f'%{query}%', f'%{query}%'))
+            for item_type, table in tables:
+                if match_query:
+                    # Индексный поиск с ранжированием bm25
+                    cursor.execute(f'''
+                        SELECT ? as type, t.id, t.user_id, t.username, t.message, t.timestamp, t.status
+                        FROM {table}_fts
+                        JOIN {table} t ON t.id = {table}_fts.rowid
+                        WHERE {table}_fts MATCH ?
+                        ORDER BY {table}_fts.rank, t.timestamp DESC
+                    ''', (item_type, match_query))
+                else:
+                    cursor.execute(f'''
+                        SELECT ? as type, id, user_id, username, message, timestamp, status
+                        FROM {table} 
+                        WHERE message LIKE ? OR username LIKE ?
+                        ORDER BY timestamp DESC
+                    ''', (item_type, f'%{query}%', f'%{query}%'))
                 
-                columns = ['type', 'id', 'user_id', 'username', 'message', 'timestamp', 'status']
                 results.extend([dict(zip(columns, row)) for row in cursor.fetchall()])
         
         return results
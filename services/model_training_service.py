@@ -270,8 +270,8 @@ class ModelTrainingService:
             example_ids = [ex['id'] for ex in train_data]
             self.training_service.mark_examples_as_used(example_ids)
             
-            # Обновляем векторы в основной БД
-            self._update_product_vectors(model_version)
+            # Переключаем поиск на новую модель после построения индекса и проверки
+            swap_result = self._update_product_vectors(model_version, model_path)
             
             logger.info(f"✅ Дообучение завершено! Модель: {model_version}, Сессия: {session_id}")
             
@@ -283,7 +283,8 @@ class ModelTrainingService:
                 'accuracy_before': accuracy_before,
                 'accuracy_after': accuracy_after,
                 'training_duration': duration,
-                'model_path': model_path
+                'model_path': model_path,
+                'swap': swap_result
             }
             
         except Exception as e:
@@ -339,20 +340,28 @@ class ModelTrainingService:
             logger.error(f"❌ Ошибка при сохранении модели: {e}")
             return ""
     
-    def _update_product_vectors(self, model_version: str):
-        """Обновление векторных представлений товаров новой моделью"""
+    def _update_product_vectors(self, model_version: str, model_path: str) -> Dict:
+        """
+        Векторы товаров новой моделью и переключение поиска на нее
+        
+        Индекс строится отдельно от работающего, поиск до проверки новой
+        версии продолжает работать на текущей модели.
+        """
+        if not model_path:
+            return {'success': False, 'error': 'Модель не сохранена'}
         try:
             logger.info("🔄 Обновление векторов товаров новой моделью...")
             
-            # Это может быть долгая операция, поэтому запускаем в фоне
-            # Здесь можно добавить логику обновления векторов в unified_products.db
-            # с использованием новой дообученной модели
+            from services.search_model_registry import get_model_swap_manager
+            result = get_model_swap_manager().prepare_and_swap(model_version, model_path)
             
-            # Пока что просто логируем
-            logger.info(f"✅ Векторы товаров обновлены для модели {model_version}")
+            if result['success']:
+                logger.info(f"✅ Векторы товаров обновлены для модели {model_version}")
+            return result
             
         except Exception as e:
             logger.error(f"❌ Ошибка при обновлении векторов: {e}")
+            return {'success': False, 'error': str(e)}
     
     def auto_training_check(self) -> bool:
         """
@@ -492,7 +501,17 @@ class ModelTrainingService:
             # Создаем резервную копию текущей модели перед восстановлением
             current_backup = self.create_model_backup(f"before_restore_{datetime.now().strftime('%Y%m%d_%H%M%S')}")
             
-            # Загружаем модель из резервной копии
+            # Поиск переключается на копию только после построения индекса и проверки
+            from services.search_model_registry import get_model_swap_manager
+            swap_result = get_model_swap_manager().prepare_and_swap(f"backup_{backup_id}", backup_path)
+            if not swap_result['success']:
+                return {
+                    'success': False,
+                    'error': swap_result['error'],
+                    'current_backup': current_backup
+                }
+            
+            # Дальнейшее дообучение продолжается от восстановленных весов
             checkpoint = torch.load(backup_path, map_location=self.device)
             self.model.load_state_dict(checkpoint['model_state_dict'])
             
@@ -502,7 +521,8 @@ class ModelTrainingService:
                 'success': True,
                 'backup_id': backup_id,
                 'restored_at': datetime.now().isoformat(),
-                'current_backup': current_backup
+                'current_backup': current_backup,
+                'swap': swap_result
             }
             
         except Exception as e:
@@ -0,0 +1,548 @@
+"""
+Версии модели поиска по фото и замена модели без остановки бота
+
+Версия - это модель CLIP (базовая или дообученная) вместе с векторами товаров,
+посчитанными именно этой моделью. DepartmentSearchService держит ссылку на
+активную версию; каждый поиск берет ее один раз в начале и работает с ней до
+конца. Поэтому замена ссылки атомарна для запросов: начатые поиски завершаются
+на старой версии, новые сразу идут на новой.
+
+ModelSwapManager готовит новую версию в фоне (загрузка весов, построение
+индекса товаров, если его еще нет), проверяет ее контрольными запросами и
+только после этого переключает. После завершения начатых на ней поисков
+предыдущая версия выгружается, а для отката запоминаются ее файлы: откат
+загружает их заново. Горячий резерв (MODEL_SWAP_KEEP_STANDBY=1) делает откат
+мгновенной заменой ссылки, но держит в памяти еще одну копию CLIP ViT-B/32
+(около 0.6 ГБ); во время подготовки новой версии в памяти тогда одновременно
+активная, резервная и проверяемая модели, а при дообучении - еще и модель
+ModelTrainingService. На сервере без GPU с ограниченной памятью резерв
+по умолчанию выключен.
+
+Активная версия записывается в models/active_model.json и загружается при
+следующем запуске.
+"""
+import gc
+import os
+import time
+import random
+import asyncio
+import logging
+import sqlite3
+import threading
+from collections import deque
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+import torch
+from PIL import Image
+
+from toolbot.utils.latency_sketch import suppress_stage_metrics
+from toolbot.utils.persisted_state import atomic_write_json, load_json
+
+logger = logging.getLogger(__name__)
+
+# Версия без дообучения: векторы товаров берутся из колонки products.vector
+BASE_VERSION = 'base'
+
+ACTIVE_MODEL_PATH = os.path.join('models', 'active_model.json')
+INDEX_DIR = os.path.join('models', 'indexes')
+
+# Дополнительные контрольные запросы (например, фото покупателей):
+# [{"image": путь или URL, "item_id": ожидаемый товар, "department": отдел}]
+SMOKE_QUERIES_PATH = os.path.join('data', 'smoke_queries.json')
+
+# Проверки перед переключением
+MIN_INDEX_COVERAGE = 0.9        # доля товаров с картинкой, попавших в новый индекс (с резервными векторами)
+CATALOG_SMOKE_SAMPLE = 25       # товаров, которые ищутся по их собственной картинке
+MIN_CATALOG_SMOKE_HIT_RATE = 0.8  # доля из них, попавших в свой топ-5
+SMOKE_TOLERANCE = 0.1           # допустимое падение доли попаданий контрольных запросов
+
+# Сколько ждать завершения поисков на старой версии перед отчетом
+DRAIN_TIMEOUT = 120
+
+# Держать предыдущую версию загруженной для мгновенного отката
+KEEP_STANDBY = os.getenv("MODEL_SWAP_KEEP_STANDBY", "0") == "1"
+
+
+class SwapValidationError(Exception):
+    """Новая версия не прошла проверку и не была включена"""
+
+
+def index_path_for(version: str) -> str:
+    """Путь к файлу индекса товаров версии"""
+    return os.path.join(INDEX_DIR, f'index_{version}.npz')
+
+
+class ProductIndex:
+    """Векторы товаров одной версии модели в памяти"""
+
+    def __init__(self, item_ids, departments, vectors, source_count: Optional[int] = None, fallback=None):
+        self.item_ids = np.asarray(item_ids, dtype=str)
+        self.departments = np.asarray(departments, dtype=str)
+        self.vectors = np.asarray(vectors, dtype=np.float32).reshape(len(self.item_ids), -1)
+        # Сколько товаров пытались проиндексировать (для проверки полноты)
+        self.source_count = source_count if source_count is not None else len(self.item_ids)
+        # Товары, чью картинку не удалось скачать: вектор взят из products.vector
+        self.fallback = (np.asarray(fallback, dtype=bool) if fallback is not None
+                         else np.zeros(len(self.item_ids), dtype=bool))
+
+    def __len__(self) -> int:
+        return len(self.item_ids)
+
+    @property
+    def dim(self) -> int:
+        return self.vectors.shape[1] if len(self) else 0
+
+    @classmethod
+    def from_database(cls, db_path: str) -> 'ProductIndex':
+        """Векторы базовой версии из колонки products.vector"""
+        conn = sqlite3.connect(db_path)
+        try:
+            rows = conn.execute(
+                "SELECT item_id, department, vector FROM products WHERE vector IS NOT NULL ORDER BY item_id"
+            ).fetchall()
+        finally:
+            conn.close()
+        vectors = [np.frombuffer(blob, dtype=np.float32) for _, _, blob in rows]
+        return cls([row[0] for row in rows], [row[1] or '' for row in rows],
+                   np.vstack(vectors) if vectors else np.zeros((0, 0), dtype=np.float32))
+
+    @classmethod
+    def load(cls, path: str) -> 'ProductIndex':
+        with np.load(path) as data:
+            fallback = data['fallback'] if 'fallback' in data.files else None
+            return cls(data['item_ids'], data['departments'], data['vectors'], int(data['source_count']), fallback)
+
+    def save(self, path: str) -> None:
+        """Атомарная запись: временный файл и os.replace"""
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, item_ids=self.item_ids, departments=self.departments,
+                     vectors=self.vectors, source_count=np.int64(self.source_count), fallback=self.fallback)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+    def search(self, query_vector, department: Optional[str] = None, top_k: int = 5,
+               min_similarity: float = 0.1) -> List[Tuple[str, float]]:
+        """
+        Ближайшие товары по косинусному сходству
+
+        Returns:
+            Список (item_id, сходство) по убыванию сходства
+        """
+        if not len(self):
+            return []
+        scores = self.vectors @ np.asarray(query_vector, dtype=np.float32)
+        candidates = scores >= min_similarity
+        if department:
+            candidates &= self.departments == department.upper()
+        positions = np.flatnonzero(candidates)
+        if len(positions) > top_k * 4:
+            # Частичная сортировка с запасом, чтобы равные сходства упорядочить по item_id
+            positions = positions[np.argpartition(-scores[positions], top_k * 4 - 1)[:top_k * 4]]
+        ranked = sorted(((str(self.item_ids[i]), float(scores[i])) for i in positions), key=lambda x: (-x[1], x[0]))
+        return ranked[:top_k]
+
+
+class SearchModelVersion:
+    """Модель CLIP и индекс товаров одной версии"""
+
+    def __init__(self, version: str, model, preprocess, index: Optional[ProductIndex] = None,
+                 checkpoint: Optional[str] = None, index_path: Optional[str] = None):
+        self.version = version
+        self.model = model
+        self.preprocess = preprocess
+        # None - индекс в колонке products.vector (базовая версия)
+        self.index = index
+        self.checkpoint = checkpoint
+        self.index_path = index_path
+        self.loaded_at = time.time()
+        self.in_flight = 0
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def lease(self):
+        """Учет поиска, выполняющегося на этой версии"""
+        with self._lock:
+            self.in_flight += 1
+        try:
+            yield self
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+
+    def pointer(self) -> Dict[str, Any]:
+        """Запись для models/active_model.json"""
+        return {
+            'version': self.version,
+            'checkpoint': self.checkpoint,
+            'index': self.index_path,
+            'activated_at': datetime.now().isoformat(),
+        }
+
+    def describe(self) -> Dict[str, Any]:
+        return {
+            'version': self.version,
+            'checkpoint': self.checkpoint,
+            'index_size': len(self.index) if self.index is not None else None,
+            'loaded_at': datetime.fromtimestamp(self.loaded_at).isoformat(),
+            'in_flight': self.in_flight,
+        }
+
+
+def load_version(version: str, model_name: str, device: str, checkpoint: Optional[str] = None,
+                 index_path: Optional[str] = None) -> SearchModelVersion:
+    """
+    Загрузка версии: базовая CLIP, при необходимости веса дообучения и индекс
+
+    Args:
+        version: Идентификатор версии
+        model_name: Название базовой модели CLIP
+        device: Устройство для модели
+        checkpoint: Файл с model_state_dict дообученной модели
+        index_path: Файл индекса товаров версии
+    """
+    import clip
+    model, preprocess = clip.load(model_name, device=device)
+    if checkpoint:
+        state = torch.load(checkpoint, map_location=device)
+        model.load_state_dict(state['model_state_dict'])
+    model.eval()
+    index = ProductIndex.load(index_path) if index_path else None
+    return SearchModelVersion(version, model, preprocess, index, checkpoint, index_path)
+
+
+def load_active_version(model_name: str, device: str) -> SearchModelVersion:
+    """Версия из models/active_model.json или базовая, если ее не удалось загрузить"""
+    pointer = load_json(ACTIVE_MODEL_PATH) or {}
+    version = pointer.get('version', BASE_VERSION)
+    if version != BASE_VERSION:
+        try:
+            loaded = load_version(version, model_name, device, pointer.get('checkpoint'), pointer.get('index'))
+            logger.info(f"✅ Загружена активная версия модели поиска {version}")
+            return loaded
+        except Exception as e:
+            logger.error(f"❌ Не удалось загрузить версию модели {version}, используется базовая: {e}")
+    return load_version(BASE_VERSION, model_name, device)
+
+
+class ModelSwapManager:
+    """Подготовка, проверка и переключение версий модели поиска"""
+
+    def __init__(self, service, keep_standby: bool = KEEP_STANDBY):
+        """
+        Args:
+            service: DepartmentSearchService, в котором переключается версия
+            keep_standby: Держать предыдущую версию загруженной (мгновенный откат ценой памяти)
+        """
+        self.service = service
+        self.keep_standby = keep_standby
+        # Предыдущая версия для мгновенного отката (только с keep_standby)
+        self.standby: Optional[SearchModelVersion] = None
+        # Файлы предыдущей версии для отката с загрузкой
+        self.rollback_target: Optional[Dict[str, Any]] = None
+        self.status: Dict[str, Any] = {'state': 'idle'}
+        self.history = deque(maxlen=20)
+        self._job_lock = threading.Lock()
+
+    def _set_status(self, state: str, version: str, **details) -> None:
+        self.status = {'state': state, 'version': version, 'updated_at': datetime.now().isoformat(), **details}
+
+    def build_index(self, candidate: SearchModelVersion) -> ProductIndex:
+        """
+        Векторы всех товаров с картинкой, посчитанные моделью новой версии
+
+        Используется пакетный конвейер импорта каталога (параллельные загрузки,
+        векторизация пачками). Замеры этапов поиска для /metrics он не пишет,
+        поэтому индексация не искажает задержки пользовательских запросов.
+
+        Товары, картинку которых не удалось скачать, остаются в индексе с
+        вектором из products.vector, если его размерность совпадает с моделью.
+        """
+        from services.catalog_importer import CatalogImporter
+
+        conn = sqlite3.connect(self.service.db_path)
+        try:
+            rows = conn.execute(
+                "SELECT item_id, department, picture FROM products "
+                "WHERE picture IS NOT NULL AND picture != '' ORDER BY item_id"
+            ).fetchall()
+        finally:
+            conn.close()
+
+        importer = CatalogImporter(self.service.db_path, search_service=self.service, version=candidate)
+        item_ids, departments, vectors = [], [], []
+        next_report = 500
+
+        def collect(products, batch_vectors):
+            nonlocal next_report
+            for product, vector in zip(products, batch_vectors):
+                item_ids.append(product['item_id'])
+                departments.append(product['department'] or '')
+                vectors.append(vector)
+            done = importer.stats.imported + importer.stats.download_failed
+            self._set_status('indexing', candidate.version, progress=f"{done}/{len(rows)}")
+            if done >= next_report:
+                next_report += 500
+                logger.info(f"🔄 Индекс версии {candidate.version}: {done}/{len(rows)} товаров")
+
+        products = ({'item_id': item_id, 'department': department, 'picture': picture}
+                    for item_id, department, picture in rows)
+        # Отдельный цикл событий в фоновом потоке замены модели
+        stats = asyncio.run(importer.embed_products(products, collect))
+        logger.info(f"✅ Индекс версии {candidate.version}: {len(item_ids)} из {len(rows)} товаров, "
+                    f"ошибок загрузки {stats.download_failed}")
+
+        fallback = [False] * len(item_ids)
+        if stats.failed_items:
+            shown = ', '.join(stats.failed_items[:50])
+            more = f" и еще {len(stats.failed_items) - 50}" if len(stats.failed_items) > 50 else ""
+            logger.warning(f"⚠️ Не удалось скачать картинки товаров: {shown}{more}")
+            dim = len(vectors[0]) if vectors else None
+            restored = 0
+            for item_id, department, vector in self._stored_vectors(stats.failed_items):
+                if dim is not None and len(vector) != dim:
+                    continue
+                item_ids.append(item_id)
+                departments.append(department or '')
+                vectors.append(vector)
+                fallback.append(True)
+                restored += 1
+            logger.info(f"🔄 Индекс версии {candidate.version}: {restored} товаров без картинки "
+                        f"с вектором из products.vector")
+
+        return ProductIndex(item_ids, departments,
+                            np.vstack(vectors) if vectors else np.zeros((0, 0), dtype=np.float32),
+                            source_count=len(rows), fallback=fallback)
+
+    def _stored_vectors(self, item_ids: List[str]) -> List[Tuple[str, str, np.ndarray]]:
+        """Векторы товаров из колонки products.vector"""
+        conn = sqlite3.connect(self.service.db_path)
+        try:
+            rows = []
+            for start in range(0, len(item_ids), 500):
+                chunk = item_ids[start:start + 500]
+                rows.extend(conn.execute(
+                    f"SELECT item_id, department, vector FROM products "
+                    f"WHERE item_id IN ({', '.join('?' for _ in chunk)}) AND vector IS NOT NULL",
+                    chunk
+                ).fetchall())
+        finally:
+            conn.close()
+        return [(item_id, department, np.frombuffer(blob, dtype=np.float32)) for item_id, department, blob in rows]
+
+    def _catalog_smoke_queries(self, index: ProductIndex) -> List[Dict[str, Any]]:
+        """
+        Контрольный набор из каталога: случайные товары индекса и их картинки
+
+        Поиск по картинке идет полным путем запроса (загрузка, модель, поиск
+        в индексе, чтение товаров из базы), поэтому проверяет всю версию,
+        а не только векторы индекса.
+        """
+        # Картинки товаров с резервным вектором не скачиваются
+        item_ids = [str(item_id) for item_id in index.item_ids[~index.fallback]]
+        sample = random.Random(0).sample(item_ids, min(CATALOG_SMOKE_SAMPLE, len(item_ids)))
+        if not sample:
+            return []
+        conn = sqlite3.connect(self.service.db_path)
+        try:
+            rows = conn.execute(
+                f"SELECT item_id, picture FROM products WHERE item_id IN ({', '.join('?' for _ in sample)}) "
+                f"AND picture IS NOT NULL AND picture != ''",
+                sample
+            ).fetchall()
+        finally:
+            conn.close()
+        return [{'image': picture, 'item_id': item_id} for item_id, picture in sorted(rows)]
+
+    def _smoke_hit_rate(self, queries: List[Dict[str, Any]], version: SearchModelVersion) -> float:
+        hits = 0
+        # Контрольные поиски не должны попадать в задержки пользовательских запросов
+        with suppress_stage_metrics():
+            for query in queries:
+                results = self.service.search_with_multiple_thresholds_by_department(
+                    query['image'], department=query.get('department'), top_k=5, version=version
+                )
+                hits += any(str(result['item_id']) == str(query['item_id']) for result in results)
+        return hits / len(queries)
+
+    def validate(self, candidate: SearchModelVersion, index: ProductIndex) -> Dict[str, Any]:
+        """
+        Проверка версии перед включением
+
+        - модель дает конечный вектор той же размерности, что и индекс;
+        - индекс полон;
+        - случайные товары каталога находятся по своей картинке в топ-5;
+        - контрольные запросы из data/smoke_queries.json (если заданы) находят
+          ожидаемые товары не хуже текущей версии с учетом допуска.
+
+        Raises:
+            SwapValidationError: Версия не прошла проверку
+        """
+        report: Dict[str, Any] = {}
+
+        with torch.no_grad():
+            image_input = candidate.preprocess(Image.new("RGB", (224, 224))).unsqueeze(0).to(self.service.device)
+            vector = candidate.model.encode_image(image_input).float().cpu().numpy().flatten()
+        if not np.all(np.isfinite(vector)):
+            raise SwapValidationError("Модель возвращает некорректные значения")
+        if vector.shape[0] != index.dim:
+            raise SwapValidationError(f"Размерность модели {vector.shape[0]} не совпадает с индексом {index.dim}")
+
+        coverage = len(index) / index.source_count if index.source_count else 0.0
+        report['index_size'] = len(index)
+        report['fallback_vectors'] = int(index.fallback.sum())
+        report['coverage'] = round(coverage, 3)
+        if coverage < MIN_INDEX_COVERAGE:
+            raise SwapValidationError(f"В индекс попало только {coverage:.0%} товаров")
+
+        catalog_queries = self._catalog_smoke_queries(index)
+        if not catalog_queries:
+            raise SwapValidationError("В индексе нет товаров с картинкой для контрольных запросов")
+        catalog_rate = self._smoke_hit_rate(catalog_queries, candidate)
+        report['catalog_smoke_queries'] = len(catalog_queries)
+        report['catalog_smoke_hit_rate'] = round(catalog_rate, 3)
+        if catalog_rate < MIN_CATALOG_SMOKE_HIT_RATE:
+            raise SwapValidationError(
+                f"Товары каталога находятся по своей картинке только в {catalog_rate:.0%} случаев"
+            )
+
+        queries = load_json(SMOKE_QUERIES_PATH, [])
+        if queries:
+            candidate_rate = self._smoke_hit_rate(queries, candidate)
+            with self.service.acquire() as active:
+                active_rate = self._smoke_hit_rate(queries, active)
+            report['smoke_hit_rate'] = round(candidate_rate, 3)
+            report['smoke_hit_rate_active'] = round(active_rate, 3)
+            if candidate_rate < active_rate - SMOKE_TOLERANCE:
+                raise SwapValidationError(
+                    f"Контрольные запросы: {candidate_rate:.0%} попаданий против {active_rate:.0%} у текущей версии"
+                )
+        return report
+
+    def prepare_and_swap(self, version: str, checkpoint: Optional[str] = None) -> Dict[str, Any]:
+        """
+        Загрузка, проверка и включение версии (блокирующий вызов для фонового потока)
+
+        Поиск все это время обслуживает текущая версия.
+
+        Args:
+            version: Идентификатор версии
+            checkpoint: Файл весов дообученной модели (None для базовой)
+
+        Returns:
+            Словарь с результатом: success, version, previous, checks или error
+        """
+        if not self._job_lock.acquire(blocking=False):
+            return {'success': False, 'error': f"Уже выполняется замена модели ({self.status.get('version')})"}
+        try:
+            # Откат на резервную версию не требует загрузки и проверки
+            if self.standby is not None and self.standby.version == version:
+                return self._activate(self.standby, {'standby': True})
+
+            self._set_status('loading', version)
+            index_path = index_path_for(version) if version != BASE_VERSION else None
+            if index_path and not os.path.exists(index_path):
+                index_path = None
+            candidate = load_version(version, self.service.model_name, self.service.device, checkpoint, index_path)
+
+            if version == BASE_VERSION:
+                index = ProductIndex.from_database(self.service.db_path)
+            elif candidate.index is None:
+                self._set_status('indexing', version)
+                index = self.build_index(candidate)
+                candidate.index_path = index_path_for(version)
+                index.save(candidate.index_path)
+                candidate.index = index
+            else:
+                index = candidate.index
+
+            self._set_status('validating', version)
+            report = self.validate(candidate, index)
+            return self._activate(candidate, report)
+        except Exception as e:
+            self._set_status('failed', version, error=str(e))
+            self.history.append(dict(self.status))
+            logger.error(f"❌ Версия модели {version} не включена, поиск продолжает работать на текущей: {e}")
+            return {'success': False, 'version': version, 'error': str(e)}
+        finally:
+            self._job_lock.release()
+
+    def _activate(self, candidate: SearchModelVersion, report: Dict[str, Any]) -> Dict[str, Any]:
+        previous = self.service.swap(candidate)
+        atomic_write_json(ACTIVE_MODEL_PATH, candidate.pointer())
+        previous_version = previous.version if previous is not None else None
+        self.standby = previous if self.keep_standby else None
+        if previous is not None:
+            self.rollback_target = {'version': previous.version, 'checkpoint': previous.checkpoint}
+        logger.info(f"✅ Поиск переключен на версию модели {candidate.version}"
+                     + (f" (предыдущая: {previous_version})" if previous is not None else ""))
+
+        # Начатые на старой версии поиски завершаются на ней же
+        drained = True
+        if previous is not None:
+            deadline = time.monotonic() + DRAIN_TIMEOUT
+            while previous.in_flight and time.monotonic() < deadline:
+                time.sleep(0.1)
+            drained = previous.in_flight == 0
+            if not self.keep_standby:
+                # Память освобождается, когда завершится последний поиск на старой версии
+                previous = None
+                gc.collect()
+                if drained:
+                    logger.info(f"🔄 Версия модели {previous_version} выгружена, откат загрузит ее заново")
+
+        result = {
+            'success': True,
+            'version': candidate.version,
+            'previous': previous_version,
+            'drained': drained,
+            'checks': report,
+        }
+        self._set_status('active', candidate.version, previous=result['previous'], checks=report)
+        self.history.append(dict(self.status))
+        return result
+
+    def rollback(self) -> Dict[str, Any]:
+        """
+        Возврат на предыдущую версию
+
+        С горячим резервом - мгновенная замена ссылки, иначе версия заново
+        загружается из своих файлов и проверяется.
+        """
+        if self.standby is not None:
+            return self.prepare_and_swap(self.standby.version)
+        if self.rollback_target is None:
+            return {'success': False, 'error': 'Нет предыдущей версии для отката'}
+        return self.prepare_and_swap(self.rollback_target['version'], self.rollback_target['checkpoint'])
+
+    def get_status(self) -> Dict[str, Any]:
+        """Состояние для админки"""
+        active = self.service.active_version
+        return {
+            'active': active.describe() if active is not None else None,
+            'standby': self.standby.describe() if self.standby is not None else None,
+            'rollback': dict(self.rollback_target) if self.rollback_target is not None else None,
+            'job': dict(self.status),
+            'history': list(self.history),
+        }
+
+
+# Глобальный менеджер замены модели
+_swap_manager = None
+_swap_manager_lock = threading.Lock()
+
+def get_model_swap_manager() -> ModelSwapManager:
+    """Получение менеджера замены модели для сервиса поиска бота"""
+    global _swap_manager
+    if _swap_manager is None:
+        with _swap_manager_lock:
+            if _swap_manager is None:
+                # Экземпляр сервиса поиска, которым пользуются обработчики фото
+                from handlers.photo_handler import get_department_search_service
+                _swap_manager = ModelSwapManager(get_department_search_service())
+    return _swap_manager
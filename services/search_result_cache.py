@@ -0,0 +1,262 @@
+"""
+Кэш результатов поиска по отделам с ключом по перцептивному хешу фото
+
+Пользователи часто присылают почти одинаковые фото одного товара (переснимают
+после "🔄 Попробовать другое фото"). Такие фото дают близкие перцептивные хеши,
+поэтому результат берется из кэша без запуска CLIP: поиск соседей по расстоянию
+Хэмминга выполняется в BK-дереве. При смене версии индекса кэш сбрасывается.
+"""
+import time
+import logging
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+from PIL import Image
+
+logger = logging.getLogger(__name__)
+
+
+def perceptual_hash(image_path: str, hash_size: int = 8) -> Optional[int]:
+    """
+    Разностный перцептивный хеш (dHash) изображения
+
+    Изображение уменьшается до (hash_size + 1) x hash_size в оттенках серого,
+    каждый бит - сравнение яркости соседних пикселей в строке.
+
+    Args:
+        image_path: Путь к изображению
+        hash_size: Размер хеша (8 -> 64 бита)
+
+    Returns:
+        Хеш как целое число или None, если изображение не читается
+    """
+    try:
+        with Image.open(image_path) as image:
+            # Для JPEG декодируем сразу в уменьшенном виде
+            image.draft('L', (hash_size * 8, hash_size * 8))
+            gray = image.convert('L').resize((hash_size + 1, hash_size), Image.Resampling.LANCZOS)
+    except Exception as e:
+        logger.warning(f"⚠️ Не удалось вычислить перцептивный хеш {image_path}: {e}")
+        return None
+
+    pixels = list(gray.getdata())
+    value = 0
+    for row in range(hash_size):
+        offset = row * (hash_size + 1)
+        for col in range(hash_size):
+            value = (value << 1) | (pixels[offset + col] > pixels[offset + col + 1])
+    return value
+
+
+class BKTree:
+    """
+    BK-дерево для поиска хешей в пределах расстояния Хэмминга
+
+    Узел: [хеш, список идентификаторов записей, {расстояние: дочерний узел}].
+    По неравенству треугольника обходятся только ветви с расстоянием
+    в диапазоне [d - max_distance, d + max_distance].
+    """
+
+    def __init__(self):
+        self.root = None
+
+    @staticmethod
+    def distance(a: int, b: int) -> int:
+        """Расстояние Хэмминга"""
+        return (a ^ b).bit_count()
+
+    def add(self, value: int, entry_id: int) -> None:
+        """Добавление хеша с идентификатором записи"""
+        if self.root is None:
+            self.root = [value, [entry_id], {}]
+            return
+
+        node = self.root
+        while True:
+            d = self.distance(value, node[0])
+            if d == 0:
+                node[1].append(entry_id)
+                return
+            child = node[2].get(d)
+            if child is None:
+                node[2][d] = [value, [entry_id], {}]
+                return
+            node = child
+
+    def find(self, value: int, max_distance: int) -> List[Tuple[int, int]]:
+        """
+        Поиск записей в пределах расстояния
+
+        Returns:
+            Список пар (расстояние, идентификатор записи)
+        """
+        found = []
+        if self.root is None:
+            return found
+
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            d = self.distance(value, node[0])
+            if d <= max_distance:
+                found.extend((d, entry_id) for entry_id in node[1])
+            for child_distance, child in node[2].items():
+                if d - max_distance <= child_distance <= d + max_distance:
+                    stack.append(child)
+        return found
+
+
+class DepartmentResultCache:
+    """
+    Кэш результатов perform_department_search
+
+    Ключ - (перцептивный хеш, отдел, top_k, версия индекса). Для каждой пары
+    (отдел, top_k) ведется свое BK-дерево. Вытесненные записи удаляются из дерева
+    лениво: дерево перестраивается, когда устаревших узлов становится больше живых.
+    """
+
+    def __init__(self, max_entries: int = 1000, max_distance: int = 6, ttl: float = 3600):
+        """
+        Args:
+            max_entries: Максимальное количество записей
+            max_distance: Максимальное расстояние Хэмминга для "почти одинаковых" фото (из 64 бит)
+            ttl: Время жизни записи в секундах
+        """
+        self.max_entries = max_entries
+        self.max_distance = max_distance
+        self.ttl = ttl
+
+        self._lock = threading.Lock()
+        self._version: Optional[str] = None
+        self._trees: Dict[Tuple[Optional[str], int], BKTree] = {}
+        self._tree_sizes: Dict[Tuple[Optional[str], int], int] = {}
+        # {идентификатор: (ключ дерева, хеш, результаты, время создания)}, порядок - LRU
+        self._entries: "OrderedDict[int, Tuple[Tuple[Optional[str], int], int, List[Dict[str, Any]], float]]" = OrderedDict()
+        self._next_id = 0
+
+        self.hits = 0
+        self.near_hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def _check_version(self, index_version: str) -> None:
+        """Сбрасывает кэш при смене версии индекса (вызывается под блокировкой)"""
+        if index_version != self._version:
+            if self._version is not None:
+                self.invalidations += 1
+                logger.info(f"♻️ Версия индекса изменилась, кэш результатов поиска сброшен ({len(self._entries)} записей)")
+            self._version = index_version
+            self._trees.clear()
+            self._tree_sizes.clear()
+            self._entries.clear()
+
+    def get(self, image_hash: Optional[int], department: Optional[str], top_k: int,
+            index_version: str) -> Optional[List[Dict[str, Any]]]:
+        """
+        Поиск результата для этого или почти такого же фото
+
+        Returns:
+            Копия результатов поиска или None при промахе
+        """
+        if image_hash is None:
+            return None
+
+        tree_key = (department, top_k)
+        now = time.time()
+        with self._lock:
+            self._check_version(index_version)
+            tree = self._trees.get(tree_key)
+            if tree is None:
+                self.misses += 1
+                return None
+
+            best = None
+            for distance, entry_id in tree.find(image_hash, self.max_distance):
+                entry = self._entries.get(entry_id)
+                if entry is None:
+                    continue
+                if now - entry[3] > self.ttl:
+                    del self._entries[entry_id]
+                    continue
+                if best is None or distance < best[0]:
+                    best = (distance, entry_id)
+
+            if best is None:
+                self.misses += 1
+                return None
+
+            distance, entry_id = best
+            self._entries.move_to_end(entry_id)
+            self.hits += 1
+            if distance:
+                self.near_hits += 1
+            results = self._entries[entry_id][2]
+
+        logger.info(f"⚡ Результат поиска взят из кэша (расстояние хешей: {distance})")
+        return [dict(result) for result in results]
+
+    def put(self, image_hash: Optional[int], department: Optional[str], top_k: int,
+            index_version: str, results: List[Dict[str, Any]]) -> None:
+        """Сохранение результатов поиска"""
+        if image_hash is None or not results:
+            return
+
+        tree_key = (department, top_k)
+        with self._lock:
+            self._check_version(index_version)
+
+            entry_id = self._next_id
+            self._next_id += 1
+            self._entries[entry_id] = (tree_key, image_hash, [dict(result) for result in results], time.time())
+            self._trees.setdefault(tree_key, BKTree()).add(image_hash, entry_id)
+            self._tree_sizes[tree_key] = self._tree_sizes.get(tree_key, 0) + 1
+
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+            self._compact(tree_key)
+
+    def _compact(self, tree_key: Tuple[Optional[str], int]) -> None:
+        """Перестраивает дерево, если в нем больше устаревших узлов, чем живых"""
+        live = [(entry_id, entry[1]) for entry_id, entry in self._entries.items() if entry[0] == tree_key]
+        if self._tree_sizes.get(tree_key, 0) <= 2 * len(live):
+            return
+
+        tree = BKTree()
+        for entry_id, image_hash in live:
+            tree.add(image_hash, entry_id)
+        self._trees[tree_key] = tree
+        self._tree_sizes[tree_key] = len(live)
+
+    def clear(self) -> None:
+        """Полная очистка кэша"""
+        with self._lock:
+            self._trees.clear()
+            self._tree_sizes.clear()
+            self._entries.clear()
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Статистика кэша"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'hits': self.hits,
+                'near_hits': self.near_hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'invalidations': self.invalidations,
+                'index_version': self._version,
+            }
+
+
+# Глобальный экземпляр кэша
+_result_cache = None
+
+def get_result_cache():
+    """Получение экземпляра кэша результатов поиска"""
+    global _result_cache
+    if _result_cache is None:
+        _result_cache = DepartmentResultCache()
+    return _result_cache
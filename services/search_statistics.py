@@ -7,6 +7,8 @@ import json
 from datetime import datetime
 from typing import List, Dict, Optional
 
+from services.db_migrations import apply_migrations, SEARCH_STATS_MIGRATIONS
+
 logger = logging.getLogger(__name__)
 
 class SearchStatisticsService:
@@ -52,6 +54,10 @@ class SearchStatisticsService:
             ''')
             
             conn.commit()
+            
+            # Индексы для админ-экранов статистики
+            apply_migrations(conn, SEARCH_STATS_MIGRATIONS)
+            
             conn.close()
             logger.info("База данных статистики поиска инициализирована")
             
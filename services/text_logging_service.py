@@ -7,6 +7,9 @@ import os
 from datetime import datetime
 from typing import Optional
 
+from services.db_migrations import (apply_migrations, fts5_available, build_fts_query,
+                                    TEXT_MESSAGES_FTS_MIGRATIONS)
+
 logger = logging.getLogger(__name__)
 
 class TextLoggingService:
@@ -14,6 +17,8 @@ class TextLoggingService:
     
     def __init__(self, db_path='data/text_messages.db'):
         self.db_path = db_path
+        # Полнотекстовый индекс используется, если SQLite собран с FTS5
+        self.fts_enabled = False
         self._init_database()
     
     def _init_database(self):
@@ -52,6 +57,14 @@ class TextLoggingService:
             cursor.execute('CREATE INDEX IF NOT EXISTS idx_is_admin ON text_messages(is_admin)')
             
             conn.commit()
+            
+            # Полнотекстовый индекс для поиска по тексту сообщений
+            if fts5_available(conn):
+                apply_migrations(conn, TEXT_MESSAGES_FTS_MIGRATIONS)
+                self.fts_enabled = True
+            else:
+                logger.warning("⚠️ SQLite без поддержки FTS5, поиск по текстам будет медленным")
+            
             conn.close()
             logger.info(f"✅ База данных логирования текстов инициализирована: {self.db_path}")
             
@@ -200,13 +213,25 @@ class TextLoggingService:
             conn = sqlite3.connect(self.db_path)
             cursor = conn.cursor()
             
-            cursor.execute('''
-                SELECT user_id, username, message_text, timestamp, message_type
-                FROM text_messages 
-                WHERE message_text LIKE ?
-                ORDER BY timestamp DESC
-                LIMIT ?
-            ''', (f'%{query}%', limit))
+            match_query = build_fts_query(query) if self.fts_enabled else ''
+            if match_query:
+                # Индексный поиск с ранжированием bm25, при равенстве - свежие первыми
+                cursor.execute('''
+                    SELECT m.user_id, m.username, m.message_text, m.timestamp, m.message_type
+                    FROM text_messages_fts
+                    JOIN text_messages m ON m.id = text_messages_fts.rowid
+                    WHERE text_messages_fts MATCH ?
+                    ORDER BY text_messages_fts.rank, m.timestamp DESC
+                    LIMIT ?
+                ''', (match_query, limit))
+            else:
+                cursor.execute('''
+                    SELECT user_id, username, message_text, timestamp, message_type
+                    FROM text_messages 
+                    WHERE message_text LIKE ?
+                    ORDER BY timestamp DESC
+                    LIMIT ?
+                ''', (f'%{query}%', limit))
             
             results = cursor.fetchall()
             conn.close()
@@ -8,6 +8,8 @@ from typing import List, Dict, Optional, Tuple
 from PIL import Image
 import torch
 
+from services.db_migrations import apply_migrations, TRAINING_DATA_MIGRATIONS
+
 logger = logging.getLogger(__name__)
 
 class TrainingDataService:
@@ -81,6 +83,10 @@ class TrainingDataService:
             ''')
             
             conn.commit()
+            
+            # Индексы для выборок по статусу и дате
+            apply_migrations(conn, TRAINING_DATA_MIGRATIONS)
+            
             conn.close()
             logger.info("✅ Таблицы для обучающих данных инициализированы")
             
@@ -0,0 +1,249 @@
+"""
+Контроль допуска к поиску по фото через настоящее приложение Telegram
+
+Приложение собирается так же, как в боте: обновления обрабатываются по одному,
+обработчики фото и выбора отдела - из handlers.photo_handler. Подменяются только
+сетевой транспорт Bot API (ответы сервера Telegram) и сервис поиска, который
+вместо CLIP просто занимает поток пула на заданное время. Пачка фото от разных
+пользователей должна пройти через контроллер допуска: не больше max_concurrent
+поисков одновременно, позиции в очереди сообщаются пользователям, администратор
+обходит очередь, а сверх длины очереди запросы отклоняются. Трасса обновления
+с фото должна содержать спаны этапов неблокирующего обработчика.
+
+Запуск:
+    python -m pytest tests/test_photo_admission.py
+    python -m unittest tests.test_photo_admission
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+# Корень проекта: обработчики импортируются как handlers.*
+project_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if project_dir not in sys.path:
+    sys.path.insert(0, project_dir)
+
+try:
+    from telegram import Update
+    from telegram.ext import Application, MessageHandler, filters
+    from telegram.request import BaseRequest
+except ImportError:
+    BaseRequest = object
+    TELEGRAM_AVAILABLE = False
+else:
+    TELEGRAM_AVAILABLE = True
+
+SEARCH_SECONDS = 0.3
+ADMIN_ID = 1000
+
+
+class FakeBotApi(BaseRequest):
+    """Транспорт Bot API: отвечает как сервер Telegram и записывает отправленные тексты"""
+
+    def __init__(self):
+        self.texts = []
+        self._message_id = 0
+
+    @property
+    def read_timeout(self):
+        return None
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None,
+                         write_timeout=None, connect_timeout=None, pool_timeout=None):
+        if '/file/bot' in url:
+            return 200, b'not an image'
+
+        api_method = url.rsplit('/', 1)[-1]
+        params = request_data.parameters if request_data else {}
+        if api_method == 'getMe':
+            result = {'id': 1, 'is_bot': True, 'first_name': 'Test', 'username': 'test_bot'}
+        elif api_method == 'getFile':
+            result = {'file_id': params['file_id'], 'file_unique_id': params['file_id'],
+                      'file_path': f"photos/{params['file_id']}.jpg"}
+        else:
+            chat_id = int(params.get('chat_id', 0))
+            self.texts.append((chat_id, params.get('text', '')))
+            self._message_id += 1
+            result = {'message_id': self._message_id, 'date': int(time.time()),
+                      'chat': {'id': chat_id, 'type': 'private'}, 'text': params.get('text', '')}
+        return 200, json.dumps({'ok': True, 'result': result}).encode()
+
+    def texts_for(self, chat_id):
+        return [text for chat, text in self.texts if chat == chat_id]
+
+
+class SlowSearchService:
+    """Сервис поиска, занимающий поток пула вместо CLIP"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.active = 0
+        self.max_active = 0
+        self.started = []
+
+    def get_index_version(self):
+        return 'test'
+
+    def get_department_stats(self):
+        return {}
+
+    def search_with_multiple_thresholds_by_department(self, photo_path, department=None, top_k=5, degraded=False):
+        from toolbot.utils.latency_sketch import stage_timer, STAGE_EMBED
+
+        with self._lock:
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+            self.started.append(os.path.basename(photo_path).split('.')[0])
+        with stage_timer(STAGE_EMBED):
+            time.sleep(SEARCH_SECONDS)
+        with self._lock:
+            self.active -= 1
+        return []
+
+
+def make_update(update_id, user_id, text=None, photo=False):
+    """Обновление с сообщением пользователя в личном чате"""
+    message = {
+        'message_id': update_id,
+        'date': int(time.time()),
+        'chat': {'id': user_id, 'type': 'private'},
+        'from': {'id': user_id, 'is_bot': False, 'first_name': f'user{user_id}'},
+    }
+    if text is not None:
+        message['text'] = text
+    if photo:
+        message['photo'] = [{'file_id': f'photo{user_id}', 'file_unique_id': f'u{user_id}',
+                             'width': 100, 'height': 100}]
+    return {'update_id': update_id, 'message': message}
+
+
+@unittest.skipUnless(TELEGRAM_AVAILABLE, "python-telegram-bot не установлен")
+class PhotoAdmissionTest(unittest.TestCase):
+    """Пачка фото от разных пользователей проходит через контроллер допуска"""
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        # Обработчик сохраняет фото в temp/ относительно текущей папки
+        cwd = os.getcwd()
+        os.chdir(tmp.name)
+        self.addCleanup(os.chdir, cwd)
+
+    def run_burst(self, photo_handler, users, controller, traced=False):
+        from handlers import photo_handler as handlers_module
+
+        api = FakeBotApi()
+        service = SlowSearchService()
+        builder = (Application.builder()
+                   .token('123:TEST')
+                   .request(api)
+                   .get_updates_request(FakeBotApi()))
+        if traced:
+            # Как в боте: трасса на каждое обновление
+            from toolbot.utils.update_tracing import TracingApplication, TracingUpdateProcessor
+            builder = builder.application_class(TracingApplication).concurrent_updates(TracingUpdateProcessor(1))
+        else:
+            builder = builder.concurrent_updates(1)
+        application = builder.build()
+        application.add_handler(photo_handler)
+        application.add_handler(MessageHandler(filters.Regex("^🔍 Поиск по всем отделам$"),
+                                               handlers_module.department_selection_handler))
+
+        async def burst():
+            async with application:
+                await application.start()
+                # Обновления идут через очередь приложения, как из getUpdates
+                update_id = 0
+                for user_id in users:
+                    update_id += 1
+                    await application.update_queue.put(Update.de_json(
+                        make_update(update_id, user_id, text="🔍 Поиск по всем отделам"), application.bot))
+                for user_id in users:
+                    update_id += 1
+                    await application.update_queue.put(Update.de_json(
+                        make_update(update_id, user_id, photo=True), application.bot))
+                await application.update_queue.join()
+                # stop() дожидается неблокирующих обработчиков
+                await application.stop()
+                # и уведомлений о позиции в очереди
+                pending = asyncio.all_tasks() - {asyncio.current_task()}
+                await asyncio.gather(*pending, return_exceptions=True)
+
+        with mock.patch.object(handlers_module, 'get_department_search_service', return_value=service), \
+                mock.patch.object(handlers_module, 'get_stats_service', return_value=None), \
+                mock.patch('handlers.admin_training_handler.is_admin', lambda user_id: user_id == ADMIN_ID), \
+                mock.patch('services.admission_control._admission_controller', controller), \
+                mock.patch('services.search_result_cache._result_cache', None):
+            asyncio.run(burst())
+        return api, service
+
+    def test_burst_is_queued(self):
+        from handlers.photo_handler import create_photo_handler
+        from services.admission_control import AdmissionController
+
+        controller = AdmissionController(max_concurrent=2, max_queue=3, slo=60.0)
+        users = [1, 2, 3, 4, 5, 6, ADMIN_ID]
+        api, service = self.run_burst(create_photo_handler(), users, controller)
+
+        stats = controller.get_stats()
+        self.assertEqual(service.max_active, 2)
+        # Двое ищут, трое ждут, шестой отклонен, администратор проходит в очередь сверх лимита
+        self.assertEqual(stats['max_queue_seen'], 4)
+        self.assertEqual(stats['rejected'], 1)
+        self.assertEqual(stats['admitted'], 6)
+        self.assertEqual(stats['active'], 0)
+        self.assertEqual(stats['queued'], 0)
+
+        # Администратор пришел последним, но начал поиск раньше ожидавших пользователей
+        self.assertEqual(service.started[:3], ['photo1', 'photo2', f'photo{ADMIN_ID}'])
+
+        self.assertTrue(any('вы в очереди: 1' in text for text in api.texts_for(3)))
+        self.assertTrue(any('вы в очереди: 3' in text for text in api.texts_for(5)))
+        self.assertTrue(any('слишком много запросов' in text for text in api.texts_for(6)))
+        self.assertFalse(any('слишком много запросов' in text for text in api.texts_for(5)))
+
+    def test_blocking_handler_serializes_searches(self):
+        from handlers.photo_handler import handle_photo
+        from services.admission_control import AdmissionController
+
+        # Прежняя регистрация: приложение ждет каждый поиск, очередь контроллера не возникает
+        controller = AdmissionController(max_concurrent=2, max_queue=3, slo=60.0)
+        api, service = self.run_burst(MessageHandler(filters.PHOTO, handle_photo), [1, 2, 3, 4], controller)
+
+        self.assertEqual(service.max_active, 1)
+        self.assertEqual(controller.get_stats()['max_queue_seen'], 0)
+
+    def test_photo_trace_contains_stage_spans(self):
+        from handlers.photo_handler import create_photo_handler
+        from services.admission_control import AdmissionController
+        from toolbot.utils.tracing import Tracer
+
+        tracer = Tracer()
+        controller = AdmissionController(max_concurrent=2, max_queue=3, slo=60.0)
+        with mock.patch('toolbot.utils.tracing._tracer', tracer):
+            self.run_burst(create_photo_handler(), [1], controller, traced=True)
+
+        traces = [trace for trace in tracer.get_recent() if trace['name'] == 'update photo']
+        self.assertEqual(len(traces), 1)
+        trace = traces[0]
+        names = [span['name'] for span in trace['spans']]
+        # Обработчик фото неблокирующий, но его этапы остаются в трассе обновления
+        for name in ('download', 'department_search', 'embed'):
+            self.assertIn(name, names)
+        self.assertGreaterEqual(trace['duration_ms'], SEARCH_SECONDS * 1000)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,110 @@
+"""
+Регрессионная проверка планов запросов админ-экранов
+
+Схемы создаются самими сервисами во временной папке (с применением миграций),
+затем вызываются методы админ-экранов. Все выполненные ими SELECT перехватываются
+через trace callback SQLite, поэтому проверяются ровно те запросы, что есть в
+коде сервисов. Тест падает, если план запроса содержит полное сканирование
+таблицы без индекса.
+
+Запуск:
+    python -m pytest tests/test_query_plans.py
+    python -m unittest tests.test_query_plans
+"""
+import os
+import sys
+import sqlite3
+import tempfile
+import unittest
+from contextlib import contextmanager
+from unittest import mock
+
+# Корень проекта: сервисы импортируются как services.*
+project_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if project_dir not in sys.path:
+    sys.path.insert(0, project_dir)
+
+from services.db_migrations import find_full_scans
+
+
+@contextmanager
+def capture_selects():
+    """Собирает SELECT всех соединений, открытых через sqlite3.connect внутри блока"""
+    queries = []
+    connect = sqlite3.connect
+
+    def record(statement):
+        if statement.lstrip().upper().startswith('SELECT'):
+            queries.append(statement)
+
+    def traced_connect(*args, **kwargs):
+        conn = connect(*args, **kwargs)
+        conn.set_trace_callback(record)
+        return conn
+
+    with mock.patch('sqlite3.connect', traced_connect):
+        yield queries
+
+
+class AdminQueryPlansTest(unittest.TestCase):
+    """Запросы админ-экранов не должны сканировать таблицы целиком"""
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+
+    def assert_no_full_scans(self, db_path, calls):
+        with capture_selects() as queries:
+            for call in calls:
+                call()
+        self.assertTrue(queries, "Методы сервиса не выполнили ни одного запроса")
+
+        # Trace callback отдает SQL с подставленными параметрами
+        with sqlite3.connect(db_path) as conn:
+            offenders = find_full_scans(conn, [(query, ()) for query in dict.fromkeys(queries)])
+        report = "\n".join(f"{item['query']}\n    {item['plan']}" for item in offenders)
+        self.assertEqual(offenders, [], f"Полное сканирование таблицы:\n{report}")
+
+    def test_search_statistics(self):
+        from services.search_statistics import SearchStatisticsService
+
+        db_path = os.path.join(self.tmp.name, 'search_stats.db')
+        service = SearchStatisticsService(db_path)
+        self.assert_no_full_scans(db_path, [
+            service.get_failed_searches_stats,
+            service.get_search_success_rate,
+            service.get_recent_failed_searches,
+        ])
+
+    def test_feedback(self):
+        from services.feedback_database import FeedbackDatabaseService
+
+        db_path = os.path.join(self.tmp.name, 'feedback.db')
+        service = FeedbackDatabaseService(db_path)
+        self.assert_no_full_scans(db_path, [
+            lambda: service.get_error_reports(status='новый'),
+            service.get_error_reports,
+            lambda: service.get_improvement_suggestions(status='новый'),
+            service.get_improvement_suggestions,
+            service.get_statistics,
+        ])
+
+    def test_training_data(self):
+        try:
+            from services.training_data_service import TrainingDataService
+        except ImportError as e:
+            self.skipTest(f"Зависимости сервиса обучающих данных не установлены: {e}")
+
+        db_path = os.path.join(self.tmp.name, 'search_stats.db')
+        service = TrainingDataService(db_path)
+        self.assert_no_full_scans(db_path, [
+            lambda: service.get_training_examples(is_used=False),
+            lambda: service.get_training_examples(feedback_type='correct'),
+            service.get_training_examples,
+            service.get_training_statistics,
+            service.get_pending_new_products,
+        ])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -2,10 +2,12 @@
 Модуль для работы с конфигурацией бота.
 Обеспечивает загрузку и шифрование конфигурационных данных.
 """
+import copy
 import json
 import logging
 import os
 import threading
+import time
 from typing import Dict, List, Any, Optional, Tuple
 from cryptography.fernet import Fernet
 from dotenv import load_dotenv
@@ -17,6 +19,30 @@ load_dotenv()
 logger = logging.getLogger(__name__)
 
 
+class ConfigSnapshot:
+    """
+    Неизменяемый снимок расшифрованной конфигурации.
+    Множества администраторов и разрешенных пользователей вычисляются один раз
+    при построении снимка, поэтому проверки доступа выполняются за O(1).
+    """
+    
+    __slots__ = ('data', 'mtime', 'admin_ids', 'allowed_ids')
+    
+    def __init__(self, data: Dict, mtime: Optional[int]):
+        """
+        Args:
+            data: Расшифрованная конфигурация с примененными переменными окружения
+            mtime: Время модификации файла конфигурации (ns), из которого построен снимок
+        """
+        self.data = data
+        self.mtime = mtime
+        # Для совместимости учитываем все ключи, под которыми хранятся администраторы
+        self.admin_ids = frozenset(
+            data.get('admin_ids', []) + data.get('admin_users', []) + data.get('admins', [])
+        )
+        self.allowed_ids = frozenset(data.get('whitelist', [])) | self.admin_ids
+
+
 class ConfigManager:
     """
     Менеджер конфигурации для работы с настройками бота.
@@ -36,6 +62,9 @@ class ConfigManager:
     DEFAULT_TYPE_BONUS = 1.5
     DEFAULT_BRAND_TYPE_BONUS = 2.5
     
+    # Как часто (в секундах) проверять время модификации файла конфигурации
+    RELOAD_CHECK_INTERVAL = 5.0
+    
     @classmethod
     def get_instance(cls):
         """
@@ -54,12 +83,20 @@ class ConfigManager:
         """
         Инициализация менеджера конфигурации.
         """
-        self.config = None
+        self._snapshot: Optional[ConfigSnapshot] = None
+        self._next_check = 0.0
+        self._reload_lock = threading.Lock()
         self.config_path = os.environ.get('CONFIG_PATH', 'config.encrypted')
         self.key_path = os.environ.get('KEY_PATH', 'key.key')
         self.fernet = None
         self.load_key()
     
+    @property
+    def config(self) -> Optional[Dict]:
+        """Текущая конфигурация из снимка (None если еще не загружена)"""
+        snapshot = self._snapshot
+        return snapshot.data if snapshot else None
+    
     def load_key(self) -> bool:
         """
         Загрузка ключа шифрования
@@ -127,11 +164,15 @@ class ConfigManager:
         try:
             encrypted_data = self.fernet.encrypt(json.dumps(config_data).encode())
             
-            with open(self.config_path, "wb") as config_file:
+            # Пишем во временный файл и атомарно подменяем, чтобы параллельная
+            # перезагрузка никогда не прочитала частично записанный файл
+            tmp_path = f"{self.config_path}.tmp"
+            with open(tmp_path, "wb") as config_file:
                 config_file.write(encrypted_data)
+            os.replace(tmp_path, self.config_path)
                 
             # Обновляем кэш
-            self.config = config_data
+            self._snapshot = ConfigSnapshot(config_data, self._get_mtime())
                 
             logger.info("Конфигурация успешно зашифрована и сохранена")
             return True
@@ -139,20 +180,56 @@ class ConfigManager:
             logger.error(f"Ошибка при шифровании конфигурации: {e}")
             return False
     
-    def load_config(self, force_reload: bool = False) -> Optional[Dict]:
+    def _get_mtime(self) -> Optional[int]:
+        """Время модификации файла конфигурации или None, если файла нет"""
+        try:
+            return os.stat(self.config_path).st_mtime_ns
+        except OSError:
+            return None
+    
+    def get_snapshot(self, force_reload: bool = False) -> Optional[ConfigSnapshot]:
         """
-        Загружает конфигурацию из зашифрованного файла или переменных окружения
+        Возвращает актуальный снимок конфигурации
+        
+        Быстрый путь не берет блокировок и не обращается к диску: файл проверяется
+        не чаще раза в RELOAD_CHECK_INTERVAL секунд, расшифровка выполняется
+        только если изменилось время модификации файла.
         
         Args:
             force_reload: Принудительная перезагрузка конфигурации из файла
             
         Returns:
-            Данные конфигурации или None в случае ошибки
-        """
-        # Если конфигурация уже загружена и не требуется перезагрузка
-        if self.config is not None and not force_reload:
-            return self.config
+            Снимок конфигурации или None, если конфигурация еще ни разу не загружалась
+        """
+        snapshot = self._snapshot
+        if snapshot is not None and not force_reload:
+            now = time.monotonic()
+            if now < self._next_check:
+                return snapshot
+            self._next_check = now + self.RELOAD_CHECK_INTERVAL
+            if self._get_mtime() == snapshot.mtime:
+                return snapshot
+        
+        with self._reload_lock:
+            # Пока ждали блокировку, снимок мог обновить другой поток
+            current = self._snapshot
+            if current is not None and current is not snapshot and not force_reload:
+                return current
             
+            reloaded = self._read_snapshot()
+            if reloaded is not None:
+                self._snapshot = reloaded
+                self._next_check = time.monotonic() + self.RELOAD_CHECK_INTERVAL
+            # При ошибке перезагрузки продолжаем работать со старым снимком
+            return self._snapshot
+    
+    def _read_snapshot(self) -> Optional[ConfigSnapshot]:
+        """
+        Читает и расшифровывает файл конфигурации
+        
+        Returns:
+            Новый снимок или None в случае ошибки
+        """
         try:
             # Если нет ключа шифрования
             if not self.fernet:
@@ -161,7 +238,8 @@ class ConfigManager:
                     return None
             
             # Проверяем наличие файла конфигурации
-            if not os.path.exists(self.config_path):
+            mtime = self._get_mtime()
+            if mtime is None:
                 logger.error(f"Файл конфигурации не найден: {self.config_path}")
                 return None
                 
@@ -178,14 +256,24 @@ class ConfigManager:
 
             logger.info("✅ Конфигурация успешно загружена")
             
-            # Сохраняем в кэш
-            self.config = config
-            
-            return config
+            return ConfigSnapshot(config, mtime)
         except Exception as e:
             logger.error(f"❌ Ошибка при загрузке конфигурации: {e}")
             return None
     
+    def load_config(self, force_reload: bool = False) -> Optional[Dict]:
+        """
+        Загружает конфигурацию из зашифрованного файла или переменных окружения
+        
+        Args:
+            force_reload: Принудительная перезагрузка конфигурации из файла
+            
+        Returns:
+            Данные конфигурации или None в случае ошибки
+        """
+        snapshot = self.get_snapshot(force_reload)
+        return snapshot.data if snapshot else None
+    
     def _override_from_env(self, config: Dict) -> Dict:
         """
         Переопределяет значения конфигурации из переменных окружения
@@ -253,16 +341,8 @@ class ConfigManager:
             True если пользователь разрешен, иначе False
         """
         # ЗАКОММЕНТИРОВАНО: Проверка доступа отключена - все пользователи могут использовать бота
-        # config = self.load_config()
-        # if not config:
-        #     return False
-        #     
-        # whitelist = config.get('whitelist', [])
-        # 
-        # # Проверяем также, является ли пользователь администратором
-        # admin_ids = config.get('admin_ids', [])
-        # 
-        # return user_id in whitelist or user_id in admin_ids
+        # snapshot = self.get_snapshot()
+        # return snapshot is not None and user_id in snapshot.allowed_ids
         
         # Разрешаем доступ всем пользователям
         return True
@@ -277,22 +357,9 @@ class ConfigManager:
         Returns:
             True если пользователь админ, иначе False
         """
-        config = self.load_config()
-        if not config:
-            return False
-            
-        # Проверяем все возможные ключи для администраторов
-        admin_ids = config.get('admin_ids', [])
-        admin_users = config.get('admin_users', [])
-        admins = config.get('admins', [])
-        
-        # Объединяем все списки для проверки
-        all_admins = set(admin_ids + admin_users + admins)
-        
-        # Логируем результат проверки (в режиме отладки)
-        logger.debug(f"Проверка админ-доступа в ConfigManager: user_id={user_id}, admin_ids={admin_ids}, admin_users={admin_users}, admins={admins}")
-        
-        return user_id in all_admins
+        # Множество администраторов (admin_ids, admin_users, admins) уже собрано в снимке
+        snapshot = self.get_snapshot()
+        return snapshot is not None and user_id in snapshot.admin_ids
     
     def add_user_to_whitelist(self, user_id: int) -> bool:
         """
@@ -304,7 +371,8 @@ class ConfigManager:
         Returns:
             True если пользователь успешно добавлен, иначе False
         """
-        config = self.load_config()
+        # Изменяем копию, чтобы текущий снимок оставался согласованным
+        config = copy.deepcopy(self.load_config())
         if not config:
             return False
             
@@ -328,7 +396,8 @@ class ConfigManager:
         Returns:
             True если пользователь успешно удален, иначе False
         """
-        config = self.load_config()
+        # Изменяем копию, чтобы текущий снимок оставался согласованным
+        config = copy.deepcopy(self.load_config())
         if not config:
             return False
             
@@ -352,7 +421,8 @@ class ConfigManager:
         Returns:
             True если пользователь успешно добавлен в админы, иначе False
         """
-        config = self.load_config()
+        # Изменяем копию, чтобы текущий снимок оставался согласованным
+        config = copy.deepcopy(self.load_config())
         if not config:
             return False
             
@@ -480,8 +550,9 @@ def encrypt_config(config_data):
 def load_config(encrypted_file=None):
     """Загружает конфигурацию из зашифрованного файла"""
     cm = _get_config_manager()
-    if encrypted_file:
+    if encrypted_file and encrypted_file != cm.config_path:
         cm.config_path = encrypted_file
+        return cm.load_config(force_reload=True)
     return cm.load_config()
 
 
@@ -780,7 +780,10 @@ async def active_users_handler(update: Update, context: ContextTypes.DEFAULT_TYP
     try:
         import datetime
         
-        recent_users = analytics.get_recent_users(days=7)
+        # Индекс отдает только 20 последних активных и их общее количество,
+        # без прохода и сортировки всех пользователей
+        recent_users = analytics.get_most_recent_users(20, days=7)
+        active_count = analytics.count_active_users(days=7)
         
         if not recent_users:
             await update.message.reply_text("📈 Активных пользователей за последние 7 дней не найдено.")
@@ -788,7 +791,7 @@ async def active_users_handler(update: Update, context: ContextTypes.DEFAULT_TYP
         
         message = "*📈 Активные пользователи (последние 7 дней)*\n\n"
         
-        for i, user_data in enumerate(recent_users[:20], 1):  # Топ-20
+        for i, user_data in enumerate(recent_users, 1):  # Топ-20
             try:
                 user_id_val = user_data.get("user_id", 0)
                 last_seen = user_data.get("last_seen", 0)
@@ -811,8 +814,8 @@ async def active_users_handler(update: Update, context: ContextTypes.DEFAULT_TYP
                 logger.warning(f"Ошибка при обработке пользователя {i}: {e}")
                 continue
         
-        if len(recent_users) > 20:
-            message += f"*...и ещё {len(recent_users) - 20} пользователей*"
+        if active_count > 20:
+            message += f"*...и ещё {active_count - 20} пользователей*"
         
         await update.message.reply_text(
             message,
@@ -848,52 +851,24 @@ async def all_users_handler(update: Update, context: ContextTypes.DEFAULT_TYPE)
         import datetime
         import time
         
-        stats = analytics.get_stats()
-        if not stats:
-            await update.message.reply_text("📋 Статистика не найдена.")
-            return
-            
-        users = stats.get("users", {})
+        total_users = analytics.get_user_count()
         
-        if not users:
+        if not total_users:
             await update.message.reply_text("📋 Пользователей в базе данных не найдено.")
             return
         
-        # Сортируем пользователей по времени последней активности
-        user_list = []
-        for user_id_str, user_data in users.items():
-            try:
-                if not user_data or not isinstance(user_data, dict):
-                    continue
-                    
-                last_seen = user_data.get("last_seen", user_data.get("first_seen", 0))
-                first_seen = user_data.get("first_seen", 0)
-                
-                # Проверяем корректность данных
-                if not isinstance(last_seen, (int, float)) or not isinstance(first_seen, (int, float)):
-                    continue
-                    
-                user_list.append({
-                    "user_id": int(user_id_str),
-                    "last_seen": last_seen,
-                    "total_requests": user_data.get("requests", 0),
-                    "first_seen": first_seen
-                })
-            except (ValueError, TypeError) as e:
-                logger.warning(f"Некорректные данные пользователя {user_id_str}: {e}")
-                continue
+        # Последние 30 по времени активности берутся из индекса за O(k log k)
+        user_list = analytics.get_most_recent_users(30)
         
         if not user_list:
             await update.message.reply_text("📋 Корректных данных пользователей не найдено.")
             return
         
-        user_list.sort(key=lambda x: x["last_seen"], reverse=True)
-        
-        message = f"*📋 Все пользователи ({len(user_list)} чел.)*\n\n"
+        message = f"*📋 Все пользователи ({total_users} чел.)*\n\n"
         
         current_time = time.time()
         
-        for i, user_data in enumerate(user_list[:30], 1):  # Первые 30
+        for i, user_data in enumerate(user_list, 1):  # Первые 30
             try:
                 user_id_val = user_data["user_id"]
                 last_seen = user_data["last_seen"]
@@ -925,8 +900,8 @@ async def all_users_handler(update: Update, context: ContextTypes.DEFAULT_TYPE)
                 logger.warning(f"Ошибка при обработке пользователя {i}: {e}")
                 continue
         
-        if len(user_list) > 30:
-            message += f"*...и ещё {len(user_list) - 30} пользователей*\n\n"
+        if total_users > 30:
+            message += f"*...и ещё {total_users - 30} пользователей*\n\n"
         
         message += "💡 _Для детальной информации используйте 'Поиск по ID'_"
         
@@ -994,13 +969,16 @@ async def activity_stats_handler(update: Update, context: ContextTypes.DEFAULT_T
         unique_users = summary.get("unique_users", 0)
         active_today = summary.get("active_today", 0)
         active_week = summary.get("active_week", 0)
+        active_hour = summary.get("active_hour", 0)
         
         message = "*📊 Общая статистика активности*\n\n"
         message += f"⏱ *Время работы:* {uptime_days:.1f} дней\n"
         message += f"📞 *Всего запросов:* {total_requests}\n"
         message += f"👥 *Уникальных пользователей:* {unique_users}\n"
+        message += f"⚡ *Активны за час:* {active_hour}\n"
         message += f"🟢 *Активны сегодня:* {active_today}\n"
-        message += f"📅 *Активны за неделю:* {active_week}\n\n"
+        message += f"📅 *Активны за неделю:* {active_week}\n"
+        message += f"🗓 *Уникальных за 30 дней:* ~{summary.get('unique_month', 0)}\n\n"
         
         # Топ команд
         top_commands = summary.get("top_commands", [])
@@ -1021,7 +999,14 @@ async def activity_stats_handler(update: Update, context: ContextTypes.DEFAULT_T
                 message += f"📸 *Поиск по фото:*\n"
                 message += f"   Всего поисков: {total_photo}\n"
                 message += f"   Успешных: {success_photo}\n"
-                message += f"   Успешность: {success_rate:.1f}%%\n"
+                message += f"   Успешность: {success_rate:.1f}%%\n\n"
+        
+        # Популярные отделы за неделю по дневным счетчикам
+        top_departments = summary.get("top_departments_week", [])
+        if top_departments:
+            message += "*🏬 Отделы за неделю:*\n"
+            for i, (department, count) in enumerate(top_departments, 1):
+                message += f"{i}. {department} - {count}\n"
         
         await update.message.reply_text(
             message,
@@ -1122,8 +1107,9 @@ async def update_databases_handler(update: Update, context: ContextTypes.DEFAULT
             status_info += f"❌ *CSV экспорт:* Файл не найден\n\n"
         
         status_info += "💡 *Примечание:* Основная база данных (SQLite) обновляется автоматически.\n"
-        status_info += "TXT и CSV файлы можно пересоздать при необходимости."
-        
+        status_info += "TXT и CSV файлы можно пересоздать при необходимости.\n"
+        status_info += "Массовая загрузка каталога: `python -m services.catalog_importer <файл.csv|xlsx>`"
+
         # Обновляем сообщение
         await status_message.edit_text(
             status_info,
@@ -1170,6 +1156,7 @@ async def realtime_monitoring_handler(update: Update, context: ContextTypes.DEFA
         ["📊 Дашборд системы", "👥 Активные пользователи"],
         ["⚡ Производительность", "🚨 Алерты и уведомления"],
         ["📈 История метрик", "⚙️ Настройки мониторинга"],
+        ["🐌 Блокировки цикла", "🐢 Медленные запросы"],
         ["🔙 Назад в админ-панель"]
     ]
     reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
@@ -1182,7 +1169,9 @@ async def realtime_monitoring_handler(update: Update, context: ContextTypes.DEFA
         "• ⚡ Производительность - скорость обработки запросов\n"
         "• 🚨 Алерты - критические состояния системы\n"
         "• 📈 История метрик - графики за последние часы\n"
-        "• ⚙️ Настройки - пороговые значения алертов\n\n"
+        "• ⚙️ Настройки - пороговые значения алертов\n"
+        "• 🐌 Блокировки цикла - обработчики, которые тормозят бота\n"
+        "• 🐢 Медленные запросы - трассы самых долгих запросов по этапам\n\n"
         "💡 _Данные обновляются каждые 5 секунд_",
         reply_markup=reply_markup,
         parse_mode='Markdown'
@@ -1264,6 +1253,22 @@ async def system_dashboard_handler(update: Update, context: ContextTypes.DEFAULT
         message += f"{disk_emoji} *Диск:* {disk_usage:.1f}%%\n"
         message += f"   Свободно: {disk.get('free_gb', 0):.1f} / {disk.get('total_gb', 0):.1f} ГБ\n\n"
         
+        # Процесс бота
+        process = system.get('process')
+        if process:
+            message += f"🤖 *Процесс:* RSS {process.get('rss_mb', 0):.0f} МБ, потоков {process.get('threads', '?')}"
+            if process.get('open_fds') is not None:
+                message += f", файлов {process['open_fds']}"
+            if process.get('torch_threads') is not None:
+                message += f", torch {process['torch_threads']}"
+            message += "\n"
+        
+        event_loop = system.get('event_loop', {})
+        if event_loop.get('attached'):
+            lag_emoji = "🔥" if event_loop.get('max_lag_ms', 0) > 500 else "⚠️" if event_loop.get('max_lag_ms', 0) > 100 else "✅"
+            message += f"{lag_emoji} *Задержка цикла событий:* {event_loop.get('lag_ms', 0):.0f}мс (макс. {event_loop.get('max_lag_ms', 0):.0f}мс)\n"
+        message += "\n"
+        
         # Активность пользователей
         activity = dashboard_data['activity']
         message += f"👥 *Активные пользователи:* {activity['active_now']}\n"
@@ -1451,6 +1456,7 @@ async def performance_monitoring_handler(update: Update, context: ContextTypes.D
             success_emoji = "🔥" if success_rate < 90 else "⚠️" if success_rate < 95 else "✅"
             
             message += f"{time_emoji} *Среднее время ответа:* {avg_time:.1f}мс\n"
+            message += f"⏱ *p95 / p99:* {performance_stats.get('p95_response_time_ms', 0):.1f} / {performance_stats.get('p99_response_time_ms', 0):.1f}мс\n"
             message += f"{success_emoji} *Успешность:* {success_rate:.1f}%%\n"
             message += f"📊 *Всего запросов:* {total_requests:,}\n"
             message += f"❌ *Ошибок:* {total_errors}\n\n"
@@ -1467,6 +1473,24 @@ async def performance_monitoring_handler(update: Update, context: ContextTypes.D
                     message += f"{model_emoji} {model_name}:\n"
                     message += f"   ↳ {avg_inference:.1f}мс (запусков: {total_runs})\n"
                 message += "\n"
+            
+            # Задержки по этапам конвейера поиска
+            stages = performance_stats.get('stages', {})
+            if stages:
+                from toolbot.utils.latency_sketch import PIPELINE_STAGES, STAGE_TITLES
+                bottleneck = performance_stats.get('bottleneck_stage')
+                message += "*⏱ Этапы поиска (p50 / p95 / p99):*\n"
+                ordered = [stage for stage in PIPELINE_STAGES if stage in stages]
+                ordered += [stage for stage in stages if stage not in PIPELINE_STAGES]
+                for stage in ordered:
+                    stats = stages[stage]
+                    marker = "🐢" if stage == bottleneck else "•"
+                    message += (f"{marker} {STAGE_TITLES.get(stage, stage)}: "
+                                f"{stats['p50_ms']:.0f} / {stats['p95_ms']:.0f} / {stats['p99_ms']:.0f}мс "
+                                f"({stats['share_percent']:.0f}%% времени)\n")
+                if bottleneck:
+                    message += f"🎯 Оптимизировать в первую очередь: {STAGE_TITLES.get(bottleneck, bottleneck)}\n"
+                message += "\n"
         
         # GPU метрики (если доступно)
         gpu_data = system_metrics.get('gpu')
@@ -1544,6 +1568,105 @@ async def performance_monitoring_handler(update: Update, context: ContextTypes.D
         )
 
 
+async def event_loop_stalls_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    Показывает худших виновников блокировок цикла событий
+    """
+    user_id = update.effective_user.id
+    
+    if not is_admin(user_id):
+        await update.message.reply_text("⛔ Доступ запрещен")
+        return
+
+    try:
+        from toolbot.utils.loop_monitor import get_loop_monitor
+        
+        stats = get_loop_monitor().get_stats()
+        
+        message = "*🐌 Блокировки цикла событий*\n\n"
+        if not stats['attached']:
+            message += "⚠️ Наблюдение за циклом событий не запущено"
+            await update.message.reply_text(message, parse_mode='Markdown')
+            return
+        
+        message += f"• Порог: {stats['threshold_ms']:.0f}мс\n"
+        message += f"• Задержка сейчас: {stats['lag_ms']:.0f}мс (макс. {stats['max_lag_ms']:.0f}мс)\n"
+        message += f"• Блокировок: {stats['stalls_total']} (всего {stats['stall_time_ms'] / 1000:.1f}с)\n\n"
+        
+        offenders = stats['top_offenders']
+        if offenders:
+            message += "*🔥 Худшие обработчики (по суммарному времени):*\n"
+            for i, item in enumerate(offenders, 1):
+                message += (f"{i}. `{item['handler']}` (`{item['update_type']}`)\n"
+                            f"   ↳ {item['count']} раз, всего {item['total_ms']:.0f}мс, макс. {item['max_ms']:.0f}мс\n")
+                if item.get('site'):
+                    message += f"   ↳ `{item['site']}`\n"
+        else:
+            message += "✅ Блокировок не обнаружено\n"
+        
+        slow_callbacks = stats['slow_callbacks']
+        if slow_callbacks:
+            message += "\n*🐢 Медленные обратные вызовы asyncio:*\n"
+            for item in slow_callbacks:
+                message += f"• `{item['name']}`: {item['count']} раз, макс. {item['max_ms']:.0f}мс\n"
+        elif not stats['debug']:
+            message += "\n💡 _Отчет asyncio о медленных вызовах включается через LOOP\\_DEBUG=1_"
+        
+        await update.message.reply_text(message, parse_mode='Markdown')
+        
+    except Exception as e:
+        logger.error(f"Ошибка при получении блокировок цикла событий: {e}")
+        await update.message.reply_text(
+            f"❌ Ошибка при получении блокировок цикла событий:\n{str(e)}"
+        )
+
+
+async def slowest_traces_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    Показывает самые медленные трассы запросов за последний час с разбивкой по спанам
+    """
+    user_id = update.effective_user.id
+    
+    if not is_admin(user_id):
+        await update.message.reply_text("⛔ Доступ запрещен")
+        return
+
+    try:
+        from toolbot.utils.tracing import get_tracer
+        
+        tracer = get_tracer()
+        traces = tracer.get_slowest(limit=5, seconds=3600)
+        
+        message = "*🐢 Самые медленные запросы за час*\n\n"
+        if not traces:
+            message += "📊 Трасс пока нет - они появятся после первых запросов к боту."
+            await update.message.reply_text(message, parse_mode='Markdown')
+            return
+        
+        for i, trace in enumerate(traces, 1):
+            status_emoji = "❌" if trace['status'] == 'error' else "⏱"
+            started = trace['timestamp'][11:19]
+            message += f"{status_emoji} *{i}. {trace['duration_ms']:.0f}мс* `{trace['name']}` в {started}\n"
+            message += f"   ↳ trace\\_id: `{trace['trace_id'][:16]}`\n"
+            
+            # Вложенные спаны - по убыванию длительности, не больше пяти
+            spans = sorted(trace['spans'][1:], key=lambda span: span['duration_ms'], reverse=True)[:5]
+            for span in spans:
+                marker = "❌" if span['status'] == 'error' else "•"
+                message += f"   {marker} `{span['name']}`: {span['duration_ms']:.0f}мс\n"
+            message += "\n"
+        
+        message += f"📦 В буфере трасс: {len(tracer.traces)} (всего завершено {tracer.finished_total})"
+        
+        await update.message.reply_text(message, parse_mode='Markdown')
+        
+    except Exception as e:
+        logger.error(f"Ошибка при получении медленных трасс: {e}")
+        await update.message.reply_text(
+            f"❌ Ошибка при получении медленных трасс:\n{str(e)}"
+        )
+
+
 async def back_to_monitoring_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """
     Возврат в главное меню мониторинга
@@ -1824,89 +1947,28 @@ async def execute_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE)
             await update.message.reply_text("❌ Данные для рассылки не найдены")
             return
 
-        # Показываем прогресс
+        from toolbot.services.broadcast import BroadcastJob, get_broadcast_manager
+        
+        manager = get_broadcast_manager()
+        if manager.is_running:
+            await update.message.reply_text(
+                "⏳ Предыдущая рассылка еще выполняется, дождитесь ее завершения."
+            )
+            return
+        
+        # Сообщение о ходе рассылки, которое будет обновляться по мере отправки
         progress_message = await update.message.reply_text(
-            f"📤 **Начинаю рассылку...**\n"
+            f"📤 *Начинаю рассылку...*\n"
             f"Всего получателей: {len(user_ids)}\n"
             f"Отправлено: 0/{len(user_ids)}",
             parse_mode='Markdown'
         )
-
-        # Статистика отправки
-        sent_count = 0
-        failed_count = 0
-        blocked_count = 0
-        failed_users = []
-
-        # Отправляем сообщения порциями, чтобы не превысить лимиты Telegram
-        import asyncio
-        for i, target_user_id in enumerate(user_ids):
-            try:
-                # Отправляем сообщение пользователю
-                await context.bot.send_message(
-                    chat_id=target_user_id,
-                    text=broadcast_text,
-                    parse_mode='Markdown'
-                )
-                sent_count += 1
-                
-                # Обновляем прогресс каждые 10 сообщений
-                if (i + 1) % 10 == 0 or i == len(user_ids) - 1:
-                    await progress_message.edit_text(
-                        f"📤 **Выполняется рассылка...**\n"
-                        f"Всего получателей: {len(user_ids)}\n"
-                        f"✅ Отправлено: {sent_count}\n"
-                        f"❌ Ошибок: {failed_count}\n"
-                        f"🚫 Заблокировали бота: {blocked_count}\n"
-                        f"Прогресс: {i+1}/{len(user_ids)} ({((i+1)/len(user_ids)*100):.1f}%)",
-                        parse_mode='Markdown'
-                    )
-                
-                # Пауза между сообщениями, чтобы не превысить лимиты
-                await asyncio.sleep(0.05)  # 50мс между сообщениями
-                
-            except Exception as e:
-                error_str = str(e).lower()
-                if "blocked" in error_str or "bot was blocked" in error_str:
-                    blocked_count += 1
-                else:
-                    failed_count += 1
-                    failed_users.append((target_user_id, str(e)))
-                
-                logger.warning(f"Не удалось отправить сообщение пользователю {target_user_id}: {e}")
-
-        # Финальный отчет
-        success_rate = (sent_count / len(user_ids)) * 100
-        
-        final_report = (
-            f"📊 **Рассылка завершена!**\n\n"
-            f"**Статистика:**\n"
-            f"• Всего пользователей: {len(user_ids)}\n"
-            f"• ✅ Успешно отправлено: {sent_count}\n"
-            f"• 🚫 Заблокировали бота: {blocked_count}\n"
-            f"• ❌ Ошибки отправки: {failed_count}\n"
-            f"• 📈 Успешность: {success_rate:.1f}%\n\n"
-        )
         
-        if failed_users:
-            final_report += f"**Пользователи с ошибками:** {len(failed_users)} чел.\n"
-            if len(failed_users) <= 5:
-                for uid, error in failed_users:
-                    final_report += f"• ID {uid}: {error[:50]}...\n"
-            else:
-                final_report += f"• Первые 5 из {len(failed_users)} ошибок:\n"
-                for uid, error in failed_users[:5]:
-                    final_report += f"  - ID {uid}: {error[:40]}...\n"
-        
-        final_report += f"\n⏰ Время выполнения: ~{len(user_ids) * 0.05:.1f} сек."
-
-        await progress_message.edit_text(final_report, parse_mode='Markdown')
-        
-        # Логируем рассылку
-        analytics = context.bot_data.get('analytics')
-        if analytics:
-            analytics.log_user_activity(user_id, "broadcast_message", 
-                                       f"Отправлено {sent_count}/{len(user_ids)} сообщений")
+        # Рассылка выполняется в фоне: обработчик сразу освобождается,
+        # прогресс сохраняется и продолжится после перезапуска бота
+        job = BroadcastJob(broadcast_text, user_ids, admin_id=user_id, chat_id=update.effective_chat.id)
+        job.progress_message_id = progress_message.message_id
+        manager.start(job, context.application)
 
         # Очищаем состояние
         context.user_data.pop('broadcast_text', None)
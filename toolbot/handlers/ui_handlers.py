@@ -17,7 +17,6 @@ from telebot.types import Message, CallbackQuery, InlineKeyboardMarkup
 from toolbot.services.ui_manager import get_ui_manager
 from toolbot.utils.brand_recognition import get_known_brands
 from toolbot.data.tool_categories import get_tool_categories, get_categories_list
-from toolbot.services.image_search import enhanced_image_search
 
 logger = logging.getLogger(__name__)
 
@@ -152,7 +151,8 @@ def register_ui_handlers(bot: TeleBot):
             time.sleep(1)  # Задержка для демонстрации прогресса
             ui_manager.update_progress(message.chat.id, 60, "Поиск в базе данных...")
             
-            # Выполняем реальный поиск
+            # Выполняем реальный поиск (модуль с transformers и faiss загружается только здесь)
+            from toolbot.services.image_search import enhanced_image_search
             results = enhanced_image_search(file_path, top_n=5)
             
             time.sleep(1)  # Задержка для демонстрации прогресса
@@ -1,15 +1,24 @@
 """
 ToolBot - основной модуль приложения
+
+Тяжелые зависимости (torch, CLIP, pandas, transformers) при импорте модуля не
+загружаются: обработчики импортируют их лениво, а модель поиска и индекс
+товаров прогреваются в фоне после начала опроса Telegram.
+Время импорта проверяет toolbot/scripts/benchmark_startup.py.
 """
+import time
+
+# Отсчет времени запуска до начала опроса
+_PROCESS_START = time.perf_counter()
+
 import os
 import logging
 import asyncio
 import sys
 import traceback
-import importlib.util
-import torch
 from telegram import Update
-from telegram.ext import Application, CommandHandler, MessageHandler, filters, ConversationHandler, CallbackQueryHandler
+from telegram.ext import (Application, CommandHandler, MessageHandler, filters, ConversationHandler, CallbackQueryHandler,
+                          TypeHandler)
 
 # Импортируем модули повышения надежности
 from toolbot.utils.enhanced_logging import setup_logging, LogLevel, LogFormat, get_logger
@@ -19,6 +28,9 @@ from toolbot.utils.recovery import RecoveryManager, ComponentState, register_com
 # Импортируем модуль совместимости telebot
 from toolbot.utils.telebot_compatibility import create_telebot
 
+# Трассировка обновлений, включая неблокирующие обработчики
+from toolbot.utils.update_tracing import TracingApplication, TracingUpdateProcessor
+
 # Настройка расширенного логирования
 setup_logging(
     console_level=LogLevel.INFO,
@@ -35,10 +47,6 @@ logger = get_logger(__name__)
 from toolbot.config import load_config
 from toolbot.services.analytics import Analytics
 
-# Импортируем модули технических улучшений
-from toolbot.utils.model_optimizer import get_model_optimizer
-from toolbot.utils.light_models import get_optimized_detector
-
 # Добавляем путь к корневым обработчикам
 import sys
 import os
@@ -59,6 +67,7 @@ from toolbot.handlers.admin import (admin_panel_handler, user_management_handler
                                   update_databases_handler, realtime_monitoring_handler,
                                   system_dashboard_handler, active_users_realtime_handler,
                                   performance_monitoring_handler, back_to_monitoring_handler,
+                                  event_loop_stalls_handler, slowest_traces_handler,
                                   metrics_history_handler, alerts_notifications_handler,
                                   monitoring_settings_handler, broadcast_message_handler,
                                   text_logs_handler, text_logs_statistics_handler,
@@ -80,7 +89,8 @@ from handlers.admin_training_handler import (admin_training_stats_command, admin
 # Используем тестовые обработчики только для навигации  
 # ИСПРАВЛЕНИЕ: Используем правильный photo_handler из корневой директории handlers
 from handlers.photo_handler import (photo_search_handler, department_selection_handler, 
-                                   back_to_departments_handler, handle_photo)
+                                   back_to_departments_handler, handle_photo,
+                                   create_photo_handler)
 from toolbot.handlers.text_handler import text_handler
 # Импортируем обработчики обратной связи
 from toolbot.handlers.feedback_handlers import (report_error_handler, suggest_improvement_handler,
@@ -100,64 +110,6 @@ from toolbot.handlers.reliability_handlers import (
 # Импортируем функцию проверки доступа из utils/access.py
 from toolbot.utils.access import is_allowed_user
 
-# Проверка доступности ONNX Runtime
-def check_onnx_available():
-    """Проверяет доступность ONNX Runtime для оптимизации моделей"""
-    try:
-        import onnxruntime
-        logger.info(f"✅ ONNX Runtime доступен (версия {onnxruntime.__version__})")
-        
-        # Проверяем доступные провайдеры (исполнители)
-        providers = onnxruntime.get_available_providers()
-        logger.info(f"Доступные провайдеры ONNX: {', '.join(providers)}")
-        
-        return True
-    except ImportError:
-        logger.warning("⚠️ ONNX Runtime не установлен. Оптимизация моделей будет ограничена.")
-        return False
-
-# Инициализация моделей
-@error_handler(severity=ErrorSeverity.MEDIUM)
-def initialize_models():
-    """Асинхронная инициализация моделей машинного обучения"""
-    try:
-        logger.info("Начинаем инициализацию оптимизированных моделей...")
-        
-        # Проверяем наличие GPU
-        gpu_available = torch.cuda.is_available()
-        if gpu_available:
-            gpu_name = torch.cuda.get_device_name(0)
-            gpu_memory = torch.cuda.get_device_properties(0).total_memory / (1024**3)
-            logger.info(f"✅ Обнаружен GPU: {gpu_name} ({gpu_memory:.2f} ГБ)")
-            logger.info("🚀 ML-модели будут работать с GPU ускорением!")
-        else:
-            logger.info("⚠️ GPU не обнаружен. Будет использован CPU для вычислений.")
-            logger.info("💡 Для ускорения установите CUDA версию PyTorch:")
-            logger.info("   pip install torch torchvision torchaudio --index-url https://download.pytorch.org/whl/cu118")
-            logger.info("   Или запустите: python check_gpu.py для диагностики")
-        
-        # Проверяем доступность ONNX Runtime
-        onnx_available = check_onnx_available()
-        
-        # Инициализируем легкие модели для обнаружения объектов
-        try:
-            # Загружаем и оптимизируем модели
-            mobilenet_detector = get_optimized_detector("mobilenet")
-            logger.info(f"✅ Модель MobileNetV3 успешно инициализирована")
-            
-            # Инициализация EfficientDet только если доступен ONNX
-            if onnx_available:
-                efficientdet_detector = get_optimized_detector("efficientdet")
-                logger.info(f"✅ Модель EfficientDet-Lite успешно инициализирована")
-        except Exception as e:
-            logger.error(f"❌ Ошибка при инициализации легких моделей: {e}")
-        
-        logger.info("✅ Инициализация моделей завершена")
-        return True
-    except Exception as e:
-        logger.error(f"❌ Критическая ошибка при инициализации моделей: {e}")
-        return False
-
 def register_handlers(application):
     """Регистрация обработчиков команд телеграм-бота"""
     try:
@@ -226,6 +178,8 @@ def register_handlers(application):
         application.add_handler(MessageHandler(filters.Regex("^📊 Дашборд системы$"), system_dashboard_handler))
         application.add_handler(MessageHandler(filters.Regex("^👥 Активные пользователи$"), active_users_realtime_handler))
         application.add_handler(MessageHandler(filters.Regex("^⚡ Производительность$"), performance_monitoring_handler))
+        application.add_handler(MessageHandler(filters.Regex("^🐌 Блокировки цикла$"), event_loop_stalls_handler))
+        application.add_handler(MessageHandler(filters.Regex("^🐢 Медленные запросы$"), slowest_traces_handler))
         application.add_handler(MessageHandler(filters.Regex("^🚨 Алерты и уведомления$"), alerts_notifications_handler))
         application.add_handler(MessageHandler(filters.Regex("^📈 История метрик$"), metrics_history_handler))
         application.add_handler(MessageHandler(filters.Regex("^⚙️ Настройки мониторинга$"), monitoring_settings_handler))
@@ -294,8 +248,9 @@ def register_handlers(application):
         application.add_handler(CommandHandler("admin_view_examples", admin_view_examples_command))
         application.add_handler(CommandHandler("admin_new_products", admin_manage_new_products_command))
         
-        # ИСПРАВЛЕНИЕ: Обработчик фотографий (используем правильный handlers.photo_handler)
-        application.add_handler(MessageHandler(filters.PHOTO, handle_photo))
+        # ИСПРАВЛЕНИЕ: Обработчик фотографий (используем правильный handlers.photo_handler);
+        # не блокирует очередь обновлений, одновременные поиски ограничивает контроллер допуска
+        application.add_handler(create_photo_handler())
         
         # Обработчики для мониторинга надежности
         application.add_handler(CommandHandler("error_stats", error_stats_handler))
@@ -312,6 +267,59 @@ def register_handlers(application):
         raise
 
 
+async def post_init(application: Application) -> None:
+    """Действия после инициализации приложения, уже внутри его цикла событий"""
+    # Обнаружение блокировок цикла с указанием обработчика и типа обновления;
+    # его пульс дает и задержку цикла событий для системных метрик
+    try:
+        from toolbot.utils.loop_monitor import get_loop_monitor
+        loop_monitor = get_loop_monitor()
+        loop_monitor.attach(asyncio.get_running_loop())
+        application.add_handler(TypeHandler(Update, loop_monitor.track_update), group=-1)
+    except Exception as e:
+        logger.warning(f"⚠️ Не удалось включить обнаружение блокировок цикла событий: {e}")
+    
+    # Незавершенная рассылка продолжается с сохраненного места
+    try:
+        from toolbot.services.broadcast import get_broadcast_manager
+        get_broadcast_manager().resume_pending(application)
+    except Exception as e:
+        logger.error(f"❌ Ошибка при возобновлении рассылки: {e}")
+    
+    # Эндпоинт метрик Prometheus и проверок /healthz, /readyz в том же цикле событий
+    from toolbot.services.metrics_server import start_metrics_server
+    await start_metrics_server()
+    
+    # Загрузка CLIP и чтение индекса в фоне: /readyz станет готов по завершении,
+    # а первый запрос пользователя не платит за загрузку модели
+    try:
+        from handlers.photo_handler import start_search_warm_up
+        start_search_warm_up(application)
+    except Exception as e:
+        logger.error(f"❌ Не удалось запустить прогрев поиска: {e}")
+    
+    logger.info(f"🚀 Запуск до начала опроса занял {time.perf_counter() - _PROCESS_START:.2f}с")
+
+
+async def post_stop(application: Application) -> None:
+    """Действия после остановки опроса, пока бот еще может отправлять сообщения"""
+    # Рассылка прерывается, но не завершается: после перезапуска она продолжится
+    try:
+        from toolbot.services.broadcast import get_broadcast_manager
+        await get_broadcast_manager().shutdown()
+    except Exception as e:
+        logger.error(f"❌ Ошибка при остановке рассылки: {e}")
+
+
+async def post_shutdown(application: Application) -> None:
+    """Освобождение ресурсов при остановке приложения"""
+    from toolbot.services.metrics_server import stop_metrics_server
+    await stop_metrics_server()
+    
+    from toolbot.utils.loop_monitor import get_loop_monitor
+    get_loop_monitor().stop()
+
+
 # Функция проверки здоровья телеграм-бота
 def check_bot_health():
     """Проверяет работоспособность бота"""
@@ -418,15 +426,30 @@ def main():
         except Exception as e:
             logger.warning(f"⚠️ Ошибка при запуске мониторинга: {e}")
         
-        # Инициализация моделей для обнаружения объектов
-        initialize_models()
+        # Полнотекстовый индекс товаров создается до начала опроса, а не в первом текстовом поиске
+        try:
+            from services.db_migrations import apply_products_fts_migrations
+            if os.path.exists('data/unified_products.db'):
+                apply_products_fts_migrations('data/unified_products.db')
+        except Exception as e:
+            logger.warning(f"⚠️ Не удалось применить миграции полнотекстового индекса товаров: {e}")
+        
+        # Модели не загружаются здесь: CLIP и индекс товаров прогреваются в фоне из post_init,
+        # детекторы MobileNet/EfficientDet в рабочем пути поиска не используются
         
         # Примечание: Используется UnifiedDatabaseService из handlers/photo_handler.py
         # Старый сервис improved_database_search больше не инициализируется
         logger.info("✅ Используется UnifiedDatabaseService для поиска по изображениям")
         
         # Создаем и настраиваем приложение
-        application = Application.builder().token(config["telegram_token"]).build()
+        application = (Application.builder()
+                       .token(config["telegram_token"])
+                       .application_class(TracingApplication)
+                       .concurrent_updates(TracingUpdateProcessor(1))
+                       .post_init(post_init)
+                       .post_stop(post_stop)
+                       .post_shutdown(post_shutdown)
+                       .build())
         
         # Создаем экземпляр совместимости TeleBot для интеграции с UI компонентами
         telebot_instance = create_telebot(application)
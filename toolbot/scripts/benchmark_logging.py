@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Замер накладных расходов логирования на один запрос поиска.
+
+Имитирует логи одного поиска по фото (начало, этапы, строка на каждого
+кандидата, итог) и измеряет время, которое эти вызовы занимают в потоке
+запроса, для трех режимов: синхронная запись во все обработчики, запись
+через очередь и поток-писатель, очередь с прореживанием болтливой категории.
+
+Запросы приходят с заданным интервалом, как в боте, где между логами одного
+поиска и следующего проходят сотни миллисекунд инференса и сети. Без паузы
+поток-писатель все время дописывает отставшую очередь и отнимает GIL у потока
+запроса, и замер показывает не накладные расходы на запрос, а разбор очереди.
+Отставание писателя видно по наибольшей длине очереди и времени дозаписи.
+
+Пример:
+    python toolbot/scripts/benchmark_logging.py --requests 1000 --interval-ms 20
+"""
+
+import os
+import sys
+import time
+import logging
+import argparse
+import tempfile
+import statistics
+
+# Добавляем корень проекта в sys.path
+script_dir = os.path.dirname(os.path.abspath(__file__))
+project_dir = os.path.dirname(os.path.dirname(script_dir))
+sys.path.insert(0, project_dir)
+
+from toolbot.utils.enhanced_logging import LoggingManager
+
+SEARCH_LOGGER = "services.department_search_service"
+
+
+def parse_args():
+    """
+    Парсинг аргументов командной строки.
+
+    Returns:
+        Объект с аргументами
+    """
+    parser = argparse.ArgumentParser(description="Замер накладных расходов логирования на запрос")
+    parser.add_argument("--requests", type=int, default=500, help="Количество имитируемых запросов")
+    parser.add_argument("--candidates", type=int, default=20, help="Строк лога на кандидатов в одном запросе")
+    parser.add_argument("--interval-ms", type=float, default=20.0,
+                        help="Интервал между запросами (мс); 0 - подряд без пауз")
+    parser.add_argument("--sample-rate", type=float, default=0.1,
+                        help="Доля сохраняемых записей поиска в режиме с прореживанием")
+    return parser.parse_args()
+
+
+def simulate_request(search_logger: logging.Logger, request_id: int, candidates: int) -> None:
+    """Логи одного поиска по фото"""
+    search_logger.info(f"🔍 Начинаем поиск по отделу: 'ИНСТРУМЕНТЫ' (запрос {request_id})")
+    search_logger.info("🎯 Отдел для API поиска: %s", "ИНСТРУМЕНТЫ")
+    for stage in ("download", "decode", "preprocess", "embed", "index_search"):
+        search_logger.debug("⏱ Этап %s завершен за %.1fмс", stage, 12.5)
+    for i in range(candidates):
+        search_logger.info(f"📦 Кандидат {i}: item_{request_id}_{i} сходство {0.9 - i * 0.01:.3f}")
+    search_logger.info(f"✅ Найдено {candidates} товаров")
+
+
+def run_mode(name: str, log_dir: str, args, async_logging: bool, sample_rates=None):
+    """
+    Прогон одного режима.
+
+    Returns:
+        (среднее, p99 времени логирования на запрос в мкс,
+         наибольшая длина очереди, время дозаписи очереди в мс)
+    """
+    manager = LoggingManager(log_dir=os.path.join(log_dir, name), async_logging=async_logging,
+                             sample_rates=sample_rates)
+    search_logger = logging.getLogger(SEARCH_LOGGER)
+    search_logger.setLevel(logging.DEBUG)
+
+    log_queue = manager.log_queue
+    interval = args.interval_ms / 1000.0
+    timings = []
+    max_queue = 0
+    next_request = time.perf_counter()
+    for request_id in range(args.requests):
+        # Ожидание следующего запроса по расписанию
+        delay = next_request - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        next_request += interval
+
+        start = time.perf_counter()
+        simulate_request(search_logger, request_id, args.candidates)
+        timings.append((time.perf_counter() - start) * 1e6)
+        if log_queue is not None:
+            max_queue = max(max_queue, log_queue.qsize())
+
+    # Время, за которое поток-писатель дописывает очередь при остановке
+    drain_start = time.perf_counter()
+    manager.shutdown()
+    drain_ms = (time.perf_counter() - drain_start) * 1000
+
+    timings.sort()
+    return statistics.mean(timings), timings[int(len(timings) * 0.99) - 1], max_queue, drain_ms
+
+
+def main():
+    args = parse_args()
+
+    # Отключаем обработчики, созданные при импорте модуля логирования
+    LoggingManager.get_instance().shutdown()
+
+    # Консольный вывод отправляем в /dev/null, чтобы не засорять отчет
+    real_stdout = sys.stdout
+    results = []
+    with tempfile.TemporaryDirectory() as log_dir, open(os.devnull, "w") as devnull:
+        sys.stdout = devnull
+        try:
+            results.append(("синхронно", *run_mode("sync", log_dir, args, async_logging=False)))
+            results.append(("очередь", *run_mode("async", log_dir, args, async_logging=True)))
+            results.append((f"очередь + прореживание {args.sample_rate}", *run_mode(
+                "sampled", log_dir, args, async_logging=True, sample_rates={SEARCH_LOGGER: args.sample_rate}
+            )))
+        finally:
+            sys.stdout = real_stdout
+
+    lines_per_request = args.candidates + 8
+    print(f"Запросов: {args.requests}, записей лога на запрос: {lines_per_request}, "
+          f"интервал {args.interval_ms:.0f}мс")
+    print(f"{'Режим':<32}{'среднее, мкс':>14}{'p99, мкс':>12}{'макс. очередь':>15}{'дозапись, мс':>15}")
+    for name, mean_us, p99_us, max_queue, drain_ms in results:
+        print(f"{name:<32}{mean_us:>14.1f}{p99_us:>12.1f}{max_queue:>15}{drain_ms:>15.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Замер времени холодного старта: импорт toolbot.main в чистом процессе.
+
+Запускает `python -X importtime -c "import toolbot.main"` несколько раз,
+разбирает отчет интерпретатора о времени импорта и выводит общее время,
+самые дорогие модули и тяжелые пакеты, которые не должны загружаться при
+старте (torch, CLIP, pandas и т.п. загружаются лениво или в фоновом прогреве).
+
+Код возврата 1, если медиана превышает бюджет или при импорте загружен
+запрещенный пакет, поэтому скрипт можно использовать как проверку в CI.
+
+Пример:
+    python toolbot/scripts/benchmark_startup.py --runs 5 --budget-ms 1000
+"""
+
+import os
+import sys
+import json
+import argparse
+import statistics
+import subprocess
+
+# Корень проекта: из него запускается бот
+script_dir = os.path.dirname(os.path.abspath(__file__))
+project_dir = os.path.dirname(os.path.dirname(script_dir))
+
+# Пакеты, которые не должны импортироваться при старте
+HEAVY_MODULES = ["torch", "torchvision", "clip", "transformers", "pandas", "cv2",
+                 "onnxruntime", "faiss", "sklearn"]
+
+IMPORT_CODE = (
+    "import sys, json; import toolbot.main; "
+    "print(json.dumps(sorted(m for m in {heavy!r} if m in sys.modules)))"
+)
+
+
+def parse_args():
+    """
+    Парсинг аргументов командной строки.
+
+    Returns:
+        Объект с аргументами
+    """
+    parser = argparse.ArgumentParser(description="Замер времени импорта toolbot.main")
+    parser.add_argument("--runs", type=int, default=5, help="Количество запусков")
+    parser.add_argument("--budget-ms", type=float, default=1000.0,
+                        help="Бюджет медианного времени импорта, мс")
+    parser.add_argument("--top", type=int, default=15, help="Сколько самых дорогих модулей показать")
+    return parser.parse_args()
+
+
+def parse_importtime(stderr: str):
+    """
+    Разбор отчета -X importtime.
+
+    Строки имеют вид "import time:  self [us] | cumulative | imported package",
+    вложенные импорты отмечены отступом имени.
+
+    Returns:
+        (суммарное время верхнеуровневых импортов в мкс, {модуль: накопленное время в мкс})
+    """
+    total_us = 0
+    cumulative = {}
+    for line in stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        parts = line[len("import time:"):].split("|")
+        if len(parts) != 3:
+            continue
+        try:
+            cumulative_us = int(parts[1])
+        except ValueError:
+            continue  # Строка заголовка
+        name = parts[2].rstrip()
+        module = name.strip()
+        cumulative[module] = max(cumulative.get(module, 0), cumulative_us)
+        # Верхний уровень - имя с одним пробелом после разделителя
+        if len(name) - len(name.lstrip()) == 1:
+            total_us += cumulative_us
+    return total_us, cumulative
+
+
+def run_once():
+    """
+    Один запуск импорта в новом процессе.
+
+    Returns:
+        (время импорта в мкс, {модуль: мкс}, список загруженных тяжелых пакетов)
+    """
+    env = dict(os.environ, PYTHONDONTWRITEBYTECODE="1")
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", IMPORT_CODE.format(heavy=HEAVY_MODULES)],
+        cwd=project_dir, env=env, capture_output=True, text=True
+    )
+    if result.returncode != 0:
+        tail = "\n".join(result.stderr.strip().splitlines()[-10:])
+        raise RuntimeError(f"Импорт toolbot.main завершился ошибкой:\n{tail}")
+    total_us, cumulative = parse_importtime(result.stderr)
+    heavy_loaded = json.loads(result.stdout.strip().splitlines()[-1])
+    return total_us, cumulative, heavy_loaded
+
+
+def main():
+    args = parse_args()
+
+    totals = []
+    cumulative = {}
+    heavy_loaded = []
+    for _ in range(args.runs):
+        total_us, cumulative, heavy_loaded = run_once()
+        totals.append(total_us / 1000)
+
+    median_ms = statistics.median(totals)
+    print(f"Запусков: {args.runs}, импорт toolbot.main: медиана {median_ms:.0f} мс, "
+          f"мин {min(totals):.0f} мс, макс {max(totals):.0f} мс, бюджет {args.budget_ms:.0f} мс")
+
+    project_modules = {name: us for name, us in cumulative.items()
+                       if name.split(".")[0] in ("toolbot", "handlers", "services", "main")}
+    for title, modules in (("Самые дорогие модули", cumulative), ("Модули проекта", project_modules)):
+        print(f"\n{title}:")
+        for name, us in sorted(modules.items(), key=lambda item: item[1], reverse=True)[:args.top]:
+            print(f"  {us / 1000:>9.1f} мс  {name}")
+
+    failed = False
+    if heavy_loaded:
+        print(f"\n❌ При старте загружены тяжелые пакеты: {', '.join(heavy_loaded)}")
+        failed = True
+    if median_ms > args.budget_ms:
+        print(f"\n❌ Время импорта {median_ms:.0f} мс превышает бюджет {args.budget_ms:.0f} мс")
+        failed = True
+    if not failed:
+        print("\n✅ Импорт укладывается в бюджет, тяжелые пакеты не загружаются")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
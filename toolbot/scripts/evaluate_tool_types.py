@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Сравнение точности zero-shot классификации типа инструмента.
+
+На размеченной папке (структура как у train_clip.py: подпапки с кодами
+категорий из tool_categories.json) считается top-1 точность трех вариантов
+подсказок для одной и той же модели:
+- legacy - прежние 16 подсказок "a photo of a drill" (до банка категорий);
+- ru - банк категорий с русскими подсказками;
+- en - банк категорий с английскими подсказками.
+
+Прежние 16 типов отображаются на коды категорий, поэтому все варианты
+сравниваются на изображениях категорий, которые прежний набор мог назвать.
+Точность на всех категориях выводится отдельно для банков.
+
+Код возврата 1, если банк на языке, выбранном для модели, хуже прежних подсказок.
+
+Пример:
+    python toolbot/scripts/evaluate_tool_types.py --data-dir data/tool_types_eval
+"""
+
+import os
+import sys
+import argparse
+
+import numpy as np
+
+# Корень проекта: из него запускается бот
+script_dir = os.path.dirname(os.path.abspath(__file__))
+project_dir = os.path.dirname(os.path.dirname(script_dir))
+sys.path.insert(0, project_dir)
+
+from toolbot.utils.label_bank import LabelBank
+
+STANDARD_CLIP_MODEL = "openai/clip-vit-base-patch32"
+
+# Прежние типы инструментов и соответствующие им категории банка
+LEGACY_TOOL_TYPES = {
+    "drill": "дрель",
+    "screwdriver": "ручной_инструмент",
+    "hammer": "ручной_инструмент",
+    "saw": "ручной_инструмент",
+    "angle grinder": "болгарка",
+    "jigsaw": "лобзик",
+    "wrench": "ручной_инструмент",
+    "pliers": "ручной_инструмент",
+    "tape measure": "измерительный_инструмент",
+    "level": "измерительный_инструмент",
+    "impact driver": "гайковерт",
+    "circular saw": "циркулярная_пила",
+    "miter saw": "торцовочная_пила",
+    "router": "фрезер",
+    "sander": "шлифовальная_машина",
+    "nail gun": "гвоздезабиватель",
+}
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg')
+
+
+def parse_args():
+    """
+    Парсинг аргументов командной строки.
+
+    Returns:
+        Объект с аргументами
+    """
+    parser = argparse.ArgumentParser(description="Точность zero-shot классификации типа инструмента")
+    parser.add_argument("--data-dir", type=str, required=True,
+                        help="Папка с изображениями (подпапки с кодами категорий)")
+    parser.add_argument("--model", type=str, default=STANDARD_CLIP_MODEL,
+                        help="Модель CLIP (название в transformers или папка дообученной модели)")
+    parser.add_argument("--language", choices=("ru", "en"), default=None,
+                        help="Язык банка для проверки (по умолчанию en для стандартной модели, иначе ru)")
+    return parser.parse_args()
+
+
+def load_samples(data_dir):
+    """Пути к изображениям и их категории"""
+    samples = []
+    for category in sorted(os.listdir(data_dir)):
+        category_dir = os.path.join(data_dir, category)
+        if not os.path.isdir(category_dir):
+            continue
+        for name in sorted(os.listdir(category_dir)):
+            if name.lower().endswith(IMAGE_EXTENSIONS):
+                samples.append((os.path.join(category_dir, name), category))
+    return samples
+
+
+def main():
+    args = parse_args()
+    language = args.language or ("en" if args.model == STANDARD_CLIP_MODEL else "ru")
+
+    import torch
+    from PIL import Image
+    from transformers import CLIPModel, CLIPProcessor
+
+    model = CLIPModel.from_pretrained(args.model).eval()
+    processor = CLIPProcessor.from_pretrained(args.model)
+
+    def encode_text(texts):
+        inputs = processor(text=list(texts), return_tensors="pt", padding=True, truncation=True)
+        with torch.no_grad():
+            features = model.get_text_features(**inputs)
+        return (features / features.norm(dim=-1, keepdim=True)).numpy()
+
+    samples = load_samples(args.data_dir)
+    if not samples:
+        print(f"❌ В {args.data_dir} нет изображений")
+        sys.exit(1)
+
+    image_features = []
+    for path, _ in samples:
+        inputs = processor(images=Image.open(path).convert("RGB"), return_tensors="pt")
+        with torch.no_grad():
+            features = model.get_image_features(**inputs)
+        image_features.append((features / features.norm(dim=-1, keepdim=True)).numpy()[0])
+    image_features = np.stack(image_features)
+    truth = np.array([category for _, category in samples])
+
+    # Прежние подсказки: одна на тип, предсказание отображается на код категории
+    legacy_text = encode_text([f"a photo of a {tool_type}" for tool_type in LEGACY_TOOL_TYPES])
+    legacy_labels = np.array(list(LEGACY_TOOL_TYPES.values()))
+    predictions = {"legacy": legacy_labels[(image_features @ legacy_text.T).argmax(axis=1)]}
+
+    for bank_language in ("ru", "en"):
+        bank = LabelBank()
+        prompts = bank.load_prompts(bank_language)
+        bank.labels = list(prompts)
+        bank.embeddings, bank.row_labels = bank._compute(prompts, encode_text)
+        predictions[bank_language] = np.array([label for label, _, _ in bank.classify(image_features)])
+
+    # Общая часть: категории, которые умел называть прежний набор подсказок
+    common = np.isin(truth, legacy_labels)
+    print(f"Модель: {args.model}, изображений: {len(samples)}, "
+          f"из них в категориях прежнего набора: {int(common.sum())}")
+    accuracy = {}
+    for name, predicted in predictions.items():
+        correct = predicted == truth
+        accuracy[name] = correct[common].mean() if common.any() else 0.0
+        overall = "" if name == "legacy" else f", все категории {correct.mean():.1%}"
+        print(f"  {name:<6} точность {accuracy[name]:.1%}{overall}")
+
+    if accuracy[language] < accuracy["legacy"]:
+        print(f"\n❌ Банк ({language}) хуже прежних подсказок: "
+              f"{accuracy[language]:.1%} против {accuracy['legacy']:.1%}")
+        sys.exit(1)
+    print(f"\n✅ Банк ({language}) не хуже прежних подсказок")
+    sys.exit(0)
+
+
+if __name__ == "__main__":
+    main()
@@ -3,11 +3,14 @@
 """
 
 import logging
+import heapq
 import time
 import json
 import os
 from typing import Dict, List, Any, Optional
 
+from toolbot.utils.activity_index import ActivityIndex
+
 logger = logging.getLogger(__name__)
 
 class Analytics:
@@ -36,6 +39,9 @@ class Analytics:
             "departments": {}
         }
         
+        # Индексы активности для админских отчетов (без полного прохода по пользователям)
+        self.index = ActivityIndex()
+        
         # Загружаем статистику, если файл существует
         self._load_stats()
     
@@ -61,6 +67,9 @@ class Analytics:
                     for user_id, user_data in loaded_stats["users"].items():
                         if isinstance(user_data, dict):
                             self.stats["users"][user_id] = user_data
+                
+                # Строим индексы один раз при загрузке
+                self.index.rebuild(self.stats["users"], loaded_stats.get("activity_index"))
                         
                 logger.info(f"Статистика загружена из {self.storage_path}")
             else:
@@ -79,6 +88,7 @@ class Analytics:
     def _save_stats(self):
         """Сохраняет статистику в файл."""
         try:
+            self.stats["activity_index"] = self.index.to_dict()
             with open(self.storage_path, 'w', encoding='utf-8') as f:
                 json.dump(self.stats, f, ensure_ascii=False, indent=2)
         except Exception as e:
@@ -109,6 +119,7 @@ class Analytics:
         # Обновляем последнее время активности
         self.stats["users"][user_id_str]["last_seen"] = current_time
         self.stats["users"][user_id_str]["requests"] += 1
+        self.index.touch(user_id, current_time)
         
         # Добавляем запись в лог активности (сохраняем последние 50 записей)
         activity_record = {
@@ -132,6 +143,33 @@ class Analytics:
         # Сохраняем статистику
         self._save_stats()
 
+    def log_activity_batch(self, records: List[tuple]):
+        """
+        Добавляет пачку записей в логи активности пользователей с одной записью файла.
+        
+        В отличие от log_user_activity, не считает записи запросами пользователя
+        и не меняет время последней активности (например, доставка рассылки).
+        
+        Args:
+            records: Список кортежей (user_id, activity_type, details)
+        """
+        current_time = time.time()
+        for user_id, activity_type, details in records:
+            user_data = self.stats["users"].get(str(user_id))
+            if user_data is None:
+                continue
+            
+            activity_log = user_data.setdefault("activity_log", [])
+            activity_log.append({
+                "timestamp": current_time,
+                "type": activity_type,
+                "details": details
+            })
+            if len(activity_log) > 50:
+                del activity_log[:-50]
+        
+        self._save_stats()
+    
     def log_command(self, command: str, user_id: int):
         """
         Логирует использование команды.
@@ -197,14 +235,19 @@ class Analytics:
         else:
             self.stats["departments"][department]["failures"] += 1
         
+        self.index.record_department(department, success)
+        
         # Обновляем статистику пользователя
         user_id_str = str(user_id)
         if user_id_str not in self.stats["users"]:
+            first_seen = time.time()
             self.stats["users"][user_id_str] = {
-                "first_seen": time.time(),
+                "first_seen": first_seen,
                 "requests": 0,
                 "commands": {}
             }
+            # Без last_seen пользователь считается активным с момента first_seen
+            self.index.last_seen.touch(user_id, first_seen)
         
         self.stats["users"][user_id_str]["requests"] += 1
         
@@ -247,38 +290,61 @@ class Analytics:
         Returns:
             Список пользователей с их активностью
         """
-        current_time = time.time()
-        cutoff_time = current_time - (days * 24 * 60 * 60)
+        cutoff_time = time.time() - (days * 24 * 60 * 60)
         
+        # Индекс отдает только активных пользователей, уже по убыванию last_seen
         recent_users = []
+        for user_id, last_seen in self.index.iter_recent(cutoff_time):
+            recent_users.append(self._user_info(user_id, last_seen, cutoff_time))
         
-        for user_id, user_data in self.stats["users"].items():
-            last_seen = user_data.get("last_seen", user_data.get("first_seen", 0))
-            
-            if last_seen >= cutoff_time:
-                recent_activity = []
-                activity_log = user_data.get("activity_log", [])
-                
-                # Фильтруем активность за указанный период
-                for activity in activity_log:
-                    if activity["timestamp"] >= cutoff_time:
-                        recent_activity.append(activity)
-                
-                user_info = {
-                    "user_id": int(user_id),
-                    "first_seen": user_data.get("first_seen", 0),
-                    "last_seen": last_seen,
-                    "total_requests": user_data.get("requests", 0),
-                    "recent_activity": recent_activity,
-                    "commands": user_data.get("commands", {})
-                }
-                
-                recent_users.append(user_info)
+        return recent_users
+    
+    def _user_info(self, user_id: int, last_seen: float, cutoff_time: float = 0) -> Dict[str, Any]:
+        """Сведения о пользователе для отчетов с активностью начиная с cutoff_time."""
+        user_data = self.stats["users"].get(str(user_id), {})
+        return {
+            "user_id": user_id,
+            "first_seen": user_data.get("first_seen", 0),
+            "last_seen": last_seen,
+            "total_requests": user_data.get("requests", 0),
+            "recent_activity": [
+                activity for activity in user_data.get("activity_log", [])
+                if activity["timestamp"] >= cutoff_time
+            ],
+            "commands": user_data.get("commands", {})
+        }
+    
+    def get_most_recent_users(self, limit: int, days: Optional[int] = None) -> List[Dict[str, Any]]:
+        """
+        Возвращает последних активных пользователей за O(k log k).
         
-        # Сортируем по последней активности (самые активные первыми)
-        recent_users.sort(key=lambda x: x["last_seen"], reverse=True)
+        Args:
+            limit: Количество пользователей
+            days: Только активные за последние N дней
+            
+        Returns:
+            Список пользователей, самые свежие первыми
+        """
+        cutoff_time = time.time() - days * 24 * 60 * 60 if days is not None else None
+        return [
+            self._user_info(user_id, last_seen, cutoff_time or 0)
+            for user_id, last_seen in self.index.most_recent(limit, cutoff_time)
+        ]
+    
+    def count_active_users(self, minutes: Optional[int] = None, days: Optional[int] = None) -> int:
+        """
+        Возвращает количество пользователей, активных за последние N минут или дней.
         
-        return recent_users
+        Args:
+            minutes: Окно в минутах
+            days: Окно в днях
+        """
+        seconds = (minutes or 0) * 60 + (days or 0) * 24 * 60 * 60
+        return self.index.count_active(seconds)
+    
+    def get_user_count(self) -> int:
+        """Возвращает общее количество пользователей."""
+        return len(self.stats["users"])
 
     def get_user_activity_log(self, user_id: int, limit: int = 20) -> List[Dict[str, Any]]:
         """
@@ -310,21 +376,9 @@ class Analytics:
         """
         uptime = time.time() - self.stats["start_time"]
         
-        # Подсчитываем активных пользователей за последние дни
-        current_time = time.time()
-        day_ago = current_time - (24 * 60 * 60)
-        week_ago = current_time - (7 * 24 * 60 * 60)
-        
-        active_today = 0
-        active_week = 0
-        
-        for user_data in self.stats["users"].values():
-            last_seen = user_data.get("last_seen", user_data.get("first_seen", 0))
-            
-            if last_seen >= day_ago:
-                active_today += 1
-            if last_seen >= week_ago:
-                active_week += 1
+        # Активные за сутки и неделю - обход индекса только по активным
+        active_today = self.count_active_users(days=1)
+        active_week = self.count_active_users(days=7)
         
         return {
             "total_requests": self.stats["total_requests"],
@@ -333,10 +387,13 @@ class Analytics:
             "unique_users": len(self.stats["users"]),
             "active_today": active_today,
             "active_week": active_week,
+            "active_hour": self.count_active_users(minutes=60),
+            # Оценки HyperLogLog по дневным скетчам
+            "unique_today": self.index.unique_users(days=1),
+            "unique_month": self.index.unique_users(days=30),
+            "top_departments_week": self.index.top_departments(k=5, days=7),
             "photo_searches": self.stats["photo_searches"],
-            "top_commands": sorted(
-                [(cmd, count) for cmd, count in self.stats["commands"].items()],
-                key=lambda x: x[1],
-                reverse=True
-            )[:5]  # Топ-5 команд
+            "top_commands": heapq.nlargest(
+                5, self.stats["commands"].items(), key=lambda x: x[1]
+            )  # Топ-5 команд
         } 
\ No newline at end of file
@@ -0,0 +1,505 @@
+"""
+Фоновые массовые рассылки с учетом лимитов Telegram
+
+Задание рассылки выполняется отдельной задачей asyncio, поэтому обработчик
+администратора сразу освобождается. Несколько отправителей работают
+параллельно, но общий темп ограничен (по умолчанию 25 сообщений в секунду при
+лимите Telegram около 30). Каждому получателю уходит одно сообщение, так что
+лимит в один чат не нарушается. При RetryAfter пауза применяется ко всем
+отправителям, а сообщение отправляется повторно.
+
+Прогресс периодически сохраняется в toolbot/data/broadcasts/<job_id>.json
+(атомарная запись через временный файл). При остановке бота рассылка
+прерывается, а задание остается незавершенным (как и после сбоя); после
+перезапуска оно продолжается с сохраненного места. Сообщения, отправленные
+между последним сохранением и остановкой, могут быть отправлены повторно.
+
+Ход рассылки показывается в одном сообщении администратору, которое
+редактируется раз в несколько секунд. Записи в аналитику накапливаются и
+сохраняются пачкой вместе с прогрессом.
+"""
+import os
+import json
+import time
+import uuid
+import asyncio
+import logging
+from typing import Any, Dict, List, Optional
+
+from telegram.error import RetryAfter, Forbidden, BadRequest, TimedOut, NetworkError
+
+from toolbot.utils.persisted_state import atomic_write_json
+
+logger = logging.getLogger(__name__)
+
+# Каталог сохраненного прогресса рассылок
+BROADCASTS_DIR = os.path.join("toolbot", "data", "broadcasts")
+
+# Общий темп отправки (сообщений в секунду) и число параллельных отправителей
+DEFAULT_RATE = 25.0
+DEFAULT_CONCURRENCY = 8
+
+# Интервалы сохранения прогресса и обновления сообщения о ходе рассылки (секунды)
+CHECKPOINT_INTERVAL = 5.0
+PROGRESS_INTERVAL = 3.0
+
+# Повторы при сетевых ошибках
+MAX_NETWORK_RETRIES = 3
+
+# Сколько ждать текущих отправок при остановке бота (секунды)
+SHUTDOWN_TIMEOUT = 5.0
+
+# Сколько ошибок хранить для итогового отчета
+MAX_FAILED_SAMPLES = 20
+
+STATUS_RUNNING = "running"
+STATUS_DONE = "done"
+STATUS_CANCELLED = "cancelled"
+
+
+def _retry_after_seconds(error) -> float:
+    """Пауза из RetryAfter (в новых версиях библиотеки - timedelta)"""
+    delay = error.retry_after
+    if hasattr(delay, "total_seconds"):
+        delay = delay.total_seconds()
+    return float(delay)
+
+
+class BroadcastJob:
+    """Одно задание рассылки и его прогресс"""
+
+    def __init__(self, text: str, user_ids: List[int], admin_id: int, chat_id: int,
+                 parse_mode: Optional[str] = "Markdown", job_id: Optional[str] = None):
+        self.job_id = job_id or time.strftime("%Y%m%d_%H%M%S_") + uuid.uuid4().hex[:6]
+        self.text = text
+        self.user_ids = list(user_ids)
+        self.admin_id = admin_id
+        self.chat_id = chat_id
+        self.parse_mode = parse_mode
+        self.progress_message_id: Optional[int] = None
+
+        self.status = STATUS_RUNNING
+        self.created_at = time.time()
+        self.finished_at: Optional[float] = None
+
+        self.sent = 0
+        self.blocked = 0
+        self.failed = 0
+        self.retry_after_count = 0
+        self.failed_samples: List[List[Any]] = []
+
+        # Отметки о завершении по позициям; все позиции до watermark завершены
+        self.done = bytearray(len(self.user_ids))
+        self.watermark = 0
+
+        # Время работы в текущем запуске (для скорости и оценки остатка)
+        self.run_started_at = time.time()
+        self.run_started_done = 0
+
+    @property
+    def total(self) -> int:
+        return len(self.user_ids)
+
+    @property
+    def completed(self) -> int:
+        return self.sent + self.blocked + self.failed
+
+    def mark_done(self, index: int) -> None:
+        self.done[index] = 1
+        self._advance_watermark()
+
+    def _advance_watermark(self) -> None:
+        while self.watermark < self.total and self.done[self.watermark]:
+            self.watermark += 1
+
+    def pending_indices(self):
+        """Позиции получателей, которым еще не отправлено"""
+        return (i for i in range(self.watermark, self.total) if not self.done[i])
+
+    def rate(self) -> float:
+        """Скорость отправки в текущем запуске (сообщений в секунду)"""
+        elapsed = time.time() - self.run_started_at
+        return (self.completed - self.run_started_done) / elapsed if elapsed > 0 else 0.0
+
+    def to_dict(self) -> Dict[str, Any]:
+        # Завершенные позиции после watermark (их не больше числа отправителей)
+        done_ahead = [i for i in range(self.watermark, self.total) if self.done[i]]
+        return {
+            'job_id': self.job_id,
+            'text': self.text,
+            'user_ids': self.user_ids,
+            'admin_id': self.admin_id,
+            'chat_id': self.chat_id,
+            'parse_mode': self.parse_mode,
+            'progress_message_id': self.progress_message_id,
+            'status': self.status,
+            'created_at': self.created_at,
+            'finished_at': self.finished_at,
+            'sent': self.sent,
+            'blocked': self.blocked,
+            'failed': self.failed,
+            'retry_after_count': self.retry_after_count,
+            'failed_samples': self.failed_samples,
+            'watermark': self.watermark,
+            'done_ahead': done_ahead,
+        }
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "BroadcastJob":
+        job = cls(data['text'], data['user_ids'], data['admin_id'], data['chat_id'],
+                  data.get('parse_mode'), data['job_id'])
+        job.progress_message_id = data.get('progress_message_id')
+        job.status = data.get('status', STATUS_RUNNING)
+        job.created_at = data.get('created_at', job.created_at)
+        job.finished_at = data.get('finished_at')
+        job.sent = data.get('sent', 0)
+        job.blocked = data.get('blocked', 0)
+        job.failed = data.get('failed', 0)
+        job.retry_after_count = data.get('retry_after_count', 0)
+        job.failed_samples = data.get('failed_samples', [])
+        for i in range(data.get('watermark', 0)):
+            job.done[i] = 1
+        for i in data.get('done_ahead', []):
+            job.done[i] = 1
+        job._advance_watermark()
+        job.run_started_done = job.completed
+        return job
+
+
+class BroadcastRunner:
+    """Выполнение задания: отправители, общий темп, сохранение прогресса"""
+
+    def __init__(self, job: BroadcastJob, bot, analytics=None, rate: float = DEFAULT_RATE,
+                 concurrency: int = DEFAULT_CONCURRENCY, storage_dir: str = BROADCASTS_DIR):
+        self.job = job
+        self.bot = bot
+        self.analytics = analytics
+        self.rate = rate
+        self.concurrency = concurrency
+        self.storage_dir = storage_dir
+
+        self._next_slot = 0.0
+        self._paused_until = 0.0
+        self._cancelled = False
+        self._stopping = False
+        self._last_checkpoint = 0.0
+        self._pending_activity: List[tuple] = []
+
+    @property
+    def checkpoint_path(self) -> str:
+        return os.path.join(self.storage_dir, f"{self.job.job_id}.json")
+
+    def cancel(self) -> None:
+        """Остановка рассылки после текущих отправок"""
+        self._cancelled = True
+
+    def stop(self) -> None:
+        """Прерывание при остановке бота: задание остается незавершенным и продолжится после перезапуска"""
+        self._stopping = True
+
+    async def _acquire_slot(self) -> None:
+        """Ожидание очередного слота общего темпа отправки (и паузы после RetryAfter)"""
+        loop = asyncio.get_running_loop()
+        while True:
+            now = loop.time()
+            slot = max(now, self._next_slot, self._paused_until)
+            self._next_slot = slot + 1.0 / self.rate
+            if slot > now:
+                await asyncio.sleep(slot - now)
+            # Пауза могла начаться, пока отправитель ждал своего слота
+            if self._paused_until <= loop.time():
+                return
+
+    def _pause(self, seconds: float) -> None:
+        """Общая пауза всех отправителей после RetryAfter"""
+        until = asyncio.get_running_loop().time() + seconds
+        if until > self._paused_until:
+            self._paused_until = until
+            logger.warning(f"⏸️ Рассылка {self.job.job_id}: Telegram просит подождать {seconds:.0f}с")
+
+    async def _send_one(self, index: int) -> None:
+        """Отправка одному получателю с учетом RetryAfter и повторов при сетевых ошибках"""
+        job = self.job
+        target_user_id = job.user_ids[index]
+        network_retries = 0
+
+        while True:
+            await self._acquire_slot()
+            try:
+                await self.bot.send_message(chat_id=target_user_id, text=job.text, parse_mode=job.parse_mode)
+                job.sent += 1
+                outcome = "delivered"
+                break
+            except RetryAfter as e:
+                job.retry_after_count += 1
+                self._pause(_retry_after_seconds(e) + 0.5)
+            except Forbidden:
+                # Пользователь заблокировал бота или удалил аккаунт
+                job.blocked += 1
+                outcome = "blocked"
+                break
+            except BadRequest as e:
+                # Чат не найден, ошибка разметки и т.п. - повтор не поможет
+                self._record_failure(target_user_id, e)
+                outcome = "failed"
+                break
+            except (TimedOut, NetworkError) as e:
+                if network_retries >= MAX_NETWORK_RETRIES:
+                    self._record_failure(target_user_id, e)
+                    outcome = "failed"
+                    break
+                network_retries += 1
+                await asyncio.sleep(2 ** network_retries)
+            except Exception as e:
+                self._record_failure(target_user_id, e)
+                outcome = "failed"
+                break
+
+        job.mark_done(index)
+        self._pending_activity.append((target_user_id, "broadcast_received", f"{job.job_id}: {outcome}"))
+
+    def _record_failure(self, target_user_id: int, error: Exception) -> None:
+        self.job.failed += 1
+        if len(self.job.failed_samples) < MAX_FAILED_SAMPLES:
+            self.job.failed_samples.append([target_user_id, str(error)[:100]])
+        logger.warning(f"Не удалось отправить сообщение пользователю {target_user_id}: {error}")
+
+    async def _worker(self, indices) -> None:
+        # Общий итератор позиций: каждую позицию забирает ровно один отправитель
+        for index in indices:
+            if self._cancelled or self._stopping:
+                return
+            await self._send_one(index)
+            if time.monotonic() - self._last_checkpoint >= CHECKPOINT_INTERVAL:
+                self.checkpoint()
+
+    def checkpoint(self) -> None:
+        """Сохранение прогресса и накопленных записей аналитики"""
+        self._last_checkpoint = time.monotonic()
+        self._flush_analytics()
+        try:
+            atomic_write_json(self.checkpoint_path, self.job.to_dict())
+        except Exception as e:
+            logger.error(f"❌ Ошибка сохранения прогресса рассылки {self.job.job_id}: {e}")
+
+    def _flush_analytics(self) -> None:
+        """Одна запись файла аналитики на пачку получателей"""
+        if not self._pending_activity or self.analytics is None:
+            return
+        batch, self._pending_activity = self._pending_activity, []
+        try:
+            self.analytics.log_activity_batch(batch)
+        except Exception as e:
+            logger.error(f"❌ Ошибка записи аналитики рассылки: {e}")
+
+    def progress_text(self) -> str:
+        job = self.job
+        percent = job.completed / job.total * 100 if job.total else 100.0
+        rate = job.rate()
+        remaining = job.total - job.completed
+        eta = f"{remaining / rate / 60:.1f} мин" if rate > 0 else "—"
+        text = (
+            f"📤 *Выполняется рассылка...*\n"
+            f"Всего получателей: {job.total}\n"
+            f"✅ Отправлено: {job.sent}\n"
+            f"❌ Ошибок: {job.failed}\n"
+            f"🚫 Заблокировали бота: {job.blocked}\n"
+            f"Прогресс: {job.completed}/{job.total} ({percent:.1f}%)\n"
+            f"⚡ Скорость: {rate:.1f} сообщ./с, осталось ~{eta}"
+        )
+        if self._paused_until > asyncio.get_running_loop().time():
+            text += "\n⏸️ Пауза по требованию Telegram"
+        return text
+
+    def final_report(self) -> str:
+        job = self.job
+        success_rate = (job.sent / job.total) * 100 if job.total else 0.0
+        duration = (job.finished_at or time.time()) - job.created_at
+        title = "⛔ *Рассылка остановлена*" if job.status == STATUS_CANCELLED else "📊 *Рассылка завершена!*"
+        report = (
+            f"{title}\n\n"
+            f"*Статистика:*\n"
+            f"• Всего пользователей: {job.total}\n"
+            f"• ✅ Успешно отправлено: {job.sent}\n"
+            f"• 🚫 Заблокировали бота: {job.blocked}\n"
+            f"• ❌ Ошибки отправки: {job.failed}\n"
+            f"• 📈 Успешность: {success_rate:.1f}%\n"
+            f"• ⏸️ Пауз по требованию Telegram: {job.retry_after_count}\n\n"
+        )
+        if job.failed_samples:
+            report += f"*Пользователи с ошибками:* {job.failed} чел.\n"
+            for uid, error in job.failed_samples[:5]:
+                report += f"• ID {uid}: {error[:40]}...\n"
+        report += f"\n⏰ Время выполнения: {duration:.1f} сек."
+        return report
+
+    async def _update_progress(self, text: str) -> None:
+        """Редактирование сообщения о ходе рассылки (или отправка нового)"""
+        job = self.job
+        try:
+            if job.progress_message_id is None:
+                message = await self.bot.send_message(chat_id=job.chat_id, text=text, parse_mode="Markdown")
+                job.progress_message_id = message.message_id
+            else:
+                await self.bot.edit_message_text(text, chat_id=job.chat_id, message_id=job.progress_message_id,
+                                                 parse_mode="Markdown")
+        except RetryAfter as e:
+            # Прогресс не важнее рассылки: пропускаем обновление
+            logger.debug(f"Обновление прогресса рассылки отложено на {_retry_after_seconds(e):.0f}с")
+        except Exception as e:
+            if "not modified" not in str(e).lower():
+                logger.warning(f"⚠️ Не удалось обновить прогресс рассылки: {e}")
+
+    async def _report_progress(self) -> None:
+        while True:
+            await asyncio.sleep(PROGRESS_INTERVAL)
+            await self._update_progress(self.progress_text())
+
+    async def run(self) -> BroadcastJob:
+        """Выполнение рассылки до конца (или до отмены)"""
+        job = self.job
+        job.run_started_at = time.time()
+        job.run_started_done = job.completed
+        logger.info(f"📢 Рассылка {job.job_id}: {job.total - job.completed} из {job.total} получателей, "
+                    f"темп {self.rate:.0f}/с, отправителей {self.concurrency}")
+
+        await self._update_progress(self.progress_text())
+        self.checkpoint()
+
+        reporter = asyncio.create_task(self._report_progress())
+        finished = False
+        try:
+            indices = job.pending_indices()
+            await asyncio.gather(*(self._worker(indices) for _ in range(self.concurrency)))
+            finished = True
+        finally:
+            reporter.cancel()
+            # При сбое, отмене задачи или остановке бота задание остается в статусе running
+            if self._cancelled:
+                job.status = STATUS_CANCELLED
+            elif finished and job.watermark >= job.total:
+                job.status = STATUS_DONE
+            if job.status != STATUS_RUNNING:
+                job.finished_at = time.time()
+            self.checkpoint()
+
+        if job.status == STATUS_RUNNING:
+            logger.info(f"⏸️ Рассылка {job.job_id} прервана на {job.completed}/{job.total}, "
+                        f"продолжится после перезапуска")
+            return job
+
+        await self._update_progress(self.final_report())
+        if self.analytics is not None:
+            self.analytics.log_user_activity(job.admin_id, "broadcast_message",
+                                             f"Отправлено {job.sent}/{job.total} сообщений")
+        logger.info(f"✅ Рассылка {job.job_id} завершена: отправлено {job.sent}, "
+                    f"заблокировали {job.blocked}, ошибок {job.failed}")
+        return job
+
+
+class BroadcastManager:
+    """Запуск рассылок в фоне и возобновление незавершенных после перезапуска"""
+
+    def __init__(self, storage_dir: str = BROADCASTS_DIR):
+        self.storage_dir = storage_dir
+        self.active: Optional[BroadcastRunner] = None
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def is_running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    def start(self, job: BroadcastJob, application) -> BroadcastRunner:
+        """
+        Запуск задания фоновой задачей приложения
+
+        Raises:
+            RuntimeError: если другая рассылка еще выполняется
+        """
+        if self.is_running:
+            raise RuntimeError(f"Рассылка {self.active.job.job_id} еще выполняется")
+        runner = BroadcastRunner(job, application.bot, application.bot_data.get('analytics'),
+                                 storage_dir=self.storage_dir)
+        self.active = runner
+        # Не application.create_task: Application.stop() ждет такие задачи, и остановка
+        # бота затянулась бы до конца рассылки. Рассылку прерывает shutdown()
+        self._task = asyncio.get_running_loop().create_task(runner.run(), name=f"broadcast:{job.job_id}")
+        self._task.add_done_callback(self._log_task_error)
+        return runner
+
+    @staticmethod
+    def _log_task_error(task: asyncio.Task) -> None:
+        if not task.cancelled() and task.exception() is not None:
+            logger.error(f"❌ Ошибка рассылки {task.get_name()}: {task.exception()}")
+
+    def cancel(self) -> bool:
+        """Остановка текущей рассылки"""
+        if not self.is_running:
+            return False
+        self.active.cancel()
+        return True
+
+    async def shutdown(self, timeout: float = SHUTDOWN_TIMEOUT) -> None:
+        """
+        Прерывание рассылки при остановке бота без ее завершения
+
+        Отправители заканчивают текущие отправки (не дольше timeout), затем
+        задача отменяется. Прогресс сохраняется со статусом running, и после
+        перезапуска resume_pending продолжит рассылку.
+        """
+        if not self.is_running:
+            return
+        self.active.stop()
+        try:
+            await asyncio.wait_for(asyncio.shield(self._task), timeout)
+        except asyncio.TimeoutError:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+        except Exception:
+            # Ошибка уже записана в журнал обработчиком завершения задачи
+            pass
+
+    def get_status(self) -> Optional[Dict[str, Any]]:
+        """Состояние текущей (или последней) рассылки"""
+        if self.active is None:
+            return None
+        job = self.active.job
+        return {
+            'job_id': job.job_id,
+            'status': job.status,
+            'total': job.total,
+            'sent': job.sent,
+            'blocked': job.blocked,
+            'failed': job.failed,
+            'rate': round(job.rate(), 1),
+        }
+
+    def resume_pending(self, application) -> Optional[BroadcastRunner]:
+        """Продолжение незавершенной рассылки из сохраненного прогресса"""
+        if not os.path.isdir(self.storage_dir) or self.is_running:
+            return None
+        for name in sorted(os.listdir(self.storage_dir)):
+            if not name.endswith(".json"):
+                continue
+            try:
+                with open(os.path.join(self.storage_dir, name), "r", encoding="utf-8") as f:
+                    data = json.load(f)
+                if data.get('status') != STATUS_RUNNING:
+                    continue
+                job = BroadcastJob.from_dict(data)
+                logger.info(f"🔁 Возобновляем рассылку {job.job_id}: выполнено {job.completed}/{job.total}")
+                return self.start(job, application)
+            except Exception as e:
+                logger.error(f"❌ Не удалось возобновить рассылку из {name}: {e}")
+        return None
+
+
+# Глобальный менеджер рассылок
+_broadcast_manager = None
+
+def get_broadcast_manager() -> BroadcastManager:
+    """Получение экземпляра менеджера рассылок"""
+    global _broadcast_manager
+    if _broadcast_manager is None:
+        _broadcast_manager = BroadcastManager()
+    return _broadcast_manager
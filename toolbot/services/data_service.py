@@ -4,13 +4,17 @@
 """
 import os
 import logging
-import pandas as pd
+import sqlite3
 from pathlib import Path
 
 from toolbot.config import load_config
+from toolbot.utils.text_index import SubstringIndex, ReloadableTable
 
 logger = logging.getLogger(__name__)
 
+# База справочников магазинов и скобяных изделий
+EXCEL_DATA_DB = "data/excel_data.db"
+
 
 def format_numeric_value(value):
     """
@@ -37,6 +41,53 @@ def format_numeric_value(value):
         return str(value)
 
 
+def _load_colors(colors_file: str) -> dict:
+    """
+    Загружает таблицу цветов и заранее форматирует все строки
+    
+    Args:
+        colors_file: Путь к Excel файлу
+        
+    Returns:
+        Снимок справочника: отформатированные строки и индекс по колонке 'Цвет'
+    """
+    # pandas нужен только для чтения Excel - не загружаем его при старте бота
+    import pandas as pd
+    
+    df = pd.read_excel(colors_file)
+    logger.info(f"Загружена таблица цветов. Количество строк: {len(df)}")
+    logger.info(f"Колонки в таблице: {df.columns.tolist()}")
+    
+    # Проверяем наличие колонки 'Цвет'
+    if 'Цвет' not in df.columns:
+        logger.error("❌ В таблице отсутствует колонка 'Цвет'")
+        return {'valid': False}
+    
+    results = []
+    for _, row in df.iterrows():
+        result_parts = []
+        for col in df.columns:
+            value = row[col]
+            if col == 'Цвет':
+                result_parts.append(f"🎨 *{value}*")
+            else:
+                if pd.notna(value):  # Проверяем, что значение не NaN
+                    # Форматируем числовое значение
+                    formatted_value = format_numeric_value(value)
+                    result_parts.append(f"• {col}: {formatted_value}")
+        
+        results.append("\n".join(result_parts))
+    
+    return {
+        'valid': True,
+        'results': results,
+        'index': SubstringIndex(df['Цвет'].astype(str).tolist()),
+    }
+
+
+_colors_table = ReloadableTable("цвета", _load_colors)
+
+
 async def search_in_colors(query: str) -> list:
     """
     Поиск в базе цветов по колонке 'Цвет'
@@ -62,47 +113,25 @@ async def search_in_colors(query: str) -> list:
                 logger.error(f"Файл с базой цветов не найден: {colors_file}")
                 return ["❌ Файл с базой цветов не найден"]
         
-        # Читаем Excel файл
-        df = pd.read_excel(colors_file)
-        logger.info(f"Загружена таблица цветов. Количество строк: {len(df)}")
-        logger.info(f"Колонки в таблице: {df.columns.tolist()}")
-        
-        # Проверяем наличие колонки 'Цвет'
-        if 'Цвет' not in df.columns:
-            logger.error("❌ В таблице отсутствует колонка 'Цвет'")
+        # Таблица читается один раз и перечитывается только при изменении файла
+        colors = _colors_table.get(colors_file)
+        if colors is None:
+            return ["❌ Файл с базой цветов не найден"]
+        if not colors['valid']:
             return ["❌ Ошибка в структуре таблицы"]
 
         # Удаляем пробелы из запроса и приводим к нижнему регистру
         query = query.lower().strip()
-        logger.info(f"Поисковый запрос: {query}")
+        logger.debug(f"Поисковый запрос: {query}")
 
         # Поиск в колонке 'Цвет'
-        mask = df['Цвет'].astype(str).str.lower().str.contains(query, na=False)
-        matches = df[mask]
+        matches = sorted(colors['index'].search(query))
         
         logger.info(f"Найдено совпадений: {len(matches)}")
         
-        if not matches.empty:
-            # Форматируем совпадения
-            results = []
-            for _, row in matches.iterrows():
-                result_parts = []
-                for col in df.columns:
-                    value = row[col]
-                    if col == 'Цвет':
-                        result_parts.append(f"🎨 *{value}*")
-                    else:
-                        if pd.notna(value):  # Проверяем, что значение не NaN
-                            # Форматируем числовое значение
-                            formatted_value = format_numeric_value(value)
-                            result_parts.append(f"• {col}: {formatted_value}")
-                
-                results.append("\n".join(result_parts))
-            return results
+        if matches:
+            return [colors['results'][row_id] for row_id in matches]
         else:
-            # Выводим первые несколько строк для отладки
-            logger.info("Примеры данных из таблицы:")
-            logger.info(df['Цвет'].head().to_string())
             return ["❌ Ничего не найдено. Попробуйте изменить запрос."]
                 
     except Exception as e:
@@ -110,6 +139,48 @@ async def search_in_colors(query: str) -> list:
         return ["❌ Произошла ошибка при поиске"]
 
 
+def _load_stores(db_path: str) -> dict:
+    """Загружает справочник магазинов и строит индексы по названию и отделу"""
+    conn = sqlite3.connect(db_path)
+    try:
+        rows = conn.execute("""
+            SELECT code, name, department, phone_numbers
+            FROM stores 
+            ORDER BY name
+        """).fetchall()
+    finally:
+        conn.close()
+    
+    return {
+        'rows': rows,
+        'name_index': SubstringIndex([row[1] for row in rows]),
+        'dept_index': SubstringIndex([row[2] for row in rows]),
+    }
+
+
+def _load_skobyanka(db_path: str) -> dict:
+    """Загружает справочник скобяных изделий и строит индексы по артикулу и названию"""
+    conn = sqlite3.connect(db_path)
+    try:
+        rows = conn.execute("""
+            SELECT article_code, name, quantity_kg
+            FROM skobyanka_products 
+            ORDER BY name
+        """).fetchall()
+    finally:
+        conn.close()
+    
+    return {
+        'rows': rows,
+        'article_index': SubstringIndex([row[0] for row in rows]),
+        'name_index': SubstringIndex([row[1] for row in rows]),
+    }
+
+
+_stores_table = ReloadableTable("магазины", _load_stores)
+_skobyanka_table = ReloadableTable("скобянка", _load_skobyanka)
+
+
 async def search_in_stores(query: str) -> list:
     """
     Поиск в базе магазинов/отделов по названию и отделу (SQLite)
@@ -121,48 +192,24 @@ async def search_in_stores(query: str) -> list:
         Список строк с результатами поиска
     """
     try:
-        # Путь к базе данных
-        db_path = "data/excel_data.db"
-        if not os.path.exists(db_path):
-            logger.error(f"База данных {db_path} не найдена")
+        # Справочник загружается один раз и перечитывается только при изменении БД
+        stores = _stores_table.get(EXCEL_DATA_DB)
+        if stores is None:
+            logger.error(f"База данных {EXCEL_DATA_DB} не найдена")
             return ["❌ База данных магазинов не найдена"]
         
-        import sqlite3
-        conn = sqlite3.connect(db_path)
-        cursor = conn.cursor()
-        
-        # Получаем все данные из БД
-        cursor.execute("""
-            SELECT code, name, department, phone_numbers
-            FROM stores 
-            ORDER BY name
-        """)
-        
-        all_results = cursor.fetchall()
+        all_results = stores['rows']
         
         # Если запрос пустой, возвращаем первые 15 магазинов
         if not query.strip():
             results = all_results[:15]
         else:
-            # Фильтруем результаты в Python (поиск по 2-й и 3-й колонке)
-            query_lower = query.lower()
-            filtered_results = []
-            
-            for row in all_results:
-                code, name, dept, phones = row
-                name_lower = (name or "").lower()
-                dept_lower = (dept or "").lower()
-                
-                # Проверяем вхождение подстроки в название или отдел
-                if query_lower in name_lower or query_lower in dept_lower:
-                    # Определяем приоритет: название важнее отдела
-                    priority = 1 if query_lower in name_lower else 2
-                    filtered_results.append((priority, row))
-            
-            # Сортируем по приоритету и берем первые 20
-            filtered_results.sort(key=lambda x: (x[0], x[1][1]))  # по приоритету, потом по имени
-            results = [row for _, row in filtered_results[:20]]
-        conn.close()
+            # Поиск по 2-й и 3-й колонке: название важнее отдела,
+            # внутри группы сохраняется порядок по имени
+            name_matches = stores['name_index'].search(query)
+            dept_matches = stores['dept_index'].search(query) - name_matches
+            ordered = sorted(name_matches) + sorted(dept_matches)
+            results = [all_results[row_id] for row_id in ordered[:20]]
         
         if results:
             formatted_results = []
@@ -210,49 +257,24 @@ async def search_in_skobyanka(query: str) -> list:
         Список строк с результатами поиска
     """
     try:
-        # Путь к базе данных
-        db_path = "data/excel_data.db"
-        if not os.path.exists(db_path):
-            logger.error(f"База данных {db_path} не найдена")
+        # Справочник загружается один раз и перечитывается только при изменении БД
+        skobyanka = _skobyanka_table.get(EXCEL_DATA_DB)
+        if skobyanka is None:
+            logger.error(f"База данных {EXCEL_DATA_DB} не найдена")
             return ["❌ База данных скобяных изделий не найдена"]
         
-        import sqlite3
-        conn = sqlite3.connect(db_path)
-        cursor = conn.cursor()
-        
-        # Получаем все данные из БД
-        cursor.execute("""
-            SELECT article_code, name, quantity_kg
-            FROM skobyanka_products 
-            ORDER BY name
-        """)
-        
-        all_results = cursor.fetchall()
+        all_results = skobyanka['rows']
         
         # Если запрос пустой, возвращаем первые 15 товаров
         if not query.strip():
             results = all_results[:15]
         else:
-            # Фильтруем результаты в Python (поиск по артикулу и названию)
-            query_lower = query.lower()
-            filtered_results = []
-            
-            for row in all_results:
-                article, name, quantity = row
-                article_lower = (article or "").lower()
-                name_lower = (name or "").lower()
-                
-                # Проверяем вхождение подстроки в артикул или название
-                if query_lower in article_lower or query_lower in name_lower:
-                    # Определяем приоритет: артикул важнее названия
-                    priority = 1 if query_lower in article_lower else 2
-                    filtered_results.append((priority, row))
-            
-            # Сортируем по приоритету и берем первые 20
-            filtered_results.sort(key=lambda x: (x[0], x[1][1]))  # по приоритету, потом по названию
-            results = [row for _, row in filtered_results[:20]]
-        
-        conn.close()
+            # Поиск по артикулу и названию: артикул важнее названия,
+            # внутри группы сохраняется порядок по названию
+            article_matches = skobyanka['article_index'].search(query)
+            name_matches = skobyanka['name_index'].search(query) - article_matches
+            ordered = sorted(article_matches) + sorted(name_matches)
+            results = [all_results[row_id] for row_id in ordered[:20]]
         
         if results:
             formatted_results = []
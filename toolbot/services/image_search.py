@@ -4,6 +4,7 @@
 import os
 import cv2
 import uuid
+import hashlib
 import logging
 import numpy as np
 import faiss
@@ -15,14 +16,20 @@ from transformers import CLIPProcessor, CLIPModel
 
 from toolbot.utils.object_detection import detect_objects_on_image as detect_objects
 from toolbot.config import get_similarity_threshold, get_top_n_results, get_image_variation_weights, get_similarity_bonuses
-from toolbot.utils.cache_manager import get_cached_search_results, cache_search_results
+from toolbot.utils.cache_manager import get_cache, compute_content_hash, make_cache_key
 from toolbot.utils.model_optimizer import optimize_clip_model
-from toolbot.utils.brand_recognition import recognize_brand, get_known_brands
+from toolbot.utils.brand_recognition import recognize_brand, get_known_brands, get_brand_recognizer
 from toolbot.utils.image_utils import preprocess_image_for_search
 from toolbot.utils.clip_fine_tuner import get_clip_fine_tuner
+from toolbot.utils.label_bank import LabelBank, UNKNOWN_LABEL
 
 logger = logging.getLogger(__name__)
 
+UNKNOWN_TOOL_TYPE = UNKNOWN_LABEL
+
+# Стандартная модель CLIP
+STANDARD_CLIP_MODEL = "openai/clip-vit-base-patch32"
+
 
 class ImageSearchService:
     """
@@ -54,7 +61,14 @@ class ImageSearchService:
         self.clip_processor = None
         self.faiss_index = None
         self.path_mapping = {}
-        self.text_features_cache = {}
+        # Версия индекса: отпечаток модели и проиндексированных файлов (ключ кэша результатов)
+        self.index_version = None
+        # Бренд и тип инструмента эталонных изображений: {путь: {"brand": ..., "tool_type": ...}}
+        self.image_labels = {}
+        # Банк текстовых признаков категорий инструментов
+        self.label_bank = LabelBank()
+        # Версия загруженной модели (ключ кэша векторов и банка категорий)
+        self.model_version = None
         self.fine_tuned_model = None
         self.use_fine_tuned = False
         
@@ -82,6 +96,7 @@ class ImageSearchService:
                     self.clip_processor = clip_tuner.processor
                     self.fine_tuned_model = True
                     self.use_fine_tuned = True
+                    self.model_version = f"fine_tuned:{os.path.getmtime(models_dir):.0f}"
                     logger.info("✓ Тонко настроенная модель CLIP успешно загружена")
                 else:
                     logger.warning("Не удалось загрузить тонко настроенную модель, используем стандартную")
@@ -106,13 +121,14 @@ class ImageSearchService:
         """
         try:
             logger.info("Загружаем стандартную модель CLIP...")
-            self.clip_processor = CLIPProcessor.from_pretrained("openai/clip-vit-base-patch32")
-            clip_model = CLIPModel.from_pretrained("openai/clip-vit-base-patch32")
+            self.clip_processor = CLIPProcessor.from_pretrained(STANDARD_CLIP_MODEL)
+            clip_model = CLIPModel.from_pretrained(STANDARD_CLIP_MODEL)
             
             # Оптимизируем модель для более быстрой работы
             self.clip_model = optimize_clip_model(clip_model, optimization_type='quantization')
             self.fine_tuned_model = False
             self.use_fine_tuned = False
+            self.model_version = STANDARD_CLIP_MODEL
             
             logger.info("✓ Стандартная модель CLIP успешно загружена")
             return True
@@ -120,12 +136,13 @@ class ImageSearchService:
             logger.error(f"Ошибка при загрузке стандартной модели CLIP: {e}")
             return False
             
-    def extract_features(self, image_path):
+    def extract_features(self, image_path, content_hash=None):
         """
         Извлекает признаки из изображения с помощью CLIP
         
         Args:
             image_path: Путь к изображению
+            content_hash: Хеш содержимого, если уже посчитан в начале запроса
             
         Returns:
             Вектор признаков или None в случае ошибки
@@ -137,6 +154,16 @@ class ImageSearchService:
                     logger.error("Не удалось инициализировать модели")
                     return None
             
+            # Векторы кэшируются по содержимому файла и используемой модели
+            embedding_cache = get_cache("embedding")
+            cache_key = make_cache_key(
+                content_hash or compute_content_hash(image_path),
+                model=self.model_version,
+            )
+            cached_features = embedding_cache.get(cache_key)
+            if cached_features is not None:
+                return cached_features
+            
             # Предобработка изображения для улучшения распознавания
             enhanced_image_path = preprocess_image_for_search(image_path)
             
@@ -159,9 +186,10 @@ class ImageSearchService:
             image_features = image_features / image_features.norm(dim=-1, keepdim=True)
             
             # Преобразуем в numpy массив
-            features = image_features.cpu().numpy().astype('float32')
+            features = image_features.cpu().numpy().astype('float32').reshape(1, -1)[0]
+            embedding_cache.set(cache_key, features)
             
-            return features.reshape(1, -1)[0]
+            return features
         except Exception as e:
             logger.error(f"Ошибка при извлечении признаков из {image_path}: {e}")
             logger.error(traceback.format_exc())
@@ -218,6 +246,14 @@ class ImageSearchService:
                 logger.error("Не удалось извлечь признаки ни из одного изображения")
                 return False
             
+            # Бренд и тип инструмента считаются один раз при построении индекса,
+            # тип - по уже извлеченным векторам одним матричным умножением
+            tool_types = self.classify_tool_types_batch(np.array(features))
+            image_labels = {
+                path: {"brand": recognize_brand(path)[0], "tool_type": tool_type[0]}
+                for path, tool_type in zip(paths, tool_types)
+            }
+            
             # Создаем индекс FAISS
             dimension = len(features[0])
             index = faiss.IndexFlatIP(dimension)  # Используем скалярное произведение для сравнения нормализованных векторов
@@ -232,11 +268,32 @@ class ImageSearchService:
             logger.info(f"Индекс успешно создан: {index.ntotal} векторов, размерность {dimension}")
             
             self.faiss_index = index
+            self.image_labels = image_labels
+            self.index_version = self._index_fingerprint(paths)
+            
+            # Результаты поиска по старому индексу больше не актуальны
+            get_cache("search").invalidate()
             return True
         except Exception as e:
             logger.error(f"Ошибка при создании индекса: {e}")
             logger.error(traceback.format_exc())
             return False
+    
+    def _index_fingerprint(self, paths):
+        """
+        Отпечаток индекса: версия модели и размер/время изменения каждого файла.
+        Одинаков после перезапуска, если ни модель, ни эталонные изображения не менялись,
+        поэтому дисковый кэш результатов переживает перезапуск, но не переобучение.
+        """
+        hasher = hashlib.blake2b(digest_size=8)
+        hasher.update(str(self.model_version).encode())
+        for path in sorted(paths):
+            try:
+                stat = os.stat(path)
+                hasher.update(f"{path}:{stat.st_size}:{stat.st_mtime_ns}".encode())
+            except OSError:
+                hasher.update(f"{path}:-".encode())
+        return hasher.hexdigest()
             
     def find_similar_images(self, query_image_path, folder_path=None, top_n=5, similarity_threshold=0.25):
         """
@@ -313,118 +370,131 @@ class ImageSearchService:
             logger.error(traceback.format_exc())
             return []
             
-    def classify_tool_type(self, image_path, clip_text_features=None):
+    def _encode_texts(self, texts, batch_size=64):
         """
-        Классифицирует тип инструмента с использованием CLIP
+        Нормализованные текстовые признаки CLIP
         
         Args:
-            image_path: Путь к изображению
-            clip_text_features: Предварительно рассчитанные текстовые признаки (опционально)
+            texts: Список текстов
+            batch_size: Размер пачки
             
         Returns:
-            Кортеж (тип_инструмента_en, тип_инструмента_ru, уверенность)
+            Матрица (число_текстов, размерность)
         """
-        try:
-            # Инициализируем модель CLIP, если нужно
-            if self.clip_model is None or self.clip_processor is None:
-                if not self.initialize_model():
-                    return "unknown", "Неизвестный инструмент", 0.0
-            
-            # Словарь типов инструментов
-            tool_types = {
-                "drill": "Дрель",
-                "screwdriver": "Отвертка",
-                "hammer": "Молоток",
-                "saw": "Пила",
-                "angle grinder": "Болгарка",
-                "jigsaw": "Лобзик",
-                "wrench": "Ключ",
-                "pliers": "Плоскогубцы",
-                "tape measure": "Рулетка",
-                "level": "Уровень",
-                "impact driver": "Ударный шуруповерт",
-                "circular saw": "Циркулярная пила",
-                "miter saw": "Торцовочная пила",
-                "router": "Фрезер",
-                "sander": "Шлифмашина",
-                "nail gun": "Гвоздезабиватель"
-            }
+        device = next(self.clip_model.parameters()).device
+        chunks = []
+        for start in range(0, len(texts), batch_size):
+            text_inputs = self.clip_processor(
+                text=list(texts[start:start + batch_size]),
+                return_tensors="pt", 
+                padding=True,
+                truncation=True
+            )
+            text_inputs = {k: v.to(device) for k, v in text_inputs.items()}
             
-            # Загружаем изображение
-            image = Image.open(image_path).convert('RGB')
-            
-            # Получаем признаки изображения
-            inputs = self.clip_processor(images=image, return_tensors="pt")
             with torch.no_grad():
-                image_features = self.clip_model.get_image_features(**inputs)
+                text_features = self.clip_model.get_text_features(**text_inputs)
             
-            # Нормализуем вектор признаков
-            image_features = image_features / image_features.norm(dim=-1, keepdim=True)
-            
-            # Если текстовые признаки не предоставлены, вычисляем их
-            if clip_text_features is None:
-                # Проверяем кэш
-                if not self.text_features_cache:
-                    # Вычисляем текстовые признаки для всех типов инструментов
-                    text_inputs = self.clip_processor(
-                        text=["a photo of a " + tool_type for tool_type in tool_types.keys()],
-                        return_tensors="pt", 
-                        padding=True
-                    )
-                    
-                    with torch.no_grad():
-                        text_features = self.clip_model.get_text_features(**text_inputs)
-                        
-                    # Нормализуем
-                    text_features = text_features / text_features.norm(dim=-1, keepdim=True)
-                    
-                    # Сохраняем в кэш
-                    self.text_features_cache = text_features
-                else:
-                    text_features = self.text_features_cache
-            else:
-                text_features = clip_text_features
-            
-            # Вычисляем сходство между изображением и каждым типом инструмента
-            similarity = (100.0 * image_features @ text_features.T).softmax(dim=-1)
-            
-            # Находим наиболее вероятный тип инструмента
-            values, indices = similarity[0].topk(1)
-            
-            # Получаем результат
-            idx = indices.item()
-            confidence = values.item()
-            tool_type_en = list(tool_types.keys())[idx]
-            tool_type_ru = tool_types[tool_type_en]
+            # Нормализуем
+            text_features = text_features / text_features.norm(dim=-1, keepdim=True)
+            chunks.append(text_features.cpu().numpy().astype('float32'))
+        
+        return np.concatenate(chunks)
+    
+    def _ensure_label_bank(self):
+        """Готовит банк категорий для текущей модели (считается один раз на версию модели)"""
+        if self.clip_model is None or self.clip_processor is None:
+            if not self.initialize_model():
+                return False
+        # Стандартный CLIP понимает только английские тексты,
+        # дообученная модель учится на русских описаниях категорий
+        language = "ru" if self.use_fine_tuned else "en"
+        return self.label_bank.ensure(self.model_version, self._encode_texts, language)
+    
+    def classify_tool_types_batch(self, features, clip_text_features=None):
+        """
+        Классифицирует тип инструмента по уже извлеченным векторам изображений
+        
+        Args:
+            features: Матрица нормализованных векторов (число_изображений, размерность)
+            clip_text_features: Предварительно рассчитанные текстовые признаки
+                                в порядке категорий банка (опционально)
             
-            return tool_type_en, tool_type_ru, confidence
+        Returns:
+            Список кортежей (код_категории, название, уверенность)
+        """
+        features = np.asarray(features, dtype='float32')
+        if features.size == 0:
+            return []
+        
+        try:
+            if isinstance(clip_text_features, torch.Tensor):
+                clip_text_features = clip_text_features.cpu().numpy()
+            if not self._ensure_label_bank():
+                return [UNKNOWN_TOOL_TYPE] * len(features)
+            return self.label_bank.classify(features, clip_text_features)
         except Exception as e:
             logger.error(f"Ошибка при классификации типа инструмента: {e}")
             logger.error(traceback.format_exc())
-            return "unknown", "Неизвестный инструмент", 0.0
+            return [UNKNOWN_TOOL_TYPE] * len(features)
+    
+    def classify_tool_type_from_features(self, features, clip_text_features=None):
+        """
+        Классифицирует тип инструмента по уже извлеченному вектору изображения
+        
+        Args:
+            features: Нормализованный вектор признаков изображения
+            clip_text_features: Предварительно рассчитанные текстовые признаки (опционально)
+            
+        Returns:
+            Кортеж (код_категории, название, уверенность)
+        """
+        return self.classify_tool_types_batch(np.asarray(features).reshape(1, -1), clip_text_features)[0]
+    
+    def classify_tool_type(self, image_path, clip_text_features=None, content_hash=None):
+        """
+        Классифицирует тип инструмента с использованием CLIP
+        
+        Args:
+            image_path: Путь к изображению
+            clip_text_features: Предварительно рассчитанные текстовые признаки (опционально)
+            content_hash: Хеш содержимого, если уже посчитан в начале запроса
             
-    def enhance_image_features(self, image_path):
+        Returns:
+            Кортеж (код_категории, название, уверенность)
+        """
+        # Вектор изображения берется из кэша признаков, если уже был посчитан
+        features = self.extract_features(image_path, content_hash)
+        if features is None:
+            return UNKNOWN_TOOL_TYPE
+        return self.classify_tool_type_from_features(features, clip_text_features)
+            
+    def enhance_image_features(self, image_path, content_hash=None):
         """
         Улучшает извлечение признаков из изображения с использованием 
         предобработки и расширенного распознавания
         
         Args:
             image_path: Путь к изображению
+            content_hash: Хеш содержимого, если уже посчитан в начале запроса
             
         Returns:
             Кортеж (вектор_признаков, метаданные) или (None, {}) в случае ошибки
         """
         try:
+            # Хеш нужен и кэшу признаков, и кэшу брендов - файл читается один раз
+            content_hash = content_hash or compute_content_hash(image_path)
+            
             # Сначала извлекаем основные признаки
-            features = self.extract_features(image_path)
+            features = self.extract_features(image_path, content_hash)
             if features is None:
                 return None, {}
             
             # Определяем бренд инструмента
-            brand_name, brand_confidence = recognize_brand(image_path)
+            brand_name, brand_confidence = recognize_brand(image_path, content_hash)
             
-            # Определяем тип инструмента
-            tool_type, type_confidence = self.classify_tool_type(image_path)
+            # Определяем тип инструмента по уже извлеченному вектору
+            tool_type, _, type_confidence = self.classify_tool_type_from_features(features)
             
             # Собираем метаданные
             metadata = {
@@ -484,16 +554,29 @@ class ImageSearchService:
             if similarity_bonuses is None:
                 similarity_bonuses = (0.2, 0.1, 0.3)  # Бонусы для бренда, типа, бренд+тип
             
+            # Хеш содержимого считается один раз на запрос и передается дальше
+            content_hash = compute_content_hash(query_image_path)
+            
             # Проверяем кэш для этого запроса
-            cache_key = f"{query_image_path}_{top_n}_{similarity_threshold}"
-            cached_results = get_cached_search_results(cache_key)
-            if cached_results:
+            search_cache = get_cache("search")
+            cache_key = make_cache_key(
+                content_hash,
+                top_n=top_n,
+                similarity_threshold=similarity_threshold,
+                variation_weights=tuple(variation_weights),
+                similarity_bonuses=tuple(similarity_bonuses),
+                enable_variations=enable_variations,
+                model=self.model_version,
+                index=self.index_version,
+            )
+            cached_results = search_cache.get(cache_key)
+            if cached_results is not None:
                 logger.info(f"Найдены кэшированные результаты для {query_image_path}")
                 return cached_results
             
             # Базовое изображение запроса
             # Используем улучшенное извлечение признаков
-            query_features, query_metadata = self.enhance_image_features(query_image_path)
+            query_features, query_metadata = self.enhance_image_features(query_image_path, content_hash)
             
             if query_features is None:
                 logger.error(f"Не удалось извлечь признаки из {query_image_path}")
@@ -501,7 +584,7 @@ class ImageSearchService:
                 
             # Получаем информацию о бренде и типе инструмента на изображении
             query_brand = query_metadata.get("brand", "Неизвестный")
-            query_tool_type = query_metadata.get("tool_type", "Неизвестный")
+            query_tool_type = query_metadata.get("tool_type", UNKNOWN_TOOL_TYPE[0])
             
             # Словарь для хранения результатов и их оценок
             all_results = {}
@@ -609,11 +692,11 @@ class ImageSearchService:
             # Корректируем оценки схожести
             final_results = {}
             for img_path, similarity in all_results.items():
-                # Получаем метаданные результата
+                # Метки результата посчитаны при построении индекса
                 try:
-                    # Извлекаем бренд и тип из пути или имени файла
-                    result_brand = recognize_brand(img_path)[0]
-                    result_type = self.classify_tool_type(img_path)[0]
+                    labels = self.image_labels.get(img_path, {})
+                    result_brand = labels.get("brand", "Неизвестный")
+                    result_type = labels.get("tool_type", UNKNOWN_TOOL_TYPE[0])
                     
                     # Корректируем схожесть
                     adjusted_similarity = similarity
@@ -623,12 +706,12 @@ class ImageSearchService:
                         adjusted_similarity += brand_bonus
                     
                     # Бонус за совпадение типа инструмента
-                    if query_tool_type != "Неизвестный" and query_tool_type == result_type:
+                    if query_tool_type != UNKNOWN_TOOL_TYPE[0] and query_tool_type == result_type:
                         adjusted_similarity += type_bonus
                     
                     # Дополнительный бонус за совпадение и бренда, и типа
                     if (query_brand != "Неизвестный" and query_brand == result_brand and
-                        query_tool_type != "Неизвестный" and query_tool_type == result_type):
+                        query_tool_type != UNKNOWN_TOOL_TYPE[0] and query_tool_type == result_type):
                         adjusted_similarity += brand_type_bonus
                     
                     # Ограничиваем максимальную схожесть до 1.0
@@ -649,7 +732,7 @@ class ImageSearchService:
             final_results = filtered_results[:top_n]
             
             # Кэшируем результаты
-            cache_search_results(cache_key, final_results)
+            search_cache.set(cache_key, final_results)
             
             return final_results
             
@@ -749,7 +832,7 @@ def classify_tool_type(image_path, clip_text_features=None):
         clip_text_features: Предварительно рассчитанные текстовые признаки (опционально)
         
     Returns:
-        Кортеж (тип_инструмента_en, тип_инструмента_ru, уверенность)
+        Кортеж (код_категории, название, уверенность)
     """
     service = ImageSearchService.get_instance()
     return service.classify_tool_type(image_path, clip_text_features)
@@ -840,98 +923,12 @@ def detect_brand_by_color(image_path):
     Определяет бренд инструмента по цветовой гамме изображения
     
     Args:
-        image_path: Путь к изображению
+        image_path: Путь к изображению или уже декодированный массив (BGR)
         
     Returns:
         Название бренда или None если не удалось определить
     """
-    try:
-        # Загружаем изображение
-        img = cv2.imread(image_path)
-        if img is None:
-            logger.error(f"Не удалось загрузить изображение для определения бренда: {image_path}")
-            return None
-        
-        # Конвертируем в HSV для лучшего анализа цветов
-        hsv = cv2.cvtColor(img, cv2.COLOR_BGR2HSV)
-        
-        # Получаем размеры изображения
-        height, width = img.shape[:2]
-        image_area = height * width
-        
-        # Определяем маски для разных цветов брендов
-        # Makita - синий (расширяем диапазон для лучшего определения)
-        lower_makita = np.array([95, 80, 50])
-        upper_makita = np.array([135, 255, 255])
-        makita_mask = cv2.inRange(hsv, lower_makita, upper_makita)
-        makita_pixels = cv2.countNonZero(makita_mask)
-        
-        # DeWalt - желтый
-        lower_dewalt = np.array([20, 100, 100])
-        upper_dewalt = np.array([40, 255, 255])
-        dewalt_mask = cv2.inRange(hsv, lower_dewalt, upper_dewalt)
-        dewalt_pixels = cv2.countNonZero(dewalt_mask)
-        
-        # Bosch зеленый (для инструментов DIY)
-        lower_bosch_green = np.array([50, 100, 50])
-        upper_bosch_green = np.array([70, 255, 255])
-        bosch_green_mask = cv2.inRange(hsv, lower_bosch_green, upper_bosch_green)
-        bosch_green_pixels = cv2.countNonZero(bosch_green_mask)
-        
-        # Bosch синий (для профессиональных инструментов)
-        lower_bosch_blue = np.array([90, 100, 50])
-        upper_bosch_blue = np.array([120, 255, 255])
-        bosch_blue_mask = cv2.inRange(hsv, lower_bosch_blue, upper_bosch_blue)
-        bosch_blue_pixels = cv2.countNonZero(bosch_blue_mask)
-        
-        # Metabo - зеленый
-        lower_metabo = np.array([70, 100, 50])
-        upper_metabo = np.array([85, 255, 255])
-        metabo_mask = cv2.inRange(hsv, lower_metabo, upper_metabo)
-        metabo_pixels = cv2.countNonZero(metabo_mask)
-        
-        # Вычисляем процент площади каждого цвета
-        makita_percent = makita_pixels / image_area
-        dewalt_percent = dewalt_pixels / image_area
-        bosch_green_percent = bosch_green_pixels / image_area
-        bosch_blue_percent = bosch_blue_pixels / image_area
-        metabo_percent = metabo_pixels / image_area
-        
-        # Снижаем порог для определения бренда с 15% до 10%
-        threshold = 0.10  # 10% от общей площади изображения
-        
-        # Логируем проценты цветов для отладки
-        logger.debug(f"Проценты цветов: Makita синий: {makita_percent:.2f}, DeWalt желтый: {dewalt_percent:.2f}, " 
-                    f"Bosch зеленый: {bosch_green_percent:.2f}, Bosch синий: {bosch_blue_percent:.2f}, "
-                    f"Metabo зеленый: {metabo_percent:.2f}")
-        
-        # Определяем бренд по преобладающему цвету
-        # Приоритет Makita увеличен, учитывая, что синий цвет Makita является ключевым идентификатором
-        if makita_percent > threshold * 0.8:  # Для Makita снижаем порог еще на 20%
-            logger.info(f"Определен бренд Makita с процентом цвета: {makita_percent:.2f}")
-            return "Makita"
-        elif dewalt_percent > threshold:
-            logger.info(f"Определен бренд DeWalt с процентом цвета: {dewalt_percent:.2f}")
-            return "DeWalt"
-        elif bosch_green_percent > threshold:
-            logger.info(f"Определен бренд Bosch (зеленый) с процентом цвета: {bosch_green_percent:.2f}")
-            return "Bosch"
-        elif bosch_blue_percent > threshold:
-            logger.info(f"Определен бренд Bosch (синий) с процентом цвета: {bosch_blue_percent:.2f}")
-            return "Bosch"
-        elif metabo_percent > threshold:
-            logger.info(f"Определен бренд Metabo с процентом цвета: {metabo_percent:.2f}")
-            return "Metabo"
-        
-        # Дополнительная проверка - если больше 5% синего цвета Makita, то это, вероятно, Makita
-        if makita_percent > 0.05:
-            logger.info(f"Определен бренд Makita (по минимальному порогу) с процентом цвета: {makita_percent:.2f}")
-            return "Makita"
-        
-        return None
-    except Exception as e:
-        logger.error(f"Ошибка при определении бренда по цвету: {e}")
-        return None
+    return get_brand_recognizer().detect_dominant_brand(image_path)
 
 
 def detect_tools_on_image(image_path):
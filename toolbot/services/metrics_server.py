@@ -0,0 +1,428 @@
+"""
+HTTP-эндпоинт метрик в формате Prometheus/OpenMetrics
+
+Сервер aiohttp работает в том же цикле событий, что и бот (запускается из
+post_init приложения), и отдает:
+
+    /metrics  - счетчики, датчики и гистограммы мониторинга, кэшей, лимитера
+                запросов и очереди поиска
+    /healthz  - процесс жив и цикл событий отвечает
+    /readyz   - модели загружены и индекс товаров доступен
+
+Формат /metrics выбирается по заголовку Accept: OpenMetrics для Prometheus,
+который его запрашивает, иначе текстовый формат Prometheus 0.0.4.
+"""
+import os
+import sys
+import time
+import sqlite3
+import logging
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+try:
+    from aiohttp import web
+    AIOHTTP_AVAILABLE = True
+except ImportError:
+    AIOHTTP_AVAILABLE = False
+
+logger = logging.getLogger(__name__)
+
+# Порт эндпоинта (0 - не запускать); по умолчанию порт, открытый в Dockerfile.
+# PORT платформы (Railway) намеренно не используется: это публичный порт,
+# а эндпоинты отвечают без авторизации
+METRICS_PORT_ENV = "METRICS_PORT"
+DEFAULT_METRICS_PORT = 8000
+
+OPENMETRICS_CONTENT_TYPE = "application/openmetrics-text; version=1.0.0; charset=utf-8"
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Границы гистограммы длительности этапов (секунды)
+STAGE_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# База товаров, по которой ищет бот
+PRODUCTS_DB_PATH = os.path.join("data", "unified_products.db")
+
+Labels = Dict[str, Any]
+
+
+class MetricsWriter:
+    """Сборка текста метрик по семействам"""
+
+    def __init__(self, openmetrics: bool = True):
+        self.openmetrics = openmetrics
+        self.lines: List[str] = []
+
+    @staticmethod
+    def _escape(value: Any) -> str:
+        return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+    def _labels(self, labels: Optional[Labels]) -> str:
+        if not labels:
+            return ""
+        return "{" + ",".join(f'{key}="{self._escape(value)}"' for key, value in labels.items()) + "}"
+
+    @staticmethod
+    def _value(value: float) -> str:
+        if value == float("inf"):
+            return "+Inf"
+        return repr(float(value))
+
+    def _header(self, name: str, metric_type: str, help_text: str) -> None:
+        self.lines.append(f"# TYPE {name} {metric_type}")
+        self.lines.append(f"# HELP {name} {self._escape(help_text)}")
+
+    def gauge(self, name: str, help_text: str, samples: Iterable[Tuple[Optional[Labels], Optional[float]]]) -> None:
+        """Семейство датчиков: samples - пары (метки, значение)"""
+        samples = [(labels, value) for labels, value in samples if value is not None]
+        if not samples:
+            return
+        self._header(name, "gauge", help_text)
+        for labels, value in samples:
+            self.lines.append(f"{name}{self._labels(labels)} {self._value(value)}")
+
+    def counter(self, name: str, help_text: str, samples: Iterable[Tuple[Optional[Labels], Optional[float]]]) -> None:
+        """Семейство счетчиков; name без суффикса _total"""
+        samples = [(labels, value) for labels, value in samples if value is not None]
+        if not samples:
+            return
+        # В OpenMetrics семейство называется без _total, в формате 0.0.4 - с ним
+        self._header(name if self.openmetrics else f"{name}_total", "counter", help_text)
+        for labels, value in samples:
+            self.lines.append(f"{name}_total{self._labels(labels)} {self._value(value)}")
+
+    def histogram(self, name: str, help_text: str,
+                  samples: Iterable[Tuple[Optional[Labels], List[Tuple[float, int]], float, int]]) -> None:
+        """Семейство гистограмм: samples - (метки, [(граница, накопленное количество)], сумма, количество)"""
+        samples = list(samples)
+        if not samples:
+            return
+        self._header(name, "histogram", help_text)
+        for labels, buckets, total_sum, count in samples:
+            labels = dict(labels or {})
+            for bound, cumulative in buckets:
+                bucket_labels = dict(labels, le=self._value(bound))
+                self.lines.append(f"{name}_bucket{self._labels(bucket_labels)} {cumulative}")
+            self.lines.append(f"{name}_bucket{self._labels(dict(labels, le='+Inf'))} {count}")
+            self.lines.append(f"{name}_sum{self._labels(labels)} {self._value(total_sum)}")
+            self.lines.append(f"{name}_count{self._labels(labels)} {count}")
+
+    def render(self) -> str:
+        if self.openmetrics:
+            self.lines.append("# EOF")
+        return "\n".join(self.lines) + "\n"
+
+
+# Проверки готовности: имя -> функция без аргументов, возвращающая True/False
+_readiness_checks: Dict[str, Callable[[], bool]] = {}
+
+def register_readiness_check(name: str, check: Callable[[], bool]) -> None:
+    """
+    Регистрирует проверку готовности для /readyz.
+
+    Args:
+        name: Название проверки
+        check: Функция без аргументов, возвращающая True, если компонент готов
+    """
+    _readiness_checks[name] = check
+
+
+def _search_model_loaded() -> bool:
+    """CLIP модель поиска по отделам загружена и прогрета"""
+    photo_handler = sys.modules.get("handlers.photo_handler")
+    service = getattr(photo_handler, "_department_search_service", None)
+    return service is not None and getattr(service, "ready", False)
+
+
+def _products_index_available() -> bool:
+    """База товаров открывается и содержит векторы"""
+    if not os.path.exists(PRODUCTS_DB_PATH):
+        return False
+    conn = sqlite3.connect(f"file:{PRODUCTS_DB_PATH}?mode=ro", uri=True, timeout=1)
+    try:
+        return conn.execute("SELECT 1 FROM products WHERE vector IS NOT NULL LIMIT 1").fetchone() is not None
+    finally:
+        conn.close()
+
+
+register_readiness_check("search_model", _search_model_loaded)
+register_readiness_check("products_index", _products_index_available)
+
+
+def run_readiness_checks() -> Dict[str, bool]:
+    """Результаты всех проверок готовности"""
+    results = {}
+    for name, check in list(_readiness_checks.items()):
+        try:
+            results[name] = bool(check())
+        except Exception as e:
+            logger.warning(f"⚠️ Проверка готовности '{name}' завершилась ошибкой: {e}")
+            results[name] = False
+    return results
+
+
+def _collect_monitoring(writer: MetricsWriter) -> None:
+    """Мониторинг: запросы, задержки, пользователи, система"""
+    from toolbot.services.monitoring import monitoring
+
+    performance = monitoring.performance_monitor
+    writer.counter("toolbot_requests", "Обработанные запросы по операциям и результату", [
+        *(({"operation": op, "result": "success"}, count) for op, count in list(performance.success_counts.items())),
+        *(({"operation": op, "result": "error"}, count) for op, count in list(performance.error_counts.items())),
+    ])
+
+    # Квантили времени ответа за последний час по операциям
+    samples = []
+    for operation, stats in performance.response_times.aggregate_by_operation(seconds=3600).items():
+        for key, quantile in (("p50", "0.5"), ("p95", "0.95"), ("p99", "0.99")):
+            if stats[key] is not None:
+                samples.append(({"operation": operation, "quantile": quantile}, stats[key] / 1000.0))
+    writer.gauge("toolbot_response_time_seconds", "Время ответа за последний час", samples)
+
+    writer.gauge("toolbot_active_users", "Пользователи, активные за последние 30 минут", [
+        (None, len(monitoring.user_activity_monitor.get_active_users(30))),
+    ])
+    writer.gauge("toolbot_uptime_seconds", "Время работы бота", [
+        (None, time.time() - monitoring.system_monitor.start_time),
+    ])
+
+    metrics = monitoring.system_monitor.get_current_metrics()
+    process = metrics.get("process") or {}
+    event_loop = metrics.get("event_loop") or {}
+    writer.gauge("toolbot_system_cpu_percent", "Загрузка CPU системы", [(None, metrics["cpu"]["usage_percent"])])
+    writer.gauge("toolbot_system_memory_percent", "Использование памяти системы", [(None, metrics["memory"]["usage_percent"])])
+    writer.gauge("toolbot_system_disk_percent", "Использование диска", [(None, metrics["disk"]["usage_percent"])])
+    writer.gauge("toolbot_process_resident_memory_bytes", "RSS процесса бота", [
+        (None, process["rss_mb"] * 1024 * 1024 if process.get("rss_mb") is not None else None),
+    ])
+    writer.gauge("toolbot_process_cpu_percent", "Загрузка CPU процессом бота", [(None, process.get("cpu_percent"))])
+    writer.gauge("toolbot_process_threads", "Потоки процесса бота", [(None, process.get("threads"))])
+    writer.gauge("toolbot_process_open_fds", "Открытые файловые дескрипторы", [(None, process.get("open_fds"))])
+    writer.gauge("toolbot_torch_threads", "Потоки torch", [(None, process.get("torch_threads"))])
+    if event_loop.get("attached"):
+        writer.gauge("toolbot_event_loop_lag_seconds", "Задержка цикла событий", [
+            ({"kind": "last"}, event_loop["lag_ms"] / 1000.0),
+            ({"kind": "max"}, event_loop["max_lag_ms"] / 1000.0),
+        ])
+
+
+def _collect_stages(writer: MetricsWriter) -> None:
+    """Гистограммы длительности этапов конвейера поиска"""
+    from toolbot.utils.latency_sketch import get_stage_metrics
+
+    samples = []
+    for stage, sketch in get_stage_metrics().get_sketches().items():
+        if not sketch.count:
+            continue
+        # Скетч хранит миллисекунды, границы гистограммы - в секундах
+        cumulative = sketch.cumulative_counts([bound * 1000.0 for bound in STAGE_BUCKETS])
+        samples.append(({"stage": stage}, list(zip(STAGE_BUCKETS, cumulative)), sketch.sum / 1000.0, sketch.count))
+    writer.histogram("toolbot_stage_duration_seconds", "Длительность этапов поиска по фото", samples)
+
+
+def _collect_caches(writer: MetricsWriter) -> None:
+    """Кэши: пространства имен CacheManager и кэш результатов поиска по отделам"""
+    from toolbot.utils.cache_manager import get_cache_stats
+
+    stats = get_cache_stats()
+    writer.counter("toolbot_cache_hits", "Попадания в кэш", [
+        *(({"namespace": ns, "tier": "memory"}, s["memory_hits"]) for ns, s in stats.items()),
+        *(({"namespace": ns, "tier": "disk"}, s["disk_hits"]) for ns, s in stats.items()),
+    ])
+    writer.counter("toolbot_cache_misses", "Промахи кэша", [({"namespace": ns}, s["misses"]) for ns, s in stats.items()])
+    writer.counter("toolbot_cache_errors", "Ошибки кэша", [({"namespace": ns}, s["errors"]) for ns, s in stats.items()])
+    writer.gauge("toolbot_cache_items", "Записи в кэше", [
+        *(({"namespace": ns, "tier": "memory"}, s["memory_items"]) for ns, s in stats.items()),
+        *(({"namespace": ns, "tier": "disk"}, s["disk_items"]) for ns, s in stats.items()),
+    ])
+    writer.gauge("toolbot_cache_memory_bytes", "Объем кэша в памяти", [
+        ({"namespace": ns}, s["memory_bytes"]) for ns, s in stats.items()
+    ])
+
+    # Кэш результатов поиска по отделам - только если модуль уже загружен
+    result_cache_module = sys.modules.get("services.search_result_cache")
+    if result_cache_module is not None:
+        result_stats = result_cache_module.get_result_cache().get_stats()
+        writer.counter("toolbot_search_result_cache_lookups", "Обращения к кэшу результатов поиска", [
+            ({"result": "hit"}, result_stats["hits"] - result_stats["near_hits"]),
+            ({"result": "near_hit"}, result_stats["near_hits"]),
+            ({"result": "miss"}, result_stats["misses"]),
+        ])
+        writer.gauge("toolbot_search_result_cache_entries", "Записи в кэше результатов поиска", [
+            (None, result_stats["entries"]),
+        ])
+
+
+def _collect_rate_limiter(writer: MetricsWriter) -> None:
+    """Лимитер запросов"""
+    from toolbot.utils.rate_limiter import RateLimiter
+
+    if RateLimiter._instance is None:
+        return
+    stats = RateLimiter._instance.get_stats()
+    writer.counter("toolbot_rate_limit_decisions", "Решения лимитера запросов", [
+        *(({"action": action, "result": "allowed"}, count) for action, count in stats["allowed"].items()),
+        *(({"action": action, "result": "rejected"}, count) for action, count in stats["rejected"].items()),
+    ])
+    writer.gauge("toolbot_rate_limit_tracked_entries", "Записи состояния лимитера", [(None, stats["tracked_entries"])])
+    writer.counter("toolbot_rate_limit_evicted", "Удаленные неактивные записи лимитера", [(None, stats["evicted_entries"])])
+
+
+def _collect_search_queue(writer: MetricsWriter) -> None:
+    """Очередь поиска по фото (контроль допуска)"""
+    admission_module = sys.modules.get("services.admission_control")
+    if admission_module is None:
+        return
+    stats = admission_module.get_admission_controller().get_stats()
+    writer.gauge("toolbot_search_active", "Выполняющиеся поиски по фото", [(None, stats["active"])])
+    writer.gauge("toolbot_search_queued", "Поиски в очереди", [(None, stats["queued"])])
+    writer.gauge("toolbot_search_concurrency_limit", "Лимит одновременных поисков", [(None, stats["max_concurrent"])])
+    writer.counter("toolbot_search_admissions", "Допуски к поиску", [
+        ({"result": "admitted"}, stats["admitted"]),
+        ({"result": "rejected"}, stats["rejected"]),
+        ({"result": "degraded"}, stats["degraded"]),
+    ])
+    writer.gauge("toolbot_search_service_time_seconds", "Сглаженное время выполнения поиска", [
+        (None, stats["avg_service_time"]),
+    ])
+
+
+def _collect_event_loop(writer: MetricsWriter) -> None:
+    """Блокировки цикла событий и их худшие виновники"""
+    from toolbot.utils.loop_monitor import get_loop_monitor
+
+    loop_monitor = get_loop_monitor()
+    if not loop_monitor.attached:
+        return
+    stats = loop_monitor.get_stats()
+    writer.counter("toolbot_event_loop_stalls", "Блокировки цикла событий дольше порога", [(None, stats["stalls_total"])])
+    writer.counter("toolbot_event_loop_stall_seconds", "Суммарное время блокировок цикла событий", [
+        (None, stats["stall_time_ms"] / 1000.0),
+    ])
+    offenders = stats["top_offenders"]
+    writer.counter("toolbot_event_loop_offender_stalls", "Блокировки цикла по обработчикам", [
+        ({"handler": item["handler"], "update_type": item["update_type"]}, item["count"]) for item in offenders
+    ])
+    writer.counter("toolbot_event_loop_offender_stall_seconds", "Время блокировок цикла по обработчикам", [
+        ({"handler": item["handler"], "update_type": item["update_type"]}, item["total_ms"] / 1000.0) for item in offenders
+    ])
+
+
+def _collect_logging(writer: MetricsWriter) -> None:
+    """Очередь асинхронного логирования и прореженные записи"""
+    logging_module = sys.modules.get("toolbot.utils.enhanced_logging")
+    if logging_module is None:
+        return
+    stats = logging_module.LoggingManager.get_instance().get_logging_stats()
+    writer.gauge("toolbot_log_queue_size", "Записи лога, ожидающие потока-писателя", [(None, stats["queue_size"])])
+    writer.counter("toolbot_log_sampled_out", "Записи лога, отброшенные прореживанием", [
+        ({"category": category}, count) for category, count in stats["sampled_out"].items()
+    ])
+
+
+COLLECTORS = (_collect_monitoring, _collect_stages, _collect_caches, _collect_rate_limiter, _collect_search_queue,
+              _collect_event_loop, _collect_logging)
+
+
+def render_metrics(openmetrics: bool = True) -> str:
+    """
+    Текст всех метрик.
+
+    Args:
+        openmetrics: True - формат OpenMetrics, False - текстовый формат Prometheus 0.0.4
+    """
+    writer = MetricsWriter(openmetrics)
+    for collector in COLLECTORS:
+        try:
+            collector(writer)
+        except Exception as e:
+            logger.error(f"❌ Ошибка при сборе метрик {collector.__name__}: {e}")
+    return writer.render()
+
+
+async def _metrics_handler(request):
+    openmetrics = "application/openmetrics-text" in request.headers.get("Accept", "")
+    body = render_metrics(openmetrics)
+    return web.Response(
+        body=body.encode("utf-8"),
+        headers={"Content-Type": OPENMETRICS_CONTENT_TYPE if openmetrics else PROMETHEUS_CONTENT_TYPE},
+    )
+
+
+async def _healthz_handler(request):
+    # Обработчик выполняется в цикле событий бота, значит цикл отвечает
+    return web.json_response({"status": "ok"})
+
+
+async def _readyz_handler(request):
+    checks = run_readiness_checks()
+    ready = all(checks.values())
+    return web.json_response({"status": "ready" if ready else "not_ready", "checks": checks},
+                             status=200 if ready else 503)
+
+
+class MetricsServer:
+    """HTTP-сервер метрик в цикле событий бота"""
+
+    def __init__(self, host: str = "0.0.0.0", port: int = DEFAULT_METRICS_PORT):
+        self.host = host
+        self.port = port
+        self._runner = None
+
+    async def start(self) -> bool:
+        """
+        Запуск сервера.
+
+        Returns:
+            True если сервер запущен
+        """
+        if not AIOHTTP_AVAILABLE:
+            logger.warning("⚠️ aiohttp не установлен, эндпоинт метрик не запущен")
+            return False
+
+        app = web.Application()
+        app.router.add_get("/metrics", _metrics_handler)
+        app.router.add_get("/healthz", _healthz_handler)
+        app.router.add_get("/readyz", _readyz_handler)
+
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+        logger.info(f"📡 Эндпоинт метрик запущен: http://{self.host}:{self.port}/metrics")
+        return True
+
+    async def stop(self) -> None:
+        """Остановка сервера"""
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+
+# Глобальный экземпляр сервера
+_metrics_server = None
+
+async def start_metrics_server() -> Optional[MetricsServer]:
+    """Запуск эндпоинта метрик на порту из METRICS_PORT (по умолчанию 8000)"""
+    global _metrics_server
+    if _metrics_server is not None:
+        return _metrics_server
+
+    port = int(os.environ.get(METRICS_PORT_ENV) or DEFAULT_METRICS_PORT)
+    if port <= 0:
+        logger.info("Эндпоинт метрик отключен")
+        return None
+
+    server = MetricsServer(port=port)
+    try:
+        if await server.start():
+            _metrics_server = server
+    except Exception as e:
+        logger.error(f"❌ Не удалось запустить эндпоинт метрик на порту {port}: {e}")
+    return _metrics_server
+
+
+async def stop_metrics_server() -> None:
+    """Остановка эндпоинта метрик"""
+    global _metrics_server
+    if _metrics_server is not None:
+        await _metrics_server.stop()
+        _metrics_server = None
@@ -2,29 +2,18 @@
 Модуль для real-time мониторинга системы и активности пользователей
 """
 import asyncio
-import psutil
 import time
 from datetime import datetime, timedelta
 import json
-import threading
-from collections import defaultdict, deque
+from collections import defaultdict
 from typing import Dict, List, Optional, Any
 import logging
 
-# Импорт GPUtil с обработкой ошибок для IDE
-try:
-    import GPUtil  # type: ignore # noqa: F401
-    GPU_AVAILABLE = True
-except ImportError as e:
-    GPU_AVAILABLE = False
-    # Не показываем warning при первом импорте, только при использовании
-
-# Импорт PyTorch с обработкой ошибок
-try:
-    import torch
-    TORCH_AVAILABLE = True
-except ImportError as e:
-    TORCH_AVAILABLE = False
+from toolbot.utils.cache_manager import get_cache_stats
+from toolbot.utils.metrics_store import MetricsStore
+from toolbot.utils.latency_sketch import get_stage_metrics
+from toolbot.utils.system_sampler import get_system_sampler
+from toolbot.utils.loop_monitor import get_loop_monitor
 
 logger = logging.getLogger(__name__)
 
@@ -34,201 +23,63 @@ class SystemMonitor:
     
     def __init__(self):
         self.start_time = time.time()
-        self.metrics_history = deque(maxlen=1440)  # 24 часа по минутам
-        self.is_running = False
-        self.monitor_thread = None
+        self.sampler = get_system_sampler()
+    
+    @property
+    def is_running(self) -> bool:
+        return self.sampler.is_running
+    
+    @property
+    def metrics_history(self):
+        """История снимков метрик (2 часа при интервале 5 секунд)"""
+        return self.sampler.history
         
     def start_monitoring(self):
         """Запуск мониторинга в отдельном потоке"""
         if not self.is_running:
-            self.is_running = True
-            self.monitor_thread = threading.Thread(target=self._monitor_loop, daemon=True)
-            self.monitor_thread.start()
+            self.sampler.start()
             logger.info("🔍 Мониторинг системы запущен")
     
     def stop_monitoring(self):
         """Остановка мониторинга"""
-        self.is_running = False
-        if self.monitor_thread:
-            self.monitor_thread.join()
+        self.sampler.stop()
         logger.info("⏹️ Мониторинг системы остановлен")
     
-    def _monitor_loop(self):
-        """Основной цикл мониторинга"""
-        while self.is_running:
-            try:
-                metrics = self.collect_system_metrics()
-                self.metrics_history.append({
-                    'timestamp': datetime.now().isoformat(),
-                    'metrics': metrics
-                })
-                time.sleep(5)  # Обновление каждые 5 секунд
-            except Exception as e:
-                # Используем безопасное логирование чтобы избежать ошибок форматирования
-                logger.error("Ошибка в мониторинге: %s", str(e))
-                time.sleep(10)
-    
     def collect_system_metrics(self) -> Dict[str, Any]:
-        """Сбор текущих метрик системы"""
-        metrics = {}
-        
-        # CPU метрики
-        cpu_percent = psutil.cpu_percent(interval=1)
-        cpu_freq = psutil.cpu_freq()
-        metrics['cpu'] = {
-            'usage_percent': cpu_percent,
-            'frequency_mhz': cpu_freq.current if cpu_freq else None,
-            'cores_logical': psutil.cpu_count(),
-            'cores_physical': psutil.cpu_count(logical=False)
-        }
-        
-        # Память
-        memory = psutil.virtual_memory()
-        metrics['memory'] = {
-            'total_gb': round(memory.total / (1024**3), 2),
-            'used_gb': round(memory.used / (1024**3), 2),
-            'available_gb': round(memory.available / (1024**3), 2),
-            'usage_percent': memory.percent
-        }
-        
-        # Диск
-        try:
-            # Используем правильный путь для Windows/Linux
-            import platform
-            disk_path = 'C:\\' if platform.system() == 'Windows' else '/'
-            disk = psutil.disk_usage(disk_path)
-            metrics['disk'] = {
-                'total_gb': round(disk.total / (1024**3), 2),
-                'used_gb': round(disk.used / (1024**3), 2),
-                'free_gb': round(disk.free / (1024**3), 2),
-                'usage_percent': round((disk.used / disk.total) * 100, 1)
-            }
-        except Exception as e:
-            # Логируем ошибку с экранированием символов
-            logger.error("Ошибка получения информации о диске: %s", str(e))
-            metrics['disk'] = {
-                'total_gb': 0,
-                'used_gb': 0,
-                'free_gb': 0,
-                'usage_percent': 0
-            }
-        
-        # Сеть
-        network = psutil.net_io_counters()
-        metrics['network'] = {
-            'bytes_sent': network.bytes_sent,
-            'bytes_recv': network.bytes_recv,
-            'packets_sent': network.packets_sent,
-            'packets_recv': network.packets_recv
-        }
-        
-        # GPU метрики (если доступно)
-        if GPU_AVAILABLE:
-            metrics['gpu'] = self._get_gpu_metrics()
-        elif TORCH_AVAILABLE and torch.cuda.is_available():
-            metrics['gpu'] = self._get_torch_gpu_metrics()
-        else:
-            metrics['gpu'] = None
-            
-        return metrics
-    
-    def _get_gpu_metrics(self) -> Optional[Dict]:
-        """Получение GPU метрик через GPUtil"""
-        try:
-            if not GPU_AVAILABLE:
-                return None
-                
-            # Локальный импорт для избежания ошибок IDE
-            import GPUtil  # type: ignore
-            
-            gpus = GPUtil.getGPUs()
-            if not gpus:
-                return None
-                
-            gpu = gpus[0]  # Берем первую GPU
-            return {
-                'name': gpu.name,
-                'temperature_c': gpu.temperature,
-                'usage_percent': round(gpu.load * 100, 1),
-                'memory_total_mb': gpu.memoryTotal,
-                'memory_used_mb': gpu.memoryUsed,
-                'memory_free_mb': gpu.memoryFree,
-                'memory_usage_percent': round((gpu.memoryUsed / gpu.memoryTotal) * 100, 1)
-            }
-        except Exception as e:
-            logger.error("Ошибка получения GPU метрик: %s", str(e))
-            return None
-    
-    def _get_torch_gpu_metrics(self) -> Optional[Dict]:
-        """Получение GPU метрик через PyTorch"""
-        try:
-            if not torch.cuda.is_available():
-                return None
-                
-            device = torch.cuda.current_device()
-            props = torch.cuda.get_device_properties(device)
-            
-            memory_reserved = torch.cuda.memory_reserved(device)
-            memory_allocated = torch.cuda.memory_allocated(device)
-            memory_total = props.total_memory
-            
-            return {
-                'name': props.name,
-                'memory_total_mb': round(memory_total / (1024**2), 1),
-                'memory_allocated_mb': round(memory_allocated / (1024**2), 1),
-                'memory_reserved_mb': round(memory_reserved / (1024**2), 1),
-                'memory_usage_percent': round((memory_allocated / memory_total) * 100, 1),
-                'compute_capability': f"{props.major}.{props.minor}"
-            }
-        except Exception as e:
-            logger.error("Ошибка получения PyTorch GPU метрик: %s", str(e))
-            return None
+        """Сбор текущих метрик системы (без ожидания, загрузка CPU - с прошлого замера)"""
+        return self.sampler.sample()
     
     def get_current_metrics(self) -> Dict[str, Any]:
-        """Получение текущих метрик"""
-        return self.collect_system_metrics()
+        """Получение текущих метрик из последнего снимка фонового сборщика"""
+        return self.sampler.get_metrics()
     
     def get_metrics_history(self, minutes: int = 60) -> List[Dict]:
         """Получение истории метрик за последние N минут"""
-        cutoff_time = datetime.now() - timedelta(minutes=minutes)
-        
-        filtered_metrics = []
-        for entry in self.metrics_history:
-            entry_time = datetime.fromisoformat(entry['timestamp'])
-            if entry_time >= cutoff_time:
-                filtered_metrics.append(entry)
-                
-        return filtered_metrics
+        return self.sampler.get_history(minutes)
 
 
 class UserActivityMonitor:
     """Мониторинг активности пользователей"""
     
     def __init__(self):
-        self.active_users = {}  # user_id -> last_activity_time
-        self.user_sessions = defaultdict(list)  # user_id -> [session_data]
+        self.active_users = {}  # user_id -> {last_activity (epoch), activity_type, additional_data}
+        self.first_seen = {}  # user_id -> время первой активности (epoch)
         self.hourly_stats = defaultdict(int)  # hour -> user_count
         self.daily_stats = defaultdict(int)  # date -> user_count
-        self.request_queue = deque(maxlen=1000)  # Очередь запросов
+        self.request_queue = MetricsStore(capacity=4096)  # Последние запросы: время и тип активности
         
     def log_user_activity(self, user_id: int, activity_type: str, additional_data: Dict = None):
         """Логирование активности пользователя"""
-        now = datetime.now()
+        now_ts = time.time()
+        now = datetime.fromtimestamp(now_ts)
         
         # Обновляем активного пользователя
         self.active_users[user_id] = {
-            'last_activity': now,
-            'activity_type': activity_type,
-            'additional_data': additional_data or {}
-        }
-        
-        # Логируем сессию
-        session_data = {
-            'timestamp': now.isoformat(),
+            'last_activity': now_ts,
             'activity_type': activity_type,
             'additional_data': additional_data or {}
         }
-        self.user_sessions[user_id].append(session_data)
+        self.first_seen.setdefault(user_id, now_ts)
         
         # Обновляем статистику
         hour_key = now.strftime('%Y-%m-%d %H:00')
@@ -237,39 +88,32 @@ class UserActivityMonitor:
         self.daily_stats[date_key] += 1
         
         # Добавляем в очередь запросов
-        self.request_queue.append({
-            'timestamp': now.isoformat(),
-            'user_id': user_id,
-            'activity_type': activity_type
-        })
+        self.request_queue.append(activity_type, timestamp=now_ts)
     
     def get_active_users(self, minutes: int = 30) -> Dict[int, Dict]:
         """Получение активных пользователей за последние N минут"""
-        cutoff_time = datetime.now() - timedelta(minutes=minutes)
+        now_ts = time.time()
+        cutoff_time = now_ts - minutes * 60
         
         active = {}
-        for user_id, user_data in self.active_users.items():
+        for user_id, user_data in list(self.active_users.items()):
             if user_data['last_activity'] >= cutoff_time:
                 active[user_id] = {
-                    'last_activity': user_data['last_activity'].isoformat(),
+                    'last_activity': datetime.fromtimestamp(user_data['last_activity']).isoformat(),
                     'activity_type': user_data['activity_type'],
-                    'minutes_ago': int((datetime.now() - user_data['last_activity']).total_seconds() / 60)
+                    'minutes_ago': int((now_ts - user_data['last_activity']) / 60)
                 }
                 
         return active
     
     def get_request_queue_status(self) -> Dict[str, Any]:
         """Статус очереди запросов"""
-        now = datetime.now()
-        recent_requests = [
-            req for req in self.request_queue 
-            if (now - datetime.fromisoformat(req['timestamp'])).seconds < 300  # 5 минут
-        ]
+        recent_requests = self.request_queue.count(seconds=300)  # 5 минут
         
         return {
             'total_in_queue': len(self.request_queue),
-            'recent_5min': len(recent_requests),
-            'avg_per_minute': len(recent_requests) / 5 if recent_requests else 0
+            'recent_5min': recent_requests,
+            'avg_per_minute': recent_requests / 5 if recent_requests else 0
         }
     
     def get_activity_statistics(self) -> Dict[str, Any]:
@@ -286,18 +130,15 @@ class UserActivityMonitor:
         requests_today = self.daily_stats.get(today_key, 0)
         
         # Новые пользователи за сегодня
-        today_start = now.replace(hour=0, minute=0, second=0, microsecond=0)
-        new_users_today = len([
-            user_id for user_id, sessions in self.user_sessions.items()
-            if sessions and datetime.fromisoformat(sessions[0]['timestamp']) >= today_start
-        ])
+        today_start = now.replace(hour=0, minute=0, second=0, microsecond=0).timestamp()
+        new_users_today = sum(1 for first_seen in list(self.first_seen.values()) if first_seen >= today_start)
         
         return {
             'active_now': len(self.get_active_users(30)),
             'requests_last_hour': requests_last_hour,
             'requests_today': requests_today,
             'new_users_today': new_users_today,
-            'total_registered_users': len(self.user_sessions),
+            'total_registered_users': len(self.first_seen),
             'queue_status': self.get_request_queue_status()
         }
 
@@ -306,21 +147,14 @@ class PerformanceMonitor:
     """Мониторинг производительности бота"""
     
     def __init__(self):
-        self.response_times = deque(maxlen=1000)
+        self.response_times = MetricsStore(capacity=4096)  # operation, response_time_ms, success
         self.error_counts = defaultdict(int)
         self.success_counts = defaultdict(int)
-        self.model_performance = defaultdict(list)
+        self.model_performance = MetricsStore(capacity=2048)  # model_name, inference_time_ms, accuracy
         
     def log_response_time(self, operation: str, response_time_ms: float, success: bool = True):
         """Логирование времени ответа"""
-        now = datetime.now()
-        
-        self.response_times.append({
-            'timestamp': now.isoformat(),
-            'operation': operation,
-            'response_time_ms': response_time_ms,
-            'success': success
-        })
+        self.response_times.append(operation, response_time_ms, success)
         
         if success:
             self.success_counts[operation] += 1
@@ -329,48 +163,44 @@ class PerformanceMonitor:
             
     def log_model_performance(self, model_name: str, inference_time_ms: float, accuracy: float = None):
         """Логирование производительности модели"""
-        self.model_performance[model_name].append({
-            'timestamp': datetime.now().isoformat(),
-            'inference_time_ms': inference_time_ms,
-            'accuracy': accuracy
-        })
-        
-        # Оставляем только последние 100 записей для каждой модели
-        if len(self.model_performance[model_name]) > 100:
-            self.model_performance[model_name] = self.model_performance[model_name][-100:]
+        self.model_performance.append(model_name, inference_time_ms, extra=accuracy)
     
     def get_performance_stats(self) -> Dict[str, Any]:
         """Получение статистики производительности"""
-        if not self.response_times:
+        if not self.response_times.total:
             return {'no_data': True}
             
         # Средние времена ответа за последние 100 запросов
-        recent_times = list(self.response_times)[-100:]
-        avg_response_time = sum(rt['response_time_ms'] for rt in recent_times) / len(recent_times)
+        recent = self.response_times.aggregate(last_n=100)
         
         # Процент успешных запросов
         total_success = sum(self.success_counts.values())
         total_errors = sum(self.error_counts.values())
         total_requests = total_success + total_errors
-        success_rate = (total_success / total_requests * 100) if total_requests > 0 else 0
+        success_rate = ((total_requests - total_errors) / total_requests * 100) if total_requests > 0 else 0
         
         # Статистика по моделям
         model_stats = {}
-        for model_name, performances in self.model_performance.items():
-            if performances:
-                recent_perfs = performances[-20:]  # Последние 20 запусков
-                avg_inference = sum(p['inference_time_ms'] for p in recent_perfs) / len(recent_perfs)
-                model_stats[model_name] = {
-                    'avg_inference_ms': round(avg_inference, 1),
-                    'total_runs': len(performances)
-                }
+        for model_name, performances in self.model_performance.aggregate_by_operation().items():
+            recent_perfs = self.model_performance.aggregate(operation=model_name, last_n=20)  # Последние 20 запусков
+            model_stats[model_name] = {
+                'avg_inference_ms': round(recent_perfs['mean'], 1),
+                'p95_inference_ms': round(performances['p95'], 1),
+                'total_runs': self.model_performance.operation_total(model_name)
+            }
         
         return {
-            'avg_response_time_ms': round(avg_response_time, 1),
+            'avg_response_time_ms': round(recent['mean'], 1),
+            'p50_response_time_ms': round(recent['p50'], 1),
+            'p95_response_time_ms': round(recent['p95'], 1),
+            'p99_response_time_ms': round(recent['p99'], 1),
             'success_rate_percent': round(success_rate, 1),
             'total_requests': total_requests,
             'total_errors': total_errors,
-            'model_stats': model_stats
+            'operations': self.response_times.aggregate_by_operation(seconds=3600),
+            'model_stats': model_stats,
+            'stages': get_stage_metrics().get_summary(),
+            'bottleneck_stage': get_stage_metrics().get_bottleneck()
         }
 
 
@@ -388,7 +218,8 @@ class RealTimeMonitoring:
             'gpu_usage': 95,
             'gpu_temperature': 80,
             'response_time_ms': 1000,
-            'error_rate_percent': 10
+            'error_rate_percent': 10,
+            'loop_stall_ms': 1000
         }
     
     def start(self):
@@ -407,6 +238,7 @@ class RealTimeMonitoring:
         activity_stats = self.user_activity_monitor.get_activity_statistics()
         performance_stats = self.performance_monitor.get_performance_stats()
         active_users = self.user_activity_monitor.get_active_users()
+        loop_stats = get_loop_monitor().get_stats()
         
         # Проверка алертов
         alerts = self._check_alerts(system_metrics, performance_stats)
@@ -418,6 +250,8 @@ class RealTimeMonitoring:
             'performance': performance_stats,
             'active_users': active_users,
             'alerts': alerts,
+            'cache': get_cache_stats(),
+            'event_loop': loop_stats,
             'uptime_seconds': int(time.time() - self.system_monitor.start_time)
         }
     
@@ -480,6 +314,17 @@ class RealTimeMonitoring:
                     'timestamp': datetime.now().isoformat()
                 })
         
+        # Проверка блокировок цикла событий за последние 5 минут
+        long_stalls = [stall for stall in get_loop_monitor().stalls_since(300)
+                       if stall['duration_ms'] > self.alert_thresholds['loop_stall_ms']]
+        if long_stalls:
+            worst = max(long_stalls, key=lambda stall: stall['duration_ms'])
+            alerts.append({
+                'type': 'warning',
+                'message': f"Цикл событий заблокирован на {worst['duration_ms']:.0f}ms: {worst['handler']}",
+                'timestamp': datetime.now().isoformat()
+            })
+        
         return alerts
     
     # Методы для логирования активности (используются в других частях бота)
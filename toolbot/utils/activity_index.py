@@ -0,0 +1,306 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Инкрементальные индексы активности пользователей для админских отчетов.
+
+- LastSeenIndex - куча по времени последней активности с ленивым удалением:
+  при новой активности в кучу добавляется запись, старая запись пользователя
+  остается и пропускается при чтении. Обход кучи в порядке убывания времени
+  идет по ее неявному дереву через вспомогательную кучу, поэтому "последние k
+  пользователей" и "активные с момента t" стоят O(k log k), а не O(n).
+- HyperLogLog - оценка числа уникальных пользователей за день (1 КБ на день
+  при точности около 3%); дни объединяются поэлементным максимумом.
+- Счетчики поисков по отделам за каждый день.
+
+Индексы поддерживаются при каждой записи активности в Analytics и сохраняются
+вместе с ее статистикой.
+"""
+
+import math
+import time
+import heapq
+import base64
+import hashlib
+import itertools
+import threading
+from collections import Counter, OrderedDict
+from datetime import datetime, timedelta
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+# Точность HyperLogLog: 2^10 регистров, стандартная ошибка ~3.25%
+DEFAULT_HLL_PRECISION = 10
+
+# Сколько дней хранить дневные скетчи и счетчики
+DEFAULT_RETENTION_DAYS = 35
+
+# Перестроение кучи, когда устаревших записей больше, чем актуальных
+COMPACT_SLACK = 1024
+
+# Записи лога, которые не являются действиями пользователя (доставка рассылки)
+PASSIVE_ACTIVITY_TYPES = {"broadcast_received"}
+
+
+def _day_key(timestamp: float) -> str:
+    return datetime.fromtimestamp(timestamp).strftime("%Y-%m-%d")
+
+
+class HyperLogLog:
+    """Оценка количества уникальных элементов"""
+
+    __slots__ = ("p", "m", "registers")
+
+    def __init__(self, p: int = DEFAULT_HLL_PRECISION, registers: Optional[bytes] = None):
+        self.p = p
+        self.m = 1 << p
+        self.registers = bytearray(registers) if registers is not None else bytearray(self.m)
+
+    def add(self, item: Any) -> None:
+        x = int.from_bytes(hashlib.blake2b(str(item).encode(), digest_size=8).digest(), "big")
+        index = x >> (64 - self.p)
+        rest = x & ((1 << (64 - self.p)) - 1)
+        rank = (64 - self.p) - rest.bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def merge(self, other: "HyperLogLog") -> None:
+        """Объединение с другим скетчем той же точности"""
+        if other.p != self.p:
+            raise ValueError("Скетчи с разной точностью нельзя объединить")
+        self.registers = bytearray(map(max, self.registers, other.registers))
+
+    def count(self) -> int:
+        m = self.m
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / sum(2.0 ** -r for r in self.registers)
+        zeros = self.registers.count(0)
+        # Поправка для малых значений: линейный подсчет по пустым регистрам
+        if estimate <= 2.5 * m and zeros:
+            estimate = m * math.log(m / zeros)
+        return int(round(estimate))
+
+    def to_str(self) -> str:
+        return base64.b64encode(bytes(self.registers)).decode("ascii")
+
+    @classmethod
+    def from_str(cls, data: str, p: int = DEFAULT_HLL_PRECISION) -> "HyperLogLog":
+        return cls(p, base64.b64decode(data))
+
+
+class LastSeenIndex:
+    """Пользователи, упорядоченные по времени последней активности"""
+
+    def __init__(self):
+        self._last_seen: Dict[int, float] = {}
+        # Записи (-время, user_id): вершина кучи - самая свежая активность
+        self._heap: List[Tuple[float, int]] = []
+
+    def __len__(self) -> int:
+        return len(self._last_seen)
+
+    def get(self, user_id: int) -> Optional[float]:
+        return self._last_seen.get(user_id)
+
+    def touch(self, user_id: int, timestamp: float) -> None:
+        """Обновление времени последней активности"""
+        previous = self._last_seen.get(user_id)
+        if previous is not None and previous >= timestamp:
+            return
+        self._last_seen[user_id] = timestamp
+        heapq.heappush(self._heap, (-timestamp, user_id))
+        if len(self._heap) > 2 * len(self._last_seen) + COMPACT_SLACK:
+            self._compact()
+
+    def _compact(self) -> None:
+        """Удаление устаревших записей: O(n), амортизированно O(1) на обновление"""
+        self._heap = [(-timestamp, user_id) for user_id, timestamp in self._last_seen.items()]
+        heapq.heapify(self._heap)
+
+    def iter_recent(self, since: Optional[float] = None) -> Iterator[Tuple[int, float]]:
+        """
+        Пользователи в порядке убывания последней активности.
+
+        Куча не меняется: обход идет по ее неявному дереву (дети позиции i -
+        2i+1 и 2i+2), а кандидаты на следующий шаг лежат во вспомогательной
+        куче. Каждый шаг стоит O(log k).
+
+        Args:
+            since: Остановиться на активности раньше этого времени
+        """
+        heap = self._heap
+        if not heap:
+            return
+        frontier = [(heap[0], 0)]
+        while frontier:
+            (neg_timestamp, user_id), position = heapq.heappop(frontier)
+            timestamp = -neg_timestamp
+            # У потомков в куче время не больше, поэтому дальше только более старые
+            if since is not None and timestamp < since:
+                return
+            if self._last_seen.get(user_id) == timestamp:
+                yield user_id, timestamp
+            for child in (2 * position + 1, 2 * position + 2):
+                if child < len(heap):
+                    heapq.heappush(frontier, (heap[child], child))
+
+    def most_recent(self, k: int, since: Optional[float] = None) -> List[Tuple[int, float]]:
+        """Последние k активных пользователей"""
+        return list(itertools.islice(self.iter_recent(since), k))
+
+    def count_since(self, since: float) -> int:
+        """Количество пользователей, активных начиная с since"""
+        return sum(1 for _ in self.iter_recent(since))
+
+
+class ActivityIndex:
+    """Индексы активности: последняя активность, уникальные за день, поиски по отделам"""
+
+    def __init__(self, retention_days: int = DEFAULT_RETENTION_DAYS, precision: int = DEFAULT_HLL_PRECISION):
+        self.retention_days = retention_days
+        self.precision = precision
+        self.last_seen = LastSeenIndex()
+        self.daily_users: "OrderedDict[str, HyperLogLog]" = OrderedDict()
+        # День -> {отдел: [поисков, неудачных]}
+        self.daily_departments: "OrderedDict[str, Dict[str, List[int]]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _trim(self, days: OrderedDict) -> None:
+        while len(days) > self.retention_days:
+            days.popitem(last=False)
+
+    def _day_entry(self, days: OrderedDict, day: str, factory):
+        entry = days.get(day)
+        if entry is None:
+            latest = next(reversed(days), None)
+            entry = days[day] = factory()
+            # Обычно дни идут по порядку; при восстановлении из логов - нет
+            if latest is not None and day < latest:
+                ordered = sorted(days.items())
+                days.clear()
+                days.update(ordered)
+            self._trim(days)
+        return entry
+
+    def touch(self, user_id: int, timestamp: Optional[float] = None) -> None:
+        """Учет активности пользователя"""
+        timestamp = time.time() if timestamp is None else timestamp
+        with self._lock:
+            self.last_seen.touch(user_id, timestamp)
+            hll = self._day_entry(self.daily_users, _day_key(timestamp), lambda: HyperLogLog(self.precision))
+            hll.add(user_id)
+
+    def record_department(self, department: str, success: bool, timestamp: Optional[float] = None) -> None:
+        """Учет поиска по отделу"""
+        timestamp = time.time() if timestamp is None else timestamp
+        with self._lock:
+            departments = self._day_entry(self.daily_departments, _day_key(timestamp), dict)
+            counts = departments.setdefault(department, [0, 0])
+            counts[0] += 1
+            if not success:
+                counts[1] += 1
+
+    def most_recent(self, k: int, since: Optional[float] = None) -> List[Tuple[int, float]]:
+        with self._lock:
+            return self.last_seen.most_recent(k, since)
+
+    def iter_recent(self, since: Optional[float] = None) -> List[Tuple[int, float]]:
+        with self._lock:
+            return list(self.last_seen.iter_recent(since))
+
+    def count_active(self, seconds: float) -> int:
+        """Точное количество пользователей, активных за последние N секунд"""
+        with self._lock:
+            return self.last_seen.count_since(time.time() - seconds)
+
+    def _last_days(self, days: int) -> List[str]:
+        today = datetime.now().date()
+        return [(today - timedelta(days=offset)).strftime("%Y-%m-%d") for offset in range(days)]
+
+    def unique_users(self, days: int = 1) -> int:
+        """Оценка уникальных пользователей за последние N дней (HyperLogLog)"""
+        with self._lock:
+            merged = HyperLogLog(self.precision)
+            for day in self._last_days(days):
+                hll = self.daily_users.get(day)
+                if hll is not None:
+                    merged.merge(hll)
+            return merged.count()
+
+    def department_counts(self, days: int = 7) -> Dict[str, Dict[str, int]]:
+        """Поиски по отделам за последние N дней: {отдел: {total, failures}}"""
+        totals = Counter()
+        failures = Counter()
+        with self._lock:
+            for day in self._last_days(days):
+                for department, (total, failed) in self.daily_departments.get(day, {}).items():
+                    totals[department] += total
+                    failures[department] += failed
+        return {department: {'total': totals[department], 'failures': failures[department]}
+                for department in totals}
+
+    def top_departments(self, k: int = 5, days: int = 7) -> List[Tuple[str, int]]:
+        """Самые популярные отделы за последние N дней"""
+        counts = self.department_counts(days)
+        return heapq.nlargest(k, ((department, stats['total']) for department, stats in counts.items()),
+                              key=lambda item: item[1])
+
+    def rebuild(self, users: Dict[str, Dict[str, Any]], saved: Optional[Dict[str, Any]] = None) -> None:
+        """
+        Построение индексов при загрузке статистики.
+
+        Последняя активность берется из пользователей; дневные скетчи и счетчики -
+        из сохраненного состояния, а если его нет - восстанавливаются по логам
+        активности пользователей (последние записи каждого).
+        """
+        with self._lock:
+            self.last_seen = LastSeenIndex()
+            self.daily_users = OrderedDict()
+            self.daily_departments = OrderedDict()
+
+            for user_id_str, user_data in users.items():
+                if not isinstance(user_data, dict):
+                    continue
+                try:
+                    user_id = int(user_id_str)
+                except (TypeError, ValueError):
+                    continue
+                last_seen = user_data.get("last_seen", user_data.get("first_seen", 0))
+                if isinstance(last_seen, (int, float)):
+                    self.last_seen.touch(user_id, float(last_seen))
+
+            if saved:
+                for day, data in sorted(saved.get("daily_users", {}).items()):
+                    self.daily_users[day] = HyperLogLog.from_str(data, self.precision)
+                for day, departments in sorted(saved.get("daily_departments", {}).items()):
+                    self.daily_departments[day] = {department: list(counts)
+                                                   for department, counts in departments.items()}
+                self._trim(self.daily_users)
+                self._trim(self.daily_departments)
+                return
+
+        cutoff = time.time() - self.retention_days * 86400
+        for user_id_str, user_data in users.items():
+            if not isinstance(user_data, dict):
+                continue
+            try:
+                user_id = int(user_id_str)
+            except (TypeError, ValueError):
+                continue
+            for activity in user_data.get("activity_log", []):
+                if activity.get("type") in PASSIVE_ACTIVITY_TYPES:
+                    continue
+                timestamp = activity.get("timestamp", 0)
+                if isinstance(timestamp, (int, float)) and timestamp >= cutoff:
+                    with self._lock:
+                        hll = self._day_entry(self.daily_users, _day_key(timestamp),
+                                              lambda: HyperLogLog(self.precision))
+                        hll.add(user_id)
+
+    def to_dict(self) -> Dict[str, Any]:
+        """Состояние дневных скетчей и счетчиков для сохранения"""
+        with self._lock:
+            return {
+                "daily_users": {day: hll.to_str() for day, hll in self.daily_users.items()},
+                "daily_departments": {day: {department: list(counts) for department, counts in departments.items()}
+                                      for day, departments in self.daily_departments.items()},
+            }
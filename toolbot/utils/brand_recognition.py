@@ -10,9 +10,10 @@ import logging
 import cv2
 import numpy as np
 import os
-from collections import Counter
 from typing import Dict, List, Tuple, Optional, Union
 
+from toolbot.utils.cache_manager import get_cache, compute_content_hash, make_cache_key
+
 logger = logging.getLogger(__name__)
 
 # Расширенная база цветовых шаблонов для брендов
@@ -132,6 +133,78 @@ BRAND_COLOR_TEMPLATES = {
     }
 }
 
+# Рабочий размер изображения для анализа цветов (по большей стороне)
+WORKING_SIZE = 128
+
+# Правила определения бренда по преобладающему цвету: (бренд, нижний_HSV, верхний_HSV, порог доли площади).
+# Правила проверяются по порядку, первое сработавшее определяет бренд
+DOMINANT_COLOR_RULES = [
+    # Приоритет Makita увеличен - синий цвет является ключевым идентификатором
+    ("Makita", np.array([95, 80, 50]), np.array([135, 255, 255]), 0.08),
+    ("DeWalt", np.array([20, 100, 100]), np.array([40, 255, 255]), 0.10),
+    # Bosch зеленый (для инструментов DIY) и синий (профессиональные)
+    ("Bosch", np.array([50, 100, 50]), np.array([70, 255, 255]), 0.10),
+    ("Bosch", np.array([90, 100, 50]), np.array([120, 255, 255]), 0.10),
+    ("Metabo", np.array([70, 100, 50]), np.array([85, 255, 255]), 0.10),
+]
+# Если ни одно правило не сработало: больше 5% синего Makita - вероятно Makita
+DOMINANT_FALLBACK_THRESHOLD = 0.05
+
+
+class ColorBoxHistogram:
+    """
+    Гистограмма HSV, границы бинов которой совпадают с границами всех цветовых диапазонов.
+
+    Бины по тону и насыщенности (и яркости - для черных, белых и серых шаблонов)
+    строятся так, что каждый диапазон [нижний, верхний] состоит из целых бинов.
+    Поэтому доли всех диапазонов получаются точно, одним умножением матрицы
+    диапазонов на гистограмму, посчитанную за один проход по пикселям.
+    """
+
+    def __init__(self, boxes: List[Tuple[np.ndarray, np.ndarray]]):
+        """
+        Args:
+            boxes: Список цветовых диапазонов (нижний_HSV, верхний_HSV), границы включительно
+        """
+        lowers = np.array([lower for lower, _ in boxes], dtype=np.int32).reshape(-1, 3)
+        uppers = np.array([upper for _, upper in boxes], dtype=np.int32).reshape(-1, 3)
+
+        self.luts = []
+        channel_masks = []
+        for channel in range(3):
+            edges = np.unique(np.concatenate(([0], lowers[:, channel], uppers[:, channel] + 1)))
+            edges = edges[edges <= 255]
+            # Номер бина для каждого значения канала 0..255
+            self.luts.append((np.searchsorted(edges, np.arange(256), side='right') - 1).astype(np.int32))
+            # Бин входит в диапазон, если его начало лежит внутри диапазона
+            channel_masks.append(
+                (edges[None, :] >= lowers[:, channel, None]) & (edges[None, :] <= uppers[:, channel, None])
+            )
+
+        self.shape = tuple(mask.shape[1] for mask in channel_masks)
+        h_mask, s_mask, v_mask = channel_masks
+        self.box_matrix = (
+            h_mask[:, :, None, None] & s_mask[:, None, :, None] & v_mask[:, None, None, :]
+        ).reshape(len(boxes), -1).astype(np.float32)
+
+    def fractions(self, hsv: np.ndarray) -> np.ndarray:
+        """
+        Доли площади изображения, попадающие в каждый диапазон.
+
+        Args:
+            hsv: Изображение в HSV (OpenCV, uint8)
+
+        Returns:
+            Вектор долей длиной len(boxes)
+        """
+        h = self.luts[0][hsv[..., 0]]
+        s = self.luts[1][hsv[..., 1]]
+        v = self.luts[2][hsv[..., 2]]
+        bins = (h * self.shape[1] + s) * self.shape[2] + v
+        counts = np.bincount(bins.ravel(), minlength=self.box_matrix.shape[1]).astype(np.float32)
+        return self.box_matrix @ counts / max(bins.size, 1)
+
+
 class BrandRecognizer:
     """
     Класс для распознавания брендов строительных инструментов.
@@ -145,71 +218,108 @@ class BrandRecognizer:
             brand_templates: Словарь шаблонов брендов или None для использования стандартного
         """
         self.brand_templates = brand_templates or BRAND_COLOR_TEMPLATES
+        
+        # Все шаблоны в плоском виде: матрица весов (бренды x шаблоны) и нормировка по брендам
+        self.brands = list(self.brand_templates.keys())
+        boxes = []
+        weights = np.zeros((len(self.brands), sum(len(c) for c in self.brand_templates.values())), dtype=np.float32)
+        for brand_idx, color_dict in enumerate(self.brand_templates.values()):
+            for lower_hsv, upper_hsv, weight in color_dict.values():
+                weights[brand_idx, len(boxes)] = weight
+                boxes.append((lower_hsv, upper_hsv))
+        self.template_weights = weights
+        self.brand_norms = np.maximum(np.log1p(100) * weights.sum(axis=1), 1e-9)
+        self.template_count = len(boxes)
+        
+        # Диапазоны правил преобладающего цвета считаются по той же гистограмме
+        boxes.extend((lower, upper) for _, lower, upper, _ in DOMINANT_COLOR_RULES)
+        self.histogram = ColorBoxHistogram(boxes)
+        
         logger.info(f"Инициализирован распознаватель брендов с {len(self.brand_templates)} шаблонами")
     
-    def recognize_brand_by_color(self, image_path: str, min_confidence: float = 0.35) -> Tuple[Optional[str], float]:
+    def _to_hsv(self, image: Union[str, np.ndarray], is_rgb: bool = False) -> Optional[np.ndarray]:
+        """
+        Загружает изображение, уменьшает до рабочего размера и переводит в HSV.
+        
+        Args:
+            image: Путь к файлу, массив (BGR по умолчанию) или PIL.Image
+            is_rgb: Массив в порядке каналов RGB
+            
+        Returns:
+            Изображение в HSV или None
+        """
+        if isinstance(image, str):
+            # JPEG декодируется сразу в уменьшенном виде
+            img = cv2.imread(image, cv2.IMREAD_REDUCED_COLOR_4)
+            if img is None:
+                logger.error(f"Не удалось загрузить изображение: {image}")
+                return None
+        elif hasattr(image, 'convert'):
+            img = np.asarray(image.convert('RGB'))
+            is_rgb = True
+        else:
+            img = np.asarray(image)
+        
+        if img.ndim == 2:
+            img = cv2.cvtColor(img, cv2.COLOR_GRAY2BGR)
+            is_rgb = False
+        elif img.shape[2] == 4:
+            img = img[:, :, :3]
+        
+        height, width = img.shape[:2]
+        scale = WORKING_SIZE / max(height, width)
+        if scale < 1:
+            # Грубое прореживание перед усреднением - для больших кадров в разы быстрее
+            step = int(1 / scale) // 2
+            if step > 1:
+                img = img[::step, ::step]
+            img = cv2.resize(img, (max(1, int(width * scale)), max(1, int(height * scale))),
+                             interpolation=cv2.INTER_AREA)
+        
+        return cv2.cvtColor(img, cv2.COLOR_RGB2HSV if is_rgb else cv2.COLOR_BGR2HSV)
+    
+    def color_fractions(self, image: Union[str, np.ndarray], is_rgb: bool = False) -> Optional[np.ndarray]:
+        """
+        Доли площади для всех цветовых диапазонов (шаблоны брендов, затем правила преобладающего цвета).
+        
+        Args:
+            image: Путь к файлу, массив (BGR по умолчанию) или PIL.Image
+            is_rgb: Массив в порядке каналов RGB
+            
+        Returns:
+            Вектор долей или None, если изображение не загружено
+        """
+        hsv = self._to_hsv(image, is_rgb)
+        if hsv is None:
+            return None
+        return self.histogram.fractions(hsv)
+    
+    def recognize_brand_by_color(self, image: Union[str, np.ndarray], min_confidence: float = 0.35,
+                                 is_rgb: bool = False) -> Tuple[Optional[str], float]:
         """
         Распознает бренд инструмента по цветовой гамме изображения.
         
         Args:
-            image_path: Путь к изображению
+            image: Путь к изображению, уже декодированный массив (BGR по умолчанию) или PIL.Image
             min_confidence: Минимальный уровень уверенности для распознавания
+            is_rgb: Массив в порядке каналов RGB
             
         Returns:
             Кортеж (название_бренда, уверенность) или (None, 0.0) если бренд не определен
         """
         try:
-            # Загружаем изображение
-            img = cv2.imread(image_path)
-            if img is None:
-                logger.error(f"Не удалось загрузить изображение: {image_path}")
+            fractions = self.color_fractions(image, is_rgb)
+            if fractions is None:
                 return None, 0.0
             
-            # Конвертируем в HSV для лучшего анализа цветов
-            hsv = cv2.cvtColor(img, cv2.COLOR_BGR2HSV)
-            
-            # Получаем размеры изображения
-            height, width = img.shape[:2]
-            image_area = height * width
-            
-            # Словарь для хранения оценок брендов
-            brand_scores = {}
-            
-            # Для каждого бренда вычисляем его оценку
-            for brand, color_dict in self.brand_templates.items():
-                # Общая оценка бренда
-                brand_score = 0.0
-                
-                # Перебираем все цвета бренда
-                for color_name, (lower_hsv, upper_hsv, weight) in color_dict.items():
-                    # Создаем маску для текущего цвета
-                    color_mask = cv2.inRange(hsv, lower_hsv, upper_hsv)
-                    
-                    # Подсчитываем количество пикселей данного цвета
-                    color_pixels = cv2.countNonZero(color_mask)
-                    
-                    # Вычисляем долю пикселей данного цвета от общей площади
-                    color_percent = color_pixels / image_area
-                    
-                    # Добавляем к оценке бренда с учетом веса цвета
-                    # Используем логарифмическую шкалу для уменьшения влияния очень больших областей
-                    if color_percent > 0:
-                        brand_score += (np.log1p(color_percent * 100) * weight)
-                    
-                    logger.debug(f"Бренд {brand}, цвет {color_name}: {color_percent:.4f} * {weight} = {color_percent * weight:.4f}")
-                
-                # Нормализуем оценку бренда (максимальная возможная оценка зависит от суммы весов)
-                total_weight = sum(weight for _, _, weight in color_dict.values())
-                if total_weight > 0:
-                    brand_score = brand_score / (np.log1p(100) * total_weight)
-                
-                brand_scores[brand] = brand_score
-                logger.debug(f"Общая оценка бренда {brand}: {brand_score:.4f}")
+            # Оценка бренда: сумма log1p(доля * 100) * вес по его цветам, нормированная на максимум.
+            # Логарифмическая шкала уменьшает влияние очень больших областей
+            terms = np.log1p(fractions[:self.template_count] * 100)
+            brand_scores = self.template_weights @ terms / self.brand_norms
             
-            # Находим бренд с максимальной оценкой
-            if brand_scores:
-                best_brand = max(brand_scores.items(), key=lambda x: x[1])
-                brand_name, confidence = best_brand
+            if brand_scores.size:
+                best_idx = int(np.argmax(brand_scores))
+                brand_name, confidence = self.brands[best_idx], float(brand_scores[best_idx])
                 
                 # Проверяем, превышает ли уверенность минимальный порог
                 if confidence >= min_confidence:
@@ -226,6 +336,42 @@ class BrandRecognizer:
             logger.error(traceback.format_exc())
             return None, 0.0
     
+    def detect_dominant_brand(self, image: Union[str, np.ndarray], is_rgb: bool = False) -> Optional[str]:
+        """
+        Определяет бренд по преобладающему фирменному цвету (правила DOMINANT_COLOR_RULES).
+        
+        Args:
+            image: Путь к изображению, уже декодированный массив (BGR по умолчанию) или PIL.Image
+            is_rgb: Массив в порядке каналов RGB
+            
+        Returns:
+            Название бренда или None если не удалось определить
+        """
+        try:
+            fractions = self.color_fractions(image, is_rgb)
+            if fractions is None:
+                return None
+            
+            rule_fractions = fractions[self.template_count:]
+            logger.debug("Проценты цветов: " + ", ".join(
+                f"{brand}: {fraction:.2f}" for (brand, _, _, _), fraction in zip(DOMINANT_COLOR_RULES, rule_fractions)
+            ))
+            
+            for (brand, _, _, threshold), fraction in zip(DOMINANT_COLOR_RULES, rule_fractions):
+                if fraction > threshold:
+                    logger.info(f"Определен бренд {brand} с процентом цвета: {fraction:.2f}")
+                    return brand
+            
+            if rule_fractions[0] > DOMINANT_FALLBACK_THRESHOLD:
+                brand = DOMINANT_COLOR_RULES[0][0]
+                logger.info(f"Определен бренд {brand} (по минимальному порогу) с процентом цвета: {rule_fractions[0]:.2f}")
+                return brand
+            
+            return None
+        except Exception as e:
+            logger.error(f"Ошибка при определении бренда по цвету: {e}")
+            return None
+    
     def recognize_brand_from_filename(self, filename: str) -> str:
         """
         Определяет бренд инструмента по имени файла.
@@ -331,18 +477,34 @@ def get_brand_recognizer() -> BrandRecognizer:
     return _brand_recognizer
 
 
-def recognize_brand(image_path: str) -> Tuple[str, float]:
+def recognize_brand(image_path: str, content_hash: Optional[str] = None) -> Tuple[str, float]:
     """
     Распознавание бренда инструмента по изображению.
     
     Args:
         image_path: Путь к изображению
+        content_hash: Хеш содержимого, если уже посчитан в начале запроса
         
     Returns:
         Кортеж (название_бренда, уверенность)
     """
     recognizer = get_brand_recognizer()
-    return recognizer.enhance_recognition_with_filename(image_path)
+    
+    # Результат зависит от содержимого и от имени файла
+    try:
+        cache_key = make_cache_key(content_hash or compute_content_hash(image_path),
+                                   filename=os.path.basename(image_path))
+    except OSError:
+        return recognizer.enhance_recognition_with_filename(image_path)
+    
+    brand_cache = get_cache("brand")
+    cached = brand_cache.get(cache_key)
+    if cached is not None:
+        return cached
+    
+    result = recognizer.enhance_recognition_with_filename(image_path)
+    brand_cache.set(cache_key, result)
+    return result
 
 
 def get_known_brands() -> List[str]:
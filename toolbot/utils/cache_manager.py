@@ -5,439 +5,664 @@
 Система кэширования для оптимизации обработки запросов.
 Предоставляет функционал для сохранения и извлечения результатов поиска,
 что позволяет избежать повторной обработки одинаковых запросов.
+
+Кэш двухуровневый:
+- в памяти - LRU на OrderedDict с ограничением по числу элементов и по объему в байтах;
+- на диске - один файл SQLite со сроком жизни каждой записи.
+
+Кэш разделен на пространства имен ("search", "detect", "embedding", "brand")
+со своими сроком жизни, бюджетами и метриками попаданий.
+
+Ключ строится из хеша содержимого изображения и параметров запроса (make_cache_key).
+Хеш считается один раз в точке входа запроса (compute_content_hash) и передается
+вложенным вызовам через параметр content_hash (извлечение признаков, бренд,
+детекция), чтобы не перечитывать файл при каждом обращении к кэшу.
 """
 
 import os
 import time
 import pickle
+import sqlite3
 import hashlib
 import logging
-from pathlib import Path
-from typing import Dict, List, Tuple, Any, Optional
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Dict, Tuple, Any, Optional, Union
 import threading
 
+# Быстрый некриптографический хеш, при отсутствии xxhash используется blake2b
+try:
+    import xxhash
+    XXHASH_AVAILABLE = True
+except ImportError:
+    XXHASH_AVAILABLE = False
+
 logger = logging.getLogger(__name__)
 
-class SearchCache:
+# Размер блока чтения файла при хешировании
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def compute_content_hash(source: Union[str, bytes, bytearray, memoryview]) -> str:
     """
-    Система кэширования результатов поиска изображений.
-    Использует в памяти LRU-кэш и персистентное хранение на диске.
+    Хеш содержимого изображения для ключа кэша.
+
+    Args:
+        source: Путь к файлу или содержимое файла
+
+    Returns:
+        Шестнадцатеричная строка хеша (128 бит)
     """
-    
-    _instance = None
-    _lock = threading.Lock()
-    
-    @classmethod
-    def get_instance(cls, cache_dir="cache", max_memory_items=100, max_disk_items=1000, ttl=86400):
+    hasher = xxhash.xxh3_128() if XXHASH_AVAILABLE else hashlib.blake2b(digest_size=16)
+
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        hasher.update(source)
+    else:
+        with open(source, 'rb') as f:
+            for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+                hasher.update(chunk)
+
+    return hasher.hexdigest()
+
+
+def _params_digest(params: Optional[Dict]) -> str:
+    """Короткий хеш параметров запроса"""
+    params_str = repr(sorted((params or {}).items()))
+    return hashlib.blake2b(params_str.encode('utf-8'), digest_size=8).hexdigest()
+
+
+class MemoryLRU:
+    """
+    LRU-кэш в памяти с ограничением по количеству элементов и по объему.
+
+    Все операции выполняются за O(1): порядок использования хранится в OrderedDict,
+    при обращении элемент переносится в конец, вытесняются элементы из начала.
+    Потокобезопасность обеспечивает вызывающий код.
+    """
+
+    def __init__(self, max_items: int = 100, max_bytes: int = 64 * 1024 * 1024):
         """
-        Получение экземпляра кэша (шаблон Singleton).
-        
         Args:
-            cache_dir: Директория для хранения файлов кэша
-            max_memory_items: Максимальное количество элементов в памяти
-            max_disk_items: Максимальное количество элементов на диске
-            ttl: Время жизни элементов кэша в секундах (по умолчанию 24 часа)
-            
+            max_items: Максимальное количество элементов
+            max_bytes: Максимальный суммарный объем элементов в байтах
+        """
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        # {ключ: (данные, размер, время_истечения)}
+        self._items: "OrderedDict[str, Tuple[Any, int, float]]" = OrderedDict()
+        self.total_bytes = 0
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def get(self, key: str, now: float) -> Tuple[bool, Any]:
+        """
+        Получение элемента.
+
         Returns:
-            Экземпляр SearchCache
+            Пара (найден, данные); просроченный элемент удаляется
         """
-        if cls._instance is None:
-            with cls._lock:
-                if cls._instance is None:
-                    cls._instance = cls(cache_dir, max_memory_items, max_disk_items, ttl)
-        return cls._instance
+        entry = self._items.get(key)
+        if entry is None:
+            return False, None
+
+        data, _, expires_at = entry
+        if expires_at <= now:
+            self.pop(key)
+            return False, None
 
-    def __init__(self, cache_dir="cache", max_memory_items=100, max_disk_items=1000, ttl=86400):
+        self._items.move_to_end(key)
+        return True, data
+
+    def put(self, key: str, data: Any, size: int, expires_at: float) -> None:
+        """Добавление элемента с вытеснением давно не использованных"""
+        self.pop(key)
+        if size > self.max_bytes:
+            # Элемент больше всего бюджета - в памяти не держим
+            return
+
+        self._items[key] = (data, size, expires_at)
+        self.total_bytes += size
+
+        while len(self._items) > self.max_items or self.total_bytes > self.max_bytes:
+            _, (_, old_size, _) = self._items.popitem(last=False)
+            self.total_bytes -= old_size
+
+    def pop(self, key: str) -> None:
+        """Удаление элемента"""
+        entry = self._items.pop(key, None)
+        if entry is not None:
+            self.total_bytes -= entry[1]
+
+    def pop_prefix(self, prefix: str) -> int:
+        """Удаление всех элементов, ключ которых начинается с префикса"""
+        keys = [key for key in self._items if key.startswith(prefix)]
+        for key in keys:
+            self.pop(key)
+        return len(keys)
+
+    def clear(self) -> None:
+        """Очистка кэша"""
+        self._items.clear()
+        self.total_bytes = 0
+
+
+class DiskCacheStore:
+    """
+    Дисковый уровень кэша в одном файле SQLite.
+
+    Каждое пространство имен хранится в своей таблице общего файла. Каждая запись хранит срок жизни и время последнего доступа. Время доступа
+    обновляется не при каждом чтении, а пачками, чтобы чтение из кэша не
+    превращалось в запись на диск.
+    """
+
+    SCHEMA = [
+        """CREATE TABLE IF NOT EXISTS {table} (
+            key TEXT PRIMARY KEY,
+            grp TEXT NOT NULL,
+            created_at REAL NOT NULL,
+            last_access REAL NOT NULL,
+            expires_at REAL NOT NULL,
+            size INTEGER NOT NULL,
+            data BLOB NOT NULL
+        )""",
+        "CREATE INDEX IF NOT EXISTS idx_{table}_grp ON {table}(grp)",
+        "CREATE INDEX IF NOT EXISTS idx_{table}_last_access ON {table}(last_access)",
+        "CREATE INDEX IF NOT EXISTS idx_{table}_expires_at ON {table}(expires_at)",
+    ]
+
+    def __init__(self, db_path: str, table: str = "cache_entries", max_items: int = 1000,
+                 access_flush_interval: float = 30.0, access_flush_batch: int = 64):
         """
-        Инициализация кэш-менеджера.
-        
         Args:
-            cache_dir: Директория для хранения файлов кэша
-            max_memory_items: Максимальное количество элементов в памяти
-            max_disk_items: Максимальное количество элементов на диске
-            ttl: Время жизни элементов кэша в секундах (по умолчанию 24 часа)
+            db_path: Путь к файлу базы кэша
+            table: Имя таблицы записей
+            max_items: Максимальное количество записей
+            access_flush_interval: Интервал сброса времени доступа на диск, секунд
+            access_flush_batch: Сколько накопленных обращений вызывает досрочный сброс
         """
-        self.cache_dir = cache_dir
-        self.max_memory_items = max_memory_items
-        self.max_disk_items = max_disk_items
-        self.ttl = ttl
-        
-        # Кэш в памяти: {ключ: (время_последнего_доступа, данные)}
-        self.memory_cache: Dict[str, Tuple[float, Any]] = {}
-        
-        # Создаем директорию кэша если не существует
-        os.makedirs(cache_dir, exist_ok=True)
-        
-        # Загружаем метаданные кэша с диска
-        self.metadata_path = os.path.join(cache_dir, "cache_metadata.pkl")
-        self.load_metadata()
-        
-        logger.info(f"✅ Система кэширования инициализирована (TTL: {ttl}s, макс.элементов: {max_memory_items} в памяти, {max_disk_items} на диске)")
-
-    def load_metadata(self):
-        """Загрузка метаданных кэша с диска"""
-        # Метаданные: {ключ: (время_создания, время_последнего_доступа, имя_файла)}
-        self.metadata: Dict[str, Tuple[float, float, str]] = {}
-        
-        if os.path.exists(self.metadata_path):
-            try:
-                with open(self.metadata_path, 'rb') as f:
-                    self.metadata = pickle.load(f)
-                logger.debug(f"Загружены метаданные кэша: {len(self.metadata)} записей")
-                
-                # Очищаем просроченные элементы
-                self._cleanup_expired()
-            except Exception as e:
-                logger.error(f"Ошибка при загрузке метаданных кэша: {e}")
-                self.metadata = {}
-    
-    def save_metadata(self):
-        """Сохранение метаданных кэша на диск"""
+        self.db_path = db_path
+        self.table = table
+        self.max_items = max_items
+        self.access_flush_interval = access_flush_interval
+        self.access_flush_batch = access_flush_batch
+
+        self._lock = threading.Lock()
+        self._pending_access: Dict[str, float] = {}
+        self._last_flush = time.time()
+
+        os.makedirs(os.path.dirname(db_path) or '.', exist_ok=True)
+        self._conn = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None, timeout=10)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        for statement in self.SCHEMA:
+            self._conn.execute(statement.format(table=table))
+        self._count = self._conn.execute(f'SELECT COUNT(*) FROM {self.table}').fetchone()[0]
+
+    def count(self) -> int:
+        """Количество записей на диске"""
+        return self._count
+
+    def get(self, key: str, now: float) -> Optional[bytes]:
+        """Чтение записи; просроченная запись удаляется"""
+        with self._lock:
+            row = self._conn.execute(
+                f'SELECT data, expires_at FROM {self.table} WHERE key = ?', (key,)
+            ).fetchone()
+            if row is None:
+                return None
+
+            data, expires_at = row
+            if expires_at <= now:
+                self._delete_where('key = ?', (key,))
+                return None
+
+            self._pending_access[key] = now
+            self._maybe_flush_access(now)
+            return data
+
+    def put(self, key: str, group: str, data: bytes, ttl: float, now: float) -> None:
+        """Запись с вытеснением давно не использованных записей при превышении лимита"""
+        with self._lock:
+            self._pending_access.pop(key, None)
+            existed = self._conn.execute(
+                f'SELECT 1 FROM {self.table} WHERE key = ?', (key,)
+            ).fetchone() is not None
+            self._conn.execute(
+                f'INSERT OR REPLACE INTO {self.table} (key, grp, created_at, last_access, expires_at, size, data) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (key, group, now, now, now + ttl, len(data), data)
+            )
+            if not existed:
+                self._count += 1
+
+            if self._count > self.max_items:
+                self._evict(now)
+
+    def delete_group(self, group: str) -> int:
+        """Удаление всех записей группы (например, всех результатов для одного изображения)"""
+        with self._lock:
+            return self._delete_where('grp = ?', (group,))
+
+    def clear(self) -> None:
+        """Удаление всех записей"""
+        with self._lock:
+            self._pending_access.clear()
+            self._conn.execute(f'DELETE FROM {self.table}')
+            self._count = 0
+
+    def cleanup_expired(self, now: Optional[float] = None) -> int:
+        """Удаление просроченных записей"""
+        with self._lock:
+            return self._delete_where('expires_at <= ?', (now or time.time(),))
+
+    def flush_access(self) -> None:
+        """Сохраняет накопленное время последнего доступа одной транзакцией"""
+        with self._lock:
+            self._flush_access(time.time())
+
+    def _maybe_flush_access(self, now: float) -> None:
+        if (len(self._pending_access) >= self.access_flush_batch
+                or now - self._last_flush >= self.access_flush_interval):
+            self._flush_access(now)
+
+    def _flush_access(self, now: float) -> None:
+        self._last_flush = now
+        if not self._pending_access:
+            return
+
+        pending = [(ts, key) for key, ts in self._pending_access.items()]
+        self._pending_access.clear()
+        self._conn.execute('BEGIN')
         try:
-            with open(self.metadata_path, 'wb') as f:
-                pickle.dump(self.metadata, f)
-            logger.debug(f"Сохранены метаданные кэша: {len(self.metadata)} записей")
-        except Exception as e:
-            logger.error(f"Ошибка при сохранении метаданных кэша: {e}")
-    
-    def _generate_key(self, image_path: str, params: Dict) -> str:
+            self._conn.executemany(f'UPDATE {self.table} SET last_access = ? WHERE key = ?', pending)
+            self._conn.execute('COMMIT')
+        except Exception:
+            self._conn.execute('ROLLBACK')
+            raise
+
+    def _evict(self, now: float) -> None:
+        """Удаляет просроченные записи, затем самые давно использованные (минимум 25% при очистке)"""
+        self._flush_access(now)
+        removed = self._delete_where('expires_at <= ?', (now,))
+
+        if self._count > self.max_items:
+            to_remove = max(self._count - self.max_items, self._count // 4)
+            removed += self._delete_where(
+                f'key IN (SELECT key FROM {self.table} ORDER BY last_access LIMIT ?)', (to_remove,)
+            )
+
+        logger.info(f"Выполнена очистка кэша на диске: удалено {removed} записей")
+
+    def _delete_where(self, condition: str, params: Tuple) -> int:
+        cursor = self._conn.execute(f'DELETE FROM {self.table} WHERE {condition}', params)
+        self._count = max(0, self._count - cursor.rowcount)
+        return cursor.rowcount
+
+    def close(self) -> None:
+        """Сохраняет время доступа и закрывает соединение"""
+        with self._lock:
+            self._flush_access(time.time())
+            self._conn.close()
+
+
+@dataclass(frozen=True)
+class NamespacePolicy:
+    """Срок жизни и бюджеты пространства имен кэша"""
+    ttl: float
+    max_memory_items: int
+    max_memory_bytes: int
+    max_disk_items: int  # 0 - пространство живет только в памяти
+
+
+# Пространства имен по умолчанию
+DEFAULT_NAMESPACE_POLICIES: Dict[str, NamespacePolicy] = {
+    # Результаты поиска похожих изображений
+    "search": NamespacePolicy(ttl=86400, max_memory_items=100, max_memory_bytes=16 * 1024 * 1024, max_disk_items=1000),
+    # Результаты детекции объектов
+    "detect": NamespacePolicy(ttl=3600, max_memory_items=200, max_memory_bytes=8 * 1024 * 1024, max_disk_items=2000),
+    # Векторы CLIP изображений (около 2-3 КБ каждый)
+    "embedding": NamespacePolicy(ttl=7 * 86400, max_memory_items=5000, max_memory_bytes=32 * 1024 * 1024, max_disk_items=50000),
+    # Результаты распознавания бренда
+    "brand": NamespacePolicy(ttl=7 * 86400, max_memory_items=5000, max_memory_bytes=4 * 1024 * 1024, max_disk_items=50000),
+}
+
+DEFAULT_CACHE_DIR = "cache"
+CACHE_DB_NAME = "cache.db"
+
+
+def make_cache_key(content_hash: str, **params) -> str:
+    """
+    Ключ кэша вида "<хеш содержимого>:<хеш параметров>".
+
+    Хеш содержимого служит группой записи: invalidate(content_hash)
+    удаляет все результаты для одного изображения.
+
+    Args:
+        content_hash: Хеш содержимого изображения (compute_content_hash)
+        **params: Параметры, от которых зависит результат
+
+    Returns:
+        Ключ кэша
+    """
+    return f"{content_hash}:{_params_digest(params)}"
+
+
+class CacheNamespace:
+    """
+    Пространство имен кэша: LRU в памяти, таблица в общем файле SQLite и метрики попаданий.
+
+    Значение None не кэшируется - get возвращает None при промахе.
+    """
+
+    def __init__(self, name: str, policy: NamespacePolicy, db_path: Optional[str] = None):
         """
-        Генерирует уникальный ключ для запроса.
-        
         Args:
-            image_path: Путь к изображению
-            params: Параметры поиска
-            
-        Returns:
-            Уникальный ключ для запроса
+            name: Название пространства имен
+            policy: Срок жизни и бюджеты
+            db_path: Путь к файлу дискового кэша (None - только память)
         """
-        # Получаем хеш содержимого файла
-        try:
-            with open(image_path, 'rb') as f:
-                file_hash = hashlib.md5(f.read()).hexdigest()
-        except Exception as e:
-            logger.error(f"Ошибка при генерации хеша файла {image_path}: {e}")
-            # Если не удалось получить хеш содержимого, используем имя файла
-            file_hash = hashlib.md5(image_path.encode()).hexdigest()
-        
-        # Сериализуем параметры запроса
-        params_str = str(sorted(params.items()))
-        
-        # Объединяем хеш файла и параметры запроса
-        key_str = f"{file_hash}_{params_str}"
-        return hashlib.md5(key_str.encode()).hexdigest()
-    
-    def get(self, image_path: str, params: Dict) -> Optional[List[Tuple[str, float]]]:
+        self.name = name
+        self.policy = policy
+        self._lock = threading.Lock()
+        self.memory = MemoryLRU(policy.max_memory_items, policy.max_memory_bytes)
+        self.disk: Optional[DiskCacheStore] = None
+
+        if db_path and policy.max_disk_items > 0:
+            try:
+                self.disk = DiskCacheStore(db_path, f"cache_{name}", policy.max_disk_items)
+                self.disk.cleanup_expired()
+            except Exception as e:
+                logger.error(f"❌ Дисковый кэш '{name}' недоступен, используется только память: {e}")
+                self.disk = None
+
+        # Метрики
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.sets = 0
+        self.errors = 0
+
+    def get(self, key: str) -> Optional[Any]:
         """
-        Получение результатов поиска из кэша.
-        
+        Получение значения.
+
         Args:
-            image_path: Путь к изображению
-            params: Параметры поиска
-            
+            key: Ключ (make_cache_key)
+
         Returns:
-            Список найденных изображений и уровней схожести,
-            или None если результат не найден в кэше
+            Значение или None при промахе
         """
-        key = self._generate_key(image_path, params)
-        current_time = time.time()
-        
-        # Проверяем кэш в памяти
-        if key in self.memory_cache:
-            last_access, data = self.memory_cache[key]
-            # Обновляем время последнего доступа
-            self.memory_cache[key] = (current_time, data)
-            
-            # Обновляем метаданные на диске
-            if key in self.metadata:
-                created_time, _, file_path = self.metadata[key]
-                self.metadata[key] = (created_time, current_time, file_path)
-                self.save_metadata()
-                
-            logger.debug(f"✓ Результат найден в памяти для ключа {key[:8]}...")
-            return data
-        
-        # Проверяем кэш на диске
-        if key in self.metadata:
-            created_time, last_access_time, file_path = self.metadata[key]
-            
-            # Проверяем срок действия
-            if current_time - created_time > self.ttl:
-                # Удаляем просроченный элемент
-                logger.debug(f"Удален просроченный элемент кэша: {key[:8]}...")
-                self._remove_from_disk(key)
-                return None
-            
-            # Загружаем данные с диска
+        now = time.time()
+        with self._lock:
+            found, data = self.memory.get(key, now)
+            if found:
+                self.memory_hits += 1
+                return data
+
+        if self.disk is not None:
             try:
-                cache_file = os.path.join(self.cache_dir, file_path)
-                if os.path.exists(cache_file):
-                    with open(cache_file, 'rb') as f:
-                        data = pickle.load(f)
-                    
-                    # Добавляем в память для быстрого доступа
-                    self._add_to_memory(key, data)
-                    
-                    # Обновляем время последнего доступа в метаданных
-                    self.metadata[key] = (created_time, current_time, file_path)
-                    self.save_metadata()
-                    
-                    logger.debug(f"✓ Результат загружен с диска для ключа {key[:8]}...")
+                blob = self.disk.get(key, now)
+                if blob is not None:
+                    data = pickle.loads(blob)
+                    with self._lock:
+                        self.memory.put(key, data, len(blob), now + self.policy.ttl)
+                        self.disk_hits += 1
                     return data
-                else:
-                    # Файл не найден, удаляем запись из метаданных
-                    logger.warning(f"Файл кэша не найден: {cache_file}")
-                    del self.metadata[key]
-                    self.save_metadata()
             except Exception as e:
-                logger.error(f"Ошибка при загрузке кэша с диска: {e}")
-                # Удаляем повреждённую запись
-                self._remove_from_disk(key)
-        
+                logger.error(f"Ошибка при загрузке кэша '{self.name}' с диска: {e}")
+                with self._lock:
+                    self.errors += 1
+
+        with self._lock:
+            self.misses += 1
         return None
-    
-    def set(self, image_path: str, params: Dict, results: List[Tuple[str, float]]) -> None:
+
+    def set(self, key: str, value: Any, ttl: Optional[float] = None) -> None:
         """
-        Сохранение результатов поиска в кэш.
-        
+        Сохранение значения.
+
         Args:
-            image_path: Путь к изображению
-            params: Параметры поиска
-            results: Результаты поиска (список кортежей путь-схожесть)
+            key: Ключ (make_cache_key)
+            value: Значение (должно сериализоваться pickle)
+            ttl: Срок жизни в секундах (по умолчанию из политики пространства)
         """
-        key = self._generate_key(image_path, params)
-        current_time = time.time()
-        
-        # Добавляем в память
-        self._add_to_memory(key, results)
-        
-        # Сохраняем на диск
+        if value is None:
+            return
+
+        ttl = ttl if ttl is not None else self.policy.ttl
+        now = time.time()
         try:
-            # Генерируем имя файла
-            file_name = f"{key}.pkl"
-            file_path = os.path.join(self.cache_dir, file_name)
-            
-            # Записываем данные
-            with open(file_path, 'wb') as f:
-                pickle.dump(results, f)
-            
-            # Обновляем метаданные
-            self.metadata[key] = (current_time, current_time, file_name)
-            
-            # Выполняем очистку диска если превышен лимит
-            if len(self.metadata) > self.max_disk_items:
-                self._cleanup_disk()
-                
-            # Сохраняем обновленные метаданные
-            self.save_metadata()
-            
-            logger.debug(f"✓ Результат сохранен в кэш для ключа {key[:8]}...")
+            blob = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
         except Exception as e:
-            logger.error(f"Ошибка при сохранении кэша на диск: {e}")
-    
-    def invalidate(self, image_path: str = None) -> None:
+            logger.error(f"Ошибка сериализации значения для кэша '{self.name}': {e}")
+            with self._lock:
+                self.errors += 1
+            return
+
+        with self._lock:
+            self.memory.put(key, value, len(blob), now + ttl)
+            self.sets += 1
+
+        if self.disk is not None:
+            try:
+                self.disk.put(key, key.split(':', 1)[0], blob, ttl, now)
+            except Exception as e:
+                logger.error(f"Ошибка при сохранении кэша '{self.name}' на диск: {e}")
+                with self._lock:
+                    self.errors += 1
+
+    def invalidate(self, content_hash: Optional[str] = None) -> int:
         """
-        Инвалидация кэша для конкретного изображения или всего кэша.
-        
+        Инвалидация записей одного изображения или всего пространства.
+
         Args:
-            image_path: Путь к изображению для инвалидации 
-                        (если None, инвалидируется весь кэш)
+            content_hash: Хеш содержимого изображения (None - очистить все)
+
+        Returns:
+            Количество удаленных записей (без учета полной очистки диска)
         """
-        if image_path is None:
-            # Очищаем весь кэш
-            self.memory_cache.clear()
-            
-            # Удаляем все файлы кэша на диске
-            for key, (_, _, file_name) in self.metadata.items():
-                file_path = os.path.join(self.cache_dir, file_name)
-                if os.path.exists(file_path):
-                    try:
-                        os.remove(file_path)
-                    except Exception as e:
-                        logger.error(f"Ошибка при удалении файла кэша {file_path}: {e}")
-            
-            # Очищаем метаданные
-            self.metadata.clear()
-            self.save_metadata()
-            
-            logger.info("Весь кэш поиска очищен")
-        else:
-            # Формируем префикс ключа для данного изображения
+        removed = 0
+        with self._lock:
+            if content_hash is None:
+                removed = len(self.memory)
+                self.memory.clear()
+            else:
+                removed = self.memory.pop_prefix(f"{content_hash}:")
+
+        if self.disk is not None:
             try:
-                with open(image_path, 'rb') as f:
-                    file_hash = hashlib.md5(f.read()).hexdigest()
-            except Exception:
-                file_hash = hashlib.md5(image_path.encode()).hexdigest()
-            
-            # Удаляем все записи, начинающиеся с этого хеша
-            keys_to_remove = []
-            
-            # Находим все ключи для этого изображения
-            for key in list(self.memory_cache.keys()):
-                if key.startswith(file_hash):
-                    keys_to_remove.append(key)
-                    del self.memory_cache[key]
-            
-            for key in list(self.metadata.keys()):
-                if key.startswith(file_hash):
-                    keys_to_remove.append(key)
-                    self._remove_from_disk(key)
-            
-            if keys_to_remove:
-                logger.info(f"Очищен кэш для изображения {os.path.basename(image_path)} ({len(keys_to_remove)} записей)")
-    
-    def _add_to_memory(self, key: str, data: Any) -> None:
+                if content_hash is None:
+                    self.disk.clear()
+                else:
+                    removed += self.disk.delete_group(content_hash)
+            except Exception as e:
+                logger.error(f"Ошибка при очистке кэша '{self.name}' на диске: {e}")
+        return removed
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Статистика пространства имен"""
+        with self._lock:
+            hits = self.memory_hits + self.disk_hits
+            lookups = hits + self.misses
+            return {
+                "namespace": self.name,
+                "hits": hits,
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_rate": hits / lookups if lookups else 0.0,
+                "sets": self.sets,
+                "errors": self.errors,
+                "memory_items": len(self.memory),
+                "memory_bytes": self.memory.total_bytes,
+                "memory_bytes_limit": self.policy.max_memory_bytes,
+                "disk_items": self.disk.count() if self.disk is not None else 0,
+                "disk_limit": self.policy.max_disk_items,
+                "ttl": self.policy.ttl,
+            }
+
+
+class CacheManager:
+    """
+    Единая точка доступа к кэшам бота.
+
+    Все пространства имен хранятся в одном файле SQLite (по таблице на пространство).
+    """
+
+    _instance = None
+    _lock = threading.Lock()
+
+    @classmethod
+    def get_instance(cls, cache_dir: str = DEFAULT_CACHE_DIR):
         """
-        Добавление данных в память.
-        
+        Получение экземпляра менеджера кэша (шаблон Singleton).
+
         Args:
-            key: Ключ кэша
-            data: Данные для сохранения
+            cache_dir: Директория для хранения файла кэша
+
+        Returns:
+            Экземпляр CacheManager
         """
-        current_time = time.time()
-        
-        # Если превышен лимит элементов в памяти, удаляем самый старый
-        if len(self.memory_cache) >= self.max_memory_items:
-            oldest_key = min(self.memory_cache.keys(), key=lambda k: self.memory_cache[k][0])
-            del self.memory_cache[oldest_key]
-            logger.debug(f"Удален самый старый элемент из памяти: {oldest_key[:8]}...")
-        
-        # Добавляем новый элемент
-        self.memory_cache[key] = (current_time, data)
-    
-    def _remove_from_disk(self, key: str) -> None:
+        if cls._instance is None:
+            with cls._lock:
+                if cls._instance is None:
+                    cls._instance = cls(cache_dir)
+        return cls._instance
+
+    def __init__(self, cache_dir: str = DEFAULT_CACHE_DIR,
+                 policies: Optional[Dict[str, NamespacePolicy]] = None):
         """
-        Удаление элемента с диска.
-        
         Args:
-            key: Ключ кэша для удаления
+            cache_dir: Директория для хранения файла кэша
+            policies: Переопределение политик пространств имен
         """
-        if key in self.metadata:
-            _, _, file_name = self.metadata[key]
-            file_path = os.path.join(self.cache_dir, file_name)
-            
-            # Удаляем файл
-            if os.path.exists(file_path):
-                try:
-                    os.remove(file_path)
-                except Exception as e:
-                    logger.error(f"Ошибка при удалении файла кэша {file_path}: {e}")
-            
-            # Удаляем из метаданных
-            del self.metadata[key]
-    
-    def _cleanup_expired(self) -> None:
-        """Очистка просроченных элементов кэша"""
-        current_time = time.time()
-        expired_keys = []
-        
-        # Находим просроченные элементы
-        for key, (created_time, _, _) in self.metadata.items():
-            if current_time - created_time > self.ttl:
-                expired_keys.append(key)
-        
-        # Удаляем просроченные элементы
-        for key in expired_keys:
-            self._remove_from_disk(key)
-        
-        if expired_keys:
-            logger.info(f"Очищены просроченные элементы кэша: {len(expired_keys)} записей")
-            self.save_metadata()
-    
-    def _cleanup_disk(self) -> None:
-        """Очистка диска при превышении лимита элементов"""
-        # Сортируем элементы по времени последнего доступа (от старых к новым)
-        sorted_items = sorted(self.metadata.items(), key=lambda x: x[1][1])
-        
-        # Определяем количество элементов для удаления
-        items_to_remove = max(len(sorted_items) - self.max_disk_items, 
-                             len(sorted_items) // 4)  # Удаляем минимум 25% при очистке
-        
-        # Удаляем старые элементы
-        for i in range(items_to_remove):
-            key, _ = sorted_items[i]
-            self._remove_from_disk(key)
-        
-        logger.info(f"Выполнена очистка кэша на диске: удалено {items_to_remove} записей")
-        self.save_metadata()
-    
-    def get_stats(self) -> Dict:
+        self.cache_dir = cache_dir
+        self.policies = dict(DEFAULT_NAMESPACE_POLICIES)
+        if policies:
+            self.policies.update(policies)
+
+        self.db_path = os.path.join(cache_dir, CACHE_DB_NAME)
+        self._namespaces: Dict[str, CacheNamespace] = {}
+        self._namespaces_lock = threading.Lock()
+
+        logger.info(f"✅ Система кэширования инициализирована ({self.db_path}, пространства: {', '.join(self.policies)})")
+
+    def namespace(self, name: str) -> CacheNamespace:
         """
-        Получение статистики использования кэша.
-        
+        Пространство имен кэша (создается при первом обращении).
+
+        Args:
+            name: Название пространства ("search", "detect", "embedding", "brand")
+
         Returns:
-            Словарь со статистикой кэша
+            Экземпляр CacheNamespace
         """
-        return {
-            "memory_items": len(self.memory_cache),
-            "disk_items": len(self.metadata),
-            "memory_limit": self.max_memory_items,
-            "disk_limit": self.max_disk_items,
-            "ttl": self.ttl,
-            "cache_dir": self.cache_dir
-        }
+        namespace = self._namespaces.get(name)
+        if namespace is not None:
+            return namespace
 
+        with self._namespaces_lock:
+            namespace = self._namespaces.get(name)
+            if namespace is None:
+                if name not in self.policies:
+                    raise KeyError(f"Неизвестное пространство имен кэша: {name}")
+                namespace = CacheNamespace(name, self.policies[name], self.db_path)
+                self._namespaces[name] = namespace
+            return namespace
 
-# Функции-обертки для обратной совместимости с существующим кодом
+    def invalidate(self, content_hash: Optional[str] = None) -> int:
+        """Инвалидация записей изображения (или всех записей) во всех пространствах"""
+        return sum(self.namespace(name).invalidate(content_hash) for name in self.policies)
 
-def get_search_cache(cache_dir="cache", max_memory_items=100, max_disk_items=1000, ttl=86400):
+    def get_stats(self) -> Dict[str, Dict[str, Any]]:
+        """
+        Статистика использования кэша.
+
+        Returns:
+            Словарь {пространство: статистика} для уже созданных пространств
+        """
+        return {name: namespace.get_stats() for name, namespace in list(self._namespaces.items())}
+
+
+def get_cache_manager(cache_dir: str = DEFAULT_CACHE_DIR) -> CacheManager:
     """
-    Получение экземпляра кэша поиска.
-    
+    Получение экземпляра менеджера кэша.
+
     Args:
-        cache_dir: Директория для хранения файлов кэша
-        max_memory_items: Максимальное количество элементов в памяти
-        max_disk_items: Максимальное количество элементов на диске
-        ttl: Время жизни элементов кэша в секундах (по умолчанию 24 часа)
-        
+        cache_dir: Директория для хранения файла кэша
+
     Returns:
-        Экземпляр SearchCache
+        Экземпляр CacheManager
     """
-    return SearchCache.get_instance(cache_dir, max_memory_items, max_disk_items, ttl)
+    return CacheManager.get_instance(cache_dir)
+
 
-def get_cached_search_results(image_path, params):
+def get_cache(namespace: str) -> CacheNamespace:
+    """
+    Получение пространства имен кэша.
+
+    Args:
+        namespace: Название пространства ("search", "detect", "embedding", "brand")
+
+    Returns:
+        Экземпляр CacheNamespace
+    """
+    return get_cache_manager().namespace(namespace)
+
+
+# Функции-обертки для обратной совместимости с существующим кодом
+
+def get_cached_search_results(image_path, params, content_hash=None):
     """
     Получение кэшированных результатов поиска.
-    
+
     Args:
         image_path: Путь к изображению
         params: Параметры поиска
-        
+        content_hash: Заранее вычисленный хеш содержимого изображения
+
     Returns:
         Результаты поиска или None если не найдены в кэше
     """
-    cache = get_search_cache()
-    return cache.get(image_path, params)
+    content_hash = content_hash or compute_content_hash(image_path)
+    return get_cache("search").get(make_cache_key(content_hash, **params))
 
-def cache_search_results(image_path, params, results):
+def cache_search_results(image_path, params, results, content_hash=None):
     """
     Сохранение результатов поиска в кэш.
-    
+
     Args:
         image_path: Путь к изображению
         params: Параметры поиска
         results: Результаты поиска
+        content_hash: Заранее вычисленный хеш содержимого изображения
     """
-    cache = get_search_cache()
-    cache.set(image_path, params, results)
+    content_hash = content_hash or compute_content_hash(image_path)
+    get_cache("search").set(make_cache_key(content_hash, **params), results)
 
-def invalidate_cache(image_path=None):
+def invalidate_cache(image_path=None, content_hash=None):
     """
     Инвалидация кэша для конкретного изображения или всего кэша.
-    
+
     Args:
         image_path: Путь к изображению для инвалидации
-                    (если None, инвалидируется весь кэш)
+                    (если None и не передан хеш, инвалидируется весь кэш)
+        content_hash: Заранее вычисленный хеш содержимого изображения
     """
-    cache = get_search_cache()
-    cache.invalidate(image_path)
+    if image_path is not None and content_hash is None:
+        content_hash = compute_content_hash(image_path)
+    removed = get_cache_manager().invalidate(content_hash)
+    if content_hash is None:
+        logger.info("Весь кэш очищен")
+    elif removed:
+        logger.info(f"Очищен кэш для изображения {content_hash[:8]} ({removed} записей)")
 
 def get_cache_stats():
     """
     Получение статистики использования кэша.
-    
+
     Returns:
-        Словарь со статистикой кэша
+        Словарь {пространство: статистика}
     """
-    cache = get_search_cache()
-    return cache.get_stats() 
\ No newline at end of file
+    return get_cache_manager().get_stats()
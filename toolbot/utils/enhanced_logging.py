@@ -5,12 +5,22 @@
 Модуль для расширенного логирования в приложении.
 Предоставляет настраиваемые форматы логов, обработчики для различных потоков вывода,
 сохранение логов в разных форматах и ротацию файлов логов.
+
+По умолчанию запись асинхронная: к корневому логгеру подключен только QueueHandler,
+который кладет запись в очередь, а консоль, файлы и JSON пишет отдельный поток
+QueueListener. Форматирование и файловый ввод-вывод не выполняются в цикле событий
+и потоках поиска. LOG_ASYNC=0 возвращает синхронную запись.
+
+Болтливые категории можно прореживать: LOG_SAMPLE="services.department_search_service=0.1"
+оставляет каждую десятую запись уровня INFO и ниже этих логгеров (предупреждения
+и ошибки не прореживаются).
 """
 
 import os
 import sys
 import json
 import time
+import queue
 import logging
 import logging.handlers
 import traceback
@@ -18,6 +28,7 @@ import datetime
 import atexit
 import socket
 import threading
+import contextvars
 from enum import Enum
 from typing import Dict, List, Any, Optional, Union, Tuple
 
@@ -29,6 +40,11 @@ try:
 except ImportError:
     COLORAMA_AVAILABLE = False
 
+from toolbot.utils.tracing import current_span
+
+# Контекст логирования текущей задачи asyncio или потока (неизменяемый словарь)
+_log_context: contextvars.ContextVar = contextvars.ContextVar("toolbot_log_context", default={})
+
 
 class LogLevel(Enum):
     """Перечисление для уровней логирования"""
@@ -66,12 +82,21 @@ class LoggingManager:
             cls._instance = cls()
         return cls._instance
     
-    def __init__(self):
-        """Инициализация менеджера логирования"""
+    def __init__(self, log_dir: str = "logs", async_logging: Optional[bool] = None,
+                 sample_rates: Optional[Dict[str, float]] = None):
+        """
+        Инициализация менеджера логирования
+        
+        Args:
+            log_dir: Директория для файлов логов
+            async_logging: Запись через очередь и отдельный поток (по умолчанию из LOG_ASYNC)
+            sample_rates: Доли сохраняемых записей INFO и ниже по префиксам логгеров
+                          (по умолчанию из LOG_SAMPLE)
+        """
         self.base_logger = logging.getLogger()
         
         # Настройки по умолчанию
-        self.log_dir = "logs"
+        self.log_dir = log_dir
         self.log_file = os.path.join(self.log_dir, "toolbot.log")
         self.error_log_file = os.path.join(self.log_dir, "errors.log")
         self.json_log_file = os.path.join(self.log_dir, "toolbot_json.log")
@@ -101,8 +126,21 @@ class LoggingManager:
             "start_time": datetime.datetime.now().isoformat()
         }
         
-        # Идентификаторы потоков и их имена для контекстного логирования
-        self.thread_context = {}
+        # Фильтр, добавляющий к записям контекст и идентификаторы трассы
+        self.context_filter = self.ContextFilter()
+        
+        # Прореживание болтливых категорий
+        if sample_rates is None:
+            sample_rates = self.parse_sample_rates(os.getenv("LOG_SAMPLE", ""))
+        self.sampler = self.SamplingFilter(sample_rates)
+        
+        # Асинхронная запись: очередь и поток-писатель
+        if async_logging is None:
+            async_logging = os.getenv("LOG_ASYNC", "1") != "0"
+        self.async_logging = async_logging
+        self.log_queue = None
+        self.queue_handler = None
+        self.listener = None
         
         # Создаем обработчики логов
         self._setup_handlers()
@@ -173,9 +211,24 @@ class LoggingManager:
         json_handler.setFormatter(self.formatters[LogFormat.JSON.value])
         self.handlers['json'] = json_handler
         
-        # Добавляем обработчики к корневому логгеру
-        for handler in self.handlers.values():
-            self.base_logger.addHandler(handler)
+        if self.async_logging:
+            # К корневому логгеру подключается только очередь; контекст и прореживание -
+            # до постановки в очередь, в потоке, который пишет лог
+            self.log_queue = queue.SimpleQueue()
+            self.queue_handler = self.ContextQueueHandler(self.log_queue)
+            self.queue_handler.addFilter(self.sampler)
+            self.queue_handler.addFilter(self.context_filter)
+            self.listener = logging.handlers.QueueListener(
+                self.log_queue, *self.handlers.values(), respect_handler_level=True
+            )
+            self.listener.start()
+            self.base_logger.addHandler(self.queue_handler)
+        else:
+            # Добавляем обработчики к корневому логгеру
+            for handler in self.handlers.values():
+                handler.addFilter(self.sampler)
+                handler.addFilter(self.context_filter)
+                self.base_logger.addHandler(handler)
         
         # Устанавливаем базовый уровень логирования
         min_level = min(self.console_level.value, self.file_level.value)
@@ -245,32 +298,34 @@ class LoggingManager:
     
     def add_context(self, key: str, value: Any):
         """
-        Добавляет контекстную информацию для текущего потока.
+        Добавляет контекстную информацию для текущей задачи asyncio или потока.
+        
+        Контекст хранится в contextvars, поэтому параллельно обрабатываемые
+        обновления не перезаписывают контекст друг друга.
         
         Args:
             key: Ключ для контекстной информации
             value: Значение контекстной информации
         """
-        thread_id = threading.get_ident()
-        if thread_id not in self.thread_context:
-            self.thread_context[thread_id] = {}
-        self.thread_context[thread_id][key] = value
+        _log_context.set({**_log_context.get(), key: value})
     
     def get_context(self) -> Dict[str, Any]:
         """
-        Возвращает контекстную информацию для текущего потока.
+        Возвращает контекстную информацию для текущей задачи или потока.
         
         Returns:
-            Словарь с контекстной информацией
+            Словарь с контекстной информацией (включая trace_id, если идет трассировка)
         """
-        thread_id = threading.get_ident()
-        return self.thread_context.get(thread_id, {})
+        context = dict(_log_context.get())
+        span = current_span()
+        if span is not None:
+            context['trace_id'] = span.trace_id
+            context['span_id'] = span.span_id
+        return context
     
     def clear_context(self):
-        """Очищает контекстную информацию для текущего потока."""
-        thread_id = threading.get_ident()
-        if thread_id in self.thread_context:
-            del self.thread_context[thread_id]
+        """Очищает контекстную информацию для текущей задачи или потока."""
+        _log_context.set({})
     
     def log_exception(self, exc_info=None, extra: Optional[Dict[str, Any]] = None, 
                     level: LogLevel = LogLevel.ERROR):
@@ -321,14 +376,109 @@ class LoggingManager:
     
     def shutdown(self):
         """Корректно завершает работу всех обработчиков логов."""
+        # Поток-писатель дописывает оставшиеся в очереди записи
+        if self.listener is not None:
+            self.base_logger.removeHandler(self.queue_handler)
+            self.listener.stop()
+            self.listener = None
+        
         for handler in self.handlers.values():
+            self.base_logger.removeHandler(handler)
             handler.close()
         
-        # Очищаем контекстную информацию
-        self.thread_context.clear()
-        
         logging.shutdown()
     
+    @staticmethod
+    def parse_sample_rates(spec: str) -> Dict[str, float]:
+        """
+        Разбор настройки прореживания.
+        
+        Args:
+            spec: Строка вида "logger.prefix=0.1,other.prefix=0.01"
+            
+        Returns:
+            Словарь {префикс логгера: доля сохраняемых записей}
+        """
+        rates = {}
+        for item in spec.split(","):
+            if "=" not in item:
+                continue
+            prefix, rate = item.split("=", 1)
+            try:
+                rates[prefix.strip()] = min(1.0, max(0.0, float(rate)))
+            except ValueError:
+                continue
+        return rates
+    
+    def get_logging_stats(self) -> Dict[str, Any]:
+        """Статистика асинхронной записи и прореживания"""
+        return {
+            "async": self.async_logging,
+            "queue_size": self.log_queue.qsize() if self.log_queue is not None else 0,
+            "sample_rates": dict(self.sampler.rates),
+            "sampled_out": dict(self.sampler.dropped),
+        }
+    
+    class ContextQueueHandler(logging.handlers.QueueHandler):
+        """
+        QueueHandler, который готовит запись в вызывающем потоке минимально:
+        подставляет аргументы в сообщение и превращает исключение в текст,
+        а форматирование (включая JSON) оставляет потоку-писателю.
+        """
+        
+        def prepare(self, record):
+            message = record.getMessage()
+            exc_text = record.exc_text
+            if record.exc_info and not exc_text:
+                exc_text = "".join(traceback.format_exception(*record.exc_info)).rstrip("\n")
+            
+            record = logging.makeLogRecord(record.__dict__)
+            record.msg = message
+            record.args = None
+            record.exc_info = None
+            record.exc_text = exc_text
+            return record
+    
+    class SamplingFilter(logging.Filter):
+        """Оставляет каждую N-ю запись уровня INFO и ниже для заданных категорий."""
+        
+        def __init__(self, rates: Optional[Dict[str, float]] = None):
+            super().__init__()
+            self.rates = dict(rates or {})
+            # Длинные префиксы проверяются первыми
+            self._prefixes = sorted(self.rates, key=len, reverse=True)
+            self._counters: Dict[str, int] = {}
+            self.dropped: Dict[str, int] = {}
+        
+        def filter(self, record):
+            if not self._prefixes or record.levelno > logging.INFO:
+                return True
+            name = record.name
+            for prefix in self._prefixes:
+                if name == prefix or name.startswith(prefix + "."):
+                    rate = self.rates[prefix]
+                    if rate >= 1.0:
+                        return True
+                    count = self._counters.get(prefix, 0)
+                    self._counters[prefix] = count + 1
+                    # Детерминированно: при доле 0.1 проходит каждая десятая запись
+                    if rate > 0.0 and count % round(1.0 / rate) == 0:
+                        return True
+                    self.dropped[prefix] = self.dropped.get(prefix, 0) + 1
+                    return False
+            return True
+    
+    class ContextFilter(logging.Filter):
+        """Добавляет к записи контекст задачи и идентификаторы трассы в момент логирования."""
+        
+        def filter(self, record):
+            if not hasattr(record, "log_context"):
+                record.log_context = _log_context.get()
+                span = current_span()
+                record.trace_id = span.trace_id if span is not None else None
+                record.span_id = span.span_id if span is not None else None
+            return True
+    
     class JsonFormatter(logging.Formatter):
         """Форматтер для вывода логов в формате JSON."""
         
@@ -358,15 +508,21 @@ class LoggingManager:
                 "process": record.process
             }
             
-            # Добавляем контекстную информацию
-            thread_id = record.thread
-            if thread_id in manager.thread_context:
-                log_data["context"] = manager.thread_context[thread_id]
+            # Добавляем контекстную информацию и идентификаторы трассы
+            context = getattr(record, "log_context", None)
+            if context:
+                log_data["context"] = context
+            if getattr(record, "trace_id", None):
+                log_data["trace_id"] = record.trace_id
+                log_data["span_id"] = record.span_id
             
             # Добавляем метаданные
             log_data.update(manager.metadata)
             
             # Добавляем информацию об исключении, если есть
+            # (при асинхронной записи исключение приходит уже текстом)
+            if not record.exc_info and record.exc_text:
+                log_data["exception"] = {"traceback": record.exc_text}
             if record.exc_info:
                 exc_type, exc_value, exc_traceback = record.exc_info
                 log_data["exception"] = {
@@ -516,7 +672,7 @@ def log_exception(exc_info=None, extra=None, level=LogLevel.ERROR):
 
 def add_context(key: str, value: Any):
     """
-    Добавляет контекстную информацию для текущего потока.
+    Добавляет контекстную информацию для текущей задачи asyncio или потока.
     
     Args:
         key: Ключ для контекстной информации
@@ -526,7 +682,7 @@ def add_context(key: str, value: Any):
 
 
 def clear_context():
-    """Очищает контекстную информацию для текущего потока."""
+    """Очищает контекстную информацию для текущей задачи или потока."""
     LoggingManager.get_instance().clear_context()
 
 
@@ -12,11 +12,12 @@ import traceback
 import functools
 import os
 import datetime
-import json
 import inspect
 from typing import Callable, Dict, Any, Optional, List, Type, Union
 from enum import Enum
 
+from toolbot.utils.persisted_state import PersistedState, load_json
+
 logger = logging.getLogger(__name__)
 
 
@@ -59,6 +60,9 @@ class ErrorHandler:
         # Создаем директорию для логов, если она не существует
         os.makedirs(os.path.dirname(self.error_log_path), exist_ok=True)
         
+        # Статистика пишется не чаще раза в интервал, а не на каждую ошибку
+        self._stats_state = PersistedState(self.error_stats_path, self._error_stats_snapshot)
+        
         # Загружаем статистику ошибок, если файл существует
         self._load_error_stats()
         
@@ -68,27 +72,29 @@ class ErrorHandler:
     def _load_error_stats(self):
         """Загружает статистику ошибок из файла"""
         try:
-            if os.path.exists(self.error_stats_path):
-                with open(self.error_stats_path, 'r', encoding='utf-8') as f:
-                    stats = json.load(f)
-                    self.error_counts = stats.get("error_counts", {})
-                    self.total_errors = stats.get("total_errors", 0)
-                    logger.info(f"Загружена статистика ошибок: {self.total_errors} всего ошибок")
+            stats = load_json(self.error_stats_path)
+            if isinstance(stats, dict):
+                self.error_counts = stats.get("error_counts", {})
+                self.total_errors = stats.get("total_errors", 0)
+                logger.info(f"Загружена статистика ошибок: {self.total_errors} всего ошибок")
         except Exception as e:
             logger.error(f"Ошибка при загрузке статистики ошибок: {e}")
     
+    def _error_stats_snapshot(self) -> Dict[str, Any]:
+        """Снимок статистики ошибок для записи в файл"""
+        return {
+            "error_counts": dict(self.error_counts),
+            "total_errors": self.total_errors,
+            "last_updated": datetime.datetime.now().isoformat()
+        }
+    
     def _save_error_stats(self):
-        """Сохраняет статистику ошибок в файл"""
-        try:
-            stats = {
-                "error_counts": self.error_counts,
-                "total_errors": self.total_errors,
-                "last_updated": datetime.datetime.now().isoformat()
-            }
-            with open(self.error_stats_path, 'w', encoding='utf-8') as f:
-                json.dump(stats, f, ensure_ascii=False, indent=2)
-        except Exception as e:
-            logger.error(f"Ошибка при сохранении статистики ошибок: {e}")
+        """Помечает статистику ошибок для отложенной атомарной записи"""
+        self._stats_state.mark_dirty()
+    
+    def flush_error_stats(self):
+        """Немедленно записывает несохраненную статистику ошибок"""
+        self._stats_state.flush()
     
     def register_handler(self, exception_type: Type[Exception], handler: Callable[[Exception], None]):
         """
@@ -210,6 +216,9 @@ class ErrorHandler:
         
         # Обрабатываем ошибку
         self.handle_error(exc_value, context, ErrorSeverity.CRITICAL)
+        
+        # Процесс может сейчас завершиться - не ждем таймера записи
+        self.flush_error_stats()
     
     def get_error_stats(self) -> Dict[str, Any]:
         """
@@ -0,0 +1,266 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Банк текстовых признаков для zero-shot классификации типа инструмента.
+
+Категории берутся из toolbot/data/tool_categories.json, для каждой категории
+строится набор подсказок по нескольким шаблонам. Язык подсказок выбирается по
+модели: стандартный CLIP (openai/clip-vit-base-patch32) обучен на английских
+текстах, для него используются английские названия из tool_categories_en.json;
+дообученная модель учится на русских описаниях, для нее подсказки русские.
+Подсказки одного понятия (всех шаблонов для одного названия) усредняются в
+строку банка; у категории может быть несколько строк ("hammer", "pliers" для
+ручного инструмента), вероятности ее строк складываются. Текстовые признаки
+считаются один раз для версии модели и сохраняются на диск.
+Классификация уже посчитанного вектора изображения - одно матричное умножение.
+"""
+
+import os
+import json
+import hashlib
+import logging
+import threading
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Файл категорий инструментов
+CATEGORIES_FILE = os.path.join(os.path.dirname(os.path.dirname(__file__)), "data", "tool_categories.json")
+
+# Английские названия категорий {код: [названия]} для стандартного CLIP
+ENGLISH_NAMES_FILE = os.path.join(os.path.dirname(os.path.dirname(__file__)), "data", "tool_categories_en.json")
+
+# Директория для сохранения посчитанных банков
+LABEL_BANK_CACHE_DIR = os.path.join("cache", "label_bank")
+
+# Шаблоны подсказок: {name} - название категории, {description} - описание из файла.
+# Формулировки совпадают с текстами, на которых дообучается CLIP (clip_fine_tuner)
+PROMPT_TEMPLATES = (
+    "{description}",
+    "изображение {name}",
+    "фото: {name}",
+    "{name}, строительный инструмент",
+)
+
+# Шаблоны для стандартного CLIP: {name} - английское название.
+# Первый шаблон - прежняя подсказка "a photo of a drill"
+PROMPT_TEMPLATES_EN = (
+    "a photo of a {name}",
+    "a product photo of a {name}",
+    "a close-up photo of a {name}",
+    "a {name}, a construction tool",
+)
+
+PROMPT_LANGUAGES = ("ru", "en")
+
+# Температура softmax, как у logit_scale CLIP
+LOGIT_SCALE = 100.0
+
+UNKNOWN_LABEL = ("unknown", "Неизвестный инструмент", 0.0)
+
+
+def category_display_name(code: str) -> str:
+    """Название категории для пользователя: "циркулярная_пила" -> "Циркулярная пила" """
+    return code.replace("_", " ").capitalize()
+
+
+class LabelBank:
+    """
+    Матрица нормализованных текстовых признаков (число_строк, размерность)
+    и номер категории для каждой строки.
+    """
+
+    def __init__(self, categories_file: str = CATEGORIES_FILE, cache_dir: str = LABEL_BANK_CACHE_DIR,
+                 templates: Sequence[str] = PROMPT_TEMPLATES,
+                 english_names_file: str = ENGLISH_NAMES_FILE,
+                 english_templates: Sequence[str] = PROMPT_TEMPLATES_EN):
+        """
+        Args:
+            categories_file: Путь к JSON с категориями {код: описание}
+            cache_dir: Директория для сохранения посчитанных банков
+            templates: Шаблоны русских подсказок
+            english_names_file: Путь к JSON с английскими названиями {код: [названия]}
+            english_templates: Шаблоны английских подсказок
+        """
+        self.categories_file = categories_file
+        self.cache_dir = cache_dir
+        self.templates = tuple(templates)
+        self.english_names_file = english_names_file
+        self.english_templates = tuple(english_templates)
+
+        self.labels: List[str] = []
+        self.embeddings: Optional[np.ndarray] = None
+        # Номер категории (индекс в labels) для каждой строки embeddings
+        self.row_labels: Optional[np.ndarray] = None
+        self.version: Optional[str] = None
+        self._lock = threading.Lock()
+
+    def load_prompts(self, language: str = "ru") -> Dict[str, List[List[str]]]:
+        """
+        Подсказки для каждой категории, сгруппированные по понятиям.
+
+        Args:
+            language: Язык подсказок: "ru" или "en". Категории без английского
+                      названия получают русские подсказки.
+
+        Returns:
+            Словарь {код_категории: [[подсказки одного понятия], ...]}
+        """
+        if language not in PROMPT_LANGUAGES:
+            raise ValueError(f"Неизвестный язык подсказок: {language}")
+
+        with open(self.categories_file, "r", encoding="utf-8") as f:
+            categories = json.load(f)
+
+        english_names = {}
+        if language == "en":
+            with open(self.english_names_file, "r", encoding="utf-8") as f:
+                english_names = json.load(f)
+
+        prompts = {}
+        for code, description in categories.items():
+            if english_names.get(code):
+                prompts[code] = [
+                    list(dict.fromkeys(template.format(name=name) for template in self.english_templates))
+                    for name in english_names[code]
+                ]
+                continue
+            name = code.replace("_", " ")
+            description = description or name
+            prompts[code] = [list(dict.fromkeys(
+                template.format(name=name, description=description) for template in self.templates
+            ))]
+        return prompts
+
+    def _bank_version(self, model_version: str, prompts: Dict[str, List[List[str]]]) -> str:
+        """Версия банка: модель + подсказки (меняется при правке файла категорий)"""
+        payload = json.dumps([model_version, prompts], ensure_ascii=False, sort_keys=True)
+        return hashlib.blake2b(payload.encode("utf-8"), digest_size=12).hexdigest()
+
+    def ensure(self, model_version: str, encode_text: Callable[[List[str]], np.ndarray],
+               language: str = "ru") -> bool:
+        """
+        Подготавливает банк для версии модели: загружает с диска или считает заново.
+
+        Args:
+            model_version: Идентификатор модели (меняется при замене весов)
+            encode_text: Функция, возвращающая нормализованные текстовые признаки (n, размерность)
+            language: Язык подсказок, на котором обучен текстовый кодировщик модели
+
+        Returns:
+            True если банк готов к классификации
+        """
+        if self.embeddings is not None and self.version is not None and self.version.startswith(f"{model_version}|"):
+            return True
+
+        with self._lock:
+            if self.embeddings is not None and self.version is not None and self.version.startswith(f"{model_version}|"):
+                return True
+
+            try:
+                prompts = self.load_prompts(language)
+                if not prompts:
+                    logger.warning("Файл категорий инструментов пуст")
+                    return False
+
+                bank_version = self._bank_version(model_version, prompts)
+                bank_path = os.path.join(self.cache_dir, f"label_bank_{bank_version}.npz")
+                labels = list(prompts.keys())
+
+                loaded = self._load(bank_path, labels)
+                if loaded is None:
+                    loaded = self._compute(prompts, encode_text)
+                    self._save(bank_path, labels, *loaded)
+                    logger.info(f"✅ Банк категорий посчитан: {len(labels)} категорий, "
+                                f"{sum(len(group) for groups in prompts.values() for group in groups)} подсказок")
+
+                self.labels = labels
+                self.embeddings, self.row_labels = loaded
+                self.version = f"{model_version}|{bank_version}"
+                return True
+            except Exception as e:
+                logger.error(f"❌ Ошибка при подготовке банка категорий: {e}")
+                return False
+
+    def _compute(self, prompts: Dict[str, List[List[str]]],
+                 encode_text: Callable[[List[str]], np.ndarray]) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Считает все подсказки одним вызовом и усредняет их по понятиям
+
+        Returns:
+            (строки банка, номер категории для каждой строки)
+        """
+        flat_prompts = [prompt for groups in prompts.values() for group in groups for prompt in group]
+        text_features = np.asarray(encode_text(flat_prompts), dtype=np.float32)
+
+        rows, row_labels = [], []
+        offset = 0
+        for label_index, groups in enumerate(prompts.values()):
+            for group in groups:
+                mean = text_features[offset:offset + len(group)].mean(axis=0)
+                rows.append(mean / np.linalg.norm(mean))
+                row_labels.append(label_index)
+                offset += len(group)
+        return np.stack(rows).astype(np.float32), np.array(row_labels, dtype=np.int64)
+
+    def _load(self, bank_path: str, labels: List[str]) -> Optional[Tuple[np.ndarray, np.ndarray]]:
+        """Загрузка сохраненного банка"""
+        if not os.path.exists(bank_path):
+            return None
+        try:
+            with np.load(bank_path, allow_pickle=False) as data:
+                if list(data["labels"]) != labels or "row_labels" not in data:
+                    return None
+                logger.info(f"Банк категорий загружен из {bank_path}")
+                return data["embeddings"].astype(np.float32), data["row_labels"].astype(np.int64)
+        except Exception as e:
+            logger.warning(f"⚠️ Не удалось загрузить банк категорий {bank_path}: {e}")
+            return None
+
+    def _save(self, bank_path: str, labels: List[str], embeddings: np.ndarray, row_labels: np.ndarray) -> None:
+        """Сохранение банка (через временный файл)"""
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            temp_path = f"{bank_path}.tmp.npz"
+            np.savez(temp_path, labels=np.array(labels), embeddings=embeddings, row_labels=row_labels)
+            os.replace(temp_path, bank_path)
+        except Exception as e:
+            logger.warning(f"⚠️ Не удалось сохранить банк категорий: {e}")
+
+    def classify(self, features: np.ndarray, text_features: Optional[np.ndarray] = None) -> List[Tuple[str, str, float]]:
+        """
+        Классификация векторов изображений.
+
+        Args:
+            features: Нормализованные векторы (число_изображений, размерность) или один вектор
+            text_features: Матрица текстовых признаков вместо банка (строки в порядке self.labels)
+
+        Returns:
+            Список кортежей (код_категории, название, уверенность)
+        """
+        features = np.asarray(features, dtype=np.float32)
+        if text_features is None:
+            bank, row_labels = self.embeddings, self.row_labels
+        else:
+            bank = np.asarray(text_features, dtype=np.float32)
+            row_labels = np.arange(len(bank))
+        if bank is None:
+            return [UNKNOWN_LABEL] * (len(features) if features.ndim > 1 else 1)
+
+        logits = LOGIT_SCALE * (features.reshape(-1, bank.shape[1]) @ bank.T)
+        logits -= logits.max(axis=1, keepdims=True)
+        row_probabilities = np.exp(logits)
+        row_probabilities /= row_probabilities.sum(axis=1, keepdims=True)
+
+        # Вероятность категории - сумма вероятностей ее понятий
+        probabilities = np.zeros((len(row_probabilities), len(self.labels)), dtype=np.float32)
+        np.add.at(probabilities.T, row_labels, row_probabilities.T)
+
+        indices = probabilities.argmax(axis=1)
+        return [
+            (self.labels[idx], category_display_name(self.labels[idx]), float(probabilities[row, idx]))
+            for row, idx in enumerate(indices)
+        ]
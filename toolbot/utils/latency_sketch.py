@@ -0,0 +1,366 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Потоковые квантильные скетчи задержек по этапам конвейера поиска.
+
+Для каждого этапа (скачивание, декодирование, предобработка, эмбеддинг, поиск
+по индексу, выборка из БД, отправка в Telegram) ведется DDSketch: значения
+раскладываются по логарифмическим корзинам, поэтому любой квантиль
+оценивается с относительной ошибкой не больше relative_accuracy, а память
+зависит только от диапазона значений. Скетчи одного этапа можно объединять
+(например, из разных процессов) сложением корзин.
+
+Каждый замер внутри трассы запроса (toolbot.utils.tracing) также становится
+спаном с названием этапа.
+
+Запись - контекстный менеджер или декоратор:
+
+    with stage_timer(STAGE_EMBED):
+        features = model.encode_image(image_input)
+
+    @timed_stage(STAGE_DB_FETCH)
+    def load_rows(...): ...
+
+Служебные поиски (контрольные запросы при замене модели) выполняются внутри
+suppress_stage_metrics(): их этапы не попадают ни в скетчи, ни в трассы.
+"""
+
+import math
+import time
+import asyncio
+import functools
+import threading
+import contextvars
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Optional
+
+from toolbot.utils.tracing import start_span
+
+# Этапы конвейера поиска по фото
+STAGE_DOWNLOAD = "download"
+STAGE_DECODE = "decode"
+STAGE_PREPROCESS = "preprocess"
+STAGE_EMBED = "embed"
+STAGE_INDEX_SEARCH = "index_search"
+STAGE_DB_FETCH = "db_fetch"
+STAGE_TELEGRAM_SEND = "telegram_send"
+
+PIPELINE_STAGES = (
+    STAGE_DOWNLOAD, STAGE_DECODE, STAGE_PREPROCESS, STAGE_EMBED,
+    STAGE_INDEX_SEARCH, STAGE_DB_FETCH, STAGE_TELEGRAM_SEND,
+)
+
+# Названия этапов для администраторов
+STAGE_TITLES = {
+    STAGE_DOWNLOAD: "Скачивание фото",
+    STAGE_DECODE: "Декодирование",
+    STAGE_PREPROCESS: "Предобработка",
+    STAGE_EMBED: "Эмбеддинг CLIP",
+    STAGE_INDEX_SEARCH: "Поиск по индексу",
+    STAGE_DB_FETCH: "Выборка из БД",
+    STAGE_TELEGRAM_SEND: "Отправка в Telegram",
+}
+
+# Относительная точность квантилей
+DEFAULT_RELATIVE_ACCURACY = 0.01
+
+# Значения меньше этого (мс) попадают в нулевую корзину
+MIN_TRACKED_VALUE = 1e-3
+
+_perf_counter = time.perf_counter
+
+# Замеры текущей задачи или потока не записываются
+_suppressed: contextvars.ContextVar = contextvars.ContextVar("toolbot_stage_metrics_suppressed", default=False)
+
+
+@contextmanager
+def suppress_stage_metrics():
+    """Этапы внутри блока не записываются в метрики и не становятся спанами"""
+    token = _suppressed.set(True)
+    try:
+        yield
+    finally:
+        _suppressed.reset(token)
+
+
+class DDSketch:
+    """
+    Квантильный скетч с гарантированной относительной точностью.
+
+    Корзина i содержит значения из (gamma^(i-1), gamma^i], где
+    gamma = (1 + a) / (1 - a); оценка квантиля - середина корзины.
+
+    Значения добавляются из пула потоков и параллельных поисков, а читаются
+    сборщиком /metrics и админкой, поэтому изменение и чтение корзин идут
+    под блокировкой скетча.
+    """
+
+    __slots__ = ("relative_accuracy", "gamma", "_inv_log_gamma", "bins", "zero_count",
+                 "count", "sum", "min", "max", "_lock")
+
+    def __init__(self, relative_accuracy: float = DEFAULT_RELATIVE_ACCURACY):
+        self.relative_accuracy = relative_accuracy
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self._inv_log_gamma = 1.0 / math.log(self.gamma)
+        self.bins: Dict[int, int] = {}
+        self.zero_count = 0
+        self.count = 0
+        self.sum = 0.0
+        self.min = math.inf
+        self.max = 0.0
+        self._lock = threading.Lock()
+
+    def add(self, value: float) -> None:
+        """Добавление значения"""
+        key = math.ceil(math.log(value) * self._inv_log_gamma) if value > MIN_TRACKED_VALUE else None
+        with self._lock:
+            self.count += 1
+            self.sum += value
+            if value < self.min:
+                self.min = value
+            if value > self.max:
+                self.max = value
+            if key is None:
+                self.zero_count += 1
+                return
+            bins = self.bins
+            bins[key] = bins.get(key, 0) + 1
+
+    def _snapshot(self):
+        """Согласованная копия корзин и счетчиков"""
+        with self._lock:
+            return dict(self.bins), self.zero_count, self.count, self.sum, self.min, self.max
+
+    def merge(self, other: "DDSketch") -> None:
+        """Объединение со скетчем той же точности"""
+        if other.gamma != self.gamma:
+            raise ValueError("Скетчи с разной точностью нельзя объединить")
+        other_bins, zero_count, count, total, other_min, other_max = other._snapshot()
+        with self._lock:
+            for key, bin_count in other_bins.items():
+                self.bins[key] = self.bins.get(key, 0) + bin_count
+            self.zero_count += zero_count
+            self.count += count
+            self.sum += total
+            self.min = min(self.min, other_min)
+            self.max = max(self.max, other_max)
+
+    def quantile(self, q: float) -> Optional[float]:
+        """Оценка квантиля q из [0, 1]"""
+        bins, zero_count, count, _, low, high = self._snapshot()
+        if count == 0:
+            return None
+
+        rank = q * (count - 1)
+        if rank < zero_count:
+            return 0.0
+
+        seen = zero_count
+        for key in sorted(bins):
+            seen += bins[key]
+            if seen > rank:
+                value = 2 * self.gamma ** key / (self.gamma + 1)
+                return min(max(value, low), high)
+        return high
+
+    def cumulative_counts(self, bounds) -> list:
+        """
+        Количество значений не больше каждой границы (для гистограмм Prometheus).
+
+        Корзина относится к границе, если ее верхний край gamma^i не больше границы.
+        """
+        bins, zero_count, _, _, _, _ = self._snapshot()
+        counts = []
+        sorted_bins = sorted(bins.items())
+        for bound in bounds:
+            total = zero_count
+            for key, bin_count in sorted_bins:
+                if self.gamma ** key > bound:
+                    break
+                total += bin_count
+            counts.append(total)
+        return counts
+
+    @property
+    def mean(self) -> Optional[float]:
+        return self.sum / self.count if self.count else None
+
+    def to_dict(self) -> Dict[str, Any]:
+        """Сериализация (например, для объединения скетчей разных процессов)"""
+        bins, zero_count, count, total, low, high = self._snapshot()
+        return {
+            'relative_accuracy': self.relative_accuracy,
+            'bins': {str(key): value for key, value in bins.items()},
+            'zero_count': zero_count,
+            'count': count,
+            'sum': total,
+            'min': low if count else None,
+            'max': high,
+        }
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "DDSketch":
+        sketch = cls(data['relative_accuracy'])
+        sketch.bins = {int(key): value for key, value in data['bins'].items()}
+        sketch.zero_count = data['zero_count']
+        sketch.count = data['count']
+        sketch.sum = data['sum']
+        sketch.min = data['min'] if data['min'] is not None else math.inf
+        sketch.max = data['max']
+        return sketch
+
+
+class _StageTimer:
+    """Контекстный менеджер замера одного этапа"""
+
+    __slots__ = ("_stage", "_sketch", "_start", "_span")
+
+    def __init__(self, stage: str, sketch: DDSketch):
+        self._stage = stage
+        self._sketch = sketch
+
+    def __enter__(self):
+        if _suppressed.get():
+            self._span = None
+            return self
+        self._span = start_span(self._stage).__enter__()
+        self._start = _perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if self._span is None:
+            return False
+        self._sketch.add((_perf_counter() - self._start) * 1000.0)
+        self._span.__exit__(exc_type, exc, tb)
+        return False
+
+
+class StageMetrics:
+    """Скетчи задержек по этапам (значения в миллисекундах)"""
+
+    def __init__(self, relative_accuracy: float = DEFAULT_RELATIVE_ACCURACY):
+        self.relative_accuracy = relative_accuracy
+        self.started_at = time.time()
+        self._sketches: Dict[str, DDSketch] = {}
+        self._lock = threading.Lock()
+
+    def sketch(self, stage: str) -> DDSketch:
+        """Скетч этапа (создается при первом обращении)"""
+        sketch = self._sketches.get(stage)
+        if sketch is None:
+            with self._lock:
+                sketch = self._sketches.setdefault(stage, DDSketch(self.relative_accuracy))
+        return sketch
+
+    def get_sketches(self) -> Dict[str, DDSketch]:
+        """Скетчи всех этапов"""
+        return dict(self._sketches)
+
+    def record(self, stage: str, duration_ms: float) -> None:
+        """Запись длительности этапа"""
+        if not _suppressed.get():
+            self.sketch(stage).add(duration_ms)
+
+    def timer(self, stage: str) -> _StageTimer:
+        """Контекстный менеджер замера этапа"""
+        return _StageTimer(stage, self.sketch(stage))
+
+    def timed(self, stage: str) -> Callable:
+        """Декоратор замера этапа для обычных и асинхронных функций"""
+        def decorator(func):
+            sketch = self.sketch(stage)
+
+            if asyncio.iscoroutinefunction(func):
+                @functools.wraps(func)
+                async def async_wrapper(*args, **kwargs):
+                    if _suppressed.get():
+                        return await func(*args, **kwargs)
+                    with start_span(stage):
+                        start = _perf_counter()
+                        try:
+                            return await func(*args, **kwargs)
+                        finally:
+                            sketch.add((_perf_counter() - start) * 1000.0)
+                return async_wrapper
+
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                if _suppressed.get():
+                    return func(*args, **kwargs)
+                with start_span(stage):
+                    start = _perf_counter()
+                    try:
+                        return func(*args, **kwargs)
+                    finally:
+                        sketch.add((_perf_counter() - start) * 1000.0)
+            return wrapper
+        return decorator
+
+    def merge(self, other: "StageMetrics") -> None:
+        """Объединение с метриками другого экземпляра"""
+        for stage, sketch in list(other._sketches.items()):
+            self.sketch(stage).merge(sketch)
+
+    def reset(self) -> None:
+        """Сброс всех скетчей"""
+        with self._lock:
+            self._sketches = {}
+            self.started_at = time.time()
+
+    def get_summary(self) -> Dict[str, Dict[str, Any]]:
+        """
+        Квантили по этапам.
+
+        Returns:
+            {этап: {count, mean_ms, p50_ms, p95_ms, p99_ms, max_ms, total_ms, share_percent}}
+        """
+        sketches = self.get_sketches()
+        grand_total = sum(sketch.sum for sketch in sketches.values()) or 1.0
+
+        summary = {}
+        for stage, sketch in sketches.items():
+            if not sketch.count:
+                continue
+            summary[stage] = {
+                'count': sketch.count,
+                'mean_ms': round(sketch.mean, 2),
+                'p50_ms': round(sketch.quantile(0.50), 2),
+                'p95_ms': round(sketch.quantile(0.95), 2),
+                'p99_ms': round(sketch.quantile(0.99), 2),
+                'max_ms': round(sketch.max, 2),
+                'total_ms': round(sketch.sum, 1),
+                'share_percent': round(sketch.sum / grand_total * 100, 1),
+            }
+        return summary
+
+    def get_bottleneck(self) -> Optional[str]:
+        """Этап с наибольшим суммарным временем - кандидат на оптимизацию"""
+        sketches = self.get_sketches()
+        if not sketches:
+            return None
+        return max(sketches, key=lambda stage: sketches[stage].sum)
+
+
+# Глобальный экземпляр метрик этапов
+_stage_metrics = None
+_stage_metrics_lock = threading.Lock()
+
+def get_stage_metrics() -> StageMetrics:
+    """Получение экземпляра метрик этапов"""
+    global _stage_metrics
+    if _stage_metrics is None:
+        with _stage_metrics_lock:
+            if _stage_metrics is None:
+                _stage_metrics = StageMetrics()
+    return _stage_metrics
+
+
+def stage_timer(stage: str) -> _StageTimer:
+    """Контекстный менеджер замера этапа в глобальных метриках"""
+    return get_stage_metrics().timer(stage)
+
+
+def timed_stage(stage: str) -> Callable:
+    """Декоратор замера этапа в глобальных метриках"""
+    return get_stage_metrics().timed(stage)
@@ -17,11 +17,10 @@ from typing import Dict, List, Any, Tuple, Optional, Union
 from pathlib import Path
 import onnxruntime as ort
 import cv2
-from functools import lru_cache
 
 from toolbot.utils.enhanced_logging import get_logger
 from toolbot.utils.model_optimizer import get_model_optimizer
-from toolbot.utils.cache_manager import get_search_cache
+from toolbot.utils.cache_manager import get_cache, compute_content_hash, make_cache_key
 
 # Получаем логгер для модуля
 logger = get_logger(__name__)
@@ -60,8 +59,8 @@ class LightDetectionModel:
         
         self.device = torch.device('cuda' if self.use_cuda else 'cpu')
         
-        # Кэш-менеджер для кэширования результатов
-        self.cache_manager = get_search_cache()
+        # Кэш результатов детекции
+        self.cache = get_cache("detect")
         
         # Загружаем модель
         self.model = None
@@ -126,21 +125,30 @@ class LightDetectionModel:
         """
         raise NotImplementedError("Метод должен быть переопределен в дочернем классе")
     
-    @lru_cache(maxsize=100)
-    def detect_from_file(self, image_path):
+    def detect_from_file(self, image_path, content_hash=None):
         """
         Обнаружение объектов на изображении из файла с кэшированием.
         
         Args:
             image_path: Путь к файлу изображения
+            content_hash: Хеш содержимого, если уже посчитан в начале запроса
             
         Returns:
             Список обнаруженных объектов
         """
-        # Проверяем кэш
-        cache_key = f"detect_{self.model_name}_{image_path}"
-        cached_result = self.cache_manager.get(cache_key)
-        if cached_result:
+        # Проверяем кэш (ключ по содержимому файла, модели и порогу)
+        try:
+            cache_key = make_cache_key(
+                content_hash or compute_content_hash(image_path),
+                model=self.model_name,
+                confidence_threshold=self.confidence_threshold,
+            )
+        except Exception as e:
+            logger.error(f"Ошибка при чтении изображения {image_path}: {e}")
+            return []
+        
+        cached_result = self.cache.get(cache_key)
+        if cached_result is not None:
             logger.debug(f"Результат детекции получен из кэша для {image_path}")
             return cached_result
         
@@ -156,7 +164,9 @@ class LightDetectionModel:
         result = self.detect(image)
         
         # Кэшируем результат
-        self.cache_manager.set(cache_key, result, expire=3600)  # Кэш на 1 час
+        # Пустой результат может означать ошибку инференса - его не кэшируем
+        if result:
+            self.cache.set(cache_key, result)  # Срок жизни задан политикой пространства "detect"
         
         return result
     
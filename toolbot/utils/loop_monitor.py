@@ -0,0 +1,347 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Обнаружение блокировок цикла событий и их виновников.
+
+Пульс - таймер внутри цикла с коротким интервалом: если обратный вызов
+запустился позже запланированного больше чем на threshold_ms, цикл был
+заблокирован синхронной работой (чтение Excel, подсчет строк, инференс модели
+прямо в корутине).
+
+Чтобы понять, кто держал цикл, сторожевой поток замечает, что пульс
+остановился, и снимает стек потока цикла через sys._current_frames():
+внешняя корутина проекта в стеке - обработчик, самый внутренний кадр
+проекта - место блокирующего вызова. Тип обновления Telegram (команда,
+фото, кнопка) запоминается обработчиком track_update из группы -1.
+
+Дополнительно включается штатный отчет asyncio о медленных обратных вызовах
+(loop.slow_callback_duration). Он работает только в отладочном режиме цикла,
+поэтому отладка включается отдельно переменной LOOP_DEBUG=1.
+"""
+
+import os
+import re
+import sys
+import time
+import asyncio
+import inspect
+import logging
+import threading
+from collections import deque
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Порог блокировки цикла (мс)
+DEFAULT_STALL_THRESHOLD_MS = float(os.getenv("LOOP_STALL_THRESHOLD_MS", "100"))
+
+# Интервал пульса цикла событий (секунды)
+DEFAULT_BEAT_INTERVAL = 0.1
+
+# Количество худших виновников в отчетах
+DEFAULT_TOP_N = 10
+
+# Количество хранимых последних блокировок
+DEFAULT_RECENT_STALLS = 100
+
+# Корень проекта: кадры из этих файлов считаются кодом бота
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+UNKNOWN_HANDLER = "неизвестно"
+
+_CORO_NAME_RE = re.compile(r"coro=<([\w.<>]+)\(")
+
+
+def describe_update(update: Any) -> str:
+    """
+    Краткий тип обновления Telegram без пользовательских данных.
+
+    Returns:
+        Например 'command:/start', 'photo', 'callback:error_status_N_', 'text'
+    """
+    callback_query = getattr(update, "callback_query", None)
+    if callback_query is not None:
+        data = callback_query.data or ""
+        return "callback:" + re.sub(r"\d+", "N", data)[:40]
+
+    message = getattr(update, "effective_message", None) or getattr(update, "message", None)
+    if message is None:
+        return "other"
+    if getattr(message, "photo", None):
+        return "photo"
+    if getattr(message, "document", None):
+        return "document"
+    text = getattr(message, "text", None) or ""
+    if text.startswith("/"):
+        return "command:" + text.split()[0].split("@")[0]
+    return "text" if text else "other"
+
+
+class _SlowCallbackHandler(logging.Handler):
+    """Перехват отчетов asyncio 'Executing <handle> took N seconds'"""
+
+    def __init__(self, monitor: "LoopMonitor"):
+        super().__init__(level=logging.WARNING)
+        self.monitor = monitor
+
+    def emit(self, record: logging.LogRecord) -> None:
+        if not isinstance(record.msg, str) or not record.msg.startswith("Executing"):
+            return
+        if not isinstance(record.args, tuple) or len(record.args) != 2:
+            return
+        try:
+            self.monitor.record_slow_callback(str(record.args[0]), float(record.args[1]) * 1000.0)
+        except Exception:
+            self.handleError(record)
+
+
+class LoopMonitor:
+    """Пульс цикла событий, сторожевой поток и учет виновников блокировок"""
+
+    def __init__(self, threshold_ms: float = DEFAULT_STALL_THRESHOLD_MS,
+                 interval: float = DEFAULT_BEAT_INTERVAL, top_n: int = DEFAULT_TOP_N):
+        """
+        Args:
+            threshold_ms: Опоздание пульса, которое считается блокировкой (мс)
+            interval: Интервал пульса в секундах
+            top_n: Количество худших виновников в статистике
+        """
+        self.threshold_ms = threshold_ms
+        self.interval = interval
+        self.top_n = top_n
+
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._loop_thread_id: Optional[int] = None
+        self._debug = False
+        self._slow_handler: Optional[_SlowCallbackHandler] = None
+
+        self._last_beat: Optional[float] = None
+        self._stall_sample: Optional[Tuple[float, Optional[str], Optional[str]]] = None
+        self._current_update = None
+
+        self._stop_event = threading.Event()
+        self._thread = None
+
+        self.lag_ms = 0.0
+        self.max_lag_ms = 0.0
+        # Максимальная задержка с прошлого снимка SystemSampler
+        self._window_max_lag_ms = 0.0
+        self.stalls_total = 0
+        self.stall_time_ms = 0.0
+        self.recent_stalls = deque(maxlen=DEFAULT_RECENT_STALLS)
+
+        # (обработчик, тип обновления) -> статистика блокировок
+        self._offenders: Dict[Tuple[str, str], Dict[str, Any]] = {}
+        # Корутина или обратный вызов -> статистика отчетов asyncio
+        self._slow_callbacks: Dict[str, Dict[str, Any]] = {}
+
+    @property
+    def attached(self) -> bool:
+        return self._loop is not None
+
+    def attach(self, loop: asyncio.AbstractEventLoop, debug: Optional[bool] = None) -> None:
+        """
+        Включает наблюдение за циклом событий. Вызывается из самого цикла.
+
+        Args:
+            loop: Цикл событий бота
+            debug: Включить отладочный режим asyncio (по умолчанию из LOOP_DEBUG)
+        """
+        if self._loop is not None:
+            return
+
+        self._loop = loop
+        self._loop_thread_id = threading.get_ident()
+
+        # Отчет asyncio о медленных обратных вызовах (пишется только в отладочном режиме)
+        loop.slow_callback_duration = self.threshold_ms / 1000.0
+        self._debug = os.getenv("LOOP_DEBUG", "0") == "1" if debug is None else debug
+        if self._debug:
+            loop.set_debug(True)
+        self._slow_handler = _SlowCallbackHandler(self)
+        logging.getLogger("asyncio").addHandler(self._slow_handler)
+
+        self._last_beat = time.perf_counter()
+        loop.call_later(self.interval, self._beat, self._last_beat + self.interval)
+
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._watch, name="loop-watchdog", daemon=True)
+        self._thread.start()
+        logger.info(f"🐌 Обнаружение блокировок цикла событий включено (порог {self.threshold_ms:.0f}мс"
+                    f"{', отладка asyncio' if self._debug else ''})")
+
+    def stop(self) -> None:
+        """Остановка сторожевого потока и отключение отчетов asyncio"""
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join(timeout=1)
+            self._thread = None
+        if self._slow_handler is not None:
+            logging.getLogger("asyncio").removeHandler(self._slow_handler)
+            self._slow_handler = None
+        self._loop = None
+
+    async def track_update(self, update: Any, context: Any = None) -> None:
+        """Обработчик группы -1: запоминает тип обрабатываемого обновления"""
+        self._current_update = describe_update(update)
+
+    def _beat(self, expected: float) -> None:
+        now = time.perf_counter()
+        lag_ms = max(0.0, (now - expected) * 1000.0)
+        self.lag_ms = lag_ms
+        if lag_ms > self.max_lag_ms:
+            self.max_lag_ms = lag_ms
+        if lag_ms > self._window_max_lag_ms:
+            self._window_max_lag_ms = lag_ms
+
+        if lag_ms >= self.threshold_ms:
+            sample = self._stall_sample
+            handler, site = (sample[1], sample[2]) if sample and sample[0] == self._last_beat else (None, None)
+            self._record_stall(lag_ms, handler, site)
+        self._stall_sample = None
+
+        self._last_beat = now
+        loop = self._loop
+        if loop is not None and not loop.is_closed():
+            loop.call_later(self.interval, self._beat, now + self.interval)
+
+    def _watch(self) -> None:
+        """Сторожевой поток: снимает стек цикла, пока пульс стоит"""
+        stall_after = self.interval + self.threshold_ms / 1000.0
+        while not self._stop_event.wait(self.interval / 2):
+            beat = self._last_beat
+            if beat is None or self._stall_sample is not None:
+                continue
+            if time.perf_counter() - beat >= stall_after:
+                try:
+                    handler, site = self._capture_stack()
+                except Exception as e:
+                    logger.debug(f"Не удалось снять стек цикла событий: {e}")
+                    handler, site = None, None
+                self._stall_sample = (beat, handler, site)
+
+    @staticmethod
+    def _is_project_file(filename: str) -> bool:
+        return (filename.startswith(PROJECT_ROOT) and "site-packages" not in filename
+                and filename != __file__)
+
+    def _capture_stack(self) -> Tuple[Optional[str], Optional[str]]:
+        """
+        Обработчик и место блокировки по стеку потока цикла.
+
+        Returns:
+            (внешняя корутина проекта, 'файл:строка функция' самого внутреннего кадра проекта)
+        """
+        frame = sys._current_frames().get(self._loop_thread_id)
+        handler = None
+        site = None
+        while frame is not None:
+            code = frame.f_code
+            if self._is_project_file(code.co_filename):
+                if site is None:
+                    path = os.path.relpath(code.co_filename, PROJECT_ROOT)
+                    site = f"{path}:{frame.f_lineno} {code.co_name}"
+                if code.co_flags & inspect.CO_COROUTINE:
+                    handler = getattr(code, "co_qualname", code.co_name)
+            frame = frame.f_back
+        return handler, site
+
+    def _record_stall(self, duration_ms: float, handler: Optional[str], site: Optional[str]) -> None:
+        update_type = self._current_update or "-"
+        handler = handler or UNKNOWN_HANDLER
+
+        self.stalls_total += 1
+        self.stall_time_ms += duration_ms
+
+        key = (handler, update_type)
+        stats = self._offenders.get(key)
+        if stats is None:
+            stats = self._offenders[key] = {
+                'handler': handler, 'update_type': update_type, 'site': site,
+                'count': 0, 'total_ms': 0.0, 'max_ms': 0.0, 'last_at': None,
+            }
+        stats['count'] += 1
+        stats['total_ms'] += duration_ms
+        stats['max_ms'] = max(stats['max_ms'], duration_ms)
+        stats['last_at'] = time.time()
+        if site:
+            stats['site'] = site
+
+        self.recent_stalls.append({
+            'time': stats['last_at'],
+            'duration_ms': round(duration_ms, 1),
+            'handler': handler,
+            'update_type': update_type,
+            'site': site,
+        })
+        logger.warning(f"🐌 Цикл событий заблокирован на {duration_ms:.0f}мс: {handler} "
+                       f"({update_type}){f' в {site}' if site else ''}")
+
+    def take_lag_window(self) -> Tuple[float, float]:
+        """
+        Задержка цикла для снимка системных метрик.
+
+        Returns:
+            (последняя задержка, максимальная с прошлого вызова) в мс
+        """
+        lag_ms = self.lag_ms
+        window_max_ms = max(self._window_max_lag_ms, lag_ms)
+        self._window_max_lag_ms = lag_ms
+        return lag_ms, window_max_ms
+
+    def record_slow_callback(self, handle_repr: str, duration_ms: float) -> None:
+        """Учет отчета asyncio о медленном обратном вызове"""
+        match = _CORO_NAME_RE.search(handle_repr)
+        name = match.group(1) if match else handle_repr[:80]
+        stats = self._slow_callbacks.setdefault(name, {'name': name, 'count': 0, 'total_ms': 0.0, 'max_ms': 0.0})
+        stats['count'] += 1
+        stats['total_ms'] += duration_ms
+        stats['max_ms'] = max(stats['max_ms'], duration_ms)
+
+    def get_top_offenders(self, n: Optional[int] = None) -> List[Dict[str, Any]]:
+        """Худшие виновники блокировок по суммарному времени"""
+        offenders = sorted(self._offenders.values(), key=lambda item: item['total_ms'], reverse=True)
+        return [dict(item) for item in offenders[:n or self.top_n]]
+
+    def get_slow_callbacks(self, n: Optional[int] = None) -> List[Dict[str, Any]]:
+        """Медленные обратные вызовы из отчетов asyncio по суммарному времени"""
+        callbacks = sorted(self._slow_callbacks.values(), key=lambda item: item['total_ms'], reverse=True)
+        return [dict(item) for item in callbacks[:n or self.top_n]]
+
+    def stalls_since(self, seconds: float) -> List[Dict[str, Any]]:
+        """Блокировки за последние N секунд"""
+        cutoff = time.time() - seconds
+        return [stall for stall in list(self.recent_stalls) if stall['time'] >= cutoff]
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Статистика блокировок цикла событий"""
+        last_stall = self.recent_stalls[-1] if self.recent_stalls else None
+        return {
+            'attached': self.attached,
+            'debug': self._debug,
+            'threshold_ms': self.threshold_ms,
+            'lag_ms': round(self.lag_ms, 1),
+            'max_lag_ms': round(self.max_lag_ms, 1),
+            'stalls_total': self.stalls_total,
+            'stall_time_ms': round(self.stall_time_ms, 1),
+            'last_stall': dict(last_stall, timestamp=datetime.fromtimestamp(last_stall['time']).isoformat())
+                          if last_stall else None,
+            'top_offenders': self.get_top_offenders(),
+            'slow_callbacks': self.get_slow_callbacks(),
+        }
+
+
+# Глобальный экземпляр наблюдателя за циклом событий
+_loop_monitor = None
+_loop_monitor_lock = threading.Lock()
+
+def get_loop_monitor() -> LoopMonitor:
+    """Получение экземпляра наблюдателя за циклом событий"""
+    global _loop_monitor
+    if _loop_monitor is None:
+        with _loop_monitor_lock:
+            if _loop_monitor is None:
+                _loop_monitor = LoopMonitor()
+    return _loop_monitor
@@ -0,0 +1,212 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Компактное хранилище метрик на кольцевых буферах numpy.
+
+Каждое событие - строка в заранее выделенных столбцах: время (epoch float),
+идентификатор операции, значение (например, длительность в мс), признак успеха
+и дополнительное значение. Память фиксирована и не зависит от числа событий.
+
+Запись не берет блокировок: номер ячейки выдает itertools.count, а его next()
+атомарен под GIL, поэтому параллельные писатели получают разные ячейки.
+Агрегаты по окну времени считаются векторными операциями только над событиями
+окна: буфер состоит из двух упорядоченных по времени отрезков, и границы окна
+находятся бинарным поиском.
+"""
+
+import time
+import itertools
+import threading
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+
+# Перцентили, которые возвращаются в агрегатах
+DEFAULT_PERCENTILES = (50, 95, 99)
+
+
+class MetricsStore:
+    """
+    Кольцевой буфер событий (время, операция, значение, успех, доп. значение).
+    """
+
+    def __init__(self, capacity: int = 4096):
+        """
+        Args:
+            capacity: Количество хранимых последних событий
+        """
+        self.capacity = capacity
+        self.timestamps = np.zeros(capacity, dtype=np.float64)
+        self.operations = np.zeros(capacity, dtype=np.int32)
+        self.values = np.zeros(capacity, dtype=np.float32)
+        self.success = np.zeros(capacity, dtype=np.bool_)
+        self.extra = np.full(capacity, np.nan, dtype=np.float32)
+
+        self._slots = itertools.count()
+        self._written = 0
+
+        # Интернирование названий операций: новые названия добавляются редко
+        self._operation_ids: Dict[str, int] = {}
+        self._operation_names: List[str] = []
+        self._operation_totals: List[int] = []
+        self._names_lock = threading.Lock()
+
+    def operation_id(self, operation: str) -> int:
+        """Числовой идентификатор операции"""
+        op_id = self._operation_ids.get(operation)
+        if op_id is None:
+            with self._names_lock:
+                op_id = self._operation_ids.get(operation)
+                if op_id is None:
+                    op_id = len(self._operation_names)
+                    self._operation_names.append(operation)
+                    self._operation_totals.append(0)
+                    self._operation_ids[operation] = op_id
+        return op_id
+
+    def append(self, operation: str, value: float = 0.0, success: bool = True,
+               extra: Optional[float] = None, timestamp: Optional[float] = None) -> None:
+        """
+        Добавление события.
+
+        Args:
+            operation: Название операции
+            value: Значение (например, длительность в мс)
+            success: Признак успешного выполнения
+            extra: Дополнительное значение (например, точность)
+            timestamp: Время события (по умолчанию текущее)
+        """
+        op_id = self.operation_id(operation)
+        slot = next(self._slots)
+        idx = slot % self.capacity
+
+        self.operations[idx] = op_id
+        self.values[idx] = value
+        self.success[idx] = success
+        self.extra[idx] = np.nan if extra is None else extra
+        # Время записывается последним: по нему читатели отбирают события окна
+        self.timestamps[idx] = time.time() if timestamp is None else timestamp
+
+        self._operation_totals[op_id] += 1
+        if slot >= self._written:
+            self._written = slot + 1
+
+    def __len__(self) -> int:
+        return min(self._written, self.capacity)
+
+    @property
+    def total(self) -> int:
+        """Количество событий за все время"""
+        return self._written
+
+    def operation_total(self, operation: str) -> int:
+        """Количество событий операции за все время"""
+        op_id = self._operation_ids.get(operation)
+        return self._operation_totals[op_id] if op_id is not None else 0
+
+    def _window_indices(self, seconds: Optional[float], last_n: Optional[int]) -> np.ndarray:
+        """
+        Индексы событий окна в порядке записи.
+
+        Буфер - это два отрезка [head:] и [:head], каждый упорядочен по времени,
+        поэтому граница окна по времени находится бинарным поиском.
+        """
+        written = self._written
+        stored = min(written, self.capacity)
+        if seconds is None:
+            count = stored if last_n is None else min(stored, last_n)
+            return np.arange(written - count, written) % self.capacity
+
+        if written <= self.capacity:
+            segments = [(0, written)]
+        else:
+            head = written % self.capacity
+            segments = [(head, self.capacity), (0, head)]
+
+        cutoff = time.time() - seconds
+        parts = []
+        for lo, hi in segments:
+            offset = int(np.searchsorted(self.timestamps[lo:hi], cutoff, side='left'))
+            if lo + offset < hi:
+                parts.append(np.arange(lo + offset, hi))
+        indices = np.concatenate(parts) if parts else np.empty(0, dtype=np.int64)
+        return indices if last_n is None else indices[-last_n:]
+
+    def select(self, seconds: Optional[float] = None, operation: Optional[str] = None,
+               last_n: Optional[int] = None) -> Dict[str, np.ndarray]:
+        """
+        Столбцы событий окна.
+
+        Args:
+            seconds: Окно по времени (последние N секунд)
+            operation: Фильтр по операции
+            last_n: Последние N событий (вместо окна по времени)
+
+        Returns:
+            Словарь столбцов: timestamps, operations, values, success, extra
+        """
+        if operation is None:
+            indices = self._window_indices(seconds, last_n)
+        else:
+            indices = self._window_indices(seconds, None)
+            op_id = self._operation_ids.get(operation)
+            indices = indices[:0] if op_id is None else indices[self.operations[indices] == op_id]
+            if last_n is not None:
+                indices = indices[-last_n:]
+
+        return {
+            'timestamps': self.timestamps[indices],
+            'operations': self.operations[indices],
+            'values': self.values[indices],
+            'success': self.success[indices],
+            'extra': self.extra[indices],
+        }
+
+    @staticmethod
+    def _summarize(values: np.ndarray, success: np.ndarray, extra: np.ndarray,
+                   percentiles=DEFAULT_PERCENTILES) -> Dict[str, Any]:
+        """Агрегаты по столбцам окна"""
+        count = int(values.size)
+        summary: Dict[str, Any] = {'count': count, 'errors': int(count - np.count_nonzero(success))}
+        if count == 0:
+            summary['mean'] = None
+            summary.update({f'p{p}': None for p in percentiles})
+            return summary
+
+        summary['mean'] = float(values.mean())
+        for p, value in zip(percentiles, np.percentile(values, percentiles)):
+            summary[f'p{p}'] = float(value)
+        known_extra = extra[~np.isnan(extra)]
+        if known_extra.size:
+            summary['extra_mean'] = float(known_extra.mean())
+        return summary
+
+    def aggregate(self, seconds: Optional[float] = None, operation: Optional[str] = None,
+                  last_n: Optional[int] = None) -> Dict[str, Any]:
+        """
+        Агрегаты окна: count, errors, mean, p50/p95/p99.
+
+        Args:
+            seconds: Окно по времени (последние N секунд)
+            operation: Фильтр по операции
+            last_n: Последние N событий (вместо окна по времени)
+        """
+        window = self.select(seconds, operation, last_n)
+        return self._summarize(window['values'], window['success'], window['extra'])
+
+    def aggregate_by_operation(self, seconds: Optional[float] = None,
+                               last_n: Optional[int] = None) -> Dict[str, Dict[str, Any]]:
+        """Агрегаты окна отдельно по каждой операции"""
+        window = self.select(seconds, None, last_n)
+        result = {}
+        for op_id in np.unique(window['operations']):
+            mask = window['operations'] == op_id
+            result[self._operation_names[op_id]] = self._summarize(
+                window['values'][mask], window['success'][mask], window['extra'][mask]
+            )
+        return result
+
+    def count(self, seconds: Optional[float] = None, operation: Optional[str] = None) -> int:
+        """Количество событий окна"""
+        return int(self.select(seconds, operation)['values'].size)
@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Сохранение небольших файлов состояния без лишней записи на диск.
+
+- atomic_write_json: запись во временный файл в той же директории, fsync и
+  os.replace. Читатель и перезапуск после сбоя видят либо старый, либо новый
+  файл целиком, обрезанный JSON невозможен.
+- PersistedState: изменения только помечают состояние "грязным", а запись
+  выполняется не чаще раза в flush_interval секунд в отдельном потоке-таймере.
+  Всплеск ошибок из тысяч событий дает одну запись за интервал.
+- load_json: чтение с переносом поврежденного файла (оставшегося от прежней
+  неатомарной записи) в *.corrupt вместо падения при запуске.
+"""
+
+import os
+import json
+import time
+import atexit
+import logging
+import tempfile
+import threading
+from typing import Any, Callable, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+# Интервал отложенной записи по умолчанию, сек
+DEFAULT_FLUSH_INTERVAL = float(os.getenv("STATE_FLUSH_INTERVAL", "5"))
+
+
+def atomic_write_json(path: str, data: Any) -> None:
+    """
+    Атомарная запись JSON в компактном виде.
+
+    Args:
+        path: Путь к файлу
+        data: Сериализуемые данные
+    """
+    directory = os.path.dirname(path) or "."
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(prefix=f".{os.path.basename(path)}.", suffix=".tmp", dir=directory)
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False, separators=(",", ":"))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+def load_json(path: str, default: Any = None) -> Any:
+    """
+    Чтение файла состояния.
+
+    Поврежденный файл переносится в <path>.corrupt, чтобы следующая запись
+    начала с чистого состояния, а содержимое осталось для разбора.
+
+    Returns:
+        Данные файла или default, если файла нет или он поврежден
+    """
+    if not os.path.exists(path):
+        return default
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (json.JSONDecodeError, UnicodeDecodeError) as e:
+        logger.warning(f"⚠️ Файл состояния {path} поврежден, переносим в .corrupt: {e}")
+        try:
+            os.replace(path, path + ".corrupt")
+        except OSError:
+            pass
+        return default
+
+
+class PersistedState:
+    """Отложенная атомарная запись состояния в файл"""
+
+    def __init__(self, path: str, snapshot: Callable[[], Any],
+                 flush_interval: float = DEFAULT_FLUSH_INTERVAL):
+        """
+        Args:
+            path: Путь к файлу состояния
+            snapshot: Функция, возвращающая сериализуемый снимок состояния
+            flush_interval: Минимальный интервал между записями, сек
+        """
+        self.path = path
+        self.snapshot = snapshot
+        self.flush_interval = flush_interval
+        self.writes = 0
+        self.coalesced = 0
+        self.failures = 0
+        self._dirty = False
+        self._last_flush = 0.0
+        self._timer: Optional[threading.Timer] = None
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        # Несохраненные изменения записываются при штатном завершении процесса
+        atexit.register(self.flush)
+
+    def mark_dirty(self) -> None:
+        """Пометить состояние измененным; запись будет выполнена таймером"""
+        with self._lock:
+            if self._dirty:
+                self.coalesced += 1
+            self._dirty = True
+            if self._timer is not None:
+                return
+            delay = max(0.0, self._last_flush + self.flush_interval - time.monotonic())
+            self._timer = threading.Timer(delay, self._on_timer)
+            self._timer.daemon = True
+            self._timer.name = f"PersistedState-{os.path.basename(self.path)}"
+            self._timer.start()
+
+    def _on_timer(self) -> None:
+        with self._lock:
+            self._timer = None
+        self.flush()
+
+    def flush(self) -> bool:
+        """
+        Немедленная запись, если есть несохраненные изменения.
+
+        Returns:
+            True, если файл был записан
+        """
+        with self._write_lock:
+            with self._lock:
+                if not self._dirty:
+                    return False
+                self._dirty = False
+                self._last_flush = time.monotonic()
+            try:
+                atomic_write_json(self.path, self.snapshot())
+                self.writes += 1
+                return True
+            except Exception as e:
+                # Повторим при следующем изменении или остановке
+                self.failures += 1
+                with self._lock:
+                    self._dirty = True
+                logger.error(f"❌ Ошибка сохранения состояния в {self.path}: {e}")
+                return False
+
+    def close(self) -> None:
+        """Отмена таймера и запись несохраненных изменений"""
+        with self._lock:
+            timer, self._timer = self._timer, None
+        if timer is not None:
+            timer.cancel()
+        self.flush()
+        atexit.unregister(self.flush)
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Счетчики записей для мониторинга"""
+        return {
+            'path': self.path,
+            'writes': self.writes,
+            'coalesced': self.coalesced,
+            'failures': self.failures,
+            'dirty': self._dirty,
+        }
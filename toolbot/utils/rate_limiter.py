@@ -1,136 +1,394 @@
 """
 Модуль для ограничения частоты запросов к боту.
+
+Используется алгоритм GCRA (generic cell rate algorithm): для каждой пары
+(действие, пользователь) хранится одно число - теоретическое время прибытия
+следующего запроса (TAT). Состояние разбито на шарды со своими блокировками,
+поэтому пользователи из разных шардов не ждут друг друга.
+
+Запись, у которой TAT уже в прошлом, ничем не отличается от отсутствующей,
+поэтому фоновая очистка удаляет такие записи без потери информации - память
+ограничена числом активных пользователей, а не всех когда-либо писавших боту.
+
+Если задана переменная окружения RATE_LIMIT_DB (путь к файлу SQLite), состояние
+хранится в общей базе и лимиты действуют сразу для нескольких процессов бота.
 """
+import os
 import time
+import sqlite3
 import threading
 import logging
+from dataclasses import dataclass, replace
 from typing import Dict, Optional, Tuple
-from collections import deque
 
 logger = logging.getLogger(__name__)
 
+# Количество шардов состояния в памяти
+DEFAULT_SHARDS = 16
+
+# Интервал фоновой очистки неактивных записей (секунды)
+DEFAULT_EVICT_INTERVAL = 60.0
+
+# Путь к общей базе лимитов для нескольких процессов (пусто - состояние в памяти)
+RATE_LIMIT_DB_ENV = "RATE_LIMIT_DB"
+
+
+@dataclass(frozen=True)
+class RatePolicy:
+    """
+    Политика ограничения для типа действия.
+
+    limit запросов за period секунд, из них до burst подряд без ожидания.
+    limit=None - без ограничений.
+    """
+    limit: Optional[int]
+    period: float
+    burst: int = 1
+
+    @property
+    def unlimited(self) -> bool:
+        return self.limit is None
+
+    @property
+    def emission_interval(self) -> float:
+        """Интервал между запросами при равномерном потоке"""
+        return self.period / self.limit
+
+    @property
+    def tolerance(self) -> float:
+        """Допустимое опережение графика (размер всплеска)"""
+        return self.emission_interval * (max(1, self.burst) - 1)
+
+
+# Политики по умолчанию: те же лимиты, что и раньше
+# (30 запросов в минуту, одно фото в 10 секунд, администраторы без ограничений)
+DEFAULT_POLICIES: Dict[str, RatePolicy] = {
+    "general": RatePolicy(limit=30, period=60, burst=30),
+    "photo": RatePolicy(limit=1, period=10, burst=1),
+    "admin": RatePolicy(limit=None, period=0),
+}
+
+
+def gcra_update(tat: Optional[float], now: float, policy: RatePolicy) -> Tuple[bool, float, Optional[float]]:
+    """
+    Один шаг GCRA.
+
+    Args:
+        tat: Текущее теоретическое время прибытия (None - записи нет)
+        now: Текущее время
+        policy: Политика действия
+
+    Returns:
+        Кортеж (разрешено, новое_TAT, время_до_следующего_запроса)
+    """
+    tat = now if tat is None else max(tat, now)
+    new_tat = tat + policy.emission_interval
+    allow_at = new_tat - policy.emission_interval - policy.tolerance
+    if allow_at > now:
+        return False, tat, allow_at - now
+    return True, new_tat, None
+
+
+class _Shard:
+    """Шард состояния: словарь {(действие, пользователь): TAT} со своей блокировкой"""
+
+    __slots__ = ("lock", "state")
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.state: Dict[Tuple[str, int], float] = {}
+
+
+class MemoryRateStore:
+    """Хранилище состояния в памяти процесса, разбитое на шарды"""
+
+    def __init__(self, shards: int = DEFAULT_SHARDS):
+        self._shards = [_Shard() for _ in range(max(1, shards))]
+
+    @staticmethod
+    def now() -> float:
+        return time.monotonic()
+
+    def _shard(self, user_id: int) -> _Shard:
+        return self._shards[hash(user_id) % len(self._shards)]
+
+    def acquire(self, action: str, user_id: int, policy: RatePolicy) -> Tuple[bool, Optional[float]]:
+        shard = self._shard(user_id)
+        key = (action, user_id)
+        now = self.now()
+        with shard.lock:
+            allowed, new_tat, wait = gcra_update(shard.state.get(key), now, policy)
+            if allowed:
+                shard.state[key] = new_tat
+        return allowed, wait
+
+    def reset(self, user_id: int) -> None:
+        shard = self._shard(user_id)
+        with shard.lock:
+            for key in [key for key in shard.state if key[1] == user_id]:
+                del shard.state[key]
+
+    def evict_idle(self) -> int:
+        removed = 0
+        for shard in self._shards:
+            now = self.now()
+            with shard.lock:
+                idle = [key for key, tat in shard.state.items() if tat <= now]
+                for key in idle:
+                    del shard.state[key]
+            removed += len(idle)
+        return removed
+
+    def count(self) -> int:
+        return sum(len(shard.state) for shard in self._shards)
+
+    def close(self) -> None:
+        pass
+
+
+class SqliteRateStore:
+    """
+    Хранилище состояния в SQLite, общее для нескольких процессов.
+
+    Время - системные часы (time.time), чтобы значения TAT были сравнимы
+    между процессами. Чтение и запись TAT выполняются в одной транзакции
+    BEGIN IMMEDIATE, поэтому два процесса не пропустят лишний запрос.
+    """
+
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        db_dir = os.path.dirname(db_path)
+        if db_dir:
+            os.makedirs(db_dir, exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None, timeout=5)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS rate_limits (
+                action TEXT NOT NULL,
+                user_id INTEGER NOT NULL,
+                tat REAL NOT NULL,
+                PRIMARY KEY (action, user_id)
+            ) WITHOUT ROWID
+        """)
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_rate_limits_tat ON rate_limits(tat)")
+
+    @staticmethod
+    def now() -> float:
+        return time.time()
+
+    def acquire(self, action: str, user_id: int, policy: RatePolicy) -> Tuple[bool, Optional[float]]:
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._conn.execute(
+                    "SELECT tat FROM rate_limits WHERE action = ? AND user_id = ?", (action, user_id)
+                ).fetchone()
+                allowed, new_tat, wait = gcra_update(row[0] if row else None, self.now(), policy)
+                if allowed:
+                    self._conn.execute(
+                        "INSERT INTO rate_limits (action, user_id, tat) VALUES (?, ?, ?) "
+                        "ON CONFLICT(action, user_id) DO UPDATE SET tat = excluded.tat",
+                        (action, user_id, new_tat)
+                    )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        return allowed, wait
+
+    def reset(self, user_id: int) -> None:
+        with self._lock:
+            self._conn.execute("DELETE FROM rate_limits WHERE user_id = ?", (user_id,))
+
+    def evict_idle(self) -> int:
+        with self._lock:
+            return self._conn.execute("DELETE FROM rate_limits WHERE tat <= ?", (self.now(),)).rowcount
+
+    def count(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM rate_limits").fetchone()[0]
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
 
 class RateLimiter:
     """
     Класс для ограничения частоты запросов к боту.
-    Реализует алгоритм скользящего окна.
+    Политики задаются отдельно для каждого типа действия.
     """
-    
+
     _instance = None
     _lock = threading.Lock()
-    
+
     @classmethod
     def get_instance(cls):
         """
         Получение экземпляра лимитера (шаблон Singleton).
-        
+
         Returns:
             Экземпляр RateLimiter
         """
         if cls._instance is None:
             with cls._lock:
                 if cls._instance is None:
-                    cls._instance = cls()
+                    cls._instance = cls(db_path=os.environ.get(RATE_LIMIT_DB_ENV) or None)
         return cls._instance
-    
-    def __init__(self):
+
+    def __init__(self, policies: Optional[Dict[str, RatePolicy]] = None, db_path: Optional[str] = None,
+                 shards: int = DEFAULT_SHARDS, evict_interval: float = DEFAULT_EVICT_INTERVAL):
         """
         Инициализация ограничителя частоты запросов.
+
+        Args:
+            policies: Политики по типам действий (по умолчанию DEFAULT_POLICIES)
+            db_path: Путь к базе SQLite для общего состояния нескольких процессов
+            shards: Количество шардов состояния в памяти
+            evict_interval: Интервал фоновой очистки неактивных записей (0 - без фоновой очистки)
+        """
+        self.policies: Dict[str, RatePolicy] = dict(policies or DEFAULT_POLICIES)
+        self.default_action = "general"
+
+        self.store = None
+        if db_path:
+            try:
+                self.store = SqliteRateStore(db_path)
+                logger.info(f"✅ Лимиты запросов хранятся в общей базе {db_path}")
+            except Exception as e:
+                logger.error(f"❌ Не удалось открыть базу лимитов {db_path}, используется память процесса: {e}")
+        if self.store is None:
+            self.store = MemoryRateStore(shards)
+
+        self.evict_interval = evict_interval
+        self.evicted = 0
+        self.allowed: Dict[str, int] = {}
+        self.rejected: Dict[str, int] = {}
+        self._stop_event = threading.Event()
+        self._evict_thread = None
+        if evict_interval > 0:
+            self._evict_thread = threading.Thread(target=self._evict_loop, name="rate-limiter-evict", daemon=True)
+            self._evict_thread.start()
+
+    def _evict_loop(self):
+        """Фоновая очистка неактивных записей"""
+        while not self._stop_event.wait(self.evict_interval):
+            self.evict_idle()
+
+    def evict_idle(self) -> int:
+        """
+        Удаляет записи пользователей, у которых лимит полностью восстановился.
+
+        Returns:
+            Количество удаленных записей
         """
-        self.user_requests = {}  # user_id -> deque[timestamp]
-        self.photo_requests = {}  # user_id -> timestamp
-        
-        # Значения по умолчанию
-        self.default_limit = 30  # Максимальное количество запросов
-        self.default_window = 60  # Окно в секундах (1 минута)
-        self.photo_cooldown = 10  # Кулдаун между запросами фото (секунды)
-    
+        try:
+            removed = self.store.evict_idle()
+        except Exception as e:
+            logger.error(f"❌ Ошибка при очистке лимитов запросов: {e}")
+            return 0
+        self.evicted += removed
+        if removed:
+            logger.debug(f"Удалено неактивных записей лимитера: {removed}")
+        return removed
+
+    def get_policy(self, action_type: str) -> RatePolicy:
+        """Политика для типа действия (неизвестные типы - как 'general')"""
+        return self.policies.get(action_type) or self.policies[self.default_action]
+
     def check_and_add(self, user_id: int, action_type: str = "general") -> Tuple[bool, Optional[float]]:
         """
-        Проверяет, не превышен ли лимит запросов и добавляет запрос в историю.
-        
+        Проверяет, не превышен ли лимит запросов и учитывает запрос.
+
         Args:
             user_id: ID пользователя
             action_type: Тип действия ('general', 'photo', 'admin', etc.)
-            
+
         Returns:
             Кортеж (можно_выполнить, время_до_следующего_запроса)
         """
-        current_time = time.time()
-        
-        # Для запросов фото используем отдельный кулдаун
-        if action_type == "photo":
-            with self._lock:
-                last_request = self.photo_requests.get(user_id, 0)
-                time_since_last = current_time - last_request
-                
-                if time_since_last < self.photo_cooldown:
-                    remaining = self.photo_cooldown - time_since_last
-                    return False, remaining
-                
-                # Обновляем время последнего запроса
-                self.photo_requests[user_id] = current_time
-                return True, None
-        
-        # Для административных действий нет ограничений
-        if action_type == "admin":
+        policy = self.get_policy(action_type)
+        if policy.unlimited:
             return True, None
-        
-        # Для обычных запросов используем алгоритм скользящего окна
-        with self._lock:
-            if user_id not in self.user_requests:
-                self.user_requests[user_id] = deque()
-            
-            # Очистка устаревших запросов
-            window_start = current_time - self.default_window
-            while self.user_requests[user_id] and self.user_requests[user_id][0] < window_start:
-                self.user_requests[user_id].popleft()
-            
-            # Проверка количества запросов в окне
-            if len(self.user_requests[user_id]) >= self.default_limit:
-                oldest = self.user_requests[user_id][0]
-                time_until_available = (oldest + self.default_window) - current_time
-                return False, time_until_available
-            
-            # Добавляем новый запрос
-            self.user_requests[user_id].append(current_time)
+
+        action = action_type if action_type in self.policies else self.default_action
+        try:
+            allowed, wait = self.store.acquire(action, user_id, policy)
+        except Exception as e:
+            # Сбой хранилища не должен блокировать пользователей
+            logger.error(f"❌ Ошибка при проверке лимита запросов: {e}")
             return True, None
-    
+
+        counters = self.allowed if allowed else self.rejected
+        counters[action] = counters.get(action, 0) + 1
+        return allowed, wait
+
+    def set_policy(self, action_type: str, policy: RatePolicy):
+        """
+        Устанавливает политику для типа действия.
+
+        Args:
+            action_type: Тип действия
+            policy: Новая политика
+        """
+        self.policies[action_type] = policy
+        logger.info(f"Установлена политика '{action_type}': {policy}")
+
     def set_limits(self, general_limit: int = None, general_window: int = None, photo_cooldown: int = None):
         """
         Устанавливает лимиты для различных типов запросов.
-        
+
         Args:
             general_limit: Общий лимит запросов в окне
             general_window: Размер окна в секундах
             photo_cooldown: Кулдаун между запросами фото
         """
-        with self._lock:
-            if general_limit is not None:
-                self.default_limit = max(1, general_limit)
-            
-            if general_window is not None:
-                self.default_window = max(1, general_window)
-            
-            if photo_cooldown is not None:
-                self.photo_cooldown = max(1, photo_cooldown)
-            
-            logger.info(f"Установлены новые лимиты: запросов={self.default_limit}, "
-                       f"окно={self.default_window}с, фото={self.photo_cooldown}с")
-    
+        general = self.policies["general"]
+        if general_limit is not None:
+            limit = max(1, general_limit)
+            general = replace(general, limit=limit, burst=limit)
+        if general_window is not None:
+            general = replace(general, period=max(1, general_window))
+        self.policies["general"] = general
+
+        if photo_cooldown is not None:
+            self.policies["photo"] = RatePolicy(limit=1, period=max(1, photo_cooldown), burst=1)
+
+        logger.info(f"Установлены новые лимиты: запросов={general.limit}, "
+                    f"окно={general.period}с, фото={self.policies['photo'].period}с")
+
     def reset_for_user(self, user_id: int):
         """
         Сбрасывает счетчики запросов для конкретного пользователя.
-        
+
         Args:
             user_id: ID пользователя
         """
-        with self._lock:
-            if user_id in self.user_requests:
-                del self.user_requests[user_id]
-            
-            if user_id in self.photo_requests:
-                del self.photo_requests[user_id]
+        try:
+            self.store.reset(user_id)
+        except Exception as e:
+            logger.error(f"❌ Ошибка при сбросе лимитов пользователя {user_id}: {e}")
+
+    def get_stats(self) -> Dict[str, object]:
+        """Статистика лимитера"""
+        return {
+            'backend': 'sqlite' if isinstance(self.store, SqliteRateStore) else 'memory',
+            'tracked_entries': self.store.count(),
+            'evicted_entries': self.evicted,
+            'allowed': dict(self.allowed),
+            'rejected': dict(self.rejected),
+            'policies': {name: (policy.limit, policy.period, policy.burst) for name, policy in self.policies.items()},
+        }
+
+    def stop(self):
+        """Останавливает фоновую очистку и закрывает хранилище"""
+        self._stop_event.set()
+        if self._evict_thread is not None:
+            self._evict_thread.join(timeout=1)
+        self.store.close()
 
 
 # Глобальные функции для использования ограничителя
@@ -138,11 +396,11 @@ class RateLimiter:
 def check_rate_limit(user_id: int, action_type: str = "general") -> Tuple[bool, Optional[float]]:
     """
     Проверяет, не превышен ли лимит запросов для пользователя.
-    
+
     Args:
         user_id: ID пользователя
         action_type: Тип действия
-        
+
     Returns:
         Кортеж (можно_выполнить, время_до_следующего_запроса)
     """
@@ -153,7 +411,7 @@ def check_rate_limit(user_id: int, action_type: str = "general") -> Tuple[bool,
 def set_rate_limits(general_limit: int = None, general_window: int = None, photo_cooldown: int = None):
     """
     Устанавливает лимиты для различных типов запросов.
-    
+
     Args:
         general_limit: Общий лимит запросов в окне
         general_window: Размер окна в секундах
@@ -166,9 +424,9 @@ def set_rate_limits(general_limit: int = None, general_window: int = None, photo
 def reset_rate_limits_for_user(user_id: int):
     """
     Сбрасывает счетчики запросов для конкретного пользователя.
-    
+
     Args:
         user_id: ID пользователя
     """
     limiter = RateLimiter.get_instance()
-    limiter.reset_for_user(user_id) 
\ No newline at end of file
+    limiter.reset_for_user(user_id)
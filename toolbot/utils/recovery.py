@@ -15,10 +15,11 @@ import subprocess
 import threading
 import traceback
 import json
-import psutil
 from typing import List, Dict, Any, Optional, Callable, Union, Tuple
 from enum import Enum
 
+from toolbot.utils.persisted_state import PersistedState, load_json
+
 logger = logging.getLogger(__name__)
 
 
@@ -78,6 +79,9 @@ class RecoveryManager:
         # Словарь обработчиков для разных компонентов
         self.recovery_handlers = {}
         
+        # Состояния пишутся отложенно и атомарно, а не на каждое изменение и тик
+        self._states_state = PersistedState(self.state_file_path, self._component_states_snapshot)
+        
         # Загружаем предыдущие состояния компонентов
         self._load_component_states()
         
@@ -101,54 +105,51 @@ class RecoveryManager:
     def _load_component_states(self):
         """Загружает предыдущие состояния компонентов из файла"""
         try:
-            if os.path.exists(self.state_file_path):
-                try:
-                    with open(self.state_file_path, 'r', encoding='utf-8') as f:
-                        states = json.load(f)
-                        # Конвертируем строковые состояния в перечисления
-                        for component, state_data in states.items():
-                            if "state" in state_data:
-                                try:
-                                    state_data["state"] = ComponentState(state_data["state"])
-                                except ValueError:
-                                    state_data["state"] = ComponentState.STOPPED
-                            self.components[component] = state_data
-                        logger.info(f"Загружены состояния {len(self.components)} компонентов")
-                except json.JSONDecodeError as je:
-                    logger.warning(f"Файл состояний компонентов поврежден, создаем новый: {je}")
-                    # Удаляем поврежденный файл
-                    try:
-                        os.remove(self.state_file_path)
-                    except Exception:
-                        pass
-                    # Создаем пустой словарь состояний
-                    self.components = {}
+            # Поврежденный файл load_json переносит в .corrupt и возвращает пустой словарь
+            states = load_json(self.state_file_path, {})
+            if isinstance(states, dict) and states:
+                # Конвертируем строковые состояния в перечисления
+                for component, state_data in states.items():
+                    if "state" in state_data:
+                        try:
+                            state_data["state"] = ComponentState(state_data["state"])
+                        except ValueError:
+                            state_data["state"] = ComponentState.STOPPED
+                    self.components[component] = state_data
+                logger.info(f"Загружены состояния {len(self.components)} компонентов")
         except Exception as e:
             logger.error(f"Ошибка при загрузке состояний компонентов: {e}")
             # Не позволяем ошибке блокировать запуск
             self.components = {}
     
-    def _save_component_states(self):
-        """Сохраняет текущие состояния компонентов в файл"""
-        try:
-            # Конвертируем перечисления в строки для сериализации
-            serializable_states = {}
-            for component, state_data in self.components.items():
-                serializable_states[component] = {}
-                for key, value in state_data.items():
-                    # Пропускаем функции, которые нельзя сериализовать
-                    if callable(value):
-                        continue
-                    # Преобразуем перечисления в строки
-                    if isinstance(value, ComponentState):
-                        serializable_states[component][key] = value.value
-                    else:
-                        serializable_states[component][key] = value
-            
-            with open(self.state_file_path, 'w', encoding='utf-8') as f:
-                json.dump(serializable_states, f, ensure_ascii=False, indent=2)
-        except Exception as e:
-            logger.error(f"Ошибка при сохранении состояний компонентов: {e}")
+    def _component_states_snapshot(self) -> Dict[str, Dict[str, Any]]:
+        """Снимок состояний компонентов для записи в файл"""
+        # Конвертируем перечисления в строки для сериализации
+        serializable_states = {}
+        for component, state_data in list(self.components.items()):
+            serializable_states[component] = {}
+            for key, value in list(state_data.items()):
+                # Пропускаем функции, которые нельзя сериализовать
+                if callable(value):
+                    continue
+                # Преобразуем перечисления в строки
+                if isinstance(value, ComponentState):
+                    serializable_states[component][key] = value.value
+                else:
+                    serializable_states[component][key] = value
+        return serializable_states
+    
+    def _save_component_states(self, immediate: bool = False):
+        """
+        Сохраняет текущие состояния компонентов в файл.
+        
+        Args:
+            immediate: Записать сразу (перед перезапуском и остановкой),
+                иначе запись откладывается и объединяется с соседними изменениями
+        """
+        self._states_state.mark_dirty()
+        if immediate:
+            self._states_state.flush()
     
     def register_component(self, component_name: str, restart_func: Optional[Callable] = None,
                          health_check_func: Optional[Callable[[], bool]] = None):
@@ -232,6 +233,7 @@ class RecoveryManager:
         self.set_component_state(component_name, ComponentState.RECOVERING)
         component["restart_count"] = component.get("restart_count", 0) + 1
         component["last_restart"] = current_time
+        self._save_component_states()
         
         # Логируем попытку восстановления
         logger.info(f"Попытка восстановления компонента {component_name}. Перезапуск #{component['restart_count']}")
@@ -314,7 +316,7 @@ class RecoveryManager:
         logger.warning("Выполняется полный перезапуск приложения...")
         
         # Сохраняем текущие состояния компонентов перед перезапуском
-        self._save_component_states()
+        self._save_component_states(immediate=True)
         
         # Получаем команду и аргументы для перезапуска
         args = sys.argv[:]
@@ -414,8 +416,8 @@ class RecoveryManager:
                 # Проверяем общее состояние приложения
                 self._check_system_resources()
                 
-                # Сохраняем текущие состояния
-                self._save_component_states()
+                # Состояния сохраняются при их изменении (set_component_state),
+                # поэтому тик без изменений не пишет на диск
             except Exception as e:
                 logger.error(f"Ошибка в цикле сторожевого таймера: {e}")
             
@@ -427,26 +429,24 @@ class RecoveryManager:
         Проверяет системные ресурсы и логирует предупреждения при их нехватке.
         """
         try:
+            # Последний снимок фонового сборщика: без ожидания замера CPU
+            from toolbot.utils.system_sampler import get_system_sampler
+            metrics = get_system_sampler().get_metrics()
+            
             # Проверка памяти
-            memory = psutil.virtual_memory()
-            if memory.percent > 90:
-                logger.warning(f"Критический уровень использования памяти: {memory.percent}%%")
+            memory_percent = metrics['memory']['usage_percent']
+            if memory_percent > 90:
+                logger.warning(f"Критический уровень использования памяти: {memory_percent}%%")
             
             # Проверка CPU
-            cpu_percent = psutil.cpu_percent(interval=1)
+            cpu_percent = metrics['cpu']['usage_percent']
             if cpu_percent > 90:
                 logger.warning(f"Критический уровень использования CPU: {cpu_percent}%%")
             
-            # Проверка диска (используем правильный путь для Windows)
-            import platform
-            if platform.system() == "Windows":
-                disk_path = "C:\\"
-            else:
-                disk_path = "/"
-            
-            disk = psutil.disk_usage(disk_path)
-            if disk.percent > 90:
-                logger.warning(f"Критический уровень использования диска: {disk.percent}%%")
+            # Проверка диска
+            disk_percent = metrics['disk']['usage_percent']
+            if disk_percent > 90:
+                logger.warning(f"Критический уровень использования диска: {disk_percent}%%")
         except Exception as e:
             logger.error(f"Ошибка при проверке системных ресурсов: {e}")
     
@@ -462,7 +462,7 @@ class RecoveryManager:
             self.watchdog_thread.join(timeout=5)
         
         # Сохраняем состояния компонентов
-        self._save_component_states()
+        self._states_state.close()
         logger.info("Менеджер восстановления остановлен")
     
     def get_component_states(self) -> Dict[str, Dict[str, Any]]:
@@ -0,0 +1,285 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Фоновый сборщик системных метрик.
+
+Поток раз в interval секунд снимает метрики системы и процесса и сохраняет
+последний снимок. Загрузка CPU считается неблокирующим psutil.cpu_percent(None)
+как разница с предыдущим замером, поэтому чтение метрик из обработчиков
+(дашборд, сторожевой таймер) не ждет секунду, а возвращает готовый снимок.
+
+Задержка цикла событий берется из пульса LoopMonitor (loop_monitor.py),
+отдельного таймера в цикле сборщик не заводит.
+"""
+
+import os
+import sys
+import time
+import logging
+import platform
+import threading
+from collections import deque
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+
+import psutil
+
+from toolbot.utils.loop_monitor import get_loop_monitor
+
+# Импорт GPUtil с обработкой ошибок для IDE
+try:
+    import GPUtil  # type: ignore # noqa: F401
+    GPU_AVAILABLE = True
+except ImportError:
+    GPU_AVAILABLE = False
+
+logger = logging.getLogger(__name__)
+
+# Интервал сбора метрик (секунды)
+DEFAULT_SAMPLE_INTERVAL = 5.0
+
+# Размер истории снимков (2 часа при интервале 5 секунд)
+DEFAULT_HISTORY_SIZE = 1440
+
+DISK_PATH = 'C:\\' if platform.system() == 'Windows' else '/'
+
+
+class SystemSampler:
+    """Фоновый сбор метрик системы и процесса с хранением последнего снимка"""
+
+    def __init__(self, interval: float = DEFAULT_SAMPLE_INTERVAL, history_size: int = DEFAULT_HISTORY_SIZE):
+        """
+        Args:
+            interval: Интервал сбора метрик в секундах
+            history_size: Количество хранимых снимков
+        """
+        self.interval = interval
+        self.history = deque(maxlen=history_size)
+        # Поток сбора дописывает историю, пока обработчики ее читают
+        self._history_lock = threading.Lock()
+        self.process = psutil.Process(os.getpid())
+
+        self._latest: Optional[Dict[str, Any]] = None
+        self._previous_network = None
+        self._previous_time = None
+
+        self._stop_event = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+
+        # Первый вызов cpu_percent(None) только запоминает счетчики
+        psutil.cpu_percent(interval=None)
+        self.process.cpu_percent(interval=None)
+
+    @property
+    def is_running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self) -> None:
+        """Запуск фонового сбора"""
+        with self._lock:
+            if self.is_running:
+                return
+            self._stop_event.clear()
+            self._thread = threading.Thread(target=self._run, name="system-sampler", daemon=True)
+            self._thread.start()
+        logger.info(f"🔍 Сбор системных метрик запущен (интервал {self.interval:.0f}с)")
+
+    def stop(self) -> None:
+        """Остановка фонового сбора"""
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join(timeout=self.interval + 1)
+            self._thread = None
+
+    def _run(self) -> None:
+        while not self._stop_event.is_set():
+            try:
+                self.sample()
+            except Exception as e:
+                logger.error("Ошибка в сборе системных метрик: %s", str(e))
+            self._stop_event.wait(self.interval)
+
+    def sample(self) -> Dict[str, Any]:
+        """
+        Снимает метрики (не блокирует) и сохраняет снимок.
+
+        Returns:
+            Словарь метрик
+        """
+        now = time.time()
+        metrics: Dict[str, Any] = {}
+
+        # CPU: загрузка с момента предыдущего замера
+        cpu_freq = psutil.cpu_freq()
+        metrics['cpu'] = {
+            'usage_percent': psutil.cpu_percent(interval=None),
+            'frequency_mhz': cpu_freq.current if cpu_freq else None,
+            'cores_logical': psutil.cpu_count(),
+            'cores_physical': psutil.cpu_count(logical=False),
+        }
+
+        memory = psutil.virtual_memory()
+        metrics['memory'] = {
+            'total_gb': round(memory.total / (1024**3), 2),
+            'used_gb': round(memory.used / (1024**3), 2),
+            'available_gb': round(memory.available / (1024**3), 2),
+            'usage_percent': memory.percent,
+        }
+
+        try:
+            disk = psutil.disk_usage(DISK_PATH)
+            metrics['disk'] = {
+                'total_gb': round(disk.total / (1024**3), 2),
+                'used_gb': round(disk.used / (1024**3), 2),
+                'free_gb': round(disk.free / (1024**3), 2),
+                'usage_percent': round((disk.used / disk.total) * 100, 1),
+            }
+        except Exception as e:
+            logger.error("Ошибка получения информации о диске: %s", str(e))
+            metrics['disk'] = {'total_gb': 0, 'used_gb': 0, 'free_gb': 0, 'usage_percent': 0}
+
+        # Сеть: счетчики и скорость с момента предыдущего снимка
+        network = psutil.net_io_counters()
+        metrics['network'] = {
+            'bytes_sent': network.bytes_sent,
+            'bytes_recv': network.bytes_recv,
+            'packets_sent': network.packets_sent,
+            'packets_recv': network.packets_recv,
+            'sent_bytes_per_sec': None,
+            'recv_bytes_per_sec': None,
+        }
+        if self._previous_network is not None and now > self._previous_time:
+            elapsed = now - self._previous_time
+            metrics['network']['sent_bytes_per_sec'] = (network.bytes_sent - self._previous_network.bytes_sent) / elapsed
+            metrics['network']['recv_bytes_per_sec'] = (network.bytes_recv - self._previous_network.bytes_recv) / elapsed
+        self._previous_network = network
+        self._previous_time = now
+
+        metrics['process'] = self._process_metrics()
+        # Задержка цикла событий: последняя и максимальная с прошлого снимка
+        loop_monitor = get_loop_monitor()
+        lag_ms, max_lag_ms = loop_monitor.take_lag_window()
+        metrics['event_loop'] = {
+            'attached': loop_monitor.attached,
+            'lag_ms': round(lag_ms, 2),
+            'max_lag_ms': round(max_lag_ms, 2),
+        }
+
+        metrics['gpu'] = self._gpu_metrics()
+
+        snapshot = {
+            'time': now,
+            'timestamp': datetime.fromtimestamp(now).isoformat(),
+            'metrics': metrics,
+        }
+        self._latest = snapshot
+        with self._history_lock:
+            self.history.append(snapshot)
+        return metrics
+
+    def _process_metrics(self) -> Dict[str, Any]:
+        """Метрики процесса бота"""
+        process = self.process
+        with process.oneshot():
+            memory_info = process.memory_info()
+            metrics = {
+                'pid': process.pid,
+                'cpu_percent': process.cpu_percent(interval=None),
+                'rss_mb': round(memory_info.rss / (1024**2), 1),
+                'vms_mb': round(memory_info.vms / (1024**2), 1),
+                'threads': process.num_threads(),
+                'open_fds': process.num_fds() if hasattr(process, 'num_fds') else None,
+            }
+
+        # Torch не импортируем ради метрик: берем только если он уже загружен
+        torch = sys.modules.get('torch')
+        metrics['torch_threads'] = torch.get_num_threads() if torch is not None else None
+        return metrics
+
+    def _gpu_metrics(self) -> Optional[Dict[str, Any]]:
+        """GPU метрики через GPUtil или PyTorch"""
+        try:
+            if GPU_AVAILABLE:
+                gpus = GPUtil.getGPUs()
+                if not gpus:
+                    return None
+                gpu = gpus[0]  # Берем первую GPU
+                return {
+                    'name': gpu.name,
+                    'temperature_c': gpu.temperature,
+                    'usage_percent': round(gpu.load * 100, 1),
+                    'memory_total_mb': gpu.memoryTotal,
+                    'memory_used_mb': gpu.memoryUsed,
+                    'memory_free_mb': gpu.memoryFree,
+                    'memory_usage_percent': round((gpu.memoryUsed / gpu.memoryTotal) * 100, 1),
+                }
+
+            torch = sys.modules.get('torch')
+            if torch is None or not torch.cuda.is_available():
+                return None
+
+            device = torch.cuda.current_device()
+            props = torch.cuda.get_device_properties(device)
+            memory_allocated = torch.cuda.memory_allocated(device)
+            return {
+                'name': props.name,
+                'memory_total_mb': round(props.total_memory / (1024**2), 1),
+                'memory_allocated_mb': round(memory_allocated / (1024**2), 1),
+                'memory_reserved_mb': round(torch.cuda.memory_reserved(device) / (1024**2), 1),
+                'memory_usage_percent': round((memory_allocated / props.total_memory) * 100, 1),
+                'compute_capability': f"{props.major}.{props.minor}",
+            }
+        except Exception as e:
+            logger.error("Ошибка получения GPU метрик: %s", str(e))
+            return None
+
+    def get_snapshot(self) -> Dict[str, Any]:
+        """
+        Последний снимок метрик без ожидания.
+
+        Returns:
+            Словарь {'time', 'timestamp', 'metrics'}
+        """
+        snapshot = self._latest
+        # Без фонового потока снимок обновляется по запросу, не чаще раза в interval
+        if snapshot is None or (not self.is_running and time.time() - snapshot['time'] > self.interval):
+            self.sample()
+            snapshot = self._latest
+        return snapshot
+
+    def get_metrics(self) -> Dict[str, Any]:
+        """Метрики из последнего снимка"""
+        return self.get_snapshot()['metrics']
+
+    def get_history(self, minutes: int = 60) -> List[Dict[str, Any]]:
+        """Снимки за последние N минут"""
+        cutoff_time = time.time() - minutes * 60
+
+        with self._history_lock:
+            history = list(self.history)
+
+        # Снимки идут по возрастанию времени: идем с конца до первого старого
+        entries = []
+        for entry in reversed(history):
+            if entry['time'] < cutoff_time:
+                break
+            entries.append(entry)
+
+        entries.reverse()
+        return entries
+
+
+# Глобальный экземпляр сборщика
+_system_sampler = None
+_system_sampler_lock = threading.Lock()
+
+def get_system_sampler() -> SystemSampler:
+    """Получение экземпляра сборщика системных метрик"""
+    global _system_sampler
+    if _system_sampler is None:
+        with _system_sampler_lock:
+            if _system_sampler is None:
+                _system_sampler = SystemSampler()
+    return _system_sampler
@@ -0,0 +1,135 @@
+"""
+Индексы для быстрого поиска подстрок в небольших справочниках.
+Справочник загружается один раз и перезагружается при изменении файла-источника.
+"""
+import os
+import logging
+import threading
+from typing import Any, Callable, Dict, Optional, Sequence
+
+logger = logging.getLogger(__name__)
+
+
+def normalize_text(value: Any) -> str:
+    """
+    Нормализует значение для поиска: строка в нижнем регистре, "ё" заменяется на "е".
+
+    Args:
+        value: Исходное значение (None превращается в пустую строку)
+
+    Returns:
+        Нормализованная строка
+    """
+    if value is None:
+        return ""
+    return str(value).lower().replace("ё", "е")
+
+
+class SubstringIndex:
+    """
+    N-граммный индекс для поиска подстрок в наборе строк.
+
+    Для каждой n-граммы длиной от 1 до ``ngram`` хранится множество номеров строк.
+    Короткий запрос (не длиннее ``ngram``) отвечается одним обращением к словарю,
+    длинный - пересечением множеств его n-грамм и проверкой оставшихся кандидатов.
+    """
+
+    def __init__(self, values: Sequence[Any], ngram: int = 3):
+        """
+        Построение индекса.
+
+        Args:
+            values: Индексируемые значения, номер значения - его позиция в списке
+            ngram: Максимальная длина n-граммы
+        """
+        self.ngram = ngram
+        self.values = [normalize_text(value) for value in values]
+        self.postings: Dict[str, set] = {}
+
+        for row_id, text in enumerate(self.values):
+            for n in range(1, ngram + 1):
+                for i in range(len(text) - n + 1):
+                    self.postings.setdefault(text[i:i + n], set()).add(row_id)
+
+    def search(self, query: str) -> set:
+        """
+        Поиск строк, содержащих подстроку.
+
+        Args:
+            query: Искомая подстрока (нормализуется так же, как индексируемые значения)
+
+        Returns:
+            Множество номеров подходящих строк
+        """
+        query = normalize_text(query)
+        if not query:
+            return set(range(len(self.values)))
+
+        if len(query) <= self.ngram:
+            return set(self.postings.get(query, ()))
+
+        # Пересекаем начиная с самых редких n-грамм
+        grams = {query[i:i + self.ngram] for i in range(len(query) - self.ngram + 1)}
+        posting_lists = sorted((self.postings.get(gram, set()) for gram in grams), key=len)
+        candidates = set(posting_lists[0])
+        for posting in posting_lists[1:]:
+            if not candidates:
+                break
+            candidates &= posting
+
+        return {row_id for row_id in candidates if query in self.values[row_id]}
+
+
+class ReloadableTable:
+    """
+    Справочник в памяти, перезагружаемый при изменении времени модификации файла.
+
+    Загрузчик получает путь к файлу и возвращает готовый снимок данных
+    (например, список записей вместе с индексами). Снимок заменяется целиком,
+    поэтому читатели всегда видят согласованные данные без блокировок.
+    """
+
+    def __init__(self, name: str, loader: Callable[[str], Any]):
+        """
+        Args:
+            name: Название справочника (для логов)
+            loader: Функция построения снимка по пути к файлу
+        """
+        self.name = name
+        self.loader = loader
+        self._lock = threading.Lock()
+        # ((путь, mtime), снимок) - меняется одним присваиванием
+        self._state = (None, None)
+
+    def get(self, path: str) -> Optional[Any]:
+        """
+        Возвращает актуальный снимок справочника.
+
+        Args:
+            path: Путь к файлу-источнику
+
+        Returns:
+            Снимок данных или None, если файл недоступен
+        """
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except OSError:
+            return None
+
+        source, snapshot = self._state
+        if source == (path, mtime):
+            return snapshot
+
+        with self._lock:
+            # Другой поток мог уже перезагрузить справочник
+            source, snapshot = self._state
+            if source != (path, mtime):
+                snapshot = self.loader(path)
+                self._state = ((path, mtime), snapshot)
+                logger.info(f"Справочник '{self.name}' загружен из {path}")
+            return snapshot
+
+    def invalidate(self) -> None:
+        """Сбрасывает снимок, следующий запрос перезагрузит справочник"""
+        with self._lock:
+            self._state = (None, None)
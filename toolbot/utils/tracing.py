@@ -0,0 +1,427 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Легковесная трассировка запросов.
+
+Каждое обновление Telegram открывает трассу с собственным trace_id, а этапы
+обработки (скачивание, предобработка, эмбеддинг, поиск, ответ) - вложенные
+спаны. Текущий спан хранится в contextvars, поэтому параллельные обновления
+не перемешиваются, а контекст переходит в задачи asyncio и, через
+bind_context, в пул потоков.
+
+Завершенные трассы попадают в кольцевой буфер (для админки - самые медленные
+за последнее время) и, если заданы переменные окружения, в файлы:
+    TRACE_JSONL      - одна трасса на строку в собственном формате
+    TRACE_OTLP_FILE  - строки OTLP/JSON (ExportTraceServiceRequest), которые
+                       читает файловый приемник OpenTelemetry Collector
+
+Без активной трассы start_span возвращает пустой спан и почти ничего не стоит.
+"""
+
+import os
+import json
+import time
+import random
+import asyncio
+import logging
+import functools
+import threading
+import contextvars
+from collections import deque
+from datetime import datetime
+from typing import Any, Callable, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# Количество хранимых последних трасс
+DEFAULT_BUFFER_SIZE = int(os.getenv("TRACE_BUFFER_SIZE", "500"))
+
+# Максимальное количество спанов в одной трассе
+MAX_SPANS_PER_TRACE = 256
+
+SERVICE_NAME = "toolbot"
+
+# Текущий спан задачи или потока
+_current_span: contextvars.ContextVar = contextvars.ContextVar("toolbot_current_span", default=None)
+
+
+def _new_id(bits: int) -> str:
+    return f"{random.getrandbits(bits):0{bits // 4}x}"
+
+
+class Span:
+    """Спан: именованный отрезок работы внутри трассы"""
+
+    __slots__ = ("name", "trace", "span_id", "parent_id", "start_ns", "end_ns", "attributes",
+                 "status", "error", "_start_perf", "_token")
+
+    def __init__(self, name: str, trace: "_Trace", parent_id: Optional[str], attributes: Dict[str, Any]):
+        self.name = name
+        self.trace = trace
+        self.span_id = _new_id(64)
+        self.parent_id = parent_id
+        self.attributes = attributes
+        self.status = "ok"
+        self.error: Optional[str] = None
+        self.start_ns = 0
+        self.end_ns = 0
+        self._start_perf = 0
+        self._token = None
+
+    @property
+    def trace_id(self) -> str:
+        return self.trace.trace_id
+
+    @property
+    def duration_ms(self) -> float:
+        return (self.end_ns - self.start_ns) / 1e6
+
+    def set_attribute(self, key: str, value: Any) -> None:
+        self.attributes[key] = value
+
+    def __enter__(self) -> "Span":
+        self.start_ns = time.time_ns()
+        self._start_perf = time.perf_counter_ns()
+        self._token = _current_span.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> bool:
+        self.end_ns = self.start_ns + (time.perf_counter_ns() - self._start_perf)
+        if exc_type is not None and not issubclass(exc_type, asyncio.CancelledError):
+            self.status = "error"
+            self.error = f"{exc_type.__name__}: {exc}"[:200]
+        _current_span.reset(self._token)
+        self._token = None
+        self.trace.finish_span(self)
+        return False
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            'name': self.name,
+            'span_id': self.span_id,
+            'parent_id': self.parent_id,
+            'start_offset_ms': round((self.start_ns - self.trace.root.start_ns) / 1e6, 2),
+            'duration_ms': round(self.duration_ms, 2),
+            'status': self.status,
+            'error': self.error,
+            'attributes': self.attributes,
+        }
+
+
+class _NoopSpan:
+    """Спан вне трассы: ничего не записывает"""
+
+    __slots__ = ()
+
+    trace_id = None
+    span_id = None
+
+    def set_attribute(self, key: str, value: Any) -> None:
+        pass
+
+    def __enter__(self) -> "_NoopSpan":
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> bool:
+        return False
+
+
+NOOP_SPAN = _NoopSpan()
+
+
+class _Trace:
+    """
+    Спаны одной трассы до завершения корневого спана.
+
+    Пока трассу удерживают задачи (hold/release), закрытие корня откладывается:
+    трасса завершается вместе с последней задачей, а длительность корня
+    продлевается до этого момента.
+    """
+
+    __slots__ = ("tracer", "trace_id", "root", "spans", "finished", "holds", "root_closed")
+
+    def __init__(self, tracer: "Tracer"):
+        self.tracer = tracer
+        self.trace_id = _new_id(128)
+        self.root: Optional[Span] = None
+        self.spans: List[Span] = []
+        self.finished = False
+        self.holds = 0
+        self.root_closed = False
+
+    def finish_span(self, span: Span) -> None:
+        # Спаны фоновых задач, завершившиеся после трассы, не учитываются
+        if self.finished:
+            return
+        if span is self.root:
+            self.root_closed = True
+            if self.holds == 0:
+                self._finish()
+        elif len(self.spans) < MAX_SPANS_PER_TRACE:
+            self.spans.append(span)
+
+    def hold(self) -> None:
+        """Задача трассы еще выполняется: корень не завершает трассу"""
+        self.holds += 1
+
+    def release(self) -> None:
+        """Задача трассы завершилась"""
+        self.holds -= 1
+        if self.holds == 0 and self.root_closed and not self.finished:
+            root = self.root
+            root.end_ns = root.start_ns + (time.perf_counter_ns() - root._start_perf)
+            self._finish()
+
+    def _finish(self) -> None:
+        self.finished = True
+        self.tracer._finish_trace(self)
+
+    def to_dict(self) -> Dict[str, Any]:
+        root = self.root
+        spans = [root] + sorted(self.spans, key=lambda span: span.start_ns)
+        return {
+            'trace_id': self.trace_id,
+            'name': root.name,
+            'start': root.start_ns / 1e9,
+            'timestamp': datetime.fromtimestamp(root.start_ns / 1e9).isoformat(),
+            'duration_ms': round(root.duration_ms, 2),
+            'status': 'error' if any(span.status == 'error' for span in spans) else 'ok',
+            'attributes': root.attributes,
+            'spans': [span.to_dict() for span in spans],
+        }
+
+
+class JsonlTraceExporter:
+    """Запись трасс в файл JSON Lines (одна трасса на строку)"""
+
+    def __init__(self, path: str):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.path = path
+        self._file = open(path, "a", encoding="utf-8")
+        self._lock = threading.Lock()
+
+    def format(self, trace: _Trace) -> Dict[str, Any]:
+        return trace.to_dict()
+
+    def export(self, trace: _Trace) -> None:
+        line = json.dumps(self.format(trace), ensure_ascii=False, default=str)
+        with self._lock:
+            self._file.write(line + "\n")
+            self._file.flush()
+
+    def close(self) -> None:
+        with self._lock:
+            self._file.close()
+
+
+class OtlpFileTraceExporter(JsonlTraceExporter):
+    """Запись трасс в формате OTLP/JSON для файлового приемника OpenTelemetry"""
+
+    @staticmethod
+    def _attributes(attributes: Dict[str, Any]) -> List[Dict[str, Any]]:
+        result = []
+        for key, value in attributes.items():
+            if isinstance(value, bool):
+                otlp_value = {'boolValue': value}
+            elif isinstance(value, int):
+                otlp_value = {'intValue': str(value)}
+            elif isinstance(value, float):
+                otlp_value = {'doubleValue': value}
+            else:
+                otlp_value = {'stringValue': str(value)}
+            result.append({'key': key, 'value': otlp_value})
+        return result
+
+    def _span(self, span: Span) -> Dict[str, Any]:
+        otlp_span = {
+            'traceId': span.trace_id,
+            'spanId': span.span_id,
+            'name': span.name,
+            'kind': 2 if span.parent_id is None else 1,  # SERVER для корня, INTERNAL для вложенных
+            'startTimeUnixNano': str(span.start_ns),
+            'endTimeUnixNano': str(span.end_ns),
+            'attributes': self._attributes(span.attributes),
+            'status': {'code': 2, 'message': span.error} if span.status == 'error' else {'code': 1},
+        }
+        if span.parent_id:
+            otlp_span['parentSpanId'] = span.parent_id
+        return otlp_span
+
+    def format(self, trace: _Trace) -> Dict[str, Any]:
+        return {
+            'resourceSpans': [{
+                'resource': {'attributes': self._attributes({'service.name': SERVICE_NAME})},
+                'scopeSpans': [{
+                    'scope': {'name': __name__},
+                    'spans': [self._span(span) for span in [trace.root] + trace.spans],
+                }],
+            }],
+        }
+
+
+class Tracer:
+    """Создание трасс и хранение последних завершенных"""
+
+    def __init__(self, buffer_size: int = DEFAULT_BUFFER_SIZE):
+        """
+        Args:
+            buffer_size: Количество хранимых последних трасс
+        """
+        self.traces = deque(maxlen=buffer_size)
+        self.exporters: List[JsonlTraceExporter] = []
+        self.finished_total = 0
+
+    def add_exporter(self, exporter: JsonlTraceExporter) -> None:
+        """Добавление экспортера завершенных трасс"""
+        self.exporters.append(exporter)
+
+    def start_trace(self, name: str, **attributes) -> Span:
+        """
+        Корневой спан новой трассы (контекстный менеджер).
+
+        Args:
+            name: Название трассы, например 'update photo'
+            **attributes: Атрибуты трассы (update_id, user_id и т.п.)
+        """
+        trace = _Trace(self)
+        trace.root = Span(name, trace, None, attributes)
+        return trace.root
+
+    def _finish_trace(self, trace: _Trace) -> None:
+        self.finished_total += 1
+        self.traces.append(trace)
+        for exporter in self.exporters:
+            try:
+                exporter.export(trace)
+            except Exception as e:
+                logger.error(f"❌ Ошибка экспорта трассы {trace.trace_id}: {e}")
+
+    def get_recent(self, limit: int = 20) -> List[Dict[str, Any]]:
+        """Последние завершенные трассы, новые первыми"""
+        return [trace.to_dict() for trace in list(self.traces)[-limit:][::-1]]
+
+    def get_slowest(self, limit: int = 5, seconds: Optional[float] = None) -> List[Dict[str, Any]]:
+        """
+        Самые медленные трассы из буфера.
+
+        Args:
+            limit: Количество трасс
+            seconds: Только трассы за последние N секунд
+        """
+        traces = list(self.traces)
+        if seconds is not None:
+            cutoff_ns = time.time_ns() - int(seconds * 1e9)
+            traces = [trace for trace in traces if trace.root.start_ns >= cutoff_ns]
+        traces.sort(key=lambda trace: trace.root.duration_ms, reverse=True)
+        return [trace.to_dict() for trace in traces[:limit]]
+
+    def get_trace(self, trace_id: str) -> Optional[Dict[str, Any]]:
+        """Трасса по идентификатору (или его началу)"""
+        for trace in reversed(self.traces):
+            if trace.trace_id.startswith(trace_id):
+                return trace.to_dict()
+        return None
+
+    def close(self) -> None:
+        """Закрытие файлов экспортеров"""
+        for exporter in self.exporters:
+            exporter.close()
+        self.exporters = []
+
+
+def current_span():
+    """Текущий спан или None"""
+    return _current_span.get()
+
+
+def current_trace_id() -> Optional[str]:
+    """Идентификатор текущей трассы или None"""
+    span = _current_span.get()
+    return span.trace_id if span is not None else None
+
+
+def keep_trace_open(coroutine):
+    """
+    Корутина, удерживающая текущую трассу открытой до своего завершения.
+
+    Вызывается при создании задачи, пока корень трассы еще открыт: так
+    неблокирующий обработчик обновления попадает в трассу целиком, хотя
+    обработка обновления закончилась раньше него.
+    """
+    span = _current_span.get()
+    if span is None or span.trace.finished:
+        return coroutine
+
+    trace = span.trace
+    trace.hold()
+
+    async def held():
+        try:
+            return await coroutine
+        finally:
+            trace.release()
+
+    return held()
+
+
+def bind_context(func: Callable, *args, **kwargs) -> Callable[[], Any]:
+    """
+    Функция для run_in_executor, выполняемая в копии текущего контекста.
+
+    loop.run_in_executor не переносит contextvars в поток, поэтому без этого
+    спаны сервисов в пуле потоков теряют родительскую трассу.
+    """
+    return functools.partial(contextvars.copy_context().run, func, *args, **kwargs)
+
+
+# Глобальный трассировщик
+_tracer = None
+_tracer_lock = threading.Lock()
+
+def get_tracer() -> Tracer:
+    """Получение экземпляра трассировщика"""
+    global _tracer
+    if _tracer is None:
+        with _tracer_lock:
+            if _tracer is None:
+                tracer = Tracer()
+                try:
+                    if os.getenv("TRACE_JSONL"):
+                        tracer.add_exporter(JsonlTraceExporter(os.getenv("TRACE_JSONL")))
+                    if os.getenv("TRACE_OTLP_FILE"):
+                        tracer.add_exporter(OtlpFileTraceExporter(os.getenv("TRACE_OTLP_FILE")))
+                except Exception as e:
+                    logger.error(f"❌ Не удалось открыть файл экспорта трасс: {e}")
+                _tracer = tracer
+    return _tracer
+
+
+def start_span(name: str, **attributes):
+    """Вложенный спан текущей трассы или пустой спан вне трассы (контекстный менеджер)"""
+    parent = _current_span.get()
+    if parent is None:
+        return NOOP_SPAN
+    return Span(name, parent.trace, parent.span_id, attributes)
+
+
+def traced(name: Optional[str] = None) -> Callable:
+    """Декоратор: спан вокруг вызова обычной или асинхронной функции"""
+    def decorator(func):
+        span_name = name or func.__qualname__
+
+        if asyncio.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with start_span(span_name):
+                    return await func(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with start_span(span_name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Трассировка обновлений Telegram.
+
+TracingUpdateProcessor открывает трассу на каждое обновление, а
+TracingApplication удерживает ее открытой, пока выполняются неблокирующие
+обработчики (block=False) этого обновления. Иначе приложение только
+планирует задачу обработчика, корень трассы закрывается сразу, и спаны
+скачивания, эмбеддинга и поиска в трассу не попадают.
+
+    application = (Application.builder()
+                   .application_class(TracingApplication)
+                   .concurrent_updates(TracingUpdateProcessor(1))
+                   ...)
+"""
+
+from telegram import Update
+from telegram.ext import Application, BaseUpdateProcessor
+
+from toolbot.utils.tracing import get_tracer, keep_trace_open
+from toolbot.utils.loop_monitor import describe_update
+
+
+class TracingUpdateProcessor(BaseUpdateProcessor):
+    """Обработка каждого обновления внутри собственной трассы (trace_id в contextvars)"""
+
+    async def do_process_update(self, update, coroutine) -> None:
+        update_type = describe_update(update)
+        attributes = {'update.type': update_type}
+        if isinstance(update, Update):
+            attributes['update.id'] = update.update_id
+            if update.effective_user:
+                attributes['user.id'] = update.effective_user.id
+
+        with get_tracer().start_trace(f"update {update_type}", **attributes):
+            await coroutine
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        get_tracer().close()
+
+
+class TracingApplication(Application):
+    """Приложение, задачи обработчиков которого входят в трассу своего обновления"""
+
+    def create_task(self, coroutine, update=None, **kwargs):
+        # С update задачи создаются для неблокирующих обработчиков и ошибок обновления
+        if update is not None:
+            coroutine = keep_trace_open(coroutine)
+        return super().create_task(coroutine, update, **kwargs)